@@ -9,11 +9,12 @@
 from __future__ import annotations
 
 from datetime import datetime, timedelta
+from html import escape
 import asyncio
 from typing import List, Dict, Any
 
 from aiogram import Router, F, Bot
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import (
@@ -25,7 +26,10 @@ from aiogram.types import (
 
 import bot.config as cfg
 import bot.utils.admin_db as adb
+import bot.utils.billing_db as billing_db
+from bot.utils.webhook_queue import webhook_queue
 from bot.utils.mailing import preview_to_chat
+from bot.utils.broadcast_engine import broadcast_engine
 from bot.states.states import CreateMailing
 from bot.handlers.calendar_picker import open_calendar, router as calendar_router  # КАЛЕНДАРЬ
 
@@ -334,6 +338,27 @@ async def _edit_or_send(msg: Message, *, text: str, kb: InlineKeyboardMarkup | N
         # если редактировать нельзя — шлём новое
         await msg.answer(text, reply_markup=kb, parse_mode=parse_mode)
 
+def _mailing_progress_line(mailing_id: int, job: Dict[str, Any] | None = None) -> str | None:
+    """
+    Прогресс индивидуальной рассылки: живой (скорость, ETA) — если идёт в этом процессе,
+    иначе — по заданию в БД (mailing_jobs). None — рассылка ещё не запускалась.
+    """
+    live = broadcast_engine.progress(mailing_id)
+    if live:
+        eta = live["eta_sec"]
+        eta_txt = f"~{eta // 60} мин {eta % 60} с" if eta is not None else "—"
+        return (
+            f"{live['done']}/{live['total']} (ок {live['sent']}, ошибок {live['failed']}) • "
+            f"{live['rate']} сообщ./с • осталось {eta_txt}"
+        )
+    if job is None:
+        job = adb.get_mailing_job(mailing_id)
+    if not job:
+        return None
+    state = "завершена" if job["status"] == "done" else "прервана, продолжится при следующем запуске"
+    return f"{job['sent'] + job['failed']}/{job['total']} (ок {job['sent']}, ошибок {job['failed']}) • {state}"
+
+
 async def _render_mailing_item(message: Message, mailing_id: int, origin: str = "list") -> None:
     """
     Единая отрисовка карточки рассылки (чтобы возвращаться в то же место после любых правок).
@@ -354,6 +379,9 @@ async def _render_mailing_item(message: Message, mailing_id: int, origin: str =
         extra = f"Альбом • фото: {photos} • видео: {videos} • caption: {cap}"
     else:
         extra = f"Caption: {cap}"
+    progress = _mailing_progress_line(mailing_id)
+    if progress:
+        extra += f"\n<b>Доставка:</b> {progress}"
     await _edit_or_send(
         message,
         text=f"<b>ID:</b> {mailing_id}\n<b>Когда:</b> {dt}\n<b>Тип:</b> <code>{ctype}</code>\n{extra}",
@@ -1076,6 +1104,68 @@ async def delete_mailing(callback: CallbackQuery):
         await callback.answer()
 
 
+# =============================================================================
+# РАССЫЛКИ: задания индивидуальной доставки (bot/utils/broadcast_engine.py)
+# =============================================================================
+async def mailing_jobs(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer(NO_ACCESS_TEXT)
+        return
+    jobs = adb.list_mailing_jobs(limit=10)
+    lines = ["<b>Доставка рассылок</b>", ""]
+    if not jobs:
+        lines.append("Индивидуальных рассылок ещё не было.")
+    for j in jobs:
+        lines.append(
+            f"ID {j['mailing_id']} • старт {escape(j['started_at'] or '—')}\n"
+            f"{escape(_mailing_progress_line(j['mailing_id'], j) or '')}"
+        )
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+# =============================================================================
+# ВЕБХУКИ YOOKASSA: dead letters входящей очереди (bot/utils/webhook_queue.py)
+# =============================================================================
+async def webhook_dead(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer(NO_ACCESS_TEXT)
+        return
+    stats = billing_db.webhook_stats()
+    items = billing_db.webhook_dead_letters(limit=20)
+    lines = [
+        "<b>Очередь вебхуков YooKassa</b>",
+        " · ".join(f"{k}: {v}" for k, v in sorted(stats.items())) or "пусто",
+        "",
+    ]
+    if not items:
+        lines.append("Необработанных событий нет.")
+    for it in items:
+        err = escape((it["last_error"] or "")[:200])
+        lines.append(
+            f"#{it['id']} <code>{escape(it['payment_id'])}</code> {escape(it['status'] or '')} "
+            f"({it['attempts']} поп.) {it['created_at']:%d.%m %H:%M}\n<i>{err}</i>"
+        )
+    if items:
+        lines.append("\nВернуть в очередь: <code>/webhook_retry ID</code>")
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+async def webhook_retry(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer(NO_ACCESS_TEXT)
+        return
+    try:
+        event_id = int((command.args or "").strip().lstrip("#"))
+    except ValueError:
+        await message.answer("Использование: /webhook_retry ID")
+        return
+    if billing_db.webhook_requeue(event_id=event_id):
+        webhook_queue.wake()
+        await message.answer(f"Событие #{event_id} возвращено в очередь.")
+    else:
+        await message.answer(f"Событие #{event_id} не найдено среди необработанных.")
+
+
 # =============================================================================
 # РОУТЕР
 # =============================================================================
@@ -1083,6 +1173,9 @@ async def delete_mailing(callback: CallbackQuery):
 def router(rt: Router) -> None:
     # Вход только командой; дальше — кнопками
     rt.message.register(admin_menu, Command("admin_menu"))
+    rt.message.register(mailing_jobs, Command("mailing_jobs"))
+    rt.message.register(webhook_dead, Command("webhook_dead"))
+    rt.message.register(webhook_retry, Command("webhook_retry"))
     rt.callback_query.register(admin_home, F.data == "admin.home")
 
     # Рассылка (контент -> дата -> подтверждение)
@@ -3,7 +3,7 @@ from __future__ import annotations
 from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.types import CallbackQuery, Message
-import bot.utils.database as app_db
+from bot.utils.event_logger import event_logger
 
 MAX_LEN = 256
 
@@ -26,7 +26,7 @@ class CallbackClickLogger(BaseMiddleware):
             uid = event.from_user.id if event.from_user else None
             if uid:
                 raw = event.data or ""
-                app_db.event_add(user_id=uid, text=f"CB:{_compact(raw)}")
+                event_logger.log(uid, f"CB:{_compact(raw)}")
 
 class MessageLogger(BaseMiddleware):
     async def __call__(
@@ -46,6 +46,6 @@ class MessageLogger(BaseMiddleware):
             if not raw:
                 # Неформатируемые типы: фото/видео/голос и т.п.
                 kind = (event.content_type or "unknown").upper()
-                app_db.event_add(user_id=uid, text=f"MSG:{kind}")
+                event_logger.log(uid, f"MSG:{kind}")
                 return
-            app_db.event_add(user_id=uid, text=f"TEXT:{_compact(raw)}")
+            event_logger.log(uid, f"TEXT:{_compact(raw)}")
@@ -3,7 +3,6 @@ from typing import Optional, List, Dict, Set
 
 import re
 
-import aiohttp
 from aiogram import Router, F, Bot
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
@@ -17,9 +16,11 @@ from yarl import URL
 from uuid import uuid4
 import os
 
-from bot.config import EXECUTOR_BASE_URL, get_file_path
+from bot.config import get_file_path
 from bot.config import EXECUTOR_CALLBACK_TOKEN, BOT_PUBLIC_BASE_URL
 from bot.states.states import DescriptionStates
+from bot.utils.executor_client import executor_client
+from bot.utils.stream_editor import StreamingMessage, edit_throttle
 import bot.utils.logging_config as logging_config
 
 # module logger
@@ -842,11 +843,21 @@ async def _cb_description_result(request: web.Request):
         text    = (data.get("text") or "").strip()
         error   = (data.get("error") or "").strip()
         fields  = data.get("fields") or {}
+        partial = bool(data.get("partial"))
     except Exception as e:
         return web.json_response({"error": "bad_request", "detail": str(e)}, status=400)
 
     bot: Bot = request.app["bot"]
 
+    # --- Промежуточный текст (stream): правим якорь не чаще интервала чата, лишние куски пропускаем ---
+    if partial:
+        if text:
+            await StreamingMessage(bot, chat_id, msg_id).update(text)
+        return web.json_response({"ok": True})
+
+    # финальная правка — не раньше, чем Telegram позволит после промежуточных
+    await edit_throttle.wait(chat_id)
+
     # --- Ошибка от executor'а: заменить якорь на ERROR_TEXT (text -> caption -> новое) ---
     if error and not text:
         try:
@@ -1100,10 +1111,9 @@ async def _request_description_async(
         "chat_id": chat_id,
         "msg_id": msg_id,
         "msgId": msg_uuid,  # для последующего обновления по msgId
+        "stream": executor_client.streaming,  # промежуточный текст — колбэками с partial=true
     }
 
-    url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/description/generate"
-    t = aiohttp.ClientTimeout(total=timeout_sec)
     # Сохраняем историю до отправки (status: processing — implicit)
     try:
         app_db.description_start(user_id=chat_id, msg_id=msg_uuid, fields=fields)
@@ -1111,15 +1121,9 @@ async def _request_description_async(
     except Exception:
         # не прерываем запрос при проблемах с БД
         pass
-    async with aiohttp.ClientSession(timeout=t) as session:
-        async with session.post(url, json=payload) as resp:
-            if resp.status not in (200, 202):
-                try:
-                    data = await resp.json()
-                    detail = data.get("detail") or data.get("error") or str(data)
-                except Exception:
-                    detail = await resp.text()
-                raise RuntimeError(f"Executor HTTP {resp.status}: {detail}")
+    await executor_client.post_json(
+        "description/generate", payload, timeout=timeout_sec, ok_statuses=(200, 202),
+    )
 
 # ==========================
 # Шаги (callbacks)
@@ -2425,7 +2429,6 @@ async def handle_history_repeat(cb: CallbackQuery, state: FSMContext, bot: Bot):
         try:
             await _edit_text_or_caption(cb.message, GENERATING)
             callback_url = _build_callback_url()
-            url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/description/generate"
             payload = {
                 "fields": fields,
                 "callback_url": callback_url,
@@ -2433,12 +2436,9 @@ async def handle_history_repeat(cb: CallbackQuery, state: FSMContext, bot: Bot):
                 "chat_id": user_id,
                 "msg_id": cb.message.message_id,
                 "msgId": msg_uuid,
+                "stream": executor_client.streaming,
             }
-            t = aiohttp.ClientTimeout(total=10)
-            async with aiohttp.ClientSession(timeout=t) as session:
-                async with session.post(url, json=payload) as resp:
-                    if resp.status not in (200, 202):
-                        raise RuntimeError(f"Executor HTTP {resp.status}")
+            await executor_client.post_json("description/generate", payload, ok_statuses=(200, 202))
             # Сообщение останется с "GENERATING" до прихода колбэка
         except Exception:
             await _edit_text_or_caption(cb.message, ERROR_TEXT, kb_retry(msg_uuid))
@@ -2489,7 +2489,6 @@ async def handle_retry_by_msgid(cb: CallbackQuery):
     try:
         await _edit_text_or_caption(cb.message, GENERATING)
         callback_url = _build_callback_url()
-        url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/description/generate"
         payload = {
             "fields": fields,
             "callback_url": callback_url,
@@ -2497,17 +2496,9 @@ async def handle_retry_by_msgid(cb: CallbackQuery):
             "chat_id": user_id,
             "msg_id": cb.message.message_id,  # текущий якорь для замены
             "msgId": msg_uuid,                # тот же msgId, чтобы не плодить записи
+            "stream": executor_client.streaming,
         }
-        t = aiohttp.ClientTimeout(total=10)
-        async with aiohttp.ClientSession(timeout=t) as session:
-            async with session.post(url, json=payload) as resp:
-                if resp.status not in (200, 202):
-                    try:
-                        data = await resp.json()
-                        detail = data.get("detail") or data.get("error") or str(data)
-                    except Exception:
-                        detail = await resp.text()
-                    raise RuntimeError(f"Executor HTTP {resp.status}: {detail}")
+        await executor_client.post_json("description/generate", payload, ok_statuses=(200, 202))
         # оставляем сообщение «Генерирую...» — текст заменит callback
         await _edit_text_or_caption(cb.message, "🛠 Генерация запущена. Результат обновится здесь.")
     except Exception:
@@ -12,7 +12,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.enums.chat_action import ChatAction
 from aiogram.exceptions import TelegramBadRequest
 
-from bot.config import EXECUTOR_BASE_URL, get_file_path
+from bot.config import get_file_path
 from bot.handlers.payment_handler import (
     format_access_text,  # централизованный короткий статус доступа
     ensure_access,       # централизованная проверка/показ экрана подписки
@@ -22,6 +22,7 @@ from bot.states.states import RedesignStates, ZeroDesignStates
 
 from bot.utils.image_processor import *
 from bot.utils.chat_actions import run_long_operation_with_action
+from bot.utils.executor_client import executor_client, ExecutorHTTPError
 import base64
 import re
 import uuid
@@ -754,7 +755,7 @@ async def generate_design(
     из которых executor соберёт промпт.
     """
     return await _post_image(
-        "/api/v1/design/generate",
+        "design/generate",
         image_path=image_path,
         style=style,
         room_type=room_type,
@@ -773,49 +774,45 @@ async def _post_image(
 ) -> str | None:
     # полезно иметь request-id и debug для логов executor'а
     req_id = f"dg-{uuid.uuid4().hex[:8]}-{int(datetime.utcnow().timestamp())}"
-    url = f"{EXECUTOR_BASE_URL.rstrip('/')}{endpoint}"
     try:
         # Читаем в память и закрываем файл сразу (на Windows это критично)
         with open(image_path, "rb") as f:
             file_bytes = f.read()
 
-        form = aiohttp.FormData()
-        form.add_field(
-            "image",
-            file_bytes,  # <-- bytes вместо открытого файла
-            filename=os.path.basename(image_path),
-            content_type="image/png",
+        def _build_form() -> aiohttp.FormData:
+            form = aiohttp.FormData()
+            form.add_field(
+                "image",
+                file_bytes,  # <-- bytes вместо открытого файла
+                filename=os.path.basename(image_path),
+                content_type="image/png",
+            )
+            # Передаём структурные поля вместо готового промпта
+            form.add_field("style", style)
+            if room_type:
+                form.add_field("room_type", room_type)
+            if furniture:
+                form.add_field("furniture", furniture)
+            return form
+
+        js = await executor_client.post_form(
+            endpoint,
+            _build_form,
+            params={"debug": "1"},
+            headers={"X-Request-ID": req_id},
         )
-        # Передаём структурные поля вместо готового промпта
-        form.add_field("style", style)
-        if room_type:
-            form.add_field("room_type", room_type)
-        if furniture:
-            form.add_field("furniture", furniture)
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url,
-                params={"debug": "1"},
-                data=form,
-                timeout=600,
-                headers={"X-Request-ID": req_id},
-            ) as resp:
-                if resp.status == 200:
-                    js = await resp.json()
-                    # 1) обычный url
-                    url_val = js.get("url")
-                    if url_val:
-                        return url_val
-                    # 2) фолбэк: images[0] (может быть data:URL)
-                    imgs = js.get("images") or []
-                    if isinstance(imgs, list) and imgs:
-                        return imgs[0]
-                    return None
-                else:
-                    txt = await resp.text()
-                    print(f"Executor error {resp.status}: {txt}")
-                    return None
+        # 1) обычный url
+        url_val = (js or {}).get("url")
+        if url_val:
+            return url_val
+        # 2) фолбэк: images[0] (может быть data:URL)
+        imgs = (js or {}).get("images") or []
+        if isinstance(imgs, list) and imgs:
+            return imgs[0]
+        return None
+    except ExecutorHTTPError as e:
+        print(f"Executor error {e.status}: {e.detail}")
+        return None
     except Exception as e:
         print(f"HTTP client error: {e}")
         return None
@@ -2,12 +2,10 @@
 from __future__ import annotations
 
 import asyncio
-import json
 from dataclasses import asdict, dataclass
 import uuid
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 
-import aiohttp
 from aiogram import F, Bot, Router
 from aiogram.enums.chat_action import ChatAction
 from aiogram.exceptions import TelegramBadRequest
@@ -15,10 +13,12 @@ from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import *
 from pathlib import Path
-from bot.config import EXECUTOR_BASE_URL, get_file_path
+from bot.config import get_file_path
 from bot.utils.database import history_add, history_get, history_list_cases, history_get_case_variants
 from bot.states.states import FeedbackStates
 from bot.utils.redis_repo import feedback_repo
+from bot.utils.executor_client import executor_client
+from bot.utils.stream_editor import StreamingMessage
 import bot.utils.logging_config as logging_config
 from bot.handlers.payment_handler import (
     format_access_text,  # короткий статус доступа для экранов
@@ -617,26 +617,19 @@ async def _request_generate(
     timeout_sec: int = 90,
     **extra: Any,  # прокидываем новые поля (tone, length_hint и т.п.)
 ) -> List[str]:
-    url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/review/generate"
-    t = aiohttp.ClientTimeout(total=timeout_sec)
     body = asdict(payload)
     body.update({"num_variants": num_variants})
     if extra:
         # добавляем только непустые значения
         body.update({k: v for k, v in extra.items() if v is not None})
-    async with aiohttp.ClientSession(timeout=t) as session:
-        async with session.post(url, json=body) as resp:
-            if resp.status != 200:
-                detail = await _extract_error_detail(resp)
-                raise RuntimeError(f"Executor HTTP {resp.status}: {detail}")
-            data = await resp.json()
-            variants = (data or {}).get("variants")
-            if not variants:
-                txt = (data or {}).get("text", "").strip()
-                if not txt:
-                    raise RuntimeError("Executor returned no variants")
-                return [txt]
-            return [str(v).strip() for v in variants if str(v).strip()]
+    data = await executor_client.post_json("review/generate", body, timeout=timeout_sec)
+    variants = (data or {}).get("variants")
+    if not variants:
+        txt = (data or {}).get("text", "").strip()
+        if not txt:
+            raise RuntimeError("Executor returned no variants")
+        return [txt]
+    return [str(v).strip() for v in variants if str(v).strip()]
 
 
 async def _request_mutate(
@@ -646,11 +639,13 @@ async def _request_mutate(
     style: Optional[str],
     payload: ReviewPayload,
     timeout_sec: int = 60,
+    on_text: Optional[Callable[[str], Awaitable[Any]]] = None,
     **extra: Any,  # на будущее: tone/length_hint и т.п.
 ) -> str:
-    """operation: 'short' | 'long' | 'style'"""
-    url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/review/mutate"
-    t = aiohttp.ClientTimeout(total=timeout_sec)
+    """
+    operation: 'short' | 'long' | 'style'
+    on_text — получает накопленный текст по мере генерации (потоковый режим).
+    """
     body = {
         "base_text": base_text,
         "operation": operation,
@@ -659,24 +654,28 @@ async def _request_mutate(
     }
     if extra:
         body.update({k: v for k, v in extra.items() if v is not None})
-    async with aiohttp.ClientSession(timeout=t) as session:
-        async with session.post(url, json=body) as resp:
-            if resp.status != 200:
-                detail = await _extract_error_detail(resp)
-                raise RuntimeError(f"Executor HTTP {resp.status}: {detail}")
-            data = await resp.json()
-            txt = (data or {}).get("text", "").strip()
-            if not txt:
-                raise RuntimeError("Empty mutate text")
-            return txt
-
-
-async def _extract_error_detail(resp: aiohttp.ClientResponse) -> str:
-    try:
-        data = await resp.json()
-        return data.get("detail") or data.get("error") or json.dumps(data)
-    except Exception:
-        return await resp.text()
+    if on_text is not None:
+        data = await executor_client.stream_text("review/mutate", body, on_text=on_text, timeout=timeout_sec)
+    else:
+        data = await executor_client.post_json("review/mutate", body, timeout=timeout_sec)
+    txt = (data or {}).get("text", "").strip()
+    if not txt:
+        raise RuntimeError("Empty mutate text")
+    return txt
+
+
+async def _mutation_stream(anchor: Message, user_id: int, bot: Bot) -> StreamingMessage:
+    """
+    Прогрессивный вывод мутации в якорное сообщение. Куски, ушедшие в Telegram,
+    дублируются в Redis-буфер флоу (FeedbackRedisRepo.append_chunk) — частичный
+    результат переживает обрыв запроса.
+    """
+    await feedback_repo.reset_buffer(user_id)
+
+    async def _buffer(chunk: str) -> None:
+        await feedback_repo.append_chunk(user_id, chunk)
+
+    return StreamingMessage(bot, anchor.chat.id, anchor.message_id, on_flush=_buffer)
 
 
 # =============================================================================
@@ -1036,19 +1035,22 @@ async def handle_tone(callback: CallbackQuery, state: FSMContext, bot: Optional[
         variants: List[str] = d.get("variants", [])
         if 1 <= mut_idx <= len(variants):
             base_text = variants[mut_idx - 1]
-            await ui_reply(callback, "Меняю тон…", state=state)
+            anchor = await ui_reply(callback, "Меняю тон…", state=state)
             chat_id = callback.message.chat.id
+            stream = await _mutation_stream(anchor, callback.from_user.id, bot or callback.bot)
             async def _do():
                 payload = _payload_from_state(await state.get_data())
                 # сохраняем текущую целевую длину, чтобы стиль не «схлопывал» текст в medium
                 cur_len = (await state.get_data()).get("length")
                 return await _request_mutate(
-                    base_text, operation="style", style=tone, payload=payload, length=cur_len
+                    base_text, operation="style", style=tone, payload=payload, length=cur_len,
+                    on_text=stream.update,
                 )
             try:
                 new_text: str = await run_long_operation_with_action(
                     bot=bot or callback.bot, chat_id=chat_id, action=ChatAction.TYPING, coro=_do()
                 )
+                await stream.finish()
                 variants[mut_idx - 1] = new_text
                 await state.update_data(variants=variants, mutating_idx=None)
                 parts = _split_for_telegram(new_text)
@@ -1060,6 +1062,7 @@ async def handle_tone(callback: CallbackQuery, state: FSMContext, bot: Optional[
                 await state.update_data(viewer_idx=mut_idx)
                 await feedback_repo.set_fields(callback.from_user.id, {"viewer_idx": mut_idx})
             except Exception as e:
+                await stream.finish()
                 await ui_reply(callback, f"{ERROR_TEXT}\n\n{e}", state=state)
         await _safe_cb_answer(callback)
         return
@@ -1123,8 +1126,9 @@ async def handle_length(callback: CallbackQuery, state: FSMContext):
             await feedback_repo.set_fields(callback.from_user.id, {"viewer_idx": mut_idx})
             return None
 
-        await ui_reply(callback, GENERATING, state=state)
+        anchor = await ui_reply(callback, GENERATING, state=state)
         chat_id = callback.message.chat.id
+        stream = await _mutation_stream(anchor, callback.from_user.id, callback.bot)
         async def _do():
             payload = _payload_from_state(await state.get_data())
             return await _request_mutate(
@@ -1134,11 +1138,13 @@ async def handle_length(callback: CallbackQuery, state: FSMContext):
                 payload=payload,
                 length=target,           # <-- важно! (short|medium|long)
                 length_hint=target_hint, # (опц.) бэко-совместимость
+                on_text=stream.update,
             )
         try:
             new_text: str = await run_long_operation_with_action(
                 bot=callback.bot, chat_id=chat_id, action=ChatAction.TYPING, coro=_do()
             )
+            await stream.finish()
             variants[mut_idx - 1] = new_text
             await state.update_data(variants=variants, mutating_length_idx=None)
             parts = _split_for_telegram(new_text)
@@ -1150,6 +1156,7 @@ async def handle_length(callback: CallbackQuery, state: FSMContext):
             await state.update_data(viewer_idx=mut_idx)
             await feedback_repo.set_fields(callback.from_user.id, {"viewer_idx": mut_idx})
         except Exception as e:
+            await stream.finish()
             await ui_reply(callback, f"{ERROR_TEXT}\n\n{e}", state=state)
         return None
 
@@ -1342,17 +1349,21 @@ async def mutate_variant(callback: CallbackQuery, state: FSMContext, bot: Bot):
     # Back-compat для старых сообщений: прямые команды short/long
     operation = "short" if op == "short" else "long"
 
-    await ui_reply(callback, GENERATING, state=state)  # редактируем якорь
+    anchor = await ui_reply(callback, GENERATING, state=state)  # редактируем якорь
     await feedback_repo.set_fields(callback.from_user.id, {"status": "mutating", "operation": operation, "idx": idx})
     chat_id = callback.message.chat.id
+    stream = await _mutation_stream(anchor, callback.from_user.id, bot)
 
     async def _do():
-        return await _request_mutate(base_text, operation=operation, style=None, payload=payload)
+        return await _request_mutate(
+            base_text, operation=operation, style=None, payload=payload, on_text=stream.update,
+        )
 
     try:
         new_text: str = await run_long_operation_with_action(
             bot=bot, chat_id=chat_id, action=ChatAction.TYPING, coro=_do()
         )
+        await stream.finish()
         variants[idx - 1] = new_text
         await state.update_data(variants=variants)
         await feedback_repo.set_fields(callback.from_user.id, {"status": "variants_ready", "variants_json": variants})
@@ -1366,6 +1377,7 @@ async def mutate_variant(callback: CallbackQuery, state: FSMContext, bot: Bot):
         await state.update_data(viewer_idx=idx)
         await feedback_repo.set_fields(callback.from_user.id, {"viewer_idx": idx})
     except Exception as e:
+        await stream.finish()
         await ui_reply(callback, f"{ERROR_TEXT}\n\n{e}", state=state)
         await feedback_repo.set_error(callback.from_user.id, str(e))
     finally:
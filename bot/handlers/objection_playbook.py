@@ -1,11 +1,10 @@
 # C:\Users\alexr\Desktop\dev\super_bot\smart_agent\bot\handlers\objection_playbook.py
 from __future__ import annotations
 
-from typing import Optional, List
+from typing import Any, Awaitable, Callable, Optional, List
 import logging
 from pathlib import Path
 
-import aiohttp
 from aiogram import Router, F, Bot
 from aiogram.enums.chat_action import ChatAction
 from aiogram.exceptions import TelegramBadRequest
@@ -19,9 +18,11 @@ from aiogram.types import (
     InputMediaPhoto,
 )
 
-from bot.config import EXECUTOR_BASE_URL, get_file_path
+from bot.config import get_file_path
 from bot.states.states import ObjectionStates
 from bot.utils.chat_actions import run_long_operation_with_action
+from bot.utils.executor_client import executor_client
+from bot.utils.stream_editor import StreamingMessage, strip_partial_html
 from bot.handlers.payment_handler import ensure_access
 
 
@@ -185,29 +186,27 @@ async def _edit_or_replace_with_photo_cb(
 # HTTP-клиент к контроллеру
 # ============================================================================
 
-async def _request_objection_text(question: str, *, timeout_sec: int = 70) -> str:
+async def _request_objection_text(
+    question: str,
+    *,
+    timeout_sec: int = 70,
+    on_text: Optional[Callable[[str], Awaitable[Any]]] = None,
+) -> str:
     """
     Отправляет вопрос в контроллер и возвращает чистый текст сценария.
+    on_text — получает накопленный текст по мере генерации (потоковый режим).
     Исключения поднимает наверх — UI часть их отловит и покажет retry.
     """
-    url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/objection/generate"
-    t = aiohttp.ClientTimeout(total=timeout_sec)
-    async with aiohttp.ClientSession(timeout=t) as session:
-        async with session.post(url, json={"question": question}) as resp:
-            if resp.status != 200:
-                # попробуем вытащить деталь
-                try:
-                    data = await resp.json()
-                    detail = data.get("detail") or data.get("error") or str(data)
-                except Exception:
-                    detail = await resp.text()
-                raise RuntimeError(f"Executor HTTP {resp.status}: {detail}")
-
-            data = await resp.json()
-            txt = (data or {}).get("text", "").strip()
-            if not txt:
-                raise RuntimeError("Executor returned empty text")
-            return txt
+    if on_text is not None:
+        data = await executor_client.stream_text(
+            "objection/generate", {"question": question}, on_text=on_text, timeout=timeout_sec,
+        )
+    else:
+        data = await executor_client.post_json("objection/generate", {"question": question}, timeout=timeout_sec)
+    txt = (data or {}).get("text", "").strip()
+    if not txt:
+        raise RuntimeError("Executor returned empty text")
+    return txt
 
 # ============================================================================
 # Экраны и обработчики
@@ -274,9 +273,12 @@ async def handle_question(message: Message, state: FSMContext, bot: Bot):
     new_anchor_id = gen_msg.message_id
     await state.update_data(anchor_id=new_anchor_id)
 
-    # 2) оборачиваем запрос к контроллеру «пишет…»
+    # 2) оборачиваем запрос к контроллеру «пишет…»; текст появляется в якоре по мере генерации
+    #    (HTML досрочно не рендерим — тег может оборваться посреди куска)
+    stream = StreamingMessage(bot, chat_id, new_anchor_id, render=strip_partial_html)
+
     async def _do_request():
-        return await _request_objection_text(message.text)
+        return await _request_objection_text(message.text, on_text=stream.update)
 
     try:
         text = await run_long_operation_with_action(
@@ -285,6 +287,7 @@ async def handle_question(message: Message, state: FSMContext, bot: Bot):
             action=ChatAction.TYPING,
             coro=_do_request()
         )
+        await stream.finish()
 
         parts = _split_for_telegram(text)
 
@@ -308,6 +311,7 @@ async def handle_question(message: Message, state: FSMContext, bot: Bot):
 
     except Exception:
         # ошибка — показываем retry в ТЕКУЩЕМ новом сообщении
+        await stream.finish()
         try:
             await bot.edit_message_text(
                 chat_id=chat_id,
@@ -4,6 +4,7 @@ from __future__ import annotations
 import logging
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional, Tuple, List
+from dataclasses import dataclass
 import asyncio
 import os
 import httpx
@@ -22,7 +23,10 @@ from bot.utils import youmoney
 from bot.utils.time_helpers import now_msk, to_aware_msk, to_utc_for_db, from_db_naive
 import bot.utils.database as app_db
 import bot.utils.billing_db as billing_db
-from bot.utils.redis_repo import yookassa_dedup, invalidate_payment_ok_cache, quota_repo
+from bot.utils.redis_repo import (
+    yookassa_dedup, invalidate_payment_ok_cache, quota_repo, access_cache, invalidate_access_cache,
+)
+from bot.utils.async_db import run_db
 
 logger = logging.getLogger(__name__)
 
@@ -172,65 +176,168 @@ PAY_TEXT = (
     "Нажмите «Оплатить» для оформления."
 )
 
+# ──────────────────────────────────────────────────────────────────────────────
+# СНИМОК ДОСТУПА: trial + подписка одним запросом в каждую БД
+# ──────────────────────────────────────────────────────────────────────────────
+# Грейс-период: доступ сохраняется, пока подряд неудачных списаний меньше этого числа
+GRACE_MAX_FAILURES = 3
+
+
+@dataclass(frozen=True)
+class AccessSnapshot:
+    """
+    Всё, что нужно для решения о доступе и текста статуса.
+    Хранит только данные из БД; всё, что зависит от «сейчас», считается при чтении,
+    поэтому снимок можно кэшировать (access_cache: in-process + Redis с коротким TTL).
+    """
+    user_id: int
+    trial_until: Optional[datetime] = None      # МСК; None — триала не было
+    sub_status: Optional[str] = None            # статус «главной» подписки (active приоритетнее); None — подписок не было
+    next_charge_at: Optional[datetime] = None   # МСК
+    failures: int = 0                           # consecutive_failures
+
+    @property
+    def had_trial(self) -> bool:
+        return self.trial_until is not None
+
+    @property
+    def had_sub(self) -> bool:
+        return self.sub_status is not None
+
+    @property
+    def sub_active(self) -> bool:
+        return self.sub_status == "active"
+
+    def trial_active(self, now: Optional[datetime] = None) -> bool:
+        now = now or now_msk()
+        return bool(self.trial_until and now < self.trial_until)
+
+    def trial_hours_left(self, now: Optional[datetime] = None) -> int:
+        if self.trial_until is None:
+            return 0
+        now = now or now_msk()
+        return max(0, int((self.trial_until - now).total_seconds() // 3600))
+
+    def paid_active(self, now: Optional[datetime] = None) -> bool:
+        """Оплаченный период ещё идёт (next_charge_at > now)."""
+        now = now or now_msk()
+        return bool(self.sub_active and self.next_charge_at and self.next_charge_at > now)
+
+    def in_grace(self, now: Optional[datetime] = None) -> bool:
+        """Оплаченный период закончился, но неудачных списаний подряд < GRACE_MAX_FAILURES."""
+        return self.sub_active and not self.paid_active(now) and self.failures < GRACE_MAX_FAILURES
+
+    def has_access(self, now: Optional[datetime] = None) -> bool:
+        now = now or now_msk()
+        return self.trial_active(now) or self.paid_active(now) or self.in_grace(now)
+
+    def to_dict(self) -> Dict:
+        return {
+            "user_id": self.user_id,
+            "trial_until": self.trial_until.isoformat() if self.trial_until else None,
+            "sub_status": self.sub_status,
+            "next_charge_at": self.next_charge_at.isoformat() if self.next_charge_at else None,
+            "failures": self.failures,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "AccessSnapshot":
+        def _dt(v: Optional[str]) -> Optional[datetime]:
+            return to_aware_msk(datetime.fromisoformat(v)) if v else None
+        return cls(
+            user_id=int(d["user_id"]),
+            trial_until=_dt(d.get("trial_until")),
+            sub_status=d.get("sub_status"),
+            next_charge_at=_dt(d.get("next_charge_at")),
+            failures=int(d.get("failures") or 0),
+        )
+
+
+def compute_access_snapshot(user_id: int) -> AccessSnapshot:
+    """Синхронно читает снимок из БД: 1 запрос в app DB (trial) + 1 в billing DB (подписка)."""
+    trial_until = app_db.get_trial_until(user_id)
+    sub = billing_db.get_access_subscription(user_id)
+    if not sub:
+        return AccessSnapshot(user_id=user_id, trial_until=trial_until)
+    return AccessSnapshot(
+        user_id=user_id,
+        trial_until=trial_until,
+        sub_status=sub.get("status"),
+        next_charge_at=sub.get("next_charge_at"),
+        failures=int(sub.get("consecutive_failures") or 0),
+    )
+
+
+def load_access_snapshot(user_id: int) -> AccessSnapshot:
+    """
+    Синхронный вариант для sync-кода (тексты экранов, клавиатуры):
+    in-process кэш → БД. Redis здесь не трогаем (async-клиент).
+    """
+    cached = access_cache.get_local(user_id)
+    if cached is not None:
+        return AccessSnapshot.from_dict(cached)
+    snap = compute_access_snapshot(user_id)
+    access_cache.set_local(user_id, snap.to_dict())
+    return snap
+
+
+async def get_access_snapshot(user_id: int) -> AccessSnapshot:
+    """
+    Снимок доступа для горячего пути: in-process кэш → Redis → БД (в пуле потоков).
+    При ошибке БД возвращает «пустой» снимок (доступа нет) и ничего не кэширует.
+    """
+    cached = await access_cache.get(user_id)
+    if cached is not None:
+        try:
+            return AccessSnapshot.from_dict(cached)
+        except Exception:
+            logger.warning("Broken access snapshot in cache for user %s", user_id)
+    try:
+        snap = await run_db(compute_access_snapshot, user_id)
+    except Exception:
+        logger.exception("compute_access_snapshot failed for user %s", user_id)
+        return AccessSnapshot(user_id=user_id)
+    await access_cache.set(user_id, snap.to_dict())
+    return snap
+
+
 def _had_trial(user_id: int) -> bool:
     """True, если пробный период когда-либо выдавался (есть trial_until в БД)."""
     try:
-        return app_db.get_trial_until(user_id) is not None
+        return load_access_snapshot(user_id).had_trial
     except Exception:
         return False
 
 def _had_subscription(user_id: int) -> bool:
     """True, если у пользователя когда-либо была запись подписки (любой статус)."""
     try:
-        from bot.utils.billing_db import SessionLocal, Subscription
-        with SessionLocal() as s:
-            return s.query(Subscription).filter(Subscription.user_id == user_id).first() is not None
+        return load_access_snapshot(user_id).had_sub
     except Exception:
         return False
 
-def format_access_text(user_id: int) -> str:
+def format_access_text(user_id: int, snapshot: Optional[AccessSnapshot] = None) -> str:
     """
     Короткий статус доступа для стартовых экранов инструментов.
     """
     try:
-        hours = app_db.trial_remaining_hours(user_id)
+        snap = snapshot or load_access_snapshot(user_id)
     except Exception:
-        hours = 0
-    if app_db.is_trial_active(user_id):
-        try:
-            until_dt = app_db.get_trial_until(user_id)
-        except Exception:
-            until_dt = None
-        if until_dt:
-            return f"🆓 Бесплатный доступ активен до <b>{until_dt.date().isoformat()}</b> (~{hours} ч.)"
-        return f"🆓 Бесплатный доступ активен ещё <b>~{hours} ч.</b>"
+        return ""
+    now = now_msk()
+    if snap.trial_active(now):
+        hours = snap.trial_hours_left(now)
+        return f"🆓 Бесплатный доступ активен до <b>{snap.trial_until.date().isoformat()}</b> (~{hours} ч.)"
     # Подписка/грейс
-    try:
-        from bot.utils.billing_db import SessionLocal, Subscription
-        now = now_msk()
-        with SessionLocal() as s:
-            rec = (
-                s.query(Subscription)
-                .filter(Subscription.user_id == user_id, Subscription.status == "active")
-                .order_by(Subscription.next_charge_at.desc(), Subscription.updated_at.desc())
-                .first()
-            )
-            if rec:
-                # Конвертируем next_charge_at из БД (UTC) в МСК для сравнения
-                next_charge_msk = from_db_naive(rec.next_charge_at)
-                if next_charge_msk and next_charge_msk > now:
-                    return "✅ Подписка активна"
-                fails = int(rec.consecutive_failures or 0)
-                if fails < 3:
-                    return f"🕊️ Грейс-период: ожидаем оплату (попыток: {fails}/6)"
-    except Exception:
-        pass
+    if snap.paid_active(now):
+        return "✅ Подписка активна"
+    if snap.in_grace(now):
+        return f"🕊️ Грейс-период: ожидаем оплату (попыток: {snap.failures}/6)"
     # Не активен пробный период и нет активной карты.
     # Если пробный период ранее был — сообщаем, что он завершён.
-    if _had_trial(user_id):
+    if snap.had_trial:
         return "😢 Бесплатный период завершён."
     # Если ранее была подписка — сообщаем, что она не активна.
-    if _had_subscription(user_id):
+    if snap.had_sub:
         return "🪫 Подписка не активна."
     # Ничего не было — ничего «не завершилось»: возвращаем пустую строку.
     return ""
@@ -238,9 +345,7 @@ def format_access_text(user_id: int) -> str:
 
 def has_access(user_id: int) -> bool:
     try:
-        if app_db.is_trial_active(user_id):
-            return True
-        return _has_paid_or_grace_access(user_id)
+        return load_access_snapshot(user_id).has_access()
     except Exception:
         return False
 
@@ -270,7 +375,9 @@ async def ensure_access(evt: Message | CallbackQuery) -> bool:
     прерывая основной флоу.
     """
     user_id = evt.from_user.id if isinstance(evt, CallbackQuery) else evt.from_user.id
-    if has_access(user_id):
+    # Один снимок (кэш → БД в пуле потоков) вместо 4–7 отдельных запросов
+    snap = await get_access_snapshot(user_id)
+    if snap.has_access():
         return True
     # Бесплатные проходы: если квота не исчерпана — пропускаем пользователя
     if await _try_free_pass(user_id):
@@ -278,9 +385,9 @@ async def ensure_access(evt: Message | CallbackQuery) -> bool:
     # Приоритет: если когда-либо была подписка (и сейчас нет) — показываем про подписку.
     # Иначе, если был пробный период — показываем про завершённый пробный период.
     # Иначе — общий экран подписки.
-    if _had_subscription(user_id):
+    if snap.had_sub:
         text = SUB_PAY
-    elif _had_trial(user_id):
+    elif snap.had_trial:
         text = SUB_FREE
     else:
         text = PAY_NOTHING
@@ -333,30 +440,15 @@ def _build_settings_text(user_id: int) -> str:
     # 1) Статус
     now_msk_val = now_msk()
     try:
-        if app_db.is_trial_active(user_id):
-            until = app_db.get_trial_until(user_id)
-            if until:
-                status_line = f"пробный период до {until.date().isoformat()}"
-            else:
-                status_line = "пробный период активен"
+        snap = load_access_snapshot(user_id)
+        if snap.trial_active(now_msk_val):
+            status_line = f"пробный период до {snap.trial_until.date().isoformat()}"
+        elif snap.paid_active(now_msk_val):
+            status_line = "активна"
+        elif snap.in_grace(now_msk_val):
+            status_line = f"грейс-период (попыток {snap.failures}/6)"
         else:
-            from bot.utils.billing_db import SessionLocal, Subscription
-            with SessionLocal() as s:
-                rec = (
-                    s.query(Subscription)
-                    .filter(Subscription.user_id == user_id, Subscription.status == "active")
-                    .order_by(Subscription.next_charge_at.desc(), Subscription.updated_at.desc())
-                    .first()
-                )
-                # Конвертируем next_charge_at из БД (UTC) в МСК для сравнения
-                next_charge_msk = from_db_naive(rec.next_charge_at) if rec and rec.next_charge_at else None
-                if rec and next_charge_msk and next_charge_msk > now_msk_val:
-                    status_line = "активна"
-                elif rec and int(rec.consecutive_failures or 0) < 3:
-                    fails = int(rec.consecutive_failures or 0)
-                    status_line = f"грейс-период (попыток {fails}/6)"
-                else:
-                    status_line = "неактивна"
+            status_line = "неактивна"
     except Exception:
         status_line = "неактивна"
 
@@ -604,24 +696,8 @@ def _has_paid_or_grace_access(user_id: int) -> bool:
         (consecutive_failures < 3) — «грейс-период».
     """
     try:
-        from bot.utils.billing_db import SessionLocal, Subscription
-        now = now_msk()
-        with SessionLocal() as s:
-            rec = (
-                s.query(Subscription)
-                .filter(Subscription.user_id == user_id, Subscription.status == "active")
-                .order_by(Subscription.next_charge_at.desc(), Subscription.updated_at.desc())
-                .first()
-            )
-            if not rec:
-                return False
-            # Конвертируем next_charge_at из БД (UTC) в МСК для сравнения
-            next_charge_msk = from_db_naive(rec.next_charge_at)
-            if next_charge_msk and next_charge_msk > now:
-                return True  # оплаченный период ещё идёт
-            # оплаченный период закончился — смотрим кол-во попыток
-            fails = int(rec.consecutive_failures or 0)
-            return fails < 3
+        snap = load_access_snapshot(user_id)
+        return snap.paid_active() or snap.in_grace()
     except Exception:
         return False
 
@@ -886,6 +962,117 @@ async def need_tos(cb: CallbackQuery) -> None:
 # WEBHOOK: успешные платежи YooKassa
 # ──────────────────────────────────────────────────────────────────────────────
 
+def _register_charge_failure(sub_id: int) -> Tuple[bool, bool]:
+    """
+    Синхронная часть обработки неуспешного списания (выполняется в пуле потоков БД):
+    увеличивает consecutive_failures и троттлит уведомление (не чаще 1 раза за 12ч).
+    Возвращает (can_notice, should_remove), где should_remove — «достигли 3-й подряд неудачи».
+    """
+    from bot.utils.billing_db import SessionLocal, Subscription
+    from sqlalchemy import update
+    can_notice = True
+    should_remove = False
+    with SessionLocal() as s, s.begin():
+        rec = s.get(Subscription, sub_id)
+        if rec:
+            now_msk_val = now_msk()
+            # Конвертируем last_fail_notice_at из БД (UTC) в МСК для сравнения
+            last_fail_notice_msk = from_db_naive(rec.last_fail_notice_at)
+            if last_fail_notice_msk and (now_msk_val - last_fail_notice_msk) < timedelta(hours=12):
+                can_notice = False
+            # Атомарное обновление consecutive_failures
+            prev_fails = int(rec.consecutive_failures or 0)
+            new_fails = min(prev_fails + 1, 6)
+            # Используем атомарное обновление через SQL
+            s.execute(
+                update(Subscription)
+                .where(Subscription.id == sub_id)
+                .values(consecutive_failures=new_fails)
+            )
+            if new_fails >= 3 and prev_fails < 3:
+                should_remove = True
+            if can_notice:
+                rec.last_fail_notice_at = to_utc_for_db(now_msk_val)
+            rec.updated_at = to_utc_for_db(now_msk_val)
+    return can_notice, should_remove
+
+
+def _renewal_fallback_subscription(
+    *,
+    user_id: int,
+    code: str,
+    months: int,
+    pm_token: Optional[str],
+    next_at: datetime,
+    payment_id: str,
+    amount_currency: str,
+) -> str:
+    """
+    Синхронная часть renewal-вебхука, когда subscription_mark_charged_for_user() не нашёл подписку.
+    Реактивирует canceled-подписку того же плана либо создаёт новую.
+    Возвращает "reactivated" | "created" | "no_token" (подписку создать нельзя — нет токена).
+    """
+    from bot.utils.billing_db import SessionLocal, Subscription
+    with SessionLocal() as s:
+        # Проверяем canceled подписки
+        canceled_sub = (
+            s.query(Subscription)
+            .filter(
+                Subscription.user_id == user_id,
+                Subscription.plan_code == code,
+                Subscription.status == "canceled"
+            )
+            .first()
+        )
+        # Проверяем активные подписки с другим plan_code
+        active_sub = (
+            s.query(Subscription)
+            .filter(
+                Subscription.user_id == user_id,
+                Subscription.status == "active"
+            )
+            .first()
+        )
+        if active_sub and active_sub.plan_code != code:
+            logger.warning(
+                "Renewal payment for plan_code=%s but user has active subscription with plan_code=%s: "
+                "user_id=%s, payment_id=%s",
+                code, active_sub.plan_code, user_id, payment_id
+            )
+        if canceled_sub:
+            # ИСПРАВЛЕНО: Активируем существующую canceled подписку вместо создания новой
+            logger.info(
+                "Renewal payment received for canceled subscription: user_id=%s, plan_code=%s, "
+                "payment_id=%s, subscription_id=%s. Activating existing subscription.",
+                user_id, code, payment_id, canceled_sub.id
+            )
+            canceled_sub.status = "active"
+            canceled_sub.payment_method_id = pm_token  # Обновляем токен
+            canceled_sub.next_charge_at = to_utc_for_db(to_aware_msk(next_at))
+            canceled_sub.last_charge_at = to_utc_for_db(now_msk())
+            canceled_sub.consecutive_failures = 0
+            canceled_sub.updated_at = to_utc_for_db(now_msk())
+            s.commit()
+            return "reactivated"
+    # если нет подписки (крайний случай) — создадим
+    # ВАЖНО: Проверяем pm_token перед созданием подписки
+    if not pm_token:
+        logger.critical(
+            "Renewal payment succeeded but cannot create subscription without pm_token: "
+            "user_id=%s, payment_id=%s, plan_code=%s. Payment processed but subscription not created.",
+            user_id, payment_id, code
+        )
+        return "no_token"
+    billing_db.subscription_upsert(
+        user_id=user_id, plan_code=code, interval_months=months,
+        amount_value=TARIFFS.get(code, {}).get("amount", "0.00"),
+        amount_currency=amount_currency,
+        payment_method_id=pm_token,  # знаем токен из текущего события
+        next_charge_at=next_at, status="active",
+    )
+    return "created"
+
+
 async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
     try:
         event = payload.get("event")
@@ -905,7 +1092,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             await yookassa_dedup.should_process(payment_id, status_lc)  # просто зафиксирует, если надо
             # Создаём запись в payment_log для истории
             try:
-                billing_db.payment_log_upsert(
+                await run_db(
+                    billing_db.payment_log_upsert,
                     payment_id=payment_id,
                     user_id=int(metadata.get("user_id") or 0) if metadata.get("user_id") else None,
                     amount_value=str(obj.get("amount", {}).get("value") or ""),
@@ -925,7 +1113,7 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             return 200, f"duplicate/no-op status={status_lc}"
 
         # Дополнительная проверка дубликатов в БД (защита от race conditions при сбое Redis)
-        if billing_db.payment_log_is_processed(payment_id):
+        if await run_db(billing_db.payment_log_is_processed, payment_id):
             logger.info("Payment %s already processed in DB, skipping duplicate webhook", payment_id)
             return 200, f"duplicate/already-processed status={status_lc}"
 
@@ -934,7 +1122,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             if payment_id and status in ("succeeded", "canceled", "expired"):
                 sub_id_raw = metadata.get("subscription_id")
                 sub_id = int(sub_id_raw) if sub_id_raw else None
-                billing_db.mark_charge_attempt_status(
+                await run_db(
+                    billing_db.mark_charge_attempt_status,
                     payment_id=payment_id,
                     subscription_id=sub_id,
                     status=("succeeded" if status == "succeeded" else status)
@@ -954,7 +1143,7 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             if user_id_fail:
                 # Записываем событие неуспешного платежа в БД
                 try:
-                    app_db.event_add(user_id_fail, f"PAYMENT:FAIL status={status} payment_id={payment_id}")
+                    await run_db(app_db.event_add, user_id_fail, f"PAYMENT:FAIL status={status} payment_id={payment_id}")
                 except Exception:
                     logger.warning("Failed to log payment fail event for user %s", user_id_fail)
                 # ⚡ сбрасываем кэш «payment_ok» при любом финальном фейле
@@ -964,33 +1153,9 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
                     logger.warning("invalidate_payment_ok_cache failed (fail branch) for user %s", user_id_fail)
                 try:
                     # троттлинг: не чаще 1 раза за 12ч
-                    can_notice = True
-                    should_remove = False  # сигнал «достигли 3-й подряд неудачи»
+                    can_notice, should_remove = True, False
                     if sub_id:
-                        from bot.utils.billing_db import SessionLocal, Subscription
-                        from sqlalchemy import select, update
-                        with SessionLocal() as s, s.begin():
-                            rec = s.get(Subscription, sub_id)
-                            if rec:
-                                now_msk_val = now_msk()
-                                # Конвертируем last_fail_notice_at из БД (UTC) в МСК для сравнения
-                                last_fail_notice_msk = from_db_naive(rec.last_fail_notice_at)
-                                if last_fail_notice_msk and (now_msk_val - last_fail_notice_msk) < timedelta(hours=12):
-                                    can_notice = False
-                                # Атомарное обновление consecutive_failures
-                                prev_fails = int(rec.consecutive_failures or 0)
-                                new_fails = min(prev_fails + 1, 6)
-                                # Используем атомарное обновление через SQL
-                                s.execute(
-                                    update(Subscription)
-                                    .where(Subscription.id == sub_id)
-                                    .values(consecutive_failures=new_fails)
-                                )
-                                if new_fails >= 3 and prev_fails < 3:
-                                    should_remove = True
-                                if can_notice:
-                                    rec.last_fail_notice_at = to_utc_for_db(now_msk_val)
-                                rec.updated_at = to_utc_for_db(now_msk_val)
+                        can_notice, should_remove = await run_db(_register_charge_failure, sub_id)
                     # если достигли 3-й неудачи — инициируем полное удаление из чата
                     if should_remove:
                         try:
@@ -1008,6 +1173,9 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
                         ##await bot.send_photo(chat_id=user_id_fail, photo=photo, caption=caption, parse_mode="Markdown")
                 except Exception as e:
                     logger.warning("Failed to send fail notice to %s: %s", user_id_fail, e)
+            # счётчик неудач изменился — снимок доступа (грейс-период) больше не актуален
+            if user_id_fail:
+                await invalidate_access_cache(user_id_fail)
             return 200, f"fail event={event} status={status}"
 
         if event not in ("payment.succeeded",):
@@ -1025,7 +1193,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
 
         # --- аудит в БД (на случай рестартов/отладка) ---
         try:
-            billing_db.payment_log_upsert(
+            await run_db(
+                billing_db.payment_log_upsert,
                 payment_id=payment_id,
                 user_id=user_id,
                 amount_value=str(obj.get("amount", {}).get("value") or ""),
@@ -1063,11 +1232,11 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             exp_year = None
 
         # Убедимся, что пользователь есть в app DB (для пробного периода/истории)
-        app_db.check_and_add_user(user_id)
+        await run_db(app_db.check_and_add_user, user_id)
 
         # Записываем событие успешного платежа в БД
         try:
-            app_db.event_add(user_id, f"PAYMENT:SUCCESS status={status} payment_id={payment_id} phase={phase} plan={code}")
+            await run_db(app_db.event_add, user_id, f"PAYMENT:SUCCESS status={status} payment_id={payment_id} phase={phase} plan={code}")
         except Exception:
             logger.warning("Failed to log payment success event for user %s", user_id)
 
@@ -1076,7 +1245,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             # 1) сохраняем карту в справочник (id не нужен в подписке; храним токен провайдера)
             if pm_token:
                 try:
-                    billing_db.card_upsert_from_provider(
+                    await run_db(
+                        billing_db.card_upsert_from_provider,
                         user_id=user_id, provider=pmethod.get("type", "yookassa"),
                         pm_token=pm_token, brand=brand, first6=first6, last4=last4,
                         exp_month=exp_month, exp_year=exp_year,
@@ -1096,7 +1266,7 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             
             # 2) включаем пробный период доступа
             trial_hours = int(str(metadata.get("trial_hours") or "72"))
-            trial_until = app_db.set_trial(user_id, hours=trial_hours)  # datetime (UTC)
+            trial_until = await run_db(app_db.set_trial, user_id, hours=trial_hours)  # datetime (UTC)
             # 3) создаём/обновляем подписку с next_charge_at после пробный периода
             # ИСПРАВЛЕНО: Используем время создания платежа из webhook (obj.created_at), если доступно,
             # чтобы избежать проблем при задержке webhook'а. Если нет - используем текущее время.
@@ -1135,7 +1305,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
                     user_id, payment_id
                 )
             
-            billing_db.subscription_upsert(
+            await run_db(
+                billing_db.subscription_upsert,
                 user_id=user_id, plan_code=code, interval_months=months,
                 amount_value=str(metadata.get("plan_amount") or TARIFFS.get(code, {}).get("amount", "0.00")),
                 amount_currency=str(obj.get("amount", {}).get("currency") or "RUB"),
@@ -1161,7 +1332,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             # Сохраняем платёжный метод (чтобы было автопродление)
             if pm_token:
                 try:
-                    billing_db.card_upsert_from_provider(
+                    await run_db(
+                        billing_db.card_upsert_from_provider,
                         user_id=user_id, provider=pmethod.get("type", "yookassa"),
                         pm_token=pm_token, brand=brand, first6=first6, last4=last4,
                         exp_month=exp_month, exp_year=exp_year,
@@ -1206,7 +1378,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             # Передаём subscription_id или plan_code из metadata для правильного выбора подписки
             sub_id_raw = metadata.get("subscription_id")
             sub_id = int(sub_id_raw) if sub_id_raw else None
-            updated_sub_id = billing_db.subscription_mark_charged_for_user(
+            updated_sub_id = await run_db(
+                billing_db.subscription_mark_charged_for_user,
                 user_id=user_id, 
                 next_charge_at=next_at,
                 subscription_id=sub_id,
@@ -1215,77 +1388,26 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
             if not updated_sub_id:
                 # Подписка не найдена - проверяем все возможные причины
                 try:
-                    from bot.utils.billing_db import SessionLocal, Subscription
-                    with SessionLocal() as s:
-                        # Проверяем canceled подписки
-                        canceled_sub = (
-                            s.query(Subscription)
-                            .filter(
-                                Subscription.user_id == user_id,
-                                Subscription.plan_code == code,
-                                Subscription.status == "canceled"
-                            )
-                            .first()
-                        )
-                        # Проверяем активные подписки с другим plan_code
-                        active_sub = (
-                            s.query(Subscription)
-                            .filter(
-                                Subscription.user_id == user_id,
-                                Subscription.status == "active"
-                            )
-                            .first()
-                        )
-                        if active_sub and active_sub.plan_code != code:
-                            logger.warning(
-                                "Renewal payment for plan_code=%s but user has active subscription with plan_code=%s: "
-                                "user_id=%s, payment_id=%s",
-                                code, active_sub.plan_code, user_id, payment_id
-                            )
-                        if canceled_sub:
-                            # ИСПРАВЛЕНО: Активируем существующую canceled подписку вместо создания новой
-                            logger.info(
-                                "Renewal payment received for canceled subscription: user_id=%s, plan_code=%s, "
-                                "payment_id=%s, subscription_id=%s. Activating existing subscription.",
-                                user_id, code, payment_id, canceled_sub.id
+                    outcome = await run_db(
+                        _renewal_fallback_subscription,
+                        user_id=user_id, code=code, months=months, pm_token=pm_token,
+                        next_at=next_at, payment_id=payment_id,
+                        amount_currency=str(obj.get("amount", {}).get("currency") or "RUB"),
+                    )
+                    if outcome == "no_token":
+                        # Отправляем уведомление пользователю о проблеме
+                        try:
+                            await bot.send_message(
+                                chat_id=user_id,
+                                text=(
+                                    "⚠️ *Проблема с подпиской*\n\n"
+                                    "Ваш платёж прошёл успешно, но возникла техническая проблема с активацией подписки.\n"
+                                    "Пожалуйста, обратитесь в поддержку для решения вопроса."
+                                ),
+                                parse_mode="Markdown",
                             )
-                            canceled_sub.status = "active"
-                            canceled_sub.payment_method_id = pm_token  # Обновляем токен
-                            canceled_sub.next_charge_at = to_utc_for_db(to_aware_msk(next_at))
-                            canceled_sub.last_charge_at = to_utc_for_db(now_msk())
-                            canceled_sub.consecutive_failures = 0
-                            canceled_sub.updated_at = to_utc_for_db(now_msk())
-                            s.commit()
-                        else:
-                            # если нет подписки (крайний случай) — создадим
-                            # ВАЖНО: Проверяем pm_token перед созданием подписки
-                            if not pm_token:
-                                logger.critical(
-                                    "Renewal payment succeeded but cannot create subscription without pm_token: "
-                                    "user_id=%s, payment_id=%s, plan_code=%s. Payment processed but subscription not created.",
-                                    user_id, payment_id, code
-                                )
-                                # Отправляем уведомление пользователю о проблеме
-                                try:
-                                    await bot.send_message(
-                                        chat_id=user_id,
-                                        text=(
-                                            "⚠️ *Проблема с подпиской*\n\n"
-                                            "Ваш платёж прошёл успешно, но возникла техническая проблема с активацией подписки.\n"
-                                            "Пожалуйста, обратитесь в поддержку для решения вопроса."
-                                        ),
-                                        parse_mode="Markdown",
-                                    )
-                                except Exception as notify_error:
-                                    logger.warning("Failed to send notification to user %s: %s", user_id, notify_error)
-                            else:
-                                billing_db.subscription_upsert(
-                                    user_id=user_id, plan_code=code, interval_months=months,
-                                    amount_value=TARIFFS.get(code, {}).get("amount", "0.00"),
-                                    amount_currency=str(obj.get("amount", {}).get("currency") or "RUB"),
-                                    payment_method_id=pm_token,  # знаем токен из текущего события
-                                    next_charge_at=next_at, status="active",
-                                )
+                        except Exception as notify_error:
+                            logger.warning("Failed to send notification to user %s: %s", user_id, notify_error)
                 except Exception as e:
                     logger.exception("Failed to check/create subscription for renewal: %s", e)
             # Проверка pm_token для renewal (дополнительная проверка после обновления)
@@ -1312,7 +1434,7 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
         else:
             # Не рекуррентный кейс (включая trial_tokenless): только пробный период.
             trial_hours = int(str(metadata.get("trial_hours") or "72"))
-            trial_until = app_db.set_trial(user_id, hours=trial_hours)
+            trial_until = await run_db(app_db.set_trial, user_id, hours=trial_hours)
             
             # ИСПРАВЛЕНО: Создаём подписку даже для нерекуррентных платежей, если есть plan_code
             # Это необходимо для отслеживания платежей и правильной работы системы
@@ -1342,7 +1464,8 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
                     next_charge_at = payment_created_dt + timedelta(hours=trial_hours)
                     
                     # Создаём подписку без payment_method_id (автопродление не будет работать)
-                    billing_db.subscription_upsert(
+                    await run_db(
+                        billing_db.subscription_upsert,
                         user_id=user_id,
                         plan_code=code,
                         interval_months=months,
@@ -1372,10 +1495,13 @@ async def process_yookassa_webhook(bot: Bot, payload: Dict) -> Tuple[int, str]:
 
         # помечаем как обработанный в БД (а в Redis уже зафиксирован финальный статус)
         try:
-            billing_db.payment_log_mark_processed(payment_id)
+            await run_db(billing_db.payment_log_mark_processed, payment_id)
         except Exception:
             logger.exception("payment_log_mark_processed failed for %s", payment_id)
 
+        # триал/подписка изменились — сбрасываем снимок доступа
+        await invalidate_access_cache(user_id)
+
         return 200, "ok"
 
     except Exception as e:
@@ -1535,7 +1661,7 @@ def kb_manage_menu() -> InlineKeyboardMarkup:
 async def open_manage(cb: CallbackQuery) -> None:
     user_id = cb.from_user.id
     # Управление доступно, если есть активный пробный период или оплаченный/грейс-доступ
-    if not (app_db.is_trial_active(user_id) or _has_paid_or_grace_access(user_id)):
+    if not has_access(user_id):
         await _edit_safe(cb, "Подписка не активна. Выберите тариф для оформления:", kb_rates(user_id))
         return
     await _edit_safe(
@@ -18,6 +18,7 @@ from aiogram.exceptions import TelegramBadRequest
 from bot.config import get_file_path
 from bot.states.states import FloorPlanStates
 from bot.utils.chat_actions import run_long_operation_with_action
+from bot.utils.executor_client import executor_client, ExecutorHTTPError
 from bot.utils.image_processor import download_image_from_url
 from bot.handlers.payment_handler import (
     ensure_access,        # централизованная проверка подписки/триала
@@ -417,17 +418,15 @@ async def generate_floor_plan(*, floor_plan_path: str, visualization_style: str,
     Промпт строится на стороне executor/apps/plan_generate.py.
     Возвращает URL сгенерированного изображения или пустую строку.
     """
-    import os, io, json, uuid
+    import os, io, uuid
     from datetime import datetime
-    from aiohttp import FormData, ClientSession
+    from aiohttp import FormData
 
-    # Основной путь через Blueprint с префиксом и фолбэк на «старый» путь без префикса
-    base = os.getenv("EXECUTOR_BASE_URL", "http://localhost:8080").rstrip("/")
-    api_prefix = os.getenv("EXECUTOR_API_PREFIX", "/api/v1").strip("/")
-    primary_url = f"{base}/{api_prefix}/plan/generate" if api_prefix else f"{base}/plan/generate"
-    fallback_url = f"{base}/plan/generate"
+    # Путь /plan/generate (с префиксом API или «старый» без него) executor_client
+    # определяет один раз при старте бота, а не пробой на каждый 404
+    url = await executor_client.plan_url()
 
-    # Читаем файл в память, чтобы можно было переиспользовать payload при фолбэке
+    # Читаем файл в память, чтобы форму можно было собрать заново при повторе
     with open(floor_plan_path, "rb") as fh:
         img_bytes = fh.read()
 
@@ -446,73 +445,34 @@ async def generate_floor_plan(*, floor_plan_path: str, visualization_style: str,
 
     req_id = f"fp-{uuid.uuid4().hex[:8]}-{int(datetime.utcnow().timestamp())}"
     try:
-        async with ClientSession() as session:
-            # 1) пробуем новый путь с префиксом (/api/v1/plan/generate)
-            async with session.post(
-                primary_url,
-                params={"debug": "1"},
-                data=_build_form(),
-                headers={"X-Request-ID": req_id},
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    # Проверяем разные форматы ответа
-                    url = data.get("url") or ""
-                    if not url and data.get("images"):
-                        # Если есть массив изображений, берем первое
-                        images = data.get("images", [])
-                        if images:
-                            url = images[0]
-                    return url
-                # 404 — пробуем фолбэк на старый путь
-                if resp.status != 404:
-                    body_text = await resp.text()
-                    try:
-                        body_json = json.loads(body_text)
-                    except Exception:
-                        body_json = {"raw": body_text}
-                    LOG.error(
-                        "FloorPlan primary failed [%s] %s status=%s details=%s",
-                        req_id, primary_url, resp.status, body_json
-                    )
-                    return ""
-
-            # 2) фолбэк на /plan/generate
-            async with session.post(
-                fallback_url,
-                params={"debug": "1"},
-                data=_build_form(),
-                headers={"X-Request-ID": req_id},
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    # Проверяем разные форматы ответа
-                    url = data.get("url") or ""
-                    if not url and data.get("images"):
-                        # Если есть массив изображений, берем первое
-                        images = data.get("images", [])
-                        if images:
-                            url = images[0]
-                    return url
-                else:
-                    body_text = await resp.text()
-                    try:
-                        body_json = json.loads(body_text)
-                    except Exception:
-                        body_json = {"raw": body_text}
-                    LOG.error(
-                        "FloorPlan fallback failed [%s] %s status=%s details=%s",
-                        req_id, fallback_url, resp.status, body_json
-                    )
-                    return ""
-    except Exception as e:
-        error_msg = str(e)
-        if "429" in error_msg or "Too Many Requests" in error_msg:
+        data = await executor_client.post_form(
+            "plan/generate",
+            _build_form,
+            url=url,
+            params={"debug": "1"},
+            headers={"X-Request-ID": req_id},
+        )
+        # Проверяем разные форматы ответа
+        result = (data or {}).get("url") or ""
+        if not result and (data or {}).get("images"):
+            # Если есть массив изображений, берем первое
+            images = data.get("images", [])
+            if images:
+                result = images[0]
+        return result
+    except ExecutorHTTPError as e:
+        if e.status == 429:
             LOG.warning("Rate limit hit for generate_floor_plan [%s]: %s", req_id, e)
-        elif "401" in error_msg or "403" in error_msg:
+        elif e.status in (401, 403):
             LOG.error("Auth error in generate_floor_plan [%s]: %s", req_id, e)
         else:
-            LOG.exception("Exception in generate_floor_plan [%s]: %s", req_id, e)
+            LOG.error(
+                "FloorPlan failed [%s] %s status=%s details=%s",
+                req_id, url, e.status, e.detail
+            )
+        return ""
+    except Exception as e:
+        LOG.exception("Exception in generate_floor_plan [%s]: %s", req_id, e)
         return ""
 
 
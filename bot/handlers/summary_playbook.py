@@ -4,7 +4,6 @@ import os
 from typing import List, Optional, Dict
 from datetime import datetime, timezone
 
-import aiohttp
 from aiogram import Router, F, Bot
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
@@ -14,9 +13,10 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.enums.chat_action import ChatAction
 
-from bot.config import EXECUTOR_BASE_URL, get_file_path
+from bot.config import get_file_path
 from bot.states.states import SummaryStates
 from bot.utils.chat_actions import run_long_operation_with_action
+from bot.utils.executor_client import executor_client
 
 from bot.utils.redis_repo import summary_repo       # Redis: черновик (единый файл)
 from bot.utils.database import (
@@ -241,18 +241,7 @@ async def _analyze(payload: dict, *, timeout_sec: int = 120) -> dict:
       "decisions": ["...","..."]
     }
     """
-    url = f"{EXECUTOR_BASE_URL.rstrip('/')}/api/v1/summary/analyze"
-    t = aiohttp.ClientTimeout(total=timeout_sec)
-    async with aiohttp.ClientSession(timeout=t) as s:
-        async with s.post(url, json=payload) as r:
-            if r.status != 200:
-                # пробуем вытащить деталь
-                try:
-                    err = await r.json()
-                except Exception:
-                    err = await r.text()
-                raise RuntimeError(f"HTTP {r.status}: {err}")
-            return await r.json()
+    return await executor_client.post_json("summary/analyze", payload, timeout=timeout_sec)
 
 def _clean_point(s: str) -> str:
     """
@@ -3,192 +3,98 @@ import asyncio
 import logging
 import os
 import signal
+import socket
+import threading
 import time
 from contextlib import suppress
-from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
+from datetime import timedelta
 
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiohttp import web
-import httpx
 
 from bot import setup
 from bot.config import *
 import bot.utils.database as db
 import bot.utils.billing_db as billing_db
-from bot.utils.mailing import run_mailing_scheduler
+from bot.utils.mailing import next_mailing_delay, run_mailing_scheduler
 from bot.utils.notification import run_notification_scheduler
 
 from bot.handlers.payment_handler import process_yookassa_webhook
 from bot.utils import youmoney
 from bot.utils.time_helpers import now_msk
+from bot.utils.event_logger import event_logger
+from bot.utils import async_db
+from bot.utils.async_db import run_db
+from bot.utils.executor_client import executor_client
+from bot.utils.yookassa_client import yookassa_client
+from bot.utils.billing_scheduler import billing_scheduler
+from bot.utils.webhook_queue import webhook_queue
+from bot.utils.membership_enforcer import membership_enforcer
+from bot.utils.tg_shaper import Priority, TrafficShaperMiddleware, send_priority, traffic_shaper
+from bot.utils.tg_assets import FileIdCacheMiddleware, asset_registry
 from bot.handlers.description_playbook import register_http_endpoints
 
 
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+# Все отправки — через общий темп и приоритеты (см. bot/utils/tg_shaper.py)
+bot.session.middleware(TrafficShaperMiddleware(traffic_shaper))
+# Файлы с диска загружаются один раз, дальше — по file_id (см. bot/utils/tg_assets.py)
+bot.session.middleware(FileIdCacheMiddleware(asset_registry))
 dp = Dispatcher(storage=MemoryStorage())
 setup(dp)
 
 # Флаг для graceful shutdown
 shutdown_event = asyncio.Event()
 
-# Приведение дат к UTC-aware (на случай, если из БД пришёл naive)
-def _as_utc(dt: datetime | None) -> datetime | None:
-    if dt is None:
-        return None
-    if dt.tzinfo is None:
-        return dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc)
-
-# ──────────────────────────────────────────────────────────────────────────────
-# Membership Enforcer: настройки
-# ──────────────────────────────────────────────────────────────────────────────
-# Базовый URL membership-сервиса (по умолчанию локально)
-MEMBERSHIP_BASE_URL = os.getenv("MEMBERSHIP_BASE_URL", "http://127.0.0.1:6000")
-# Как часто сканировать просроченные подписки, сек
-ENFORCER_INTERVAL_SEC = int(os.getenv("MEMBERSHIP_ENFORCER_INTERVAL_SEC", "900"))  # 15 минут
-# Кулдаун между повторными попытками remove одного и того же пользователя, часы
-REMOVAL_COOLDOWN_HOURS = int(os.getenv("MEMBERSHIP_REMOVAL_COOLDOWN_HOURS", "24"))
-# Память последних попыток удаления (анти-спам при неудачах/повторах)
-_last_removal_attempt: dict[int, datetime] = {}
-
+# Сколько рекуррентных списаний billing_loop выполняет параллельно
+BILLING_CONCURRENCY = int(os.getenv("BILLING_CONCURRENCY", "10"))
+# Воркер биллинга: идентификатор аренды, размер пачки и срок аренды подписки
+BILLING_WORKER_ID = os.getenv("BILLING_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+BILLING_CLAIM_BATCH = int(os.getenv("BILLING_CLAIM_BATCH", "100"))
+BILLING_LEASE_SEC = int(os.getenv("BILLING_LEASE_SEC", "300"))
+# Сколько ждать закрытия клиентов/очередей при остановке, дальше — принудительный выход
+SHUTDOWN_TIMEOUT_SEC = float(os.getenv("SHUTDOWN_TIMEOUT_SEC", "10"))
+# Пауза перед повторной сверкой после ошибки БД
+BILLING_ERROR_RETRY_SEC = 5.0
 
 async def yookassa_webhook_handler(request: web.Request):
-    try:
-        data = await request.json()
-        logging.info(f"YooKassa webhook received: {data}")
-
-        # Централизованный вызов
-        status, msg = await process_yookassa_webhook(bot, data)
-        if status != 200:
-            logging.warning("Webhook not OK: %s", msg)
-        return web.Response(status=status)
-
-    except Exception as e:
-        logging.error(f"Error processing YooKassa webhook: {e}")
-        return web.Response(status=500)
-
-
-def _has_active_paid_period_strict(user_id: int) -> bool:
     """
-    Строгое состояние «оплачено»: есть запись подписки со статусом 'active'
-    и next_charge_at > сейчас (то есть оплаченный период ещё идёт).
-    Грейс-периоды сюда не входят.
+    Быстрый ACK: событие сохраняется в webhook_inbox и обрабатывается воркерами
+    webhook_queue (process_yookassa_webhook). 500 — только если событие не удалось
+    сохранить: YooKassa повторит доставку.
     """
     try:
-        from bot.utils.billing_db import SessionLocal, Subscription
-        now_utc = datetime.now(ZoneInfo("UTC"))
-        with SessionLocal() as s:
-            rec = (
-                s.query(Subscription)
-                .filter(Subscription.user_id == user_id, Subscription.status == "active")
-                .order_by(Subscription.next_charge_at.desc(), Subscription.updated_at.desc())
-                .first()
-            )
-            if not rec:
-                return False
-            # next_charge_at может быть naive → сравниваем только UTC-aware
-            next_at_utc = _as_utc(rec.next_charge_at)
-            return bool(next_at_utc and next_at_utc > now_utc)
-    except Exception:
-        return False
-
-
-def _should_attempt_remove(user_id: int) -> bool:
-    """
-    Не даём «дубасить» Telegram remove слишком часто.
-    Возвращает True, если последняя попытка была достаточно давно.
-    """
-    now = datetime.now(ZoneInfo("UTC"))
-    last = _last_removal_attempt.get(user_id)
-    if last and (now - last) < timedelta(hours=REMOVAL_COOLDOWN_HOURS):
-        return False
-    _last_removal_attempt[user_id] = now
-    return True
-
+        data = await request.json()
+    except Exception as e:
+        logging.warning("YooKassa webhook: invalid JSON: %s", e)
+        return web.Response(status=400)
+    obj = (data.get("object") or {}) if isinstance(data, dict) else {}
+    if not obj.get("id") or not obj.get("status"):
+        logging.warning("Webhook not OK: missing payment_id/status")
+        return web.Response(status=400)
 
-async def _membership_remove_http(user_id: int) -> bool:
-    """
-    Аккуратный HTTP-вызов membership-сервиса на удаление пользователя из чата.
-    Возвращает True при HTTP 2xx.
-    """
-    url = f"{MEMBERSHIP_BASE_URL}/members/remove"
-    payload = {"user_id": int(user_id)}
     try:
-        async with httpx.AsyncClient(timeout=10) as http:
-            r = await http.post(url, json=payload)
-            if 200 <= r.status_code < 300:
-                return True
-            logging.warning("membership remove failed: user_id=%s status=%s body=%s",
-                            user_id, r.status_code, r.text)
-            return False
-    except (httpx.ConnectError, httpx.TimeoutException, httpx.NetworkError) as e:
-        # Сетевые ошибки - логируем только предупреждение без полного traceback
-        logging.warning("membership remove connection error for user_id=%s: %s (service may be unavailable)", 
-                       user_id, str(e))
-        return False
+        event_id = await webhook_queue.enqueue(data)
     except Exception as e:
-        # Другие ошибки - логируем с полным traceback для отладки
-        logging.exception("membership remove unexpected error for user_id=%s: %s", user_id, e)
-        return False
+        logging.error(f"Error enqueueing YooKassa webhook: {e}")
+        return web.Response(status=500)
+    if event_id is None:
+        logging.info("YooKassa webhook duplicate: %s %s", obj.get("id"), obj.get("status"))
+    else:
+        logging.info("YooKassa webhook queued #%s: %s %s", event_id, obj.get("id"), obj.get("status"))
+    return web.Response(status=200)
 
 
 async def membership_enforcer_loop():
     """
-    Периодически проверяет пользователей с истёкшим доступом
-    (нет активного триала и нет активного оплаченного периода)
-    и аккуратно инициирует удаление из чата через membership-service.
-    Анти-спам: один и тот же user_id удаляем не чаще, чем раз в REMOVAL_COOLDOWN_HOURS.
+    Удаление из чата пользователей с истёкшим доступом — по сработавшим срокам
+    из Redis ZSET, а не обходом всех подписок (см. bot/utils/membership_enforcer.py).
     """
-    while not shutdown_event.is_set():
-        try:
-            # 1) Кандидаты: подписки со статусом 'active', у которых оплаченный период уже закончился
-            from bot.utils.billing_db import SessionLocal, Subscription
-            now_utc = datetime.now(ZoneInfo("UTC"))
-            user_ids: set[int] = set()
-            with SessionLocal() as s:
-                rows = (
-                    s.query(Subscription.user_id, Subscription.next_charge_at)
-                    .filter(Subscription.status == "active")
-                    .all()
-                )
-            for uid, next_at in rows:
-                # Если триал активен — не трогаем
-                try:
-                    if db.is_trial_active(uid):
-                        continue
-                except Exception:
-                    # если не смогли проверить триал — подстрахуемся дальнейшей строгой проверкой
-                    pass
-                # Строго: активный оплаченный период?
-                if _has_active_paid_period_strict(uid):
-                    continue  # всё ещё в оплаченной зоне
-                # next_at в прошлом → оплаченный период закончился (нормализуем к UTC-aware)
-                next_at_utc = _as_utc(next_at)
-                if next_at_utc is None or next_at_utc <= now_utc:
-                    user_ids.add(int(uid))
-            # 2) Попробуем удалить каждого кандидата с анти-спамом
-            for uid in user_ids:
-                if shutdown_event.is_set():
-                    break
-                if not _should_attempt_remove(uid):
-                    continue
-                ok = await _membership_remove_http(uid)
-                if ok:
-                    logging.info("membership_enforcer: removed user %s from chat", uid)
-                else:
-                    logging.warning("membership_enforcer: failed to remove user %s", uid)
-        except Exception:
-            logging.exception("membership_enforcer_loop error")
-        # Прерываемый sleep
-        try:
-            await asyncio.wait_for(shutdown_event.wait(), timeout=ENFORCER_INTERVAL_SEC)
-            break
-        except asyncio.TimeoutError:
-            continue
+    await membership_enforcer.run(shutdown_event)
+    logging.info("membership enforcer stats: %s", membership_enforcer.stats())
 
 
 async def main():
@@ -207,10 +113,28 @@ async def main():
     site = web.TCPSite(runner, "0.0.0.0", YOUMONEY_PORT)
     await site.start()
 
+    # Фоновая запись кликов/сообщений пачками (см. bot/utils/event_logger.py)
+    event_logger.start()
+
+    # Воркеры входящей очереди вебхуков YooKassa (см. bot/utils/webhook_queue.py)
+    async def _process_webhook(payload):
+        # уведомления об оплате — впереди сценарных уведомлений и рассылок
+        with send_priority(Priority.PAYMENT):
+            return await process_yookassa_webhook(bot, payload)
+
+    webhook_queue.start(_process_webhook)
+
+    # Общий пул соединений к executor'у (см. bot/utils/executor_client.py)
+    try:
+        await executor_client.start()
+    except Exception as e:
+        logging.warning(f"executor client start failed: {e}")
+
     async def mailing_loop():
         """
         Фоновый цикл рассылок.
-        Раз в 120 секунд проверяет «созревшие» записи и отправляет подписчикам.
+        Проверяет «созревшие» записи и отправляет подписчикам; спит до ближайшей
+        publish_at, но не дольше 120 секунд.
         """
         # Опционально: на старте «прожечь» всё, что просрочено
         try:
@@ -225,192 +149,18 @@ async def main():
                 # Любая ошибка внутри — логируем и продолжаем цикл
                 logging.exception("mailing_loop tick failed")
             
-            # Прерываемый sleep
             try:
-                await asyncio.wait_for(shutdown_event.wait(), timeout=120)
-                break
-            except asyncio.TimeoutError:
-                continue
+                delay = await next_mailing_delay(120)
+            except Exception:
+                logging.exception("mailing_loop next due lookup failed")
+                delay = 120
 
-async def billing_loop(shutdown_event_param=None):
-    """
-    Простой фоновый цикл рекуррентного биллинга.
-    Забирает «просроченные» подписки и создаёт платёж по сохранённому способу оплаты.
-    Поддерживает корректное завершение по сигналам (SIGTERM/SIGINT) для systemd.
-    """
-    # Используем переданный shutdown_event или глобальный
-    event = shutdown_event_param if shutdown_event_param is not None else shutdown_event
-    logging.info("billing_loop started")
-    while not event.is_set():
+            # Прерываемый sleep
             try:
-                # Используем МСК везде
-                now_msk_val = now_msk()
-                due = billing_db.subscriptions_due(now=now_msk_val, limit=100)
-                
-                # Проверяем shutdown_event перед началом обработки
-                if event.is_set():
-                    logging.info("billing_loop: shutdown signal received, exiting immediately")
-                    break
-                
-                for sub in due:
-                    # Частая проверка shutdown_event для быстрого завершения
-                    if event.is_set():
-                        logging.info("billing_loop: shutdown signal received during processing, breaking")
-                        break
-                    
-                    user_id = sub["user_id"]
-                    pm_id = sub["payment_method_id"]
-                    subscription_id = sub.get("id")
-                    # если токена нет (триал был без сохранённой карты) — пропускаем
-                    if not pm_id:
-                        # Это нормальная ситуация для trial без сохранённой карты - логируем только на debug
-                        logging.debug("Skip recurring: subscription %s for user %s has no payment_method_id", subscription_id, user_id)
-                        continue
-                    amount = sub["amount_value"]
-                    plan_code = sub["plan_code"]
-
-                    # Проверка на дубликаты: есть ли активная попытка с payment_id или недавно созданная попытка без payment_id
-                    # Это предотвращает создание нескольких платежей при race condition между созданием платежа и получением webhook
-                    try:
-                        from bot.utils.billing_db import SessionLocal, ChargeAttempt
-                        from bot.utils.time_helpers import to_utc_for_db
-                        from datetime import timedelta
-                        with SessionLocal() as s:
-                            # Проверяем попытки с payment_id (уже создан платёж)
-                            existing_attempt_with_payment = (
-                                s.query(ChargeAttempt)
-                                .filter(
-                                    ChargeAttempt.subscription_id == subscription_id,
-                                    ChargeAttempt.status == "created",
-                                    ChargeAttempt.payment_id.isnot(None)
-                                )
-                                .first()
-                            )
-                            if existing_attempt_with_payment:
-                                logging.warning(
-                                    "Skip recurring: active attempt with payment_id exists (sub=%s, user=%s, payment_id=%s, attempt_id=%s)", 
-                                    subscription_id, user_id, existing_attempt_with_payment.payment_id, existing_attempt_with_payment.id
-                                )
-                                continue
-                            
-                            # Проверяем недавно созданные попытки без payment_id (за последние 5 минут)
-                            # Это предотвращает создание нескольких платежей при race condition
-                            recent_threshold = now_msk_val - timedelta(minutes=5)
-                            recent_threshold_utc = to_utc_for_db(recent_threshold)
-                            recent_attempt = (
-                                s.query(ChargeAttempt)
-                                .filter(
-                                    ChargeAttempt.subscription_id == subscription_id,
-                                    ChargeAttempt.status == "created",
-                                    ChargeAttempt.payment_id.is_(None),
-                                    ChargeAttempt.attempted_at >= recent_threshold_utc
-                                )
-                                .first()
-                            )
-                            if recent_attempt:
-                                logging.warning(
-                                    "Skip recurring: recent attempt without payment_id exists (sub=%s, user=%s, attempt_id=%s, attempted_at=%s)", 
-                                    subscription_id, user_id, recent_attempt.id, recent_attempt.attempted_at
-                                )
-                                continue
-                    except Exception as e:
-                        logging.warning("Failed to check for duplicate attempts: %s", e)
-
-                    # Валидация payment_method_id перед созданием платежа
-                    if not pm_id or not isinstance(pm_id, str) or len(pm_id.strip()) == 0:
-                        logging.warning(
-                            "Invalid payment_method_id for subscription %s, user %s: %s",
-                            subscription_id, user_id, pm_id
-                        )
-                        continue
-                    
-                    # Второй щит + атомарная фиксация попытки (created)
-                    attempt_id = None
-                    try:
-                        attempt_id = billing_db.precharge_guard_and_attempt(
-                            subscription_id=subscription_id,
-                            now=now_msk_val,  # Передаём МСК
-                            user_id=user_id,
-                        )
-                        if not attempt_id:
-                            # Guard заблокировал - это нормально (лимиты ретраев, паузы и т.д.)
-                            # Логируем только на debug уровне, чтобы не засорять логи
-                            logging.debug("Skip recurring: guard blocked (sub=%s, user=%s)", subscription_id, user_id)
-                            continue
-                        
-                        # Создаём платёж с передачей attempt_id для обработки ошибок
-                        pay_id = youmoney.charge_saved_method(
-                            user_id=user_id,
-                            payment_method_id=pm_id,
-                            amount_rub=amount,
-                            description=f"Подписка {plan_code}",
-                            metadata={"is_recurring": "1", "plan_code": plan_code},
-                            subscription_id=subscription_id,
-                            record_attempt=False,
-                            attempt_id=attempt_id,  # Передаём для пометки как failed при ошибке
-                        )
-                        billing_db.link_payment_to_attempt(attempt_id=attempt_id, payment_id=pay_id)
-                        logging.info("Recurring charge created: %s (user=%s, sub=%s, attempt=%s)", 
-                                   pay_id, user_id, subscription_id, attempt_id)
-                    except ValueError as e:
-                        # Ошибки валидации - логируем и помечаем попытку
-                        logging.error(
-                            "Validation error creating recurring charge for user %s, subscription %s: %s",
-                            user_id, subscription_id, e
-                        )
-                        if attempt_id:
-                            try:
-                                from bot.utils.billing_db import SessionLocal, ChargeAttempt
-                                with SessionLocal() as s, s.begin():
-                                    attempt_rec = s.get(ChargeAttempt, attempt_id)
-                                    if attempt_rec:
-                                        attempt_rec.status = "failed"
-                                        s.flush()
-                            except Exception as mark_error:
-                                logging.warning("Failed to mark attempt %s as failed: %s", attempt_id, mark_error)
-                        continue
-                    except Exception as e:
-                        # Другие ошибки - логируем с полным контекстом
-                        logging.exception(
-                            "Failed to create recurring charge for user %s, subscription %s, attempt %s: %s",
-                            user_id, subscription_id, attempt_id, e
-                        )
-                        # Помечаем попытку как failed при ошибке (charge_saved_method уже должен был это сделать,
-                        # но делаем дополнительную проверку на всякий случай)
-                        if attempt_id:
-                            try:
-                                from bot.utils.billing_db import SessionLocal, ChargeAttempt
-                                with SessionLocal() as s, s.begin():
-                                    attempt_rec = s.get(ChargeAttempt, attempt_id)
-                                    if attempt_rec and attempt_rec.status == "created":
-                                        attempt_rec.status = "failed"
-                                        s.flush()
-                            except Exception as mark_error:
-                                logging.warning("Failed to mark attempt %s as failed: %s", attempt_id, mark_error)
-                        continue
-
-                    # перенос next_charge_at и продление — только по вебхуку
-            except Exception as e:
-                logging.exception("billing_loop error: %s", e)
-            
-            # Проверяем shutdown_event перед sleep
-            if event.is_set():
-                logging.info("billing_loop: shutdown signal received, exiting")
+                await asyncio.wait_for(shutdown_event.wait(), timeout=delay)
                 break
-            
-            # Прерываемый sleep с коротким таймаутом для быстрой реакции на сигналы
-            try:
-                # Используем короткий таймаут (5 секунд) для быстрой реакции на shutdown_event
-                await asyncio.wait_for(event.wait(), timeout=5.0)
-                # Если shutdown_event установлен, выходим немедленно
-                if event.is_set():
-                    logging.info("billing_loop: shutdown signal received during sleep, exiting")
-                    break
             except asyncio.TimeoutError:
-                # Таймаут истёк, продолжаем цикл
                 continue
-    
-    logging.info("billing_loop stopped")
 
     async def notification_loop():
         """
@@ -436,62 +186,69 @@ async def billing_loop(shutdown_event_param=None):
             except asyncio.TimeoutError:
                 continue
 
-    # ---Жёсткий стоп по сигналу---
-    def _hard_stop(signum, frame):
-        # максимально быстрый stop для systemd: устанавливаем shutdown_event и отменяем таски
+    main_tasks: list[asyncio.Task] = []
+    loop = asyncio.get_running_loop()
+
+    # ---Стоп по сигналу---
+    def _force_exit(reason: str):
+        # Жёсткий выход без ожидания cleanup — гарантирует моментальный рестарт
+        logging.warning("Принудительное завершение процесса: %s", reason)
+        try:
+            logging.shutdown()
+        except Exception:
+            pass
+        os._exit(0)
+
+    def _stop(signum):
+        # быстрый stop для systemd: останавливаем циклы и polling, а закрытие клиентов,
+        # очередей и пула БД выполняет finally ниже (не дольше SHUTDOWN_TIMEOUT_SEC)
         signal_name = "SIGTERM" if signum == signal.SIGTERM else "SIGINT"
-        logging.warning(f"Получен сигнал {signal_name} ({signum}), выполняю немедленную остановку...")
-        
+        if shutdown_event.is_set():
+            _force_exit(f"повторный сигнал {signal_name}")
+        logging.warning(f"Получен сигнал {signal_name} ({signum}), выполняю остановку...")
+
         # Устанавливаем shutdown_event - все циклы должны немедленно завершиться
         shutdown_event.set()
-        
+
+        # Дописываем буфер event_log (write-behind), пока процесс ещё жив
         try:
-            # Отменяем все задачи, кроме текущей
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                current_task = asyncio.current_task(loop)
-                for task in asyncio.all_tasks(loop):
-                    if task is not current_task and not task.done():
-                        task.cancel()
-                        logging.debug(f"Отменена задача: {task.get_name()}")
+            written = event_logger.flush_sync()
+            logging.info("event_log flushed on stop: %s events, stats=%s", written, event_logger.stats())
         except Exception as e:
-            logging.warning(f"Ошибка при отмене задач: {e}")
-        
-        # Даём немного времени на корректное завершение (но не ждём долго)
-        try:
-            # Небольшая задержка для завершения текущих операций в циклах
-            # но не более 2 секунд
-            time.sleep(0.5)  # 500ms на завершение текущих операций
-        except Exception:
-            pass
-        
+            logging.warning(f"Ошибка при сбросе event_log: {e}")
+
+        # Отменяем фоновые циклы и polling — main() переходит к finally
+        for task in main_tasks:
+            if not task.done():
+                task.cancel()
+                logging.debug(f"Отменена задача: {task.get_name()}")
+
+        # Страховка: если остановка зависла (БД/сеть), выходим по таймеру
+        watchdog = threading.Timer(SHUTDOWN_TIMEOUT_SEC + 1.0, _force_exit, args=("таймаут остановки",))
+        watchdog.daemon = True
+        watchdog.start()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
         try:
-            logging.shutdown()
-        except Exception:
-            pass
-        
-        # Жёсткий выход без ожидания сборки/cleanup — гарантирует моментальный рестарт
-        logging.warning("Принудительное завершение процесса")
-        os._exit(0)
+            loop.add_signal_handler(sig, _stop, sig)
+        except NotImplementedError:
+            # Windows: обработчик вызывается вне цикла — передаём в цикл
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(_stop, signum))
 
-    signal.signal(signal.SIGTERM, _hard_stop)
-    signal.signal(signal.SIGINT, _hard_stop)
-    
     try:
         logging.info("Бот запущен")
         # Запускаем задачи как отдельные таски, чтобы их можно было отменить мгновенно
-        billing_task = asyncio.create_task(billing_loop(shutdown_event), name="billing_loop")
-        mailing_task = asyncio.create_task(mailing_loop(), name="mailing_loop")
-        notification_task = asyncio.create_task(notification_loop(), name="notification_loop")
-        enforcer_task = asyncio.create_task(membership_enforcer_loop(), name="membership_enforcer_loop")
-        # Важно: отключаем встроенную обработку сигналов, чтобы не было «грейсфул» задержек
-        polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False), name="polling")
-
-        # ждём, пока любая из задач завершится с исключением или по отмене
-        done, pending = await asyncio.wait(
-            {billing_task, mailing_task, notification_task, enforcer_task, polling_task},
-            return_when=asyncio.FIRST_EXCEPTION,
-        )
+        main_tasks += [
+            asyncio.create_task(billing_loop(shutdown_event), name="billing_loop"),
+            asyncio.create_task(mailing_loop(), name="mailing_loop"),
+            asyncio.create_task(notification_loop(), name="notification_loop"),
+            asyncio.create_task(membership_enforcer_loop(), name="membership_enforcer_loop"),
+            # Важно: отключаем встроенную обработку сигналов — сигналы обрабатывает _stop
+            asyncio.create_task(dp.start_polling(bot, handle_signals=False), name="polling"),
+        ]
+
+        # ждём, пока любая из задач завершится с исключением или все — по отмене
+        done, pending = await asyncio.wait(main_tasks, return_when=asyncio.FIRST_EXCEPTION)
 
         for t in done:
             with suppress(asyncio.CancelledError):
@@ -501,6 +258,183 @@ async def billing_loop(shutdown_event_param=None):
                 
     except Exception as e:
         logging.error(f"Ошибка при запуске бота: {e}")
+    finally:
+        shutdown_event.set()
+        for task in main_tasks:
+            task.cancel()
+        await asyncio.gather(*main_tasks, return_exceptions=True)
+        try:
+            await asyncio.wait_for(_close_resources(runner), timeout=SHUTDOWN_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logging.warning("shutdown: resources not closed in %.0fs", SHUTDOWN_TIMEOUT_SEC)
+
+
+async def _close_resources(runner: web.AppRunner):
+    """Остановка HTTP-сервера и очереди вебхуков, закрытие клиентов и пула БД (при любом завершении main)."""
+    # сначала перестаём принимать вебхуки/колбэки, затем дорабатываем очередь
+    await runner.cleanup()
+    await webhook_queue.stop()
+    logging.info("webhook queue stats: %s", webhook_queue.stats())
+    logging.info("telegram shaper stats: %s", traffic_shaper.stats())
+    logging.info("telegram file_id cache stats: %s", asset_registry.stats())
+    logging.info("executor client stats: %s", executor_client.stats())
+    await executor_client.close()
+    logging.info("yookassa client stats: %s", yookassa_client.stats())
+    await yookassa_client.close()
+    await event_logger.stop()
+    # пул потоков БД — последним: закрытие клиентов выше ещё может писать в БД
+    async_db.shutdown()
+
+
+async def _charge_claimed(sub: dict) -> bool:
+    """
+    Одно рекуррентное списание по подписке, забранной claim_due_subscriptions
+    (попытка created уже записана в той же транзакции, что и аренда):
+    платёж через async-клиент YooKassa → привязка payment_id.
+    Возвращает True, если платёж создан.
+    """
+    user_id = sub["user_id"]
+    pm_id = sub["payment_method_id"]
+    subscription_id = sub["id"]
+    attempt_id = sub["attempt_id"]
+    plan_code = sub["plan_code"]
+    try:
+        # Idempotence-Key = attempt_id: повтор запроса не спишет дважды
+        pay_id = await youmoney.charge_saved_method_async(
+            user_id=user_id,
+            payment_method_id=pm_id,
+            amount_rub=sub["amount_value"],
+            description=f"Подписка {plan_code}",
+            metadata={"is_recurring": "1", "plan_code": plan_code},
+            subscription_id=subscription_id,
+            attempt_id=attempt_id,
+        )
+        await run_db(billing_db.link_payment_to_attempt, attempt_id=attempt_id, payment_id=pay_id)
+        logging.info("Recurring charge created: %s (user=%s, sub=%s, attempt=%s)", 
+                   pay_id, user_id, subscription_id, attempt_id)
+        # перенос next_charge_at и продление — только по вебхуку
+        return True
+    except ValueError as e:
+        # Ошибки валидации - логируем и помечаем попытку
+        logging.error(
+            "Validation error creating recurring charge for user %s, subscription %s: %s",
+            user_id, subscription_id, e
+        )
+        try:
+            await run_db(billing_db.mark_attempt_failed, attempt_id=attempt_id)
+        except Exception as mark_error:
+            logging.warning("Failed to mark attempt %s as failed: %s", attempt_id, mark_error)
+        return False
+    except Exception as e:
+        # Другие ошибки - логируем с полным контекстом
+        logging.exception(
+            "Failed to create recurring charge for user %s, subscription %s, attempt %s: %s",
+            user_id, subscription_id, attempt_id, e
+        )
+        # Помечаем попытку как failed (если вебхук ещё не проставил финальный статус)
+        try:
+            await run_db(billing_db.mark_attempt_failed, attempt_id=attempt_id, only_if_created=True)
+        except Exception as mark_error:
+            logging.warning("Failed to mark attempt %s as failed: %s", attempt_id, mark_error)
+        return False
+
+
+async def process_claimed_batch(
+    claimed: list[dict],
+    event: asyncio.Event,
+    *,
+    concurrency: int = BILLING_CONCURRENCY,
+) -> int:
+    """
+    Списывает забранные подписки, не более concurrency запросов к YooKassa одновременно.
+    После shutdown новые списания не начинаются: не начатые подписки возвращаются (release_claim),
+    уже начатые дорабатывают. Возвращает число созданных платежей.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def _one(sub: dict) -> bool:
+        async with sem:
+            if event.is_set():
+                await run_db(
+                    billing_db.release_claim,
+                    subscription_id=sub["id"],
+                    attempt_id=sub["attempt_id"],
+                    prev_last_attempt_at=sub.get("prev_last_attempt_at"),
+                )
+                return False
+            return await _charge_claimed(sub)
+
+    results = await asyncio.gather(*(_one(sub) for sub in claimed), return_exceptions=True)
+    for sub, res in zip(claimed, results):
+        if isinstance(res, BaseException):
+            logging.error("billing: unexpected error for subscription %s: %s", sub.get("id"), res)
+    return sum(1 for res in results if res is True)
+
+
+async def billing_loop(shutdown_event_param=None):
+    """
+    Фоновый цикл рекуррентного биллинга.
+    Спит до ближайшего срока списания (billing_scheduler), просыпается по событиям
+    подписок/вебхуков; раз в BILLING_SWEEP_SEC — сверка с БД как страховка.
+    Забирает подписки через claim_due_subscriptions (воркеров может быть несколько) и
+    создаёт платежи по сохранённому способу оплаты (до BILLING_CONCURRENCY параллельно).
+    Обращения к БД — через run_db (пул потоков): ожидание блокировок и медленный
+    round-trip к MySQL не останавливают polling Telegram.
+    Поддерживает корректное завершение по сигналам (SIGTERM/SIGINT) для systemd.
+    """
+    # Используем переданный shutdown_event или глобальный
+    event = shutdown_event_param if shutdown_event_param is not None else shutdown_event
+    billing_scheduler.start()
+    logging.info("billing_loop started")
+    try:
+        while not event.is_set():
+            try:
+                # Используем МСК везде
+                now_msk_val = now_msk()
+                sweep = billing_scheduler.sweep_due()
+                fired = billing_scheduler.pop_due()
+                
+                if sweep or fired:
+                    # Атомарно забираем пачку (аренда + попытки created)
+                    claimed = await run_db(
+                        billing_db.claim_due_subscriptions,
+                        now=now_msk_val,
+                        worker_id=BILLING_WORKER_ID,
+                        limit=BILLING_CLAIM_BATCH,
+                        lease_sec=BILLING_LEASE_SEC,
+                    )
+                    if claimed:
+                        t0 = time.perf_counter()
+                        created = await process_claimed_batch(claimed, event)
+                        logging.info(
+                            "billing_loop[%s]: %s claimed, %s charges created in %.2fs",
+                            BILLING_WORKER_ID, len(claimed), created, time.perf_counter() - t0,
+                        )
+                    if len(claimed) >= BILLING_CLAIM_BATCH:
+                        # пачка полная — за ней, вероятно, ещё: следующий проход без сна
+                        billing_scheduler.notify_nowait(None)
+                    elif sweep:
+                        # сверка: ближайшие сроки до следующей сверки (с запасом)
+                        horizon = timedelta(seconds=billing_scheduler.sweep_sec * 2)
+                        billing_scheduler.reload(
+                            await run_db(billing_db.next_due_times, until=now_msk() + horizon)
+                        )
+            except Exception as e:
+                logging.exception("billing_loop error: %s", e)
+                billing_scheduler.defer_sweep(BILLING_ERROR_RETRY_SEC)
+            
+            # Проверяем shutdown_event перед sleep
+            if event.is_set():
+                logging.info("billing_loop: shutdown signal received, exiting")
+                break
+            
+            # Сон до ближайшего срока / сверки / события; shutdown прерывает сразу
+            await billing_scheduler.wait(event)
+    finally:
+        billing_scheduler.stop()
+    
+    logging.info("billing_loop stopped")
+
 
 
 if __name__ == '__main__':
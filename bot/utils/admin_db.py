@@ -4,12 +4,18 @@
 from __future__ import annotations
 
 import json
+import logging
+import threading
+from bisect import bisect_right
 from typing import Optional, List, Tuple, Any, Dict
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import create_engine, String, Integer, Text, func
+from sqlalchemy import (
+    create_engine, String, Integer, BigInteger, DateTime, Text, Index, func, insert, inspect, update,
+    bindparam, column, table,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker, Session
 
 MSK = ZoneInfo("Europe/Moscow")
@@ -59,13 +65,21 @@ class Mailing(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     created_at: Mapped[str] = mapped_column(String(19))   # 'YYYY-MM-DD HH:MM:SS'
-    publish_at: Mapped[str] = mapped_column(String(16))   # 'YYYY-MM-DD HH:MM'
+    # UTC без tzinfo; наружу (get_*/create_*) — строкой МСК 'YYYY-MM-DD HH:MM'
+    publish_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
     mailing_on: Mapped[int] = mapped_column(Integer, default=0)        # 0/1
     mailing_completed: Mapped[int] = mapped_column(Integer, default=0) # 0/1
     content_type: Mapped[str] = mapped_column(String(32)) # text/photo/video/audio/animation/media_group
     caption: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     payload: Mapped[str] = mapped_column(Text)            # JSON с file_ids/text
 
+    __table_args__ = (
+        # «пора слать»: mailing_on=1 AND mailing_completed=0 AND publish_at <= now — диапазон по индексу
+        Index("idx_mailings_due", "mailing_on", "mailing_completed", "publish_at"),
+        # календарь и «последние опубликованные»
+        Index("idx_mailings_publish_at", "publish_at"),
+    )
+
 
 class NotificationMessage(Base):
     __tablename__ = "NotificationMessages"
@@ -80,17 +94,42 @@ class MailingEvent(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     mailing_post_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
     date: Mapped[str] = mapped_column(String(19), nullable=False)  # 'YYYY-MM-DD HH:MM:SS' (храним строкой для единообразия)
-    user_id: Mapped[int] = mapped_column(Integer, index=True, nullable=False)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True, nullable=False)  # id Telegram не влезают в INT
     user_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     success: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # 0/1
 
+    __table_args__ = (
+        # докачка рассылки: кто из получателей после курсора уже записан
+        Index("idx_mailing_events_post_user", "mailing_post_id", "user_id"),
+    )
+
+
+class MailingJob(Base):
+    """
+    Индивидуальная рассылка одной записи Mailings (bot/utils/broadcast_engine.py).
+    Получатели обходятся по возрастанию user_id; last_user_id — курсор: все получатели
+    с user_id <= last_user_id обработаны и записаны в mailing_events.
+    """
+    __tablename__ = "mailing_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    mailing_id: Mapped[int] = mapped_column(Integer, nullable=False, unique=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False, default="running")  # running/done
+    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    sent: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    failed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_user_id: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    started_at: Mapped[str] = mapped_column(String(19))                  # 'YYYY-MM-DD HH:MM:SS' (МСК)
+    updated_at: Mapped[str] = mapped_column(String(19))
+    finished_at: Mapped[Optional[str]] = mapped_column(String(19), nullable=True)
+
 
 # =========================
 #      Helper functions
 # =========================
-def _norm_publish_at(s: str) -> str:
+def _publish_at_utc(s: str) -> datetime:
     """
-    Нормализуем дату публикации к единому формату 'YYYY-MM-DD HH:MM'
+    Дата публикации из админки (МСК) → значение колонки publish_at (UTC без tzinfo).
     Поддерживаем входные форматы:
       - 'YYYY-MM-DD HH:MM'
       - 'YYYY-MM-DDTHH:MM'
@@ -99,21 +138,35 @@ def _norm_publish_at(s: str) -> str:
       - 'DD.MM.YYYY HH:MM'
     """
     s = (s or "").strip().replace("T", " ")
-    tried = [
-        "%Y-%m-%d %H:%M",
-        "%Y-%m-%d %H:%M:%S",
-        "%d.%m.%Y %H:%M",
-    ]
-    for fmt in tried:
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%d.%m.%Y %H:%M"):
         try:
             dt = datetime.strptime(s, fmt)
-            return dt.strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            pass
-    # last resort: отрезать до минут
-    if len(s) >= 16:
-        return s[:16]
-    return s
+        except ValueError:
+            continue
+        return dt.replace(second=0, tzinfo=MSK).astimezone(timezone.utc).replace(tzinfo=None)
+    raise ValueError(f"unsupported publish_at: {s!r}")
+
+
+def _publish_at_msk(dt: datetime) -> str:
+    """Значение колонки publish_at → 'YYYY-MM-DD HH:MM' по МСК (формат для хендлеров)."""
+    return dt.replace(tzinfo=timezone.utc).astimezone(MSK).strftime("%Y-%m-%d %H:%M")
+
+
+def _utc_naive(dt: datetime) -> datetime:
+    """Момент времени (aware или naive UTC) → UTC без tzinfo для сравнения с publish_at."""
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _msk_day_bound(s: str, *, end: bool) -> datetime:
+    """Граница диапазона календаря (МСК, 'YYYY-MM-DD' или с временем) → UTC; конец — исключительно."""
+    s = (s or "").strip().replace("T", " ")
+    if len(s) == 10:
+        d = datetime.strptime(s, "%Y-%m-%d") + timedelta(days=1 if end else 0)
+        return d.replace(tzinfo=MSK).astimezone(timezone.utc).replace(tzinfo=None)
+    dt = _publish_at_utc(s)
+    return dt + timedelta(minutes=1) if end else dt
 
 
 def _json_load(s: Optional[str]) -> Dict[str, Any]:
@@ -135,10 +188,90 @@ def _json_dump(obj: Dict[str, Any]) -> str:
 class AdminRepository:
     def __init__(self, session_factory: sessionmaker[Session]):
         self._sf = session_factory
+        # счётчики календаря: (from_utc, to_utc, only_pending) → {'YYYY-MM-DD': n}.
+        # Рассылки меняет только этот процесс (админка + mailing_loop), поэтому кэш локальный;
+        # сбрасывается при создании/переносе/удалении/завершении (_mailings_changed).
+        self._counts_cache: Dict[Tuple[datetime, datetime, bool], Dict[str, int]] = {}
+        self._counts_gen = 0
+        self._counts_lock = threading.Lock()
 
     # --- schema ---
-    def init_schema(self) -> None:
-        Base.metadata.create_all(bind=engine)
+    def init_schema(self, bind=None) -> None:
+        bind = bind or engine
+        Base.metadata.create_all(bind=bind)
+        with bind.begin() as conn:
+            insp = inspect(conn)
+            self._migrate_publish_at(conn, insp)
+            # mailing_events создавалась с INT user_id и без составного индекса
+            cols = {c["name"]: c for c in insp.get_columns("mailing_events")}
+            if conn.dialect.name == "mysql" and "BIGINT" not in str(cols["user_id"]["type"]).upper():
+                conn.exec_driver_sql("ALTER TABLE mailing_events MODIFY user_id BIGINT NOT NULL")
+            indexes = {ix["name"] for ix in insp.get_indexes("mailing_events")}
+            if "idx_mailing_events_post_user" not in indexes:
+                conn.exec_driver_sql(
+                    "CREATE INDEX idx_mailing_events_post_user ON mailing_events (mailing_post_id, user_id)"
+                )
+
+    @staticmethod
+    def _migrate_publish_at(conn, insp) -> None:
+        """
+        Mailings.publish_at был VARCHAR 'YYYY-MM-DD HH:MM' по МСК — сравнения строк и substr
+        не шли по индексу. Переводим в DATETIME (UTC): новая колонка, заполнение, замена старой.
+        DDL в MySQL коммитится сам по себе, поэтому каждый шаг проверяет, не сделан ли он
+        прошлым (прерванным) запуском, — миграция продолжается с места остановки.
+        """
+        cols = {c["name"]: c for c in insp.get_columns("Mailings")}
+        legacy = "publish_at" not in cols or "CHAR" in str(cols["publish_at"]["type"]).upper()
+        if legacy:
+            if "publish_at" in cols:
+                if "publish_at_utc" not in cols:
+                    conn.exec_driver_sql("ALTER TABLE Mailings ADD COLUMN publish_at_utc DATETIME NULL")
+                rows = conn.exec_driver_sql(
+                    "SELECT id, publish_at, created_at FROM Mailings WHERE publish_at_utc IS NULL"
+                ).all()
+                values = [{"mid": mid, "at": AdminRepository._legacy_publish_at(mid, raw, created)}
+                          for mid, raw, created in rows]
+                mailings = table("Mailings", column("id"), column("publish_at_utc", DateTime))
+                for i in range(0, len(values), 5000):
+                    conn.execute(
+                        mailings.update().where(mailings.c.id == bindparam("mid"))
+                        .values(publish_at_utc=bindparam("at")),
+                        values[i:i + 5000],
+                    )
+                conn.exec_driver_sql("ALTER TABLE Mailings DROP COLUMN publish_at")
+            # без publish_at — прошлый запуск остановился между DROP и RENAME
+            conn.exec_driver_sql("ALTER TABLE Mailings RENAME COLUMN publish_at_utc TO publish_at")
+            if conn.dialect.name == "mysql":
+                conn.exec_driver_sql("ALTER TABLE Mailings MODIFY publish_at DATETIME NOT NULL")
+            logging.info("[admin_db] Mailings.publish_at migrated to DATETIME (UTC)")
+        indexes = {ix["name"] for ix in inspect(conn).get_indexes("Mailings")}
+        if "idx_mailings_due" not in indexes:
+            conn.exec_driver_sql(
+                "CREATE INDEX idx_mailings_due ON Mailings (mailing_on, mailing_completed, publish_at)"
+            )
+        if "idx_mailings_publish_at" not in indexes:
+            conn.exec_driver_sql("CREATE INDEX idx_mailings_publish_at ON Mailings (publish_at)")
+
+    @staticmethod
+    def _legacy_publish_at(mid: int, raw: Any, created: Any) -> datetime:
+        """Строковая publish_at (МСК) → UTC; битая — время создания, битое и оно — текущее время."""
+        try:
+            return _publish_at_utc(raw)
+        except ValueError:
+            pass
+        try:
+            at = _publish_at_utc(str(created or ""))
+            logging.warning("[admin_db] Mailings id=%s: bad publish_at %r, using created_at", mid, raw)
+            return at
+        except ValueError:
+            logging.warning("[admin_db] Mailings id=%s: bad publish_at %r and created_at %r, using now",
+                            mid, raw, created)
+            return datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+
+    def _mailings_changed(self) -> None:
+        with self._counts_lock:
+            self._counts_gen += 1
+            self._counts_cache.clear()
 
     def _s(self) -> Session:
         return self._sf()
@@ -243,7 +376,7 @@ class AdminRepository:
         content_type: str,
         caption: Optional[str],
         payload: Dict[str, Any],
-        publish_at: str,   # 'YYYY-MM-DD HH:MM' (или ISO, нормализуем)
+        publish_at: str,   # 'YYYY-MM-DD HH:MM' по МСК (или ISO)
         mailing_on: bool = True,
     ) -> int:
         # метка создания в МСК
@@ -252,7 +385,7 @@ class AdminRepository:
         with self._s() as s, s.begin():
             m = Mailing(
                 created_at=now_iso,
-                publish_at=_norm_publish_at(publish_at),
+                publish_at=_publish_at_utc(publish_at),
                 mailing_on=1 if mailing_on else 0,
                 mailing_completed=0,
                 content_type=content_type,
@@ -261,17 +394,18 @@ class AdminRepository:
             )
             s.add(m)
             s.flush()
-            return m.id
+            mailing_id = m.id
+        self._mailings_changed()
+        return mailing_id
 
-    def get_pending_mailings(self) -> List[Dict[str, Any]]:
-        # сравниваем «пора слать» по МСК
-        now_iso = datetime.now(MSK).strftime("%Y-%m-%d %H:%M")
+    def get_pending_mailings(self, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        now_utc = _utc_naive(now or datetime.now(timezone.utc))
         with self._s() as s:
             rows = (
                 s.query(Mailing)
                 .filter(Mailing.mailing_on == 1)
                 .filter(Mailing.mailing_completed == 0)
-                .filter(Mailing.publish_at <= now_iso)
+                .filter(Mailing.publish_at <= now_utc)
                 .order_by(Mailing.publish_at.asc())
                 .all()
             )
@@ -279,32 +413,45 @@ class AdminRepository:
         for r in rows:
             out.append({
                 "id": r.id,
-                "publish_at": r.publish_at,
+                "publish_at": _publish_at_msk(r.publish_at),
                 "content_type": r.content_type,
                 "caption": r.caption,
                 "payload": _json_load(r.payload),
             })
         return out
 
+    def get_next_mailing_due(self, after: Optional[datetime] = None) -> Optional[datetime]:
+        """
+        Ближайшая publish_at среди ждущих отправки (aware UTC) или None — для сна mailing_loop.
+        after — только строго позже этого момента: просроченная рассылка (отправка упала
+        или ещё докачивается) не должна навсегда оставаться минимумом.
+        """
+        with self._s() as s:
+            q = (
+                s.query(func.min(Mailing.publish_at))
+                .filter(Mailing.mailing_on == 1)
+                .filter(Mailing.mailing_completed == 0)
+            )
+            if after is not None:
+                q = q.filter(Mailing.publish_at > _utc_naive(after))
+            at = q.scalar()
+        return at.replace(tzinfo=timezone.utc) if at else None
+
     def mark_mailing_completed(self, mailing_id: int) -> None:
         with self._s() as s, s.begin():
             m = s.get(Mailing, mailing_id)
             if m:
                 m.mailing_completed = 1
                 m.mailing_on = 0  # отключаем, чтобы не отправлялось повторно
+        self._mailings_changed()
 
     def get_last_publish_at(self) -> Optional[str]:
         """
-        Максимальная дата publish_at из Mailings (строкой) или None, если записей нет.
-        Формат в БД: 'YYYY-MM-DD HH:MM'
+        Максимальная дата publish_at из Mailings ('YYYY-MM-DD HH:MM' по МСК) или None, если записей нет.
         """
         with self._s() as s:
-            row = (
-                s.query(Mailing.publish_at)
-                .order_by(Mailing.publish_at.desc())
-                .first()
-            )
-            return row[0] if row else None
+            at = s.query(func.max(Mailing.publish_at)).scalar()
+            return _publish_at_msk(at) if at else None
 
     def get_scheduled_mailings(self, limit: int = 20, include_completed: bool = False) -> List[Dict[str, Any]]:
         with self._s() as s:
@@ -321,7 +468,7 @@ class AdminRepository:
             out.append({
                 "id": r.id,
                 "created_at": r.created_at,
-                "publish_at": r.publish_at,
+                "publish_at": _publish_at_msk(r.publish_at),
                 "mailing_on": r.mailing_on,
                 "mailing_completed": r.mailing_completed,
                 "content_type": r.content_type,
@@ -338,7 +485,7 @@ class AdminRepository:
             return {
                 "id": r.id,
                 "created_at": r.created_at,
-                "publish_at": r.publish_at,
+                "publish_at": _publish_at_msk(r.publish_at),
                 "mailing_on": r.mailing_on,
                 "mailing_completed": r.mailing_completed,
                 "content_type": r.content_type,
@@ -351,8 +498,9 @@ class AdminRepository:
             m = s.get(Mailing, mailing_id)
             if not m:
                 return False
-            m.publish_at = _norm_publish_at(publish_at)
-            return True
+            m.publish_at = _publish_at_utc(publish_at)
+        self._mailings_changed()
+        return True
 
     def update_mailing_payload(
         self,
@@ -403,7 +551,8 @@ class AdminRepository:
             if not m:
                 return False
             s.delete(m)
-            return True
+        self._mailings_changed()
+        return True
 
     # --- calendar / counts ---
     def get_mailing_counts_map(
@@ -413,38 +562,50 @@ class AdminRepository:
         only_pending: bool = True,
     ) -> Dict[str, int]:
         """
-        Вернёт словарь {'YYYY-MM-DD': count} по рассылкам в диапазоне дат (включительно).
+        Вернёт словарь {'YYYY-MM-DD': count} по рассылкам в диапазоне дат МСК (включительно).
         Аргументы можно передавать как 'YYYY-MM-DD' или 'YYYY-MM-DD HH:MM'.
         По умолчанию считаем только невыполненные и включённые (mailing_on=1, mailing_completed=0).
+        Выборка — диапазон по индексу publish_at, дни МСК считаются здесь; результат кэшируется
+        до ближайшего изменения рассылок.
         """
-        def _as_start_bound(s: str) -> str:
-            s = (s or "").strip().replace("T", " ")
-            # если пришла только дата — берём начало суток
-            if len(s) == 10:
-                return f"{s} 00:00"
-            return _norm_publish_at(s)
-
-        def _as_end_bound(s: str) -> str:
-            s = (s or "").strip().replace("T", " ")
-            # если пришла только дата — берём конец суток
-            if len(s) == 10:
-                return f"{s} 23:59"
-            return _norm_publish_at(s)
-
-        start_b = _as_start_bound(start_iso)
-        end_b = _as_end_bound(end_iso)
-
-        day_expr = func.substr(Mailing.publish_at, 1, 10)  # 'YYYY-MM-DD'
+        key = (_msk_day_bound(start_iso, end=False), _msk_day_bound(end_iso, end=True), bool(only_pending))
+        with self._counts_lock:
+            cached = self._counts_cache.get(key)
+            gen = self._counts_gen
+        if cached is not None:
+            return dict(cached)
+
+        # границы суток МСК в UTC: строки из диапазона индекса раскладываем по дням бинпоиском
+        starts: List[datetime] = []
+        labels: List[str] = []
+        day = datetime.strptime(_publish_at_msk(key[0])[:10], "%Y-%m-%d")
+        while True:
+            lo = max(_msk_day_bound(day.strftime("%Y-%m-%d"), end=False), key[0])
+            if lo >= key[1]:
+                break
+            starts.append(lo)
+            labels.append(day.strftime("%Y-%m-%d"))
+            day += timedelta(days=1)
+        counts: Dict[str, int] = {}
         with self._s() as s:
             q = (
-                s.query(day_expr.label("d"), func.count(Mailing.id).label("c"))
-                 .filter(Mailing.publish_at >= start_b)
-                 .filter(Mailing.publish_at <= end_b)
+                s.query(Mailing.publish_at)
+                 .filter(Mailing.publish_at >= key[0])
+                 .filter(Mailing.publish_at < key[1])
             )
             if only_pending:
                 q = q.filter(Mailing.mailing_on == 1).filter(Mailing.mailing_completed == 0)
-            rows = q.group_by(day_expr).all()
-        return {r.d: int(r.c) for r in rows}
+            for (at,) in q.all():
+                d = labels[bisect_right(starts, at) - 1]
+                counts[d] = counts.get(d, 0) + 1
+
+        with self._counts_lock:
+            # пока считали, рассылки могли измениться — такой результат не кэшируем
+            if gen == self._counts_gen:
+                if len(self._counts_cache) >= 64:
+                    self._counts_cache.clear()
+                self._counts_cache[key] = counts
+        return dict(counts)
 
     # --- notifications ---
     def get_notification_message(self, days_before: int) -> Optional[str]:
@@ -509,6 +670,86 @@ class AdminRepository:
             ))
 
 
+    # --- mailing jobs (индивидуальная рассылка с докачкой) ---
+    @staticmethod
+    def _job_dict(j: MailingJob) -> Dict[str, Any]:
+        return {
+            "id": j.id, "mailing_id": j.mailing_id, "status": j.status,
+            "total": j.total, "sent": j.sent, "failed": j.failed, "last_user_id": j.last_user_id,
+            "started_at": j.started_at, "updated_at": j.updated_at, "finished_at": j.finished_at,
+        }
+
+    def mailing_job_start(self, mailing_id: int, total: int) -> Dict[str, Any]:
+        """Задание рассылки: новое или существующее (докачка после рестарта). total обновляется."""
+        now_iso = datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S")
+        with self._s() as s, s.begin():
+            j = s.query(MailingJob).filter(MailingJob.mailing_id == mailing_id).one_or_none()
+            if j is None:
+                j = MailingJob(mailing_id=mailing_id, status="running", total=int(total),
+                               started_at=now_iso, updated_at=now_iso)
+                s.add(j)
+                s.flush()
+            elif j.status != "done":
+                j.total = int(total)
+                j.updated_at = now_iso
+            return self._job_dict(j)
+
+    def mailing_job_logged_users(self, mailing_id: int, after_user_id: int) -> set[int]:
+        """Получатели после курсора, по которым уже есть запись (успели записать до остановки)."""
+        with self._s() as s:
+            rows = (
+                s.query(MailingEvent.user_id)
+                .filter(MailingEvent.mailing_post_id == mailing_id, MailingEvent.user_id > after_user_id)
+                .all()
+            )
+        return {int(uid) for (uid,) in rows}
+
+    def mailing_job_flush(self, job_id: int, mailing_id: int,
+                          results: List[Tuple[int, bool]], last_user_id: int) -> None:
+        """
+        Пачка результатов одной транзакцией: multi-row INSERT в mailing_events,
+        счётчики задания и курсор (движок сбрасывает пачки по очереди, курсор только растёт).
+        """
+        now_iso = datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S")
+        ok = sum(1 for _, success in results if success)
+        with self._s() as s, s.begin():
+            if results:
+                s.execute(insert(MailingEvent), [
+                    {"mailing_post_id": mailing_id, "date": now_iso, "user_id": int(uid),
+                     "user_name": None, "success": 1 if success else 0}
+                    for uid, success in results
+                ])
+            s.execute(
+                update(MailingJob)
+                .where(MailingJob.id == job_id)
+                .values(
+                    sent=MailingJob.sent + ok,
+                    failed=MailingJob.failed + (len(results) - ok),
+                    last_user_id=int(last_user_id),
+                    updated_at=now_iso,
+                )
+            )
+
+    def mailing_job_finish(self, job_id: int, total: Optional[int] = None) -> None:
+        """Задание завершено; total — фактическое число получателей (при потоковой выборке заранее не известно)."""
+        now_iso = datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S")
+        values: Dict[str, Any] = {"status": "done", "finished_at": now_iso, "updated_at": now_iso}
+        if total is not None:
+            values["total"] = int(total)
+        with self._s() as s, s.begin():
+            s.execute(update(MailingJob).where(MailingJob.id == job_id).values(**values))
+
+    def get_mailing_job(self, mailing_id: int) -> Optional[Dict[str, Any]]:
+        with self._s() as s:
+            j = s.query(MailingJob).filter(MailingJob.mailing_id == mailing_id).one_or_none()
+            return self._job_dict(j) if j else None
+
+    def list_mailing_jobs(self, limit: int = 10) -> List[Dict[str, Any]]:
+        with self._s() as s:
+            rows = s.query(MailingJob).order_by(MailingJob.id.desc()).limit(int(limit)).all()
+            return [self._job_dict(j) for j in rows]
+
+
 # Глобальный репозиторий + совместимые функции
 _repo = AdminRepository(SessionLocal)
 _repo.init_schema()
@@ -574,8 +815,12 @@ def create_scheduled_mailing(
     )
 
 
-def get_pending_mailings() -> List[Dict[str, Any]]:
-    return _repo.get_pending_mailings()
+def get_pending_mailings(now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    return _repo.get_pending_mailings(now)
+
+
+def get_next_mailing_due(after: Optional[datetime] = None) -> Optional[datetime]:
+    return _repo.get_next_mailing_due(after)
 
 
 def mark_mailing_completed(mailing_id: int) -> None:
@@ -659,19 +904,16 @@ def get_mailing_counts_map(start_iso: str, end_iso: str, only_pending: bool = Tr
 
 def get_last_3_published_mailings(before_dt: datetime) -> List[dict]:
     """
-    Возвращает до ТРЁХ последних постов с publish_at <= before_dt (МСК).
+    Возвращает до ТРЁХ последних постов с publish_at <= before_dt (aware или naive UTC).
     Маркеры (mailing_on / mailing_completed) НЕ учитываем.
     Отсортированы по publish_at DESC, лимит 3.
     """
-    # Приводим момент времени к МСК и формату 'YYYY-MM-DD HH:MM' (в БД publish_at — строка)
-    if before_dt.tzinfo is None:
-        before_dt = before_dt.replace(tzinfo=timezone.utc)
-    msk_iso = before_dt.astimezone(MSK).strftime("%Y-%m-%d %H:%M")
+    before_utc = _utc_naive(before_dt)
 
     with _session() as s:
         rows = (
             s.query(Mailing)
-             .filter(Mailing.publish_at <= msk_iso)      # только прошедшие по времени
+             .filter(Mailing.publish_at <= before_utc)   # только прошедшие по времени
              .order_by(Mailing.publish_at.desc())
              .limit(3)
              .all()
@@ -680,7 +922,7 @@ def get_last_3_published_mailings(before_dt: datetime) -> List[dict]:
         for r in rows:
             out.append({
                 "id": r.id,
-                "publish_at": r.publish_at,
+                "publish_at": _publish_at_msk(r.publish_at),
                 "content_type": r.content_type,
                 "caption": r.caption,
                 "payload": _json_load(r.payload),
@@ -690,20 +932,16 @@ def get_last_3_published_mailings(before_dt: datetime) -> List[dict]:
 
 def get_last_published_mailing(before_dt: datetime) -> dict | None:
     """
-    Возвращает ОДНУ запись с publish_at <= before_dt (МСК) — самую «свежую» по времени.
+    Возвращает ОДНУ запись с publish_at <= before_dt — самую «свежую» по времени.
     Маркеры (mailing_on / mailing_completed) НЕ учитываем.
-    ВАЖНО: publish_at хранится строкой 'YYYY-MM-DD HH:MM' в МСК — сравнение по строке.
+    before_dt — aware или naive UTC.
     """
-    # Приводим момент времени к МСК и формату 'YYYY-MM-DD HH:MM', чтобы сравнение строк было корректным
-    if before_dt.tzinfo is None:
-        before_dt = before_dt.replace(tzinfo=timezone.utc)
-    
-    msk_iso = before_dt.astimezone(MSK).strftime("%Y-%m-%d %H:%M")
-    
+    before_utc = _utc_naive(before_dt)
+
     with _session() as s:
         row = (
             s.query(Mailing)
-             .filter(Mailing.publish_at <= msk_iso)       # только прошедшие по времени
+             .filter(Mailing.publish_at <= before_utc)    # только прошедшие по времени
              .order_by(Mailing.publish_at.desc())
              .first()
         )
@@ -721,3 +959,27 @@ def add_mailing_event(*, mailing_post_id: int, at_dt: datetime, user_id: int,
                       user_name: Optional[str], success: bool) -> None:
     _repo.add_mailing_event(mailing_post_id=mailing_post_id, at_dt=at_dt,
                             user_id=user_id, user_name=user_name, success=success)
+
+
+def mailing_job_start(mailing_id: int, total: int) -> Dict[str, Any]:
+    return _repo.mailing_job_start(mailing_id, total)
+
+
+def mailing_job_logged_users(mailing_id: int, after_user_id: int) -> set[int]:
+    return _repo.mailing_job_logged_users(mailing_id, after_user_id)
+
+
+def mailing_job_flush(job_id: int, mailing_id: int, results: List[Tuple[int, bool]], last_user_id: int) -> None:
+    _repo.mailing_job_flush(job_id, mailing_id, results, last_user_id)
+
+
+def mailing_job_finish(job_id: int, total: Optional[int] = None) -> None:
+    _repo.mailing_job_finish(job_id, total)
+
+
+def get_mailing_job(mailing_id: int) -> Optional[Dict[str, Any]]:
+    return _repo.get_mailing_job(mailing_id)
+
+
+def list_mailing_jobs(limit: int = 10) -> List[Dict[str, Any]]:
+    return _repo.list_mailing_jobs(limit)
@@ -0,0 +1,107 @@
+# smart_agent/bot/utils/async_db.py
+"""
+Асинхронный фасад над синхронными репозиториями (app_db / billing_db / admin_db).
+
+Репозитории работают на синхронном SQLAlchemy (pymysql), и прямой вызов из
+хендлера блокирует event loop на время round-trip'а к MySQL. Здесь все вызовы
+уводятся в ОГРАНИЧЕННЫЙ пул потоков: размер пула не превышает пул соединений
+движка, поэтому очередь за коннектом образуется в пуле потоков, а не внутри
+SQLAlchemy (где поток висел бы с таймаутом).
+
+Использование — те же имена функций, что и у синхронных модулей:
+
+    from bot.utils import async_db
+    await async_db.app.event_add(user_id, "TEXT:...")
+    await async_db.billing.subscription_upsert(...)
+
+либо точечно для уже импортированного модуля (удобно для patch() в тестах):
+
+    await async_db.run_db(app_db.event_add, user_id, "TEXT:...")
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Any, Callable, Optional, TypeVar
+
+LOG = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Дефолтный QueuePool SQLAlchemy: pool_size=5 + max_overflow=10.
+# Держим пул потоков чуть меньше, чтобы не упираться в pool timeout.
+DB_EXECUTOR_THREADS = int(os.getenv("DB_EXECUTOR_THREADS", "8"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=max(1, DB_EXECUTOR_THREADS),
+            thread_name_prefix="db",
+        )
+    return _executor
+
+
+async def run_db(fn: Callable[..., T], /, *args: Any, **kwargs: Any) -> T:
+    """
+    Выполняет синхронную функцию БД в пуле потоков и возвращает её результат.
+    Исключения пробрасываются как есть.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+class _AsyncModule:
+    """
+    Прокси над модулем-фасадом: module.func(...) → await proxy.func(...).
+    Атрибут резолвится в момент вызова, поэтому patch() исходного модуля
+    продолжает работать.
+    """
+
+    def __init__(self, module: ModuleType):
+        self._module = module
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        attr = getattr(self._module, name)
+        if not callable(attr):
+            return attr
+
+        async def _call(*args: Any, **kwargs: Any) -> Any:
+            return await run_db(getattr(self._module, name), *args, **kwargs)
+
+        _call.__name__ = name
+        return _call
+
+
+def shutdown(wait: bool = True) -> None:
+    """Останавливает пул потоков (вызывать при остановке бота)."""
+    global _executor
+    ex, _executor = _executor, None
+    if ex is not None:
+        try:
+            ex.shutdown(wait=wait, cancel_futures=not wait)
+        except Exception as e:
+            LOG.warning("async_db shutdown failed: %s", e)
+
+
+def __getattr__(name: str) -> _AsyncModule:
+    # Ленивая загрузка: импорт app_db/billing_db/admin_db тянет init_schema(),
+    # поэтому не делаем это при импорте самого фасада.
+    if name == "app":
+        import bot.utils.database as _m
+    elif name == "billing":
+        import bot.utils.billing_db as _m
+    elif name == "admin":
+        import bot.utils.admin_db as _m
+    else:
+        raise AttributeError(name)
+    proxy = _AsyncModule(_m)
+    globals()[name] = proxy
+    return proxy
@@ -6,16 +6,23 @@ from typing import Optional, Any, List, Dict
 from datetime import datetime, timedelta
 
 from sqlalchemy import (
-    create_engine, text, inspect,
-    String, Integer, BigInteger, ForeignKey, DateTime, Text,
-    or_, select
+    create_engine, text, inspect, func,
+    String, Integer, BigInteger, ForeignKey, DateTime, Text, Index,
+    or_, select, case, update, delete
 )
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from sqlalchemy.orm import (
     DeclarativeBase, Mapped, mapped_column, sessionmaker, Session
 )
 
 from bot.config import DB_URL  # <— общий DSN для биллинга
 from bot.utils.redis_repo import _redis as _redis_client  # используем уже настроенный Redis из проекта
+from bot.utils.redis_repo import (
+    invalidate_access_cache_nowait, schedule_membership_expiry_nowait, schedule_notification_nowait,
+)
+from bot.utils.billing_scheduler import notify_nowait as notify_billing_nowait
 from bot.utils.time_helpers import (
     now_msk, to_aware_msk, to_utc_for_db, from_db_naive
 )
@@ -43,6 +50,30 @@ engine = _make_engine()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
 
 
+class _trunc_seconds(FunctionElement):
+    """
+    DATETIME, обрезанный до секунд. В MySQL DATETIME (без fsp) дробной части нет —
+    колонка как есть (индекс остаётся применим); SQLite хранит микросекунды в строке.
+    """
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(_trunc_seconds)
+def _trunc_seconds_default(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(_trunc_seconds, "sqlite")
+def _trunc_seconds_sqlite(element, compiler, **kw):
+    return "datetime(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(_trunc_seconds, "postgresql")
+def _trunc_seconds_pg(element, compiler, **kw):
+    return "date_trunc('second', %s)" % compiler.process(element.clauses, **kw)
+
+
 # =========================
 #          Models
 # =========================
@@ -72,12 +103,16 @@ class Subscription(Base):
     # троттлинг уведомлений:
     last_fail_notice_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     cancel_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # аренда воркером биллинга (claim_due_subscriptions): кто и до какого момента списывает
+    claimed_by: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    claimed_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_msk, nullable=False)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_msk, nullable=False)
 
     __table_args__ = (
         # быстрые выборки по дью и статусам
+        Index("idx_sub_status_next", "status", "next_charge_at"),
         {'sqlite_autoincrement': True},
     )
 
@@ -120,7 +155,9 @@ class ChargeAttempt(Base):
     due_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     attempted_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_msk, nullable=False)
     __table_args__ = (
-        # для быстрых окон по попыткам
+        # для быстрых окон по попыткам (покрывающие для subscriptions_due)
+        Index("idx_attempt_sub_time", "subscription_id", "attempted_at"),
+        Index("idx_attempt_sub_due_status", "subscription_id", "due_at", "status"),
         {},
     )
 
@@ -144,6 +181,39 @@ class PaymentLog(Base):
     processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
 
+class WebhookEvent(Base):
+    """
+    Входящая очередь webhook-событий YooKassa (outbox): хендлер /payment только
+    пишет сырое событие и отвечает 200, обработку делают воркеры (bot/utils/webhook_queue.py).
+    state: pending -> processing -> done | dead (исчерпаны попытки / событие некорректно).
+    """
+    __tablename__ = "webhook_inbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # повтор доставки того же события (payment_id:status:event) — не вторая строка
+    dedup_key: Mapped[str] = mapped_column(String(160), unique=True, nullable=False)
+    payment_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    event: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    status: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    payload_json: Mapped[str] = mapped_column(Text, nullable=False)
+
+    state: Mapped[str] = mapped_column(String(16), nullable=False, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    locked_by: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    locked_until: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (
+        # выборка готовых к обработке и «первое незавершённое событие платежа»
+        Index("idx_wh_state_next", "state", "next_attempt_at"),
+        Index("idx_wh_payment_state", "payment_id", "state", "id"),
+        {},
+    )
+
+
 # =========================
 #       Repository
 # =========================
@@ -169,6 +239,10 @@ def init_schema() -> None:
             conn.exec_driver_sql(f"ALTER TABLE subscriptions ADD COLUMN consecutive_failures {int_type} NOT NULL {default_expr}")
         if "last_fail_notice_at" not in subs_cols:
             conn.exec_driver_sql(f"ALTER TABLE subscriptions ADD COLUMN last_fail_notice_at {dt_type} NULL")
+        if "claimed_by" not in subs_cols:
+            conn.exec_driver_sql("ALTER TABLE subscriptions ADD COLUMN claimed_by VARCHAR(64) NULL")
+        if "claimed_until" not in subs_cols:
+            conn.exec_driver_sql(f"ALTER TABLE subscriptions ADD COLUMN claimed_until {dt_type} NULL")
 
         # ---- subscriptions: индексы ----
         subs_indexes = {ix["name"] for ix in insp.get_indexes("subscriptions")}
@@ -188,6 +262,66 @@ def init_schema() -> None:
         # Индекс по (subscription_id, due_at) для быстрых подсчётов попыток "в рамках одного платежа"
         if "idx_attempt_sub_due" not in attempts_indexes:
             conn.exec_driver_sql("CREATE INDEX idx_attempt_sub_due ON charge_attempts (subscription_id, due_at)")
+        # Покрывающий индекс для подсчёта неуспешных попыток цикла в subscriptions_due
+        if "idx_attempt_sub_due_status" not in attempts_indexes:
+            conn.exec_driver_sql(
+                "CREATE INDEX idx_attempt_sub_due_status ON charge_attempts (subscription_id, due_at, status)"
+            )
+
+
+def _due_criteria(now_utc: datetime) -> list:
+    """
+    Условия «подписку пора списывать» (now_utc — naive UTC, как в БД).
+    Общие для subscriptions_due и claim_due_subscriptions.
+    """
+    # Политика ретраев авто-списаний:
+    # 1) Не чаще 2-х попыток в сутки (окно 24h).
+    # 2) Минимальный интервал между попытками — 12 часов.
+    # 3) Максимум 6 НЕуспешных попыток В РАМКАХ ОДНОГО ПЛАТЕЖНОГО ЦИКЛА
+    #    (т.е. для той же пары subscription_id + due_at = next_charge_at),
+    #    считаются только status IN ('canceled','expired').
+    since_24h_utc = now_utc - timedelta(hours=24)
+    since_12h_utc = now_utc - timedelta(hours=12)
+
+    ca = ChargeAttempt.__table__
+    sub_id = Subscription.__table__.c.id
+    attempts_24h = (
+        select(func.count())
+        .select_from(ca)
+        .where(ca.c.subscription_id == sub_id, ca.c.attempted_at >= since_24h_utc)
+        .scalar_subquery()
+    )
+    attempted_12h = (
+        select(ca.c.id)
+        .where(ca.c.subscription_id == sub_id, ca.c.attempted_at >= since_12h_utc)
+        .exists()
+    )
+    # due_at пишется с точностью до секунды — сравниваем с next_charge_at, обрезанным до секунд
+    failed_in_cycle = (
+        select(func.count())
+        .select_from(ca)
+        .where(
+            ca.c.subscription_id == sub_id,
+            _trunc_seconds(ca.c.due_at) == _trunc_seconds(Subscription.next_charge_at),
+            ca.c.status.in_(("canceled", "expired")),
+        )
+        .scalar_subquery()
+    )
+    return [
+        Subscription.status == "active",
+        Subscription.next_charge_at != None,                     # noqa: E711
+        Subscription.next_charge_at <= now_utc,  # Сравниваем с UTC (БД хранит в UTC)
+        Subscription.payment_method_id != None,                  # noqa: E711
+        # Быстрые проверки на самой подписке — второй щит
+        or_(Subscription.consecutive_failures == None,           # noqa: E711
+            Subscription.consecutive_failures < 6),
+        or_(Subscription.last_attempt_at == None,                # noqa: E711
+            Subscription.last_attempt_at <= since_12h_utc),
+        # Лимиты по окнам + лимит 6 фейлов В ТЕКУЩЕМ ЦИКЛЕ
+        ~attempted_12h,
+        attempts_24h < 2,
+        failed_in_cycle < 6,
+    ]
 
 
 class BillingRepository:
@@ -314,6 +448,248 @@ class BillingRepository:
                 import logging
                 logging.warning("ChargeAttempt with id=%s not found when linking payment_id=%s", attempt_id, payment_id)
 
+    def claim_due_subscriptions(
+        self,
+        *,
+        now: datetime,
+        worker_id: str,
+        limit: int = 100,
+        lease_sec: int = 300,
+    ) -> List[Dict[str, Any]]:
+        """
+        Забирает пачку подписок к списанию для одного воркера биллинга.
+        now должен быть в МСК.
+
+        В одной транзакции:
+          1) выбрать подходящие подписки (те же правила, что subscriptions_due, плюс
+             «нет открытой попытки» и «не арендована другим воркером»)
+             с FOR UPDATE OF subscriptions SKIP LOCKED — строки, которые сейчас
+             забирает другой воркер, пропускаются без ожидания;
+          2) условным UPDATE поставить аренду claimed_by/claimed_until и last_attempt_at
+             (на SQLite FOR UPDATE нет — гонку решает этот UPDATE по rowcount);
+          3) записать ChargeAttempt(status='created') — как precharge_guard_and_attempt.
+
+        Возвращает словари подписок (как subscriptions_due) с attempt_id и
+        prev_last_attempt_at (для release_claim). Пустой список, если БД занята.
+        """
+        from bot.config import TIMEZONE
+        now = to_aware_msk(now) if now.tzinfo is None else now.astimezone(TIMEZONE)
+        now_utc = to_utc_for_db(now)
+        since_12h_utc = now_utc - timedelta(hours=12)
+        lease_until_utc = to_utc_for_db(now + timedelta(seconds=int(lease_sec)))
+
+        ca = ChargeAttempt.__table__
+        # Открытая попытка: платёж создан и ждёт вебхука, или попытка только что записана
+        open_attempt = (
+            select(ca.c.id)
+            .where(
+                ca.c.subscription_id == Subscription.__table__.c.id,
+                ca.c.status == "created",
+                or_(ca.c.payment_id != None,                             # noqa: E711
+                    ca.c.attempted_at >= now_utc - timedelta(minutes=5)),
+            )
+            .exists()
+        )
+        lease_free = or_(Subscription.claimed_until == None,             # noqa: E711
+                         Subscription.claimed_until < now_utc)
+
+        claimed: List[Dict[str, Any]] = []
+        try:
+            with self._session() as s, s.begin():
+                rows = (
+                    s.query(Subscription)
+                    .filter(*_due_criteria(now_utc), lease_free, ~open_attempt)
+                    .order_by(Subscription.next_charge_at.asc(), Subscription.id.asc())
+                    .limit(int(limit))
+                    .with_for_update(skip_locked=True, of=Subscription)
+                    .all()
+                )
+                for rec in rows:
+                    prev_last_attempt_at = rec.last_attempt_at
+                    won = s.execute(
+                        update(Subscription)
+                        .where(
+                            Subscription.id == rec.id,
+                            lease_free,
+                            or_(Subscription.last_attempt_at == None,    # noqa: E711
+                                Subscription.last_attempt_at <= since_12h_utc),
+                        )
+                        .values(
+                            claimed_by=worker_id,
+                            claimed_until=lease_until_utc,
+                            last_attempt_at=now_utc,
+                            updated_at=now_utc,
+                        )
+                        .execution_options(synchronize_session=False)
+                    ).rowcount == 1
+                    if not won:
+                        continue
+                    # якорь цикла — как в precharge_guard_and_attempt
+                    existing_attempt = (
+                        s.query(ChargeAttempt)
+                        .filter(ChargeAttempt.subscription_id == rec.id, ChargeAttempt.status == "created")
+                        .order_by(ChargeAttempt.attempted_at.desc())
+                        .first()
+                    )
+                    if existing_attempt and existing_attempt.due_at:
+                        due_at_utc = existing_attempt.due_at
+                    else:
+                        due_at_utc = rec.next_charge_at.replace(microsecond=0) if rec.next_charge_at else None
+                    attempt = ChargeAttempt(
+                        subscription_id=rec.id,
+                        user_id=rec.user_id,
+                        payment_id=None,
+                        status="created",
+                        attempted_at=now_utc,
+                        due_at=due_at_utc,
+                    )
+                    s.add(attempt)
+                    s.flush()
+                    claimed.append({
+                        "id": rec.id,
+                        "user_id": rec.user_id,
+                        "plan_code": rec.plan_code,
+                        "interval_months": rec.interval_months,
+                        "amount_value": rec.amount_value,
+                        "amount_currency": rec.amount_currency,
+                        "payment_method_id": rec.payment_method_id,
+                        "consecutive_failures": rec.consecutive_failures,
+                        "attempt_id": attempt.id,
+                        "prev_last_attempt_at": prev_last_attempt_at,
+                    })
+        except OperationalError as e:
+            # lock wait timeout / deadlock / SQLite busy — заберём на следующем тике
+            import logging
+            logging.getLogger(__name__).warning("claim_due_subscriptions(%s) failed, will retry: %s", worker_id, e)
+            return []
+        return claimed
+
+    def next_due_times(self, *, until: datetime, limit: int = 5000) -> List[tuple]:
+        """
+        Для billing_scheduler: [(subscription_id, когда её можно списывать)] на горизонте until.
+        Момент = max(next_charge_at, last_attempt_at + 12ч, claimed_until), aware МСК.
+        Окно 2/24ч и лимит фейлов цикла не учитываются — их проверит claim
+        (в худшем случае лишний claim раз в сверку).
+        """
+        until_msk = to_aware_msk(until) if until.tzinfo is None else until
+        with self._session() as s:
+            rows = (
+                s.query(Subscription.id, Subscription.next_charge_at,
+                        Subscription.last_attempt_at, Subscription.claimed_until)
+                .filter(
+                    Subscription.status == "active",
+                    Subscription.payment_method_id != None,              # noqa: E711
+                    Subscription.next_charge_at != None,                 # noqa: E711
+                    Subscription.next_charge_at <= to_utc_for_db(until_msk),
+                    or_(Subscription.consecutive_failures == None,       # noqa: E711
+                        Subscription.consecutive_failures < 6),
+                )
+                .order_by(Subscription.next_charge_at.asc())
+                .limit(int(limit))
+                .all()
+            )
+        out = []
+        for sub_id, next_charge_at, last_attempt_at, claimed_until in rows:
+            candidates = [from_db_naive(next_charge_at)]
+            if last_attempt_at is not None:
+                candidates.append(from_db_naive(last_attempt_at) + timedelta(hours=12))
+            if claimed_until is not None:
+                candidates.append(from_db_naive(claimed_until))
+            at = max(candidates)
+            if at <= until_msk:
+                out.append((sub_id, at))
+        return out
+
+    def release_claim(self, *, subscription_id: int, attempt_id: int, prev_last_attempt_at: Optional[datetime]) -> None:
+        """
+        Возвращает забранную, но не начатую подписку (остановка воркера до запроса к YooKassa):
+        удаляет попытку без платежа и откатывает last_attempt_at и аренду.
+        """
+        with self._session() as s, s.begin():
+            deleted = s.execute(
+                delete(ChargeAttempt).where(
+                    ChargeAttempt.id == attempt_id,
+                    ChargeAttempt.status == "created",
+                    ChargeAttempt.payment_id == None,                    # noqa: E711
+                )
+            ).rowcount
+            if deleted:
+                s.execute(
+                    update(Subscription)
+                    .where(Subscription.id == subscription_id)
+                    .values(last_attempt_at=prev_last_attempt_at, claimed_by=None, claimed_until=None)
+                    .execution_options(synchronize_session=False)
+                )
+
+    def mark_attempt_failed(self, *, attempt_id: int, only_if_created: bool = False) -> None:
+        """Помечает попытку как failed (платёж не создан). only_if_created — не трогать финальные статусы."""
+        with self._session() as s, s.begin():
+            rec = s.get(ChargeAttempt, attempt_id)
+            if rec and (not only_if_created or rec.status == "created"):
+                rec.status = "failed"
+
+    def membership_paid_until_map(self, user_ids: Optional[List[int]] = None) -> Dict[int, datetime]:
+        """
+        {user_id: конец оплаченного периода (МСК)} — max(next_charge_at) по подпискам 'active'.
+        Пользователи без активной подписки в ответ не попадают.
+        user_ids=None — все (сверка membership enforcer'а), иначе пачка одним запросом на 1000 id.
+        """
+        def _query(s: Session, ids: Optional[List[int]]):
+            q = (
+                s.query(Subscription.user_id, func.max(Subscription.next_charge_at))
+                .filter(Subscription.status == "active")
+            )
+            if ids is not None:
+                q = q.filter(Subscription.user_id.in_(ids))
+            return q.group_by(Subscription.user_id).all()
+
+        out: Dict[int, datetime] = {}
+        with self._session() as s:
+            if user_ids is None:
+                chunks = [None]
+            else:
+                ids = list({int(u) for u in user_ids})
+                chunks = [ids[i:i + 1000] for i in range(0, len(ids), 1000)]
+            for chunk in chunks:
+                for uid, paid_until in _query(s, chunk):
+                    if paid_until is not None:
+                        out[int(uid)] = from_db_naive(paid_until)
+        return out
+
+    def paid_lifecycle_map(self, user_ids: List[int], now: Optional[datetime] = None) -> Dict[int, Dict[str, Any]]:
+        """
+        Кампания подписчика: по пачке пользователей — последняя (по created_at) активная
+        подписка с next_charge_at > now. {user_id: {created_at, next_charge_at, last_charge_at}} в МСК.
+        """
+        now_utc = to_utc_for_db(to_aware_msk(now) if now else now_msk())
+        out: Dict[int, Dict[str, Any]] = {}
+        ids = list({int(u) for u in user_ids})
+        with self._session() as s:
+            for i in range(0, len(ids), 1000):
+                rows = (
+                    s.query(
+                        Subscription.user_id, Subscription.created_at,
+                        Subscription.next_charge_at, Subscription.last_charge_at,
+                    )
+                    .filter(
+                        Subscription.user_id.in_(ids[i:i + 1000]),
+                        Subscription.status == "active",
+                        Subscription.next_charge_at != None,   # noqa: E711
+                        Subscription.next_charge_at > now_utc,
+                    )
+                    .order_by(Subscription.user_id.asc(), Subscription.created_at.desc())
+                    .all()
+                )
+                for uid, created_at, next_charge_at, last_charge_at in rows:
+                    if int(uid) in out or created_at is None:
+                        continue
+                    out[int(uid)] = {
+                        "created_at": from_db_naive(created_at),
+                        "next_charge_at": from_db_naive(next_charge_at),
+                        "last_charge_at": from_db_naive(last_charge_at) if last_charge_at else None,
+                    }
+        return out
+
     def list_mailing_eligible_users(self) -> List[int]:
         """
         Пользователи с ПРИВЯЗАННОЙ картой и активной подпиской, у которой не исчерпан лимит фейлов:
@@ -789,6 +1165,32 @@ class BillingRepository:
             s.flush()
             return rec.id
 
+    def get_access_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Одна строка подписки для решения о доступе (одним запросом):
+        приоритет у active, затем по next_charge_at DESC, updated_at DESC.
+        Возвращает {"status", "next_charge_at" (МСК), "consecutive_failures"} или None,
+        если подписок у пользователя не было никогда.
+        """
+        with self._session() as s:
+            row = (
+                s.query(Subscription.status, Subscription.next_charge_at, Subscription.consecutive_failures)
+                .filter(Subscription.user_id == user_id)
+                .order_by(
+                    case((Subscription.status == "active", 0), else_=1),
+                    Subscription.next_charge_at.desc(),
+                    Subscription.updated_at.desc(),
+                )
+                .first()
+            )
+            if row is None:
+                return None
+            return {
+                "status": row.status,
+                "next_charge_at": from_db_naive(row.next_charge_at),
+                "consecutive_failures": int(row.consecutive_failures or 0),
+            }
+
     def list_active_subscription_user_ids(self, now: Optional[datetime] = None) -> List[int]:
         """
         Все пользователи с активной подпиской, доступной на момент now:
@@ -810,6 +1212,42 @@ class BillingRepository:
             )
             return [uid for (uid,) in rows]
 
+    def active_subscription_user_ids_page(self, now: Optional[datetime] = None, *,
+                                          after_user_id: int = 0, limit: int = 1000) -> List[int]:
+        """
+        Страница пользователей с активной подпиской по возрастанию user_id
+        (keyset: user_id > after_user_id, по индексу subscriptions.user_id, без OFFSET).
+        """
+        now_utc = to_utc_for_db(to_aware_msk(now) if now else now_msk())
+        with self._session() as s:
+            rows = (
+                s.query(Subscription.user_id)
+                 .filter(
+                    Subscription.user_id > after_user_id,
+                    Subscription.status == "active",
+                    Subscription.next_charge_at != None,   # noqa: E711
+                    Subscription.next_charge_at > now_utc,
+                 )
+                 .group_by(Subscription.user_id)
+                 .order_by(Subscription.user_id)
+                 .limit(limit)
+                 .all()
+            )
+            return [uid for (uid,) in rows]
+
+    def count_active_subscription_users(self, now: Optional[datetime] = None) -> int:
+        now_utc = to_utc_for_db(to_aware_msk(now) if now else now_msk())
+        with self._session() as s:
+            return int(
+                s.query(func.count(func.distinct(Subscription.user_id)))
+                 .filter(
+                    Subscription.status == "active",
+                    Subscription.next_charge_at != None,   # noqa: E711
+                    Subscription.next_charge_at > now_utc,
+                 )
+                 .scalar() or 0
+            )
+
     # --- retries / attempts ---
     def record_charge_attempt(self, *, subscription_id: int, user_id: int, payment_id: Optional[str], status: str, due_at: Optional[datetime] = None) -> int:
         with self._session() as s, s.begin():
@@ -860,134 +1298,23 @@ class BillingRepository:
         """
         Возвращает подписки, требующие списания.
         now должен быть в МСК.
-        """
-        now_msk = to_aware_msk(now)
-        now_utc = to_utc_for_db(now_msk)  # Для сравнения с БД (БД хранит в UTC)
 
-        # Политика ретраев авто-списаний:
-        # 1) Не чаще 2-х попыток в сутки (окно 24h).
-        # 2) Минимальный интервал между попытками — 12 часов.
-        # 3) Максимум 6 НЕуспешных попыток В РАМКАХ ОДНОГО ПЛАТЕЖНОГО ЦИКЛА
-        #    (т.е. для той же пары subscription_id + due_at = next_charge_at),
-        #    считаются только status IN ('canceled','expired').
-        window_24h = timedelta(hours=24)
-        min_gap = timedelta(hours=12)
+        Вся политика ретраев считается одним SQL-запросом: по каждой кандидатке
+        (в порядке next_charge_at) — коррелированные подзапросы по индексам
+        charge_attempts (subscription_id, attempted_at) и (subscription_id, due_at, status).
+        БД сканирует подписки по idx_sub_status_next, пока не наберёт limit подходящих.
+        """
+        now_utc = to_utc_for_db(to_aware_msk(now))  # Для сравнения с БД (БД хранит в UTC)
 
         with self._session() as s:
-            q = (
+            rows = (
                 s.query(Subscription)
-                .filter(
-                    Subscription.status == "active",
-                    Subscription.next_charge_at != None,                     # noqa: E711
-                    Subscription.next_charge_at <= now_utc,  # Сравниваем с UTC (БД хранит в UTC)
-                    Subscription.payment_method_id != None,                  # noqa: E711
-                )
-                .order_by(Subscription.next_charge_at.asc())
-                .limit(limit * 3)
+                .filter(*_due_criteria(now_utc))
+                .order_by(Subscription.next_charge_at.asc(), Subscription.id.asc())
+                .limit(int(limit))
             )
-            # Некоторым диалектам не нравится параметризация LIMIT — подстрахуемся.
-            try:
-                subs = list(q.limit(int(limit * 3)))
-            except Exception:
-                subs = list(q)
-            # Ограничение 2 попытки в сутки
-            since_24h_msk = now_msk - window_24h
-            since_24h_utc = to_utc_for_db(since_24h_msk)
-            blocked_ids_day2 = {
-                sub_id for (sub_id,) in
-                s.query(ChargeAttempt.subscription_id)
-                 .filter(ChargeAttempt.attempted_at >= since_24h_utc)
-                 .group_by(ChargeAttempt.subscription_id)
-                 .having(text("COUNT(*) >= 2"))
-                 .all()
-            }
-
-            # Минимальный интервал 12 часов (любая последняя попытка, независимо от статуса)
-            since_12h_msk = now_msk - min_gap
-            since_12h_utc = to_utc_for_db(since_12h_msk)
-            blocked_ids_gap12h = {
-                sub_id for (sub_id,) in
-                s.query(ChargeAttempt.subscription_id)
-                 .filter(ChargeAttempt.attempted_at >= since_12h_utc)
-                 .group_by(ChargeAttempt.subscription_id)
-                 .all()
-            }
-
-            # Лимит 6 НЕуспешных попыток в рамках ТЕКУЩЕГО цикла (due_at == rec.next_charge_at)
-            # Сначала соберём пары (sub_id, due_at) для кандидатов
-            # Округляем due_at до секунд для сравнения
-            candidate_pairs: List[tuple[int, Optional[datetime]]] = []
-            for rec in subs:
-                due_at_raw = from_db_naive(rec.next_charge_at)
-                if due_at_raw:
-                    due_at_rounded = due_at_raw.replace(microsecond=0)
-                    candidate_pairs.append((rec.id, due_at_rounded))
-                else:
-                    candidate_pairs.append((rec.id, None))
-            
-            # Вычислим counts по всем парам разом: group by (subscription_id, due_at)
-            from sqlalchemy import func
-            failed_counts = {}
-            if candidate_pairs:
-                # Конвертируем due_at в UTC для сравнения с БД и округляем
-                due_at_utc_set = {
-                    to_utc_for_db(due_at).replace(microsecond=0) 
-                    for (_, due_at) in candidate_pairs 
-                    if due_at is not None
-                }
-                if due_at_utc_set:
-                    failed_rows = (
-                        s.query(
-                            ChargeAttempt.subscription_id,
-                            ChargeAttempt.due_at,
-                            func.count("*")
-                        )
-                        .filter(
-                            ChargeAttempt.status.in_(('canceled', 'expired')),
-                            ChargeAttempt.subscription_id.in_([sid for (sid, _) in candidate_pairs]),
-                            ChargeAttempt.due_at.in_(due_at_utc_set)
-                        )
-                        .group_by(ChargeAttempt.subscription_id, ChargeAttempt.due_at)
-                        .all()
-                    )
-                    # Маппинг обратно на МСК для сравнения
-                    for sid, due_at_utc, cnt in failed_rows:
-                        due_at_msk = from_db_naive(due_at_utc)
-                        if due_at_msk:
-                            due_at_msk = due_at_msk.replace(microsecond=0)
-                        # Находим соответствующую пару
-                        for pair_sid, pair_due in candidate_pairs:
-                            if pair_sid == sid:
-                                if pair_due and due_at_msk:
-                                    # Сравниваем округлённые значения
-                                    if pair_due.replace(microsecond=0) == due_at_msk:
-                                        failed_counts[(sid, pair_due)] = cnt
-                                        break
-                                elif pair_due is None and due_at_msk is None:
-                                    failed_counts[(sid, None)] = cnt
-                                    break
-
-            items: List[Dict[str, Any]] = []
-            for rec in subs:
-                # Быстрые проверки на самой подписке — второй щит
-                if rec.consecutive_failures is not None and rec.consecutive_failures >= 6:
-                    # skip: max failures reached (>=6)
-                    continue
-                # last_attempt_at может быть naive → привести к aware МСК
-                last_attempt_msk = from_db_naive(rec.last_attempt_at)
-                if last_attempt_msk is not None and (now_msk - last_attempt_msk) < min_gap:
-                    # skip: 12h gap not passed
-                    continue
-                # Лимиты по окнам + лимит 6 фейлов В ТЕКУЩЕМ ЦИКЛЕ
-                # (по паре (subscription_id, due_at = rec.next_charge_at))
-                next_charge_msk = from_db_naive(rec.next_charge_at)
-                if next_charge_msk:
-                    next_charge_msk = next_charge_msk.replace(microsecond=0)
-                pair = (rec.id, next_charge_msk)
-                failed6_now = failed_counts.get(pair, 0) >= 6
-                if (rec.id in blocked_ids_day2) or (rec.id in blocked_ids_gap12h) or failed6_now:
-                    continue
-                items.append({
+            return [
+                {
                     "id": rec.id,
                     "user_id": rec.user_id,
                     "plan_code": rec.plan_code,
@@ -997,10 +1324,9 @@ class BillingRepository:
                     "payment_method_id": rec.payment_method_id,
                     "consecutive_failures": rec.consecutive_failures,
                     "last_attempt_at": rec.last_attempt_at,
-                })
-                if len(items) >= limit:
-                    break
-            return items
+                }
+                for rec in rows
+            ]
 
     # --- webhooks / log ---
     def payment_log_upsert(
@@ -1098,6 +1424,220 @@ class BillingRepository:
                 rec.processed_at = to_utc_for_db(now_msk())
 
 
+    # ---------- входящая очередь вебхуков (webhook_inbox) ----------
+
+    def webhook_enqueue(self, *, payload: Dict[str, Any]) -> Optional[int]:
+        """
+        Сохраняет сырое webhook-событие YooKassa. Возвращает id строки или None,
+        если это повтор уже принятого события (тот же payment_id/status/event).
+        """
+        return self.webhook_enqueue_many(payloads=[payload])[0]
+
+    def webhook_enqueue_many(self, *, payloads: List[Dict[str, Any]]) -> List[Optional[int]]:
+        """
+        Пачка событий одной транзакцией (групповой коммит webhook_queue.enqueue).
+        Результат — по позициям payloads: id строки или None для повтора.
+        """
+        now_utc = to_utc_for_db(now_msk())
+        recs: List[Optional[WebhookEvent]] = []
+        for payload in payloads:
+            obj = payload.get("object") or {}
+            payment_id = str(obj.get("id") or "")
+            status = str(obj.get("status") or "").lower() or None
+            event = str(payload.get("event") or "") or None
+            recs.append(WebhookEvent(
+                dedup_key=f"{payment_id}:{status or ''}:{event or ''}"[:160],
+                payment_id=payment_id,
+                event=event,
+                status=status,
+                payload_json=json.dumps(payload, ensure_ascii=False),
+                state="pending",
+                attempts=0,
+                next_attempt_at=now_utc,
+                created_at=now_utc,
+            ))
+        try:
+            with self._session() as s, s.begin():
+                keys = {r.dedup_key for r in recs}
+                seen = set(
+                    k for (k,) in s.query(WebhookEvent.dedup_key).filter(WebhookEvent.dedup_key.in_(keys))
+                )
+                for i, rec in enumerate(recs):
+                    if rec.dedup_key in seen:
+                        recs[i] = None
+                    else:
+                        seen.add(rec.dedup_key)
+                        s.add(rec)
+                s.flush()
+                return [r.id if r is not None else None for r in recs]
+        except IntegrityError:
+            # тот же ключ одновременно вставил другой процесс — по одному
+            if len(payloads) == 1:
+                return [None]
+            return [self.webhook_enqueue(payload=p) for p in payloads]
+
+    def webhook_claim(self, *, worker_id: str, limit: int = 1, lease_sec: int = 120) -> List[Dict[str, Any]]:
+        """
+        Забирает события для обработки воркером очереди — как claim_due_subscriptions:
+        FOR UPDATE SKIP LOCKED + условный UPDATE (state/аренда) по rowcount.
+
+        Порядок внутри платежа: берётся только самое раннее незавершённое событие
+        payment_id (pending/processing с меньшим id блокирует следующие, в том числе
+        пока ждёт ретрая). dead-события порядок не держат — иначе один «битый»
+        вебхук навсегда остановил бы платёж.
+        Обработка, чья аренда истекла (воркер упал), забирается заново.
+        """
+        now_utc = to_utc_for_db(now_msk())
+        lease_until_utc = now_utc + timedelta(seconds=int(lease_sec))
+        ready = or_(
+            (WebhookEvent.state == "pending") & (WebhookEvent.next_attempt_at <= now_utc),
+            (WebhookEvent.state == "processing") & (WebhookEvent.locked_until < now_utc),
+        )
+        wh = WebhookEvent.__table__
+        earlier = wh.alias("earlier")
+        blocked = (
+            select(earlier.c.id)
+            .where(
+                earlier.c.payment_id == wh.c.payment_id,
+                earlier.c.id < wh.c.id,
+                earlier.c.state.in_(("pending", "processing")),
+            )
+            .exists()
+        )
+
+        claimed: List[Dict[str, Any]] = []
+        try:
+            with self._session() as s, s.begin():
+                rows = (
+                    s.query(WebhookEvent)
+                    .filter(ready, ~blocked)
+                    .order_by(WebhookEvent.id.asc())
+                    .limit(int(limit))
+                    .with_for_update(skip_locked=True, of=WebhookEvent)
+                    .all()
+                )
+                for rec in rows:
+                    won = s.execute(
+                        update(WebhookEvent)
+                        .where(WebhookEvent.id == rec.id, ready)
+                        .values(
+                            state="processing",
+                            locked_by=worker_id,
+                            locked_until=lease_until_utc,
+                            attempts=WebhookEvent.attempts + 1,
+                        )
+                        .execution_options(synchronize_session=False)
+                    ).rowcount == 1
+                    if not won:
+                        continue
+                    claimed.append({
+                        "id": rec.id,
+                        "payment_id": rec.payment_id,
+                        "status": rec.status,
+                        "attempts": (rec.attempts or 0) + 1,
+                        "payload": json.loads(rec.payload_json),
+                    })
+        except OperationalError as e:
+            import logging
+            logging.getLogger(__name__).warning("webhook_claim(%s) failed, will retry: %s", worker_id, e)
+            return []
+        return claimed
+
+    def webhook_done(self, *, event_id: int, worker_id: str) -> bool:
+        """Событие обработано. False — аренду уже перехватил другой воркер."""
+        with self._session() as s, s.begin():
+            return s.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id == event_id, WebhookEvent.locked_by == worker_id,
+                       WebhookEvent.state == "processing")
+                .values(state="done", locked_by=None, locked_until=None, last_error=None,
+                        processed_at=to_utc_for_db(now_msk()))
+                .execution_options(synchronize_session=False)
+            ).rowcount == 1
+
+    def webhook_failed(self, *, event_id: int, worker_id: str, error: str, retry_in_sec: Optional[float]) -> bool:
+        """
+        Обработка не удалась: retry_in_sec — через сколько повторить,
+        None — больше не пробовать (state='dead', виден в webhook_dead_letters).
+        """
+        now_utc = to_utc_for_db(now_msk())
+        if retry_in_sec is None:
+            values = dict(state="dead", processed_at=now_utc)
+        else:
+            values = dict(state="pending", next_attempt_at=now_utc + timedelta(seconds=float(retry_in_sec)))
+        with self._session() as s, s.begin():
+            return s.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id == event_id, WebhookEvent.locked_by == worker_id,
+                       WebhookEvent.state == "processing")
+                .values(locked_by=None, locked_until=None, last_error=(error or "")[:2000], **values)
+                .execution_options(synchronize_session=False)
+            ).rowcount == 1
+
+    def webhook_release(self, *, event_ids: List[int], worker_id: str) -> int:
+        """Возвращает забранные, но не начатые события (остановка воркера) — без ожидания аренды."""
+        if not event_ids:
+            return 0
+        with self._session() as s, s.begin():
+            return s.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id.in_(event_ids), WebhookEvent.locked_by == worker_id,
+                       WebhookEvent.state == "processing")
+                .values(state="pending", locked_by=None, locked_until=None,
+                        attempts=WebhookEvent.attempts - 1)
+                .execution_options(synchronize_session=False)
+            ).rowcount or 0
+
+    def webhook_dead_letters(self, *, limit: int = 20) -> List[Dict[str, Any]]:
+        """Последние события, которые не удалось обработать (для админки)."""
+        with self._session() as s:
+            rows = (
+                s.query(WebhookEvent)
+                .filter(WebhookEvent.state == "dead")
+                .order_by(WebhookEvent.id.desc())
+                .limit(int(limit))
+                .all()
+            )
+            return [
+                {
+                    "id": r.id,
+                    "payment_id": r.payment_id,
+                    "event": r.event,
+                    "status": r.status,
+                    "attempts": r.attempts,
+                    "last_error": r.last_error,
+                    "created_at": from_db_naive(r.created_at),
+                }
+                for r in rows
+            ]
+
+    def webhook_requeue(self, *, event_id: int) -> bool:
+        """Вернуть dead-событие в очередь (после исправления причины)."""
+        with self._session() as s, s.begin():
+            return s.execute(
+                update(WebhookEvent)
+                .where(WebhookEvent.id == event_id, WebhookEvent.state == "dead")
+                .values(state="pending", attempts=0, next_attempt_at=to_utc_for_db(now_msk()),
+                        processed_at=None)
+                .execution_options(synchronize_session=False)
+            ).rowcount == 1
+
+    def webhook_stats(self) -> Dict[str, int]:
+        """Количество событий по состояниям."""
+        with self._session() as s:
+            rows = s.query(WebhookEvent.state, func.count()).group_by(WebhookEvent.state).all()
+        return {state: int(n) for state, n in rows}
+
+    def webhook_purge_done(self, *, older_than: datetime) -> int:
+        """Удаляет обработанные события старше older_than (dead не трогаем)."""
+        with self._session() as s, s.begin():
+            return s.execute(
+                delete(WebhookEvent).where(
+                    WebhookEvent.state == "done",
+                    WebhookEvent.processed_at < to_utc_for_db(older_than),
+                )
+            ).rowcount or 0
+
 # Глобальный репозиторий (billing DB)
 _repo = BillingRepository(SessionLocal)
 init_schema()
@@ -1140,14 +1680,30 @@ def card_upsert_from_provider(
 def subscription_upsert(*, user_id: int, plan_code: str, interval_months: int, amount_value: str,
                         amount_currency: str, payment_method_id: Optional[str],
                         next_charge_at: Optional[datetime], status: str = "active") -> int:
-    return _repo.subscription_upsert(
+    sub_id = _repo.subscription_upsert(
         user_id=user_id, plan_code=plan_code, interval_months=interval_months,
         amount_value=amount_value, amount_currency=amount_currency,
         payment_method_id=payment_method_id, next_charge_at=next_charge_at, status=status
     )
+    # состояние подписки изменилось — снимок доступа пересчитается при следующем входе
+    invalidate_access_cache_nowait(user_id)
+    # новый срок списания — разбудить billing_loop (если он в этом процессе)
+    if status == "active" and payment_method_id and next_charge_at is not None:
+        notify_billing_nowait(sub_id, to_utc_for_db(next_charge_at))
+    # и перенести проверку доступа в очереди удалений из чата
+    if status == "active":
+        schedule_membership_expiry_nowait(user_id, next_charge_at)
+        # шаги кампании подписчика (в т.ч. «скоро списание») считаются от подписки
+        schedule_notification_nowait("paid", user_id)
+    return sub_id
+
+def get_access_subscription(user_id: int) -> Optional[Dict[str, Any]]:
+    return _repo.get_access_subscription(user_id)
 
 def subscription_cancel_for_user(*, user_id: int) -> int:
-    return _repo.subscription_cancel_for_user(user_id=user_id)
+    updated = _repo.subscription_cancel_for_user(user_id=user_id)
+    invalidate_access_cache_nowait(user_id)
+    return updated
 
 def subscription_mark_charged(sub_id: int, *, next_charge_at: datetime) -> None:
     _repo.subscription_mark_charged(sub_id, next_charge_at=next_charge_at)
@@ -1159,12 +1715,18 @@ def subscription_mark_charged_for_user(
     subscription_id: Optional[int] = None,
     plan_code: Optional[str] = None
 ) -> Optional[int]:
-    return _repo.subscription_mark_charged_for_user(
+    sub_id = _repo.subscription_mark_charged_for_user(
         user_id, 
         next_charge_at=next_charge_at,
         subscription_id=subscription_id,
         plan_code=plan_code
     )
+    invalidate_access_cache_nowait(user_id)
+    if sub_id is not None:
+        notify_billing_nowait(sub_id, to_utc_for_db(next_charge_at))
+        schedule_membership_expiry_nowait(user_id, next_charge_at)
+        schedule_notification_nowait("paid", user_id)
+    return sub_id
 
 # Retries / Scheduler
 def subscriptions_due(now: datetime, limit: int = 200) -> List[Dict[str, Any]]:
@@ -1184,6 +1746,8 @@ def mark_charge_attempt_status(
         subscription_id=subscription_id,
         status=status
     )
+    # исход попытки (вебхук) меняет срок ретрая — внеочередная сверка планировщика
+    notify_billing_nowait(subscription_id)
 
 def precharge_guard_and_attempt(*, subscription_id: int, now: datetime, user_id: int) -> Optional[int]:
     return _repo.precharge_guard_and_attempt(subscription_id=subscription_id, now=now, user_id=user_id)
@@ -1191,6 +1755,49 @@ def precharge_guard_and_attempt(*, subscription_id: int, now: datetime, user_id:
 def link_payment_to_attempt(*, attempt_id: int, payment_id: str) -> None:
     return _repo.link_payment_to_attempt(attempt_id=attempt_id, payment_id=payment_id)
 
+def claim_due_subscriptions(*, now: datetime, worker_id: str, limit: int = 100, lease_sec: int = 300) -> List[Dict[str, Any]]:
+    return _repo.claim_due_subscriptions(now=now, worker_id=worker_id, limit=limit, lease_sec=lease_sec)
+
+def next_due_times(*, until: datetime, limit: int = 5000) -> List[tuple]:
+    return _repo.next_due_times(until=until, limit=limit)
+
+def release_claim(*, subscription_id: int, attempt_id: int, prev_last_attempt_at: Optional[datetime]) -> None:
+    return _repo.release_claim(subscription_id=subscription_id, attempt_id=attempt_id, prev_last_attempt_at=prev_last_attempt_at)
+
+def mark_attempt_failed(*, attempt_id: int, only_if_created: bool = False) -> None:
+    return _repo.mark_attempt_failed(attempt_id=attempt_id, only_if_created=only_if_created)
+
+# Webhooks: входящая очередь
+def webhook_enqueue(*, payload: Dict[str, Any]) -> Optional[int]:
+    return _repo.webhook_enqueue(payload=payload)
+
+def webhook_enqueue_many(*, payloads: List[Dict[str, Any]]) -> List[Optional[int]]:
+    return _repo.webhook_enqueue_many(payloads=payloads)
+
+def webhook_claim(*, worker_id: str, limit: int = 1, lease_sec: int = 120) -> List[Dict[str, Any]]:
+    return _repo.webhook_claim(worker_id=worker_id, limit=limit, lease_sec=lease_sec)
+
+def webhook_done(*, event_id: int, worker_id: str) -> bool:
+    return _repo.webhook_done(event_id=event_id, worker_id=worker_id)
+
+def webhook_failed(*, event_id: int, worker_id: str, error: str, retry_in_sec: Optional[float]) -> bool:
+    return _repo.webhook_failed(event_id=event_id, worker_id=worker_id, error=error, retry_in_sec=retry_in_sec)
+
+def webhook_release(*, event_ids: List[int], worker_id: str) -> int:
+    return _repo.webhook_release(event_ids=event_ids, worker_id=worker_id)
+
+def webhook_dead_letters(*, limit: int = 20) -> List[Dict[str, Any]]:
+    return _repo.webhook_dead_letters(limit=limit)
+
+def webhook_requeue(*, event_id: int) -> bool:
+    return _repo.webhook_requeue(event_id=event_id)
+
+def webhook_stats() -> Dict[str, int]:
+    return _repo.webhook_stats()
+
+def webhook_purge_done(*, older_than: datetime) -> int:
+    return _repo.webhook_purge_done(older_than=older_than)
+
 # Webhooks / Log
 def payment_log_upsert(*, payment_id: str, user_id: Optional[int], amount_value: Optional[str],
                        amount_currency: Optional[str], event: Optional[str], status: Optional[str],
@@ -1211,6 +1818,18 @@ def payment_log_mark_processed(payment_id: str) -> None:
 def list_active_subscription_user_ids(now: Optional[datetime] = None) -> List[int]:
     return _repo.list_active_subscription_user_ids(now)
 
+def active_subscription_user_ids_page(now: Optional[datetime] = None, *, after_user_id: int = 0, limit: int = 1000) -> List[int]:
+    return _repo.active_subscription_user_ids_page(now, after_user_id=after_user_id, limit=limit)
+
+def count_active_subscription_users(now: Optional[datetime] = None) -> int:
+    return _repo.count_active_subscription_users(now)
+
+def membership_paid_until_map(user_ids: Optional[List[int]] = None) -> Dict[int, datetime]:
+    return _repo.membership_paid_until_map(user_ids)
+
+def paid_lifecycle_map(user_ids: List[int], now: Optional[datetime] = None) -> Dict[int, Dict[str, Any]]:
+    return _repo.paid_lifecycle_map(user_ids, now)
+
 def list_mailing_eligible_users(now: Optional[datetime] = None) -> List[int]:
     return _repo.list_mailing_eligible_users()
 
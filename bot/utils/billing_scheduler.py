@@ -0,0 +1,160 @@
+# smart_agent/bot/utils/billing_scheduler.py
+"""
+Планировщик рекуррентных списаний: billing_loop спит ровно до ближайшего
+момента, когда какая-то подписка станет доступна для списания, а не опрашивает
+БД каждые 5 секунд.
+
+Устройство:
+  — min-heap (время, subscription_id) в памяти процесса: next_charge_at и моменты,
+    когда снова можно ретраить (last_attempt_at + 12ч, конец аренды);
+  — сверка (sweep) раз в BILLING_SWEEP_SEC: billing_loop забирает всё, что пора
+    (claim_due_subscriptions — страховка от потерянных событий), и перечитывает
+    ближайшие сроки из БД (next_due_times) на горизонт до следующей сверки;
+  — notify_nowait(sub_id, at) из billing_db (subscription_upsert,
+    subscription_mark_charged_for_user, статусы попыток из вебхука) кладёт новый
+    срок в кучу и будит цикл; at=None — «срок неизвестен», цикл делает внеочередную сверку.
+
+notify_nowait безопасен из пула потоков БД (run_db): в loop планировщика через
+call_soon_threadsafe. Без запущенного billing_loop (скрипты, тесты) — no-op,
+изменения подхватит ближайшая сверка.
+
+Другие воркеры (на других хостах) событий этого процесса не видят и узнают о
+новых сроках на своей сверке; двойных списаний нет — это решает claim.
+
+ENV:
+  BILLING_SWEEP_SEC=300 — период сверки (верхняя граница задержки без событий)
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+
+SWEEP_SEC = float(os.getenv("BILLING_SWEEP_SEC", "300"))
+
+
+class BillingScheduler:
+    def __init__(self, *, sweep_sec: float = SWEEP_SEC):
+        self.sweep_sec = max(1.0, float(sweep_sec))
+        self._heap: List[Tuple[float, int]] = []        # (unix-время, subscription_id)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._next_sweep = 0.0                           # time.time() следующей сверки
+        self.counters: Dict[str, int] = {
+            "sweeps": 0, "notifies": 0, "wakeups": 0, "fired": 0,
+        }
+
+    # ---------- жизненный цикл ----------
+
+    def start(self) -> None:
+        """Привязка к текущему loop'у; первая сверка — сразу."""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._heap = []
+        self._next_sweep = 0.0
+
+    def stop(self) -> None:
+        self._loop = None
+        self._wake = None
+
+    # ---------- события ----------
+
+    def notify_nowait(self, subscription_id: Optional[int], at: Optional[datetime] = None) -> None:
+        """
+        Срок подписки изменился. at — aware-время, когда её можно списывать
+        (None — неизвестно: внеочередная сверка). Вызывается из любого потока.
+        """
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            return
+        ts = at.timestamp() if at is not None else None
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        try:
+            if running is loop:
+                self._push(subscription_id, ts)
+            else:
+                loop.call_soon_threadsafe(self._push, subscription_id, ts)
+        except Exception as e:
+            LOG.warning("billing scheduler notify failed for subscription %s: %s", subscription_id, e)
+
+    def _push(self, subscription_id: Optional[int], ts: Optional[float]) -> None:
+        self.counters["notifies"] += 1
+        if ts is None:
+            self._next_sweep = 0.0
+        elif subscription_id is not None:
+            heapq.heappush(self._heap, (ts, int(subscription_id)))
+        if self._wake is not None:
+            self._wake.set()
+
+    # ---------- состояние для billing_loop ----------
+
+    def sweep_due(self, now: Optional[float] = None) -> bool:
+        """Пора ли делать сверку (claim + перечитать сроки)."""
+        return (now if now is not None else time.time()) >= self._next_sweep
+
+    def reload(self, items: Iterable[Tuple[int, datetime]], now: Optional[float] = None) -> None:
+        """Результат сверки: ближайшие сроки из БД заменяют кучу."""
+        now = now if now is not None else time.time()
+        self._heap = [(at.timestamp(), int(sub_id)) for sub_id, at in items]
+        heapq.heapify(self._heap)
+        self._next_sweep = now + self.sweep_sec
+        self.counters["sweeps"] += 1
+
+    def defer_sweep(self, delay_sec: float) -> None:
+        """Ошибка БД в сверке — повторить через delay_sec, а не крутиться в цикле."""
+        self._next_sweep = time.time() + delay_sec
+
+    def pop_due(self, now: Optional[float] = None) -> List[int]:
+        """Снимает с кучи всё, что уже наступило; непустой список — пора делать claim."""
+        now = now if now is not None else time.time()
+        fired: List[int] = []
+        while self._heap and self._heap[0][0] <= now:
+            fired.append(heapq.heappop(self._heap)[1])
+        self.counters["fired"] += len(fired)
+        return fired
+
+    def next_wakeup(self) -> float:
+        """unix-время ближайшего события: срок из кучи или следующая сверка."""
+        if self._heap:
+            return min(self._heap[0][0], self._next_sweep)
+        return self._next_sweep
+
+    async def wait(self, shutdown: asyncio.Event) -> None:
+        """Сон до ближайшего срока / сверки, notify_nowait или shutdown."""
+        delay = self.next_wakeup() - time.time()
+        if delay <= 0:
+            return
+        wake = self._wake
+        if wake is None:
+            wake = self._wake = asyncio.Event()
+        wake.clear()
+        waiters = [asyncio.ensure_future(shutdown.wait()), asyncio.ensure_future(wake.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waiters:
+                w.cancel()
+        self.counters["wakeups"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "queued": len(self._heap),
+            "next_in_sec": round(max(0.0, self.next_wakeup() - time.time()), 1),
+        }
+
+
+billing_scheduler = BillingScheduler()
+
+
+def notify_nowait(subscription_id: Optional[int], at: Optional[datetime] = None) -> None:
+    billing_scheduler.notify_nowait(subscription_id, at)
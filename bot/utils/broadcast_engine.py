@@ -0,0 +1,236 @@
+# smart_agent/bot/utils/broadcast_engine.py
+"""
+Индивидуальная рассылка записи Mailings с докачкой после рестарта.
+
+Раньше broadcast слал получателям строго по одному (await на каждого), а
+mailing_events не писались вовсе: при падении посреди рассылки было неизвестно,
+кто её уже получил. Теперь:
+  — на рассылку заводится задание admin_db.MailingJob; получатели обходятся по
+    возрастанию user_id, курсор last_user_id двигается только по непрерывному
+    префиксу завершённых отправок;
+  — результаты копятся в памяти и пишутся пачкой (multi-row INSERT в mailing_events
+    + счётчики и курсор задания одной транзакцией) каждые BROADCAST_FLUSH_EVERY
+    отправок или BROADCAST_FLUSH_SEC секунд;
+  — после рестарта задание продолжается с курсора; получатели после курсора,
+    по которым запись уже есть, пропускаются. Повторно могут получить только те,
+    чья отправка завершилась, но не успела попасть в БД (не больше пачки + параллелизма);
+  — получатели читаются потоком (mailing.iter_recipients — keyset-страницы из БД)
+    по мере отправки: память не растёт с базой, первая отправка — сразу после первой страницы;
+  — отправляют BROADCAST_CONCURRENCY воркеров; темп и лимиты Telegram держит
+    общий слой bot/utils/tg_shaper.py;
+  — прогресс (скорость, ETA) — progress(mailing_id) для админ-панели.
+
+ENV:
+  BROADCAST_CONCURRENCY=25 / BROADCAST_FLUSH_EVERY=200 / BROADCAST_FLUSH_SEC=2
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union,
+)
+
+from aiogram import Bot
+
+import bot.utils.admin_db as adb
+from bot.utils.async_db import run_db
+
+LOG = logging.getLogger(__name__)
+
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+FLUSH_EVERY = int(os.getenv("BROADCAST_FLUSH_EVERY", "200"))
+FLUSH_SEC = float(os.getenv("BROADCAST_FLUSH_SEC", "2"))
+
+# send(bot, user_id, mailing) — mailing.send_to_user
+Sender = Callable[[Bot, int, Dict[str, Any]], Awaitable[None]]
+
+
+async def _aiter(items: Iterable[int]) -> AsyncIterator[int]:
+    for item in items:
+        yield item
+
+
+@dataclass
+class BroadcastProgress:
+    mailing_id: int
+    job_id: int
+    total: int
+    done: int                      # обработано получателей (включая прошлые запуски)
+    sent: int
+    failed: int
+    started: float = field(default_factory=time.monotonic)
+    done_at_start: int = 0
+
+    def add(self, ok: bool) -> None:
+        self.done += 1
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self.done_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        rate = self.rate()
+        left = max(0, self.total - self.done)
+        return {
+            "mailing_id": self.mailing_id,
+            "total": self.total,
+            "done": self.done,
+            "sent": self.sent,
+            "failed": self.failed,
+            "rate": round(rate, 1),
+            "eta_sec": int(left / rate) if rate > 0 else None,
+        }
+
+
+@dataclass
+class _RunState:
+    job_id: int
+    mailing_id: int
+    cursor: int
+    dispatched: Deque[int] = field(default_factory=deque)   # в порядке отправки (= по возрастанию)
+    completed: Set[int] = field(default_factory=set)        # завершены, но курсор ещё не дошёл
+    buffer: List[Tuple[int, bool]] = field(default_factory=list)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class BroadcastEngine:
+    def __init__(
+        self,
+        *,
+        concurrency: int = CONCURRENCY,
+        flush_every: int = FLUSH_EVERY,
+        flush_sec: float = FLUSH_SEC,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.flush_every = max(1, flush_every)
+        self.flush_sec = flush_sec
+        self._live: Dict[int, BroadcastProgress] = {}
+
+    def progress(self, mailing_id: int) -> Optional[Dict[str, Any]]:
+        """Прогресс идущей в этом процессе рассылки (None — не идёт)."""
+        p = self._live.get(int(mailing_id))
+        return p.snapshot() if p else None
+
+    async def run(
+        self,
+        bot: Bot,
+        mailing: Dict[str, Any],
+        user_ids: Union[Iterable[int], AsyncIterable[int]],
+        send: Sender,
+        *,
+        total: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Разослать mailing получателям (или докачать начатое). Возвращает итог задания.
+        user_ids — список или асинхронный поток по возрастанию user_id (mailing.iter_recipients):
+        поток читается по мере отправки, total — оценка размера для прогресса/ETA.
+        """
+        mailing_id = int(mailing["id"])
+        if not isinstance(user_ids, AsyncIterable):
+            ids = sorted({int(u) for u in user_ids})
+            total = len(ids)
+            user_ids = _aiter(ids)
+        job = await run_db(adb.mailing_job_start, mailing_id, int(total or 0))
+        if job["status"] == "done":
+            return job
+
+        cursor = int(job["last_user_id"])
+        # после курсора записаны только пачки, сброшенные перед остановкой, — множество небольшое
+        logged = await run_db(adb.mailing_job_logged_users, mailing_id, cursor)
+        if cursor:
+            LOG.info("mailing %s: resuming after user %s (%s already logged past it)", mailing_id, cursor, len(logged))
+
+        progress = BroadcastProgress(
+            mailing_id, job["id"], total=int(total or 0), done=int(job["sent"]) + int(job["failed"]),
+            sent=int(job["sent"]), failed=int(job["failed"]),
+        )
+        progress.done_at_start = progress.done
+        st = _RunState(job["id"], mailing_id, cursor)
+        errors: Counter = Counter()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def produce() -> None:
+            last, queued = cursor, 0
+            async for uid in user_ids:
+                uid = int(uid)
+                # до курсора и записанные после него — обработаны прошлыми запусками;
+                # поток идёт по возрастанию, повторы (пересечение когорт) пропускаем
+                if uid <= last or uid in logged:
+                    continue
+                last = uid
+                queued += 1
+                progress.total = max(progress.total, progress.done_at_start + queued)
+                st.dispatched.append(uid)
+                await queue.put(uid)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def worker() -> None:
+            while True:
+                uid = await queue.get()
+                if uid is None:
+                    return
+                try:
+                    await send(bot, uid, mailing)
+                    ok = True
+                except Exception as e:
+                    ok = False
+                    errors[type(e).__name__] += 1
+                    LOG.debug("mailing %s: send to %s failed: %s", mailing_id, uid, e)
+                st.buffer.append((uid, ok))
+                st.completed.add(uid)
+                progress.add(ok)
+                if len(st.buffer) >= self.flush_every:
+                    await self._flush(st)
+
+        async def flush_loop() -> None:
+            while True:
+                await asyncio.sleep(self.flush_sec)
+                await self._flush(st)
+
+        self._live[mailing_id] = progress
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        flusher = asyncio.create_task(flush_loop())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in (*tasks, flusher):
+                t.cancel()
+            await asyncio.gather(*tasks, flusher, return_exceptions=True)
+            # остановка посреди рассылки: записываем всё, что успели, — отсюда продолжит следующий запуск
+            await asyncio.shield(self._flush(st))
+            self._live.pop(mailing_id, None)
+
+        progress.total = progress.done                    # оценка total → фактическое число получателей
+        await run_db(adb.mailing_job_finish, st.job_id, progress.total)
+        summary = progress.snapshot()
+        LOG.info("mailing %s done: %s, errors: %s", mailing_id, summary, dict(errors))
+        return summary
+
+    async def _flush(self, st: _RunState) -> None:
+        async with st.lock:
+            # без await до записи: буфер и курсор снимаются согласованно
+            batch, st.buffer = st.buffer, []
+            while st.dispatched and st.dispatched[0] in st.completed:
+                st.cursor = st.dispatched.popleft()
+                st.completed.discard(st.cursor)
+            if not batch:
+                return
+            try:
+                await run_db(adb.mailing_job_flush, st.job_id, st.mailing_id, batch, st.cursor)
+            except Exception as e:
+                # запишем вместе со следующей пачкой
+                LOG.warning("mailing %s: flush of %s results failed: %s", st.mailing_id, len(batch), e)
+                st.buffer[:0] = batch
+
+
+broadcast_engine = BroadcastEngine()
@@ -6,7 +6,8 @@ from typing import Optional
 from datetime import datetime, timedelta
 
 from sqlalchemy import (
-    create_engine, String, Integer, BigInteger, ForeignKey, DateTime, Text, func
+    create_engine, insert, select, update, inspect, bindparam, case, and_, or_,
+    String, Integer, BigInteger, ForeignKey, DateTime, Text, Index, func
 )
 from sqlalchemy.orm import (
     DeclarativeBase, Mapped, mapped_column, relationship,
@@ -14,10 +15,14 @@ from sqlalchemy.orm import (
 )
 
 from bot.config import DB_URL
+from bot.utils.redis_repo import (
+    invalidate_access_cache_nowait, schedule_membership_expiry_nowait, schedule_notification_nowait,
+)
 from bot.utils.time_helpers import (
     now_msk, to_aware_msk, to_utc_for_db, from_db_naive
 )
 import json
+import logging
 
 
 # =========================
@@ -45,48 +50,70 @@ SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expi
 #          Models
 # =========================
 class User(Base):
+    """
+    Пользователь бота.
+    Дочерние коллекции НЕ грузятся неявно (lazy="raise_on_sql"): у активного
+    пользователя в event_log десятки тысяч строк, и s.get(User) не должен их тянуть.
+    Если коллекция действительно нужна — загружать явно:
+        s.get(User, uid, options=[selectinload(User.consents)])
+    Удаление детей — на стороне БД (ondelete="CASCADE", passive_deletes=True).
+    """
     __tablename__ = "users"
+    __table_args__ = (
+        # диапазонные выборки кампаний по «давности» пользователя (run_unsubscribed_nurture)
+        Index("idx_users_first_seen", "first_seen_at"),
+    )
 
     user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     # Новые поля
     chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True, index=True)
     username: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
+    # Первое/последнее событие в event_log. Ведутся при записи (events_add_bulk),
+    # чтобы не агрегировать event_log целиком. NULL — событий ещё не было.
+    first_seen_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    last_seen_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
     # Логи событий
     events: Mapped[list["EventLog"]] = relationship(
         back_populates="user",
         cascade="all, delete-orphan",
-        lazy="selectin",
+        lazy="raise_on_sql",
+        passive_deletes=True,
     )
     # История черновиков
     history: Mapped[list["ReviewHistory"]] = relationship(
         back_populates="user",
         cascade="all, delete-orphan",
-        lazy="selectin",
+        lazy="raise_on_sql",
+        passive_deletes=True,
     )
     # История саммари переговоров
     summaries: Mapped[list["SummaryHistory"]] = relationship(
         back_populates="user",
         cascade="all, delete-orphan",
-        lazy="selectin",
+        lazy="raise_on_sql",
+        passive_deletes=True,
     )
     # История «Описание объекта»
     descriptions: Mapped[list["DescriptionHistory"]] = relationship(
         back_populates="user",
         cascade="all, delete-orphan",
-        lazy="selectin",
+        lazy="raise_on_sql",
+        passive_deletes=True,
     )
     # Согласия (TOS и т.п.)
     consents: Mapped[list["UserConsent"]] = relationship(
         back_populates="user",
         cascade="all, delete-orphan",
-        lazy="selectin",
+        lazy="raise_on_sql",
+        passive_deletes=True,
     )
     # Триал
     trials: Mapped[list["Trial"]] = relationship(
         back_populates="user",
         cascade="all, delete-orphan",
-        lazy="selectin",
+        lazy="raise_on_sql",
+        passive_deletes=True,
     )
 
 
@@ -227,11 +254,31 @@ class EventLog(Base):
 # =========================
 def init_schema() -> None:
     """
-    Инициализация схемы БД.
-    Опираемся на SQLAlchemy `Base.metadata.create_all`, без сырых ALTER/CREATE INDEX.
-    Все необходимые таблицы/индексы должны быть созданы миграциями либо заранее.
+    Инициализация схемы БД: `Base.metadata.create_all` плюс добавление новых
+    колонок в уже существующие таблицы (как init_schema в billing_db).
     """
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        dt_type = "TIMESTAMPTZ" if conn.dialect.name in ("postgresql",) else "DATETIME"
+
+        # ---- users: first_seen_at / last_seen_at ----
+        users_cols = {c["name"] for c in insp.get_columns("users")}
+        if "first_seen_at" not in users_cols:
+            conn.exec_driver_sql(f"ALTER TABLE users ADD COLUMN first_seen_at {dt_type} NULL")
+        if "last_seen_at" not in users_cols:
+            conn.exec_driver_sql(f"ALTER TABLE users ADD COLUMN last_seen_at {dt_type} NULL")
+        users_indexes = {ix["name"] for ix in insp.get_indexes("users")}
+        if "idx_users_first_seen" not in users_indexes:
+            conn.exec_driver_sql("CREATE INDEX idx_users_first_seen ON users (first_seen_at)")
+
+    # Заполнение по истории event_log; дальше значения ведёт events_add_bulk.
+    # Проверяется на каждом старте: прерванное заполнение продолжается, иначе старые
+    # пользователи получили бы first_seen_at по следующему событию и снова попали в кампанию.
+    repo = AppRepository(SessionLocal)
+    if repo.seen_backfill_pending():
+        filled = repo.backfill_seen_at()
+        logging.info("users.first_seen_at backfilled for %s users", filled)
 
 
 class AppRepository:
@@ -241,6 +288,18 @@ class AppRepository:
     def _session(self) -> Session:
         return self._session_factory()
 
+    @staticmethod
+    def _user_exists(s: Session, user_id: int) -> bool:
+        """Проверка существования по PK: SELECT user_id, без загрузки строки и связей."""
+        return s.execute(
+            select(User.user_id).where(User.user_id == user_id)
+        ).first() is not None
+
+    def _ensure_user_row(self, s: Session, user_id: int) -> None:
+        """Создаёт пустую запись пользователя, если её ещё нет (внутри текущей транзакции)."""
+        if not self._user_exists(s, user_id):
+            s.add(User(user_id=user_id))
+
     # --- users ---
     def ensure_user(self, user_id: int, *, chat_id: Optional[int] = None, username: Optional[str] = None) -> bool:
         with self._session() as s, s.begin():
@@ -264,8 +323,7 @@ class AppRepository:
     # --- consents ---
     def add_consent(self, user_id: int, kind: str, when: Optional[datetime] = None) -> int:
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
+            self._ensure_user_row(s, user_id)
             when_msk = to_aware_msk(when) if when else now_msk()
             rec = UserConsent(user_id=user_id, kind=kind, accepted_at=to_utc_for_db(when_msk))
             s.add(rec)
@@ -277,8 +335,7 @@ class AppRepository:
         until_msk = now_msk() + timedelta(hours=int(hours))
         until_utc = to_utc_for_db(until_msk)  # Для БД храним в UTC
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
+            self._ensure_user_row(s, user_id)
             rec = s.get(Trial, user_id)
             if rec is None:
                 s.add(Trial(user_id=user_id, until_at=until_utc))
@@ -431,6 +488,34 @@ class AppRepository:
         now_msk_val = now_msk()
         return max(0, int((until - now_msk_val).total_seconds() // 3600))
 
+    def trial_until_map(self, user_ids: list[int]) -> dict[int, datetime]:
+        """{user_id: конец триала (МСК)} одним запросом на пачку (membership enforcer)."""
+        out: dict[int, datetime] = {}
+        ids = list({int(u) for u in user_ids})
+        with self._session() as s:
+            for i in range(0, len(ids), 1000):
+                rows = s.query(Trial.user_id, Trial.until_at).filter(Trial.user_id.in_(ids[i:i + 1000])).all()
+                for uid, until_at in rows:
+                    if until_at is not None:
+                        out[int(uid)] = from_db_naive(until_at)
+        return out
+
+    def trial_rows_map(self, user_ids: list[int]) -> dict[int, tuple[datetime, datetime]]:
+        """{user_id: (created_at, until_at) в МСК} одним запросом на пачку (кампании уведомлений)."""
+        out: dict[int, tuple[datetime, datetime]] = {}
+        ids = list({int(u) for u in user_ids})
+        with self._session() as s:
+            for i in range(0, len(ids), 1000):
+                rows = (
+                    s.query(Trial.user_id, Trial.created_at, Trial.until_at)
+                    .filter(Trial.user_id.in_(ids[i:i + 1000]))
+                    .all()
+                )
+                for uid, created_at, until_at in rows:
+                    if created_at is not None and until_at is not None:
+                        out[int(uid)] = (from_db_naive(created_at), from_db_naive(until_at))
+        return out
+
     def list_trial_active_user_ids(self, now: Optional[datetime] = None) -> list[int]:
         """Все пользователи, у кого активен триал на момент now (MySQL 8+)."""
         now_msk_val = to_aware_msk(now) if now else now_msk()
@@ -443,12 +528,33 @@ class AppRepository:
             )
             return [uid for (uid,) in rows]
 
+    def trial_active_user_ids_page(self, now: Optional[datetime] = None, *,
+                                   after_user_id: int = 0, limit: int = 1000) -> list[int]:
+        """
+        Страница активных триалов по возрастанию user_id (keyset: user_id > after_user_id).
+        Потоковая выборка получателей рассылки: идёт по PK trials, без OFFSET.
+        """
+        now_utc = to_utc_for_db(to_aware_msk(now) if now else now_msk())
+        with self._session() as s:
+            rows = (
+                s.query(Trial.user_id)
+                .filter(Trial.user_id > after_user_id, Trial.until_at > now_utc)
+                .order_by(Trial.user_id)
+                .limit(limit)
+                .all()
+            )
+            return [uid for (uid,) in rows]
+
+    def count_trial_active(self, now: Optional[datetime] = None) -> int:
+        now_utc = to_utc_for_db(to_aware_msk(now) if now else now_msk())
+        with self._session() as s:
+            return int(s.query(func.count(Trial.user_id)).filter(Trial.until_at > now_utc).scalar() or 0)
+
     # --- history ---
     def history_add(self, user_id: int, payload: dict, final_text: str, *,
                     case_id: Optional[str] = None) -> ReviewHistory:
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
+            self._ensure_user_row(s, user_id)
             rec = ReviewHistory(
                 user_id=user_id,
                 case_id=case_id,
@@ -541,8 +647,7 @@ class AppRepository:
     def summary_add_entry(self, user_id: int, *, source_type: str, options: dict, payload: dict,
                           result: Optional[dict]) -> int:
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
+            self._ensure_user_row(s, user_id)
             rec = SummaryHistory(
                 user_id=user_id,
                 source_type=source_type or "unknown",
@@ -589,8 +694,7 @@ class AppRepository:
     # --- description ---
     def description_add(self, user_id: int, *, fields: dict, result_text: str) -> int:
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
+            self._ensure_user_row(s, user_id)
             # Не сохраняем пустые/пробельные результаты
             trimmed = (result_text or "").strip()
             if not trimmed:
@@ -612,8 +716,7 @@ class AppRepository:
         result_text пустой). Возвращает id записи.
         """
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
+            self._ensure_user_row(s, user_id)
             rec = DescriptionHistory(
                 user_id=user_id,
                 msg_id=msg_id,
@@ -744,12 +847,177 @@ class AppRepository:
     # --- events ---
     def event_add(self, user_id: int, text: str) -> None:
         """Сохраняет событие (user_id, сообщение и точный timestamp)."""
-        ts = to_utc_for_db(now_msk())  # Для БД храним в UTC
+        self.events_add_bulk([(user_id, text, now_msk())])
+
+    def events_add_bulk(self, events: list[tuple[int, str, datetime]]) -> int:
+        """
+        Пакетная запись событий (user_id, сообщение, время) за одну транзакцию:
+          1) недостающие пользователи — одним INSERT IGNORE (без get() на каждое событие);
+          2) события — одним multi-row INSERT в event_log;
+          3) users.first_seen_at/last_seen_at — _touch_seen.
+        Поддерживает как MySQL, так и SQLite (для тестов). Возвращает число записанных событий.
+        """
+        return self.events_add_bulk_tracked(events)[0]
+
+    def events_add_bulk_tracked(
+        self, events: list[tuple[int, str, datetime]],
+    ) -> tuple[int, dict[int, datetime]]:
+        """То же + {user_id: first_seen_at} для тех, у кого это первые события."""
+        if not events:
+            return 0, {}
+        user_ids = sorted({int(uid) for uid, _, _ in events})
+        rows = [
+            {"user_id": int(uid), "message": str(text), "created_at": to_utc_for_db(ts)}
+            for uid, text, ts in events
+        ]
         with self._session() as s, s.begin():
-            if s.get(User, user_id) is None:
-                s.add(User(user_id=user_id))
-            rec = EventLog(user_id=user_id, message=str(text), created_at=ts)
-            s.add(rec)
+            # Определяем диалект БД
+            dialect = s.bind.dialect.name
+            if dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+                users_stmt = (
+                    sqlite_insert(User)
+                    .values([{"user_id": uid} for uid in user_ids])
+                    .on_conflict_do_nothing(index_elements=['user_id'])
+                )
+            else:
+                from sqlalchemy.dialects.mysql import insert as mysql_insert
+                users_stmt = (
+                    mysql_insert(User)
+                    .values([{"user_id": uid} for uid in user_ids])
+                    .prefix_with("IGNORE")
+                )
+            s.execute(users_stmt)
+            s.execute(insert(EventLog).values(rows))
+            first_seen = self._touch_seen(s, rows)
+        return len(rows), first_seen
+
+    @staticmethod
+    def _touch_seen(s: Session, rows: list[dict]) -> dict[int, datetime]:
+        """
+        Сдвигает users.first_seen_at/last_seen_at по событиям пачки:
+        одно UPDATE (executemany) на пачку, а не MIN(created_at) по всему event_log.
+        Возвращает {user_id: first_seen_at} для пользователей, у кого его ещё не было.
+        """
+        seen: dict[int, list[datetime]] = {}
+        for r in rows:
+            ts = r["created_at"]
+            cur = seen.get(r["user_id"])
+            if cur is None:
+                seen[r["user_id"]] = [ts, ts]
+            else:
+                cur[0] = min(cur[0], ts)
+                cur[1] = max(cur[1], ts)
+        t = User.__table__
+        dt = t.c.first_seen_at.type
+        first, last = bindparam("b_first", type_=dt), bindparam("b_last", type_=dt)
+        stmt = (
+            update(t)
+            .where(t.c.user_id == bindparam("b_uid"))
+            .values(
+                first_seen_at=case(
+                    (or_(t.c.first_seen_at.is_(None), t.c.first_seen_at > first), first),
+                    else_=t.c.first_seen_at,
+                ),
+                last_seen_at=case(
+                    (or_(t.c.last_seen_at.is_(None), t.c.last_seen_at < last), last),
+                    else_=t.c.last_seen_at,
+                ),
+            )
+        )
+        fresh = {
+            uid for (uid,) in s.execute(
+                select(User.user_id).where(User.user_id.in_(list(seen)), User.first_seen_at.is_(None))
+            )
+        }
+        s.execute(stmt, [{"b_uid": uid, "b_first": f, "b_last": l} for uid, (f, l) in seen.items()])
+        return {uid: seen[uid][0] for uid in fresh}
+
+    def seen_backfill_pending(self) -> bool:
+        """Есть пользователи без first_seen_at, но с событиями в event_log (заполнение не закончено)."""
+        with self._session() as s:
+            return s.execute(
+                select(User.user_id)
+                .where(User.first_seen_at.is_(None))
+                .where(select(EventLog.id).where(EventLog.user_id == User.user_id).exists())
+                .limit(1)
+            ).first() is not None
+
+    def backfill_seen_at(self, chunk: int = 1000) -> int:
+        """
+        Заполняет first_seen_at/last_seen_at по event_log для пользователей, у кого их нет
+        (миграция существующей базы). Идёт пачками по user_id: агрегат event_log
+        только по пачке (индекс по event_log.user_id). Возвращает число заполненных.
+        """
+        filled = 0
+        after = -1
+        while True:
+            with self._session() as s, s.begin():
+                ids = [
+                    uid for (uid,) in s.execute(
+                        select(User.user_id)
+                        .where(User.user_id > after, User.first_seen_at.is_(None))
+                        .order_by(User.user_id)
+                        .limit(chunk)
+                    )
+                ]
+                if not ids:
+                    return filled
+                after = ids[-1]
+                agg = s.execute(
+                    select(EventLog.user_id, func.min(EventLog.created_at), func.max(EventLog.created_at))
+                    .where(EventLog.user_id.in_(ids))
+                    .group_by(EventLog.user_id)
+                ).all()
+                if agg:
+                    t = User.__table__
+                    s.execute(
+                        update(t)
+                        .where(t.c.user_id == bindparam("b_uid"))
+                        .values(first_seen_at=bindparam("b_first"), last_seen_at=bindparam("b_last")),
+                        [{"b_uid": uid, "b_first": f, "b_last": l} for uid, f, l in agg],
+                    )
+                    filled += len(agg)
+
+    def first_seen_map(self, user_ids: list[int]) -> dict[int, datetime]:
+        """{user_id: first_seen_at (МСК)} для пачки; без событий — нет в ответе."""
+        out: dict[int, datetime] = {}
+        ids = list({int(u) for u in user_ids})
+        with self._session() as s:
+            for i in range(0, len(ids), 1000):
+                rows = s.execute(
+                    select(User.user_id, User.first_seen_at)
+                    .where(User.user_id.in_(ids[i:i + 1000]), User.first_seen_at.is_not(None))
+                )
+                for uid, first_at in rows:
+                    out[int(uid)] = from_db_naive(first_at)
+        return out
+
+    def list_first_seen_in_windows(
+        self, now: Optional[datetime], thresholds_h: list[float], window_h: float,
+    ) -> list[tuple[int, datetime]]:
+        """
+        Пользователи, у кого с first_seen_at прошло [порог, порог + window_h) часов
+        хотя бы для одного порога. Диапазоны по idx_users_first_seen, без event_log.
+        first_seen_at возвращается как в БД (naive UTC).
+        """
+        now_utc = to_utc_for_db(to_aware_msk(now) if now else now_msk())
+        ranges = [
+            and_(
+                User.first_seen_at > now_utc - timedelta(hours=t + window_h),
+                User.first_seen_at <= now_utc - timedelta(hours=t),
+            )
+            for t in thresholds_h
+        ]
+        if not ranges:
+            return []
+        with self._session() as s:
+            return [
+                (int(uid), first_at)
+                for uid, first_at in s.execute(
+                    select(User.user_id, User.first_seen_at).where(or_(*ranges))
+                )
+            ]
 
 
 # Глобальный репозиторий (app DB)
@@ -768,7 +1036,14 @@ def check_and_add_user(user_id: int, *, chat_id: Optional[int] = None, username:
 
 # Trial (возвращаем datetime, чтобы вызывать .date() в хендлере без плясок)
 def set_trial(user_id: int, hours: int = 72) -> datetime:
-    return _repo.set_trial(user_id, hours)
+    until = _repo.set_trial(user_id, hours)
+    # триал изменился — сбрасываем кэш снимка доступа (см. payment_handler.AccessSnapshot)
+    invalidate_access_cache_nowait(user_id)
+    # и переносим срок проверки в очереди удалений из чата (bot/utils/membership_enforcer.py)
+    schedule_membership_expiry_nowait(user_id, until)
+    # кампания онбординга триала (bot/utils/notification.py) пересчитает шаги
+    schedule_notification_nowait("trial", user_id)
+    return until
 
 
 def get_trial_until(user_id: int) -> Optional[datetime]:
@@ -791,6 +1066,18 @@ def list_trial_active_user_ids(now: Optional[datetime] = None) -> list[int]:
     return _repo.list_trial_active_user_ids(now)
 
 
+def trial_active_user_ids_page(now: Optional[datetime] = None, *, after_user_id: int = 0, limit: int = 1000) -> list[int]:
+    return _repo.trial_active_user_ids_page(now, after_user_id=after_user_id, limit=limit)
+
+
+def count_trial_active(now: Optional[datetime] = None) -> int:
+    return _repo.count_trial_active(now)
+
+
+def trial_until_map(user_ids: list[int]) -> dict[int, datetime]:
+    return _repo.trial_until_map(user_ids)
+
+
 # Trial cooldown helpers
 def trial_cooldown_days_left(user_id: int, *, cooldown_days: int = 60) -> int:
     return _repo.trial_cooldown_days_left(user_id, cooldown_days=cooldown_days)
@@ -889,4 +1176,30 @@ def add_consent(user_id: int, kind: str, when: Optional[datetime] = None) -> int
 # Event log (простой интерфейс)
 def event_add(user_id: int, text: str) -> None:
     return _repo.event_add(user_id, text)
+
+
+def events_add_bulk(events: list[tuple[int, str, datetime]]) -> int:
+    written, first_seen = _repo.events_add_bulk_tracked(events)
+    # первые события пользователя — он входит в кампанию «не подписался»
+    for uid, first_at in first_seen.items():
+        schedule_notification_nowait("unsub", uid, first_at)
+    return written
+
+
+def first_seen_map(user_ids: list[int]) -> dict[int, datetime]:
+    return _repo.first_seen_map(user_ids)
+
+
+def trial_rows_map(user_ids: list[int]) -> dict[int, tuple[datetime, datetime]]:
+    return _repo.trial_rows_map(user_ids)
+
+
+def backfill_seen_at(chunk: int = 1000) -> int:
+    return _repo.backfill_seen_at(chunk)
+
+
+def list_first_seen_in_windows(
+    now: Optional[datetime], thresholds_h: list[float], window_h: float,
+) -> list[tuple[int, datetime]]:
+    return _repo.list_first_seen_in_windows(now, thresholds_h, window_h)
 #I'm using MYSQL8+ for this proj.
\ No newline at end of file
@@ -0,0 +1,185 @@
+# smart_agent/bot/utils/event_logger.py
+"""
+Write-behind логгер кликов/сообщений (event_log).
+
+Мидлвари не пишут в БД сами: событие кладётся в ограниченную asyncio-очередь,
+а фоновая задача сбрасывает накопленное пачкой (app_db.events_add_bulk) —
+каждые FLUSH_INTERVAL_MS или по достижении BATCH_SIZE событий.
+
+Backpressure: очередь ограничена MAX_QUEUE; при переполнении новое событие
+отбрасывается (хендлер никогда не ждёт логгер), счётчик dropped растёт.
+На остановке бота очередь дописывается синхронно через flush_sync().
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import bot.utils.database as app_db
+from bot.utils.async_db import run_db
+from bot.utils.time_helpers import now_msk
+
+LOG = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_MS = int(os.getenv("EVENT_LOG_FLUSH_INTERVAL_MS", "500"))
+BATCH_SIZE = int(os.getenv("EVENT_LOG_BATCH_SIZE", "200"))
+MAX_QUEUE = int(os.getenv("EVENT_LOG_MAX_QUEUE", "10000"))
+
+# Не чаще одного предупреждения о дропах в N секунд
+_DROP_WARN_EVERY_SEC = 30
+
+EventRow = Tuple[int, str, datetime]
+
+
+class EventLogWriter:
+    def __init__(
+        self,
+        *,
+        flush_interval_ms: int = FLUSH_INTERVAL_MS,
+        batch_size: int = BATCH_SIZE,
+        max_queue: int = MAX_QUEUE,
+    ):
+        self.flush_interval = max(1, flush_interval_ms) / 1000.0
+        self.batch_size = max(1, batch_size)
+        self.max_queue = max(1, max_queue)
+        self._queue: Optional[asyncio.Queue[EventRow]] = None
+        self._task: Optional[asyncio.Task] = None
+        # Пачка, которая собирается прямо сейчас (ещё не отправлена в БД)
+        self._collecting: List[EventRow] = []
+        self._last_drop_warn = 0.0
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    # --- жизненный цикл ---
+    def start(self) -> None:
+        """Запускает фоновую задачу сброса (идемпотентно, нужен работающий event loop)."""
+        if self._task is not None and not self._task.done():
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="event_log_writer")
+
+    async def stop(self) -> None:
+        """Останавливает фоновую задачу и дописывает всё, что осталось в очереди."""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        batch = self._drain()
+        if batch:
+            await self._write(batch)
+
+    # --- запись ---
+    def log(self, user_id: int, text: str) -> bool:
+        """
+        Неблокирующая постановка события в очередь.
+        Возвращает False, если очередь переполнена и событие отброшено.
+        """
+        try:
+            self.start()
+        except RuntimeError:
+            # нет работающего event loop — пишем напрямую (скрипты/тесты)
+            return self._write_sync([(int(user_id), str(text), now_msk())])
+        try:
+            self._queue.put_nowait((int(user_id), str(text), now_msk()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            now = time.monotonic()
+            if now - self._last_drop_warn >= _DROP_WARN_EVERY_SEC:
+                self._last_drop_warn = now
+                LOG.warning("event_log queue is full (%s), dropped=%s", self.max_queue, self.dropped)
+            return False
+        self.enqueued += 1
+        return True
+
+    async def flush(self) -> None:
+        """Принудительно сбрасывает очередь (без остановки фоновой задачи)."""
+        batch = self._drain()
+        if batch:
+            await self._write(batch)
+
+    def flush_sync(self) -> int:
+        """
+        Синхронный сброс очереди для обработчика сигнала (_stop в run.py): событие
+        записано, даже если дальнейшая остановка не уложится в таймаут.
+        Возвращает число записанных событий.
+        """
+        batch = self._drain()
+        if not batch:
+            return 0
+        return len(batch) if self._write_sync(batch) else 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+    # --- внутреннее ---
+    def _drain(self) -> List[EventRow]:
+        batch, self._collecting = self._collecting, []
+        if self._queue is not None:
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Ждём первое событие без таймаута, дальше добираем пачку до дедлайна
+            self._collecting.append(await self._queue.get())
+            deadline = loop.time() + self.flush_interval
+            while len(self._collecting) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._collecting.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._collecting = self._collecting, []
+            await self._write(batch)
+
+    async def _write(self, batch: List[EventRow]) -> None:
+        for i in range(0, len(batch), self.batch_size):
+            chunk = batch[i:i + self.batch_size]
+            try:
+                await run_db(app_db.events_add_bulk, chunk)
+                self.written += len(chunk)
+                self.batches += 1
+            except Exception as e:
+                self.failed += len(chunk)
+                LOG.warning("event_log batch write failed (%s events): %s", len(chunk), e)
+
+    def _write_sync(self, batch: List[EventRow]) -> bool:
+        try:
+            for i in range(0, len(batch), self.batch_size):
+                app_db.events_add_bulk(batch[i:i + self.batch_size])
+            self.written += len(batch)
+            self.batches += 1
+            return True
+        except Exception as e:
+            self.failed += len(batch)
+            LOG.warning("event_log sync write failed (%s events): %s", len(batch), e)
+            return False
+
+
+# Глобальный логгер событий (используется мидлварями clicklog_mw)
+event_logger = EventLogWriter()
@@ -0,0 +1,367 @@
+# smart_agent/bot/utils/executor_client.py
+"""
+Общий HTTP-клиент бота к executor'у (описания, отзывы, возражения, саммари, дизайн, планы).
+
+Раньше каждый вызов создавал и закрывал свой aiohttp.ClientSession — новый TCP connect
+на каждый запрос и никакого keep-alive. Здесь одна сессия на всё приложение:
+  — пул соединений (TCPConnector: EXECUTOR_HTTP_LIMIT / keep-alive);
+  — таймауты и ретраи по эндпоинтам (_POLICIES, вызывающий может переопределить timeout);
+  — счётчики задержек/ошибок по эндпоинтам (stats());
+  — путь /plan/generate (с префиксом API или без) определяется один раз при старте;
+  — потоковый режим (stream_text): SSE-дельты от executor'а для прогрессивного вывода.
+
+Жизненный цикл: await executor_client.start() при запуске бота, await executor_client.close()
+при остановке. Если start() не вызывали (скрипты/тесты) — сессия создаётся лениво.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+import aiohttp
+
+from bot.config import EXECUTOR_BASE_URL
+
+LOG = logging.getLogger(__name__)
+
+HTTP_LIMIT = int(os.getenv("EXECUTOR_HTTP_LIMIT", "64"))
+HTTP_KEEPALIVE_SEC = float(os.getenv("EXECUTOR_HTTP_KEEPALIVE_SEC", "60"))
+CONNECT_TIMEOUT_SEC = float(os.getenv("EXECUTOR_CONNECT_TIMEOUT_SEC", "5"))
+API_PREFIX = os.getenv("EXECUTOR_API_PREFIX", "/api/v1").strip("/")
+# Потоковый вывод генерации (SSE); 0 — старый режим «ждём весь ответ»
+STREAM_ENABLED = os.getenv("EXECUTOR_STREAM", "1") == "1"
+
+# Статусы, на которых имеет смысл повторить запрос (executor перегружен/перезапускается)
+_RETRY_STATUSES = {429, 502, 503, 504}
+_RETRY_BACKOFF_SEC = 0.5
+_RETRY_AFTER_CAP_SEC = 5.0
+
+
+@dataclass(frozen=True)
+class EndpointPolicy:
+    timeout: float
+    retries: int = 0
+
+
+# Ключ — путь эндпоинта без префикса API
+_POLICIES: Dict[str, EndpointPolicy] = {
+    "objection/generate": EndpointPolicy(timeout=70, retries=1),
+    "review/generate": EndpointPolicy(timeout=90, retries=1),
+    "review/mutate": EndpointPolicy(timeout=60, retries=1),
+    "summary/analyze": EndpointPolicy(timeout=120, retries=1),
+    # async-режим: executor отвечает 202 сразу, результат придёт callback'ом
+    "description/generate": EndpointPolicy(timeout=10, retries=2),
+    # генерация изображений — минуты, повтор = повторная оплата генерации
+    "design/generate": EndpointPolicy(timeout=600, retries=0),
+    "plan/generate": EndpointPolicy(timeout=600, retries=0),
+}
+_DEFAULT_POLICY = EndpointPolicy(timeout=60, retries=0)
+
+
+class ExecutorHTTPError(RuntimeError):
+    """Executor ответил неуспешным статусом."""
+
+    def __init__(self, status: int, detail: Any):
+        super().__init__(f"Executor HTTP {status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+class _EndpointStats:
+    __slots__ = ("requests", "errors", "retries", "timeouts", "total_ms", "max_ms", "last_status")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_status: Optional[int] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "avg_ms": round(self.total_ms / self.requests, 1) if self.requests else 0.0,
+            "max_ms": round(self.max_ms, 1),
+            "last_status": self.last_status,
+        }
+
+
+class ExecutorClient:
+    def __init__(
+        self,
+        base_url: Optional[str],
+        *,
+        api_prefix: str = API_PREFIX,
+        limit: int = HTTP_LIMIT,
+        keepalive_sec: float = HTTP_KEEPALIVE_SEC,
+        connect_timeout_sec: float = CONNECT_TIMEOUT_SEC,
+        streaming: bool = STREAM_ENABLED,
+    ):
+        self.base_url = (base_url or "http://localhost:8080").rstrip("/")
+        self.api_prefix = api_prefix.strip("/")
+        self.limit = max(1, limit)
+        self.keepalive_sec = keepalive_sec
+        self.connect_timeout_sec = connect_timeout_sec
+        self.streaming = streaming
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stats: Dict[str, _EndpointStats] = {}
+        # Полный URL /plan/generate после проверки (None — ещё не определён)
+        self._plan_url: Optional[str] = None
+
+    # --- жизненный цикл ---
+    async def start(self) -> None:
+        """Создаёт сессию с пулом соединений и определяет путь plan/generate."""
+        self._session_or_init()
+        await self.resolve_plan_url()
+
+    async def close(self) -> None:
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    def _session_or_init(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit,
+                keepalive_timeout=self.keepalive_sec,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    # --- URL ---
+    def url(self, endpoint: str) -> str:
+        """'objection/generate' → '{base}/api/v1/objection/generate'."""
+        path = endpoint.strip("/")
+        return f"{self.base_url}/{self.api_prefix}/{path}" if self.api_prefix else f"{self.base_url}/{path}"
+
+    async def resolve_plan_url(self) -> str:
+        """
+        Один раз проверяет, где executor обслуживает plan/generate: с префиксом API
+        или по «старому» пути без префикса. GET на POST-маршрут отдаёт 405, на
+        отсутствующий — 404. Если executor недоступен — определим при первом вызове.
+        """
+        primary = self.url("plan/generate")
+        fallback = f"{self.base_url}/plan/generate"
+        if not self.api_prefix:
+            self._plan_url = primary
+            return primary
+        session = self._session_or_init()
+        timeout = aiohttp.ClientTimeout(total=self.connect_timeout_sec * 2, connect=self.connect_timeout_sec)
+        try:
+            async with session.get(primary, timeout=timeout) as resp:
+                if resp.status != 404:
+                    self._plan_url = primary
+                    return primary
+            async with session.get(fallback, timeout=timeout) as resp:
+                self._plan_url = fallback if resp.status != 404 else primary
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOG.warning("executor plan url probe failed (%s), will retry on first use", e)
+            return primary
+        LOG.info("executor plan/generate resolved to %s", self._plan_url)
+        return self._plan_url
+
+    async def plan_url(self) -> str:
+        return self._plan_url or await self.resolve_plan_url()
+
+    # --- запросы ---
+    async def post_json(
+        self,
+        endpoint: str,
+        payload: Dict[str, Any],
+        *,
+        timeout: Optional[float] = None,
+        ok_statuses: Iterable[int] = (200,),
+        params: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        """POST JSON на эндпоинт executor'а; возвращает JSON ответа или бросает ExecutorHTTPError."""
+        return await self._request(
+            endpoint, self.url(endpoint), lambda: {"json": payload},
+            timeout=timeout, ok_statuses=ok_statuses, params=params, headers=headers,
+        )
+
+    async def post_form(
+        self,
+        endpoint: str,
+        build_form: Callable[[], aiohttp.FormData],
+        *,
+        url: Optional[str] = None,
+        timeout: Optional[float] = None,
+        ok_statuses: Iterable[int] = (200,),
+        params: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        """
+        POST multipart. FormData одноразовая, поэтому передаётся фабрика —
+        на ретрае форма собирается заново.
+        """
+        return await self._request(
+            endpoint, url or self.url(endpoint), lambda: {"data": build_form()},
+            timeout=timeout, ok_statuses=ok_statuses, params=params, headers=headers,
+        )
+
+    async def _request(
+        self,
+        endpoint: str,
+        url: str,
+        body: Callable[[], Dict[str, Any]],
+        *,
+        timeout: Optional[float],
+        ok_statuses: Iterable[int],
+        params: Optional[Dict[str, str]],
+        headers: Optional[Dict[str, str]],
+        read: Optional[Callable[[aiohttp.ClientResponse], Awaitable[Any]]] = None,
+    ) -> Any:
+        key = endpoint.strip("/")
+        policy = _POLICIES.get(key, _DEFAULT_POLICY)
+        st = self._stats.setdefault(key, _EndpointStats())
+        client_timeout = aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else policy.timeout,
+            connect=self.connect_timeout_sec,
+        )
+        ok = set(ok_statuses)
+        session = self._session_or_init()
+
+        attempt = 0
+        while True:
+            st.requests += 1
+            t0 = time.perf_counter()
+            retry_delay: Optional[float] = None
+            try:
+                async with session.post(url, timeout=client_timeout, params=params, headers=headers, **body()) as resp:
+                    st.last_status = resp.status
+                    if resp.status in ok:
+                        if read is not None:
+                            return await read(resp)
+                        try:
+                            return await resp.json(content_type=None)
+                        except Exception:
+                            return {}
+                    detail = await _extract_error_detail(resp)
+                    st.errors += 1
+                    err: Exception = ExecutorHTTPError(resp.status, detail)
+                    if resp.status in _RETRY_STATUSES:
+                        retry_delay = _retry_after(resp, attempt)
+            except ExecutorHTTPError:
+                # оборванный/ошибочный поток — повтор задублировал бы уже показанный текст
+                st.errors += 1
+                raise
+            except asyncio.TimeoutError as e:
+                st.errors += 1
+                st.timeouts += 1
+                err = e
+            except aiohttp.ClientConnectionError as e:
+                # executor перезапускается / соединение из пула оборвано — безопасно повторить
+                st.errors += 1
+                err = e
+                retry_delay = _RETRY_BACKOFF_SEC * (2 ** attempt)
+            finally:
+                elapsed_ms = (time.perf_counter() - t0) * 1000
+                st.total_ms += elapsed_ms
+                st.max_ms = max(st.max_ms, elapsed_ms)
+
+            if retry_delay is None or attempt >= policy.retries:
+                raise err
+            attempt += 1
+            st.retries += 1
+            LOG.warning("executor %s failed (%s), retry %s/%s in %.1fs", key, err, attempt, policy.retries, retry_delay)
+            await asyncio.sleep(retry_delay)
+
+    async def stream_text(
+        self,
+        endpoint: str,
+        payload: Dict[str, Any],
+        *,
+        on_text: Callable[[str], Awaitable[Any]],
+        timeout: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        POST с ?stream=1: executor отдаёт SSE (delta/done/error, см. executor/streaming.py).
+        on_text(накопленный_текст) вызывается на каждую дельту; возвращает данные done
+        ({"text": ..., "model": ...}). Повторы — только до начала потока.
+        Если стриминг выключен (EXECUTOR_STREAM=0) — обычный JSON-запрос без промежуточных вызовов.
+        """
+        if not self.streaming:
+            return await self.post_json(endpoint, payload, timeout=timeout, headers=headers)
+        return await self._request(
+            endpoint, self.url(endpoint), lambda: {"json": payload},
+            timeout=timeout, ok_statuses=(200,), params={"stream": "1"},
+            headers={"Accept": "text/event-stream", **(headers or {})},
+            read=lambda resp: _read_sse(resp, on_text),
+        )
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {key: st.as_dict() for key, st in self._stats.items()}
+
+
+async def _read_sse(resp: aiohttp.ClientResponse, on_text: Callable[[str], Awaitable[Any]]) -> Dict[str, Any]:
+    """Разбор SSE-потока executor'а; ошибки посреди потока → ExecutorHTTPError."""
+    text = ""
+    event, data_lines = "message", []
+    try:
+        async for raw in resp.content:
+            line = raw.decode("utf-8").rstrip("\r\n")
+            if line.startswith(":"):
+                continue
+            if line:
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "event":
+                    event = value
+                elif field == "data":
+                    data_lines.append(value)
+                continue
+            if not data_lines:
+                continue
+            data = json.loads("\n".join(data_lines))
+            if event == "delta":
+                text += data.get("text") or ""
+                try:
+                    await on_text(text)
+                except Exception as e:
+                    LOG.warning("executor stream on_text failed: %s", e)
+            elif event == "done":
+                return data
+            elif event == "error":
+                status = 429 if data.get("retry_after") else 502
+                raise ExecutorHTTPError(status, data.get("detail") or data.get("error"))
+            event, data_lines = "message", []
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise ExecutorHTTPError(502, f"stream interrupted: {e!r}") from e
+    raise ExecutorHTTPError(502, "stream ended without result")
+
+
+def _retry_after(resp: aiohttp.ClientResponse, attempt: int) -> float:
+    try:
+        return min(float(resp.headers.get("Retry-After", "")), _RETRY_AFTER_CAP_SEC)
+    except ValueError:
+        return _RETRY_BACKOFF_SEC * (2 ** attempt)
+
+
+async def _extract_error_detail(resp: aiohttp.ClientResponse) -> Any:
+    try:
+        data = await resp.json(content_type=None)
+        if isinstance(data, dict):
+            return data.get("detail") or data.get("error") or data
+        return data
+    except Exception:
+        try:
+            return await resp.text()
+        except Exception:
+            return ""
+
+
+# Глобальный клиент бота (start/close — в bot/run.py)
+executor_client = ExecutorClient(EXECUTOR_BASE_URL)
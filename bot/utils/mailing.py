@@ -3,7 +3,8 @@
 from __future__ import annotations
 
 import logging
-from typing import Dict, Any, List
+import heapq
+from typing import Dict, Any, AsyncIterable, AsyncIterator, Iterable, List, Tuple
 from zoneinfo import ZoneInfo
 from datetime import datetime, timezone
 from html import escape as _html_escape
@@ -14,12 +15,16 @@ from aiogram.types import InputMediaPhoto, InputMediaVideo
 import bot.utils.admin_db as adb
 import bot.utils.database as app_db
 import bot.utils.billing_db as billing_db
+from bot.utils.tg_shaper import Priority, send_priority
+from bot.utils.async_db import run_db
+from bot.utils.broadcast_engine import broadcast_engine
 
 
 MSK = ZoneInfo("Europe/Moscow")
 
 
 CHUNK_SIZE = 10  # Telegram ограничивает медиа-группу 10 элементами
+RECIPIENT_PAGE = 1000  # размер keyset-страницы при потоковой выборке получателей
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ГРУППОВОЙ РЕЖИМ ТОЛЬКО ДЛЯ "СООБЩЕНИЙ ИЗ БД" (run_mailing_scheduler/broadcast)
@@ -135,12 +140,20 @@ async def preview_to_chat(bot: Bot, chat_id: int, mailing: Dict[str, Any]) -> No
     await send_to_user(bot, chat_id, mailing)
 
 
-async def broadcast(bot: Bot, mailing: Dict[str, Any], user_ids: List[int]) -> None:
+async def broadcast(bot: Bot, mailing: Dict[str, Any], user_ids: Iterable[int] | AsyncIterable[int]) -> None:
     """
     Отправляет одну запись сразу списку пользователей.
-    Ошибки по отдельным пользователям логируем в stdout, остальные не блокируем.
+    Индивидуальный режим — broadcast_engine: параллельные отправки, журнал доставки
+    в mailing_events и докачка с курсора после рестарта; ошибки по отдельным
+    пользователям остальных не блокируют.
     В групповом режиме (MAILING_DB_TO_GROUP=True) — отправляем ОДИН раз в GROUP_CHAT_ID.
+    Темп отправки — общий (tg_shaper) с низшим приоритетом: ответы пользователям идут вперёд.
     """
+    with send_priority(Priority.BROADCAST):
+        await _broadcast(bot, mailing, user_ids)
+
+
+async def _broadcast(bot: Bot, mailing: Dict[str, Any], user_ids: Iterable[int] | AsyncIterable[int]) -> None:
     # Групповой режим: публикуем один раз и выходим
     if MAILING_DB_TO_GROUP:
         try:
@@ -150,12 +163,14 @@ async def broadcast(bot: Bot, mailing: Dict[str, Any], user_ids: List[int]) -> N
             print(f"[mailing] send error to group {GROUP_CHAT_ID}: {e}")
         return
 
-    # Индивидуальный режим: как было
-    for uid in user_ids:
+    # Индивидуальный режим: задание с курсором (повторный вызов продолжит с места остановки)
+    total = None
+    if isinstance(user_ids, AsyncIterable):
         try:
-            await send_to_user(bot, int(uid), mailing)
+            total = await run_db(count_recipients, datetime.now(timezone.utc))
         except Exception as e:
-            print(f"[mailing] send error to {uid}: {e}")
+            logging.warning("[mailing] count_recipients failed: %s", e)
+    await broadcast_engine.run(bot, mailing, user_ids, send_to_user, total=total)
 
 
 async def send_last_published_to_user(bot: Bot, user_id: int) -> None:
@@ -215,7 +230,7 @@ async def run_mailing_scheduler(bot: Bot) -> None:
       - publish_at <= NOW()
     Шлёт подписчикам и помечает как выполненные.
     """
-    pending = adb.get_pending_mailings()
+    pending = await run_db(adb.get_pending_mailings)
     logging.info(
         "[mailing] pending=%s at %s MSK",
         len(pending),
@@ -233,42 +248,70 @@ async def run_mailing_scheduler(bot: Bot) -> None:
             logging.info("[mailing] completed (group) id=%s → posted to %s", m["id"], GROUP_CHAT_ID)
         return
 
-    # Индивидуальный режим: как было — собираем реципиентов
-    now_utc = datetime.now(timezone.utc)
-    user_ids = _collect_recipients(now_utc)
-    logging.info("[mailing] recipients total=%s", len(user_ids))
-
-    if not user_ids:
-        for m in pending:
-            adb.mark_mailing_completed(m["id"])
-            logging.info("[mailing] no recipients (individual mode) → mark completed id=%s", m["id"])
-        return
-
+    # Индивидуальный режим: получатели читаются потоком по ходу отправки.
+    # Ошибка выборки/отправки оставляет задание незавершённым — следующий тик продолжит с курсора.
     for m in pending:
-        await broadcast(bot, m, user_ids)
+        now_utc = datetime.now(timezone.utc)
+        await broadcast(bot, m, iter_recipients(now_utc))
         adb.mark_mailing_completed(m["id"])
         logging.info("[mailing] completed (individual) id=%s", m["id"])
 
 
-def _collect_recipients(now_utc: datetime) -> List[int]:
+async def next_mailing_delay(max_sec: float = 120.0) -> float:
     """
-    Возвращает отсортированный список user_id, которые должны получить рассылку «на сейчас»:
+    Сколько mailing_loop спать до следующего тика: до ближайшей будущей publish_at среди
+    ждущих (MIN по индексу), но не дольше max_sec — запись, созданную или перенесённую
+    в админке на более раннее время, подхватит следующий тик. Просроченные (тик упал,
+    рассылка докачивается) в MIN не входят: их повторяет каждый тик в обычном ритме,
+    а следующая по расписанию уходит вовремя.
+    """
+    now = datetime.now(timezone.utc)
+    due = await run_db(adb.get_next_mailing_due, now)
+    if due is None:
+        return max_sec
+    left = (due - now).total_seconds()
+    return max(0.0, min(max_sec, left))
+
+
+async def iter_recipients(now_utc: datetime, *, page_size: int = RECIPIENT_PAGE) -> AsyncIterator[int]:
+    """
+    Получатели рассылки «на сейчас» по возрастанию user_id, без повторов:
     пользователи с активным триалом ИЛИ с активной подпиской.
-    Вход: now_utc — aware datetime в UTC.
+    Когорты в разных БД, поэтому каждая читается своими keyset-страницами
+    (user_id > :last ORDER BY user_id LIMIT page_size) и они сливаются на лету —
+    в памяти не больше страницы на когорту. Вход: now_utc — aware datetime в UTC.
     """
-    try:
-        trial_ids = set(app_db.list_trial_active_user_ids(now_utc))
-    except Exception:
-        logging.exception("[mailing] list_trial_active_user_ids failed")
-        trial_ids = set()
-    try:
-        paid_ids = set(billing_db.list_active_subscription_user_ids(now_utc))
-    except Exception:
-        logging.exception("[mailing] list_active_subscription_user_ids failed")
-        paid_ids = set()
-    all_ids = sorted(trial_ids | paid_ids)
-    # подробный лог только при наличии получателей (чтобы не засорять)
-    if all_ids:
-        logging.info("[mailing] recipients breakdown: trial=%s, paid=%s, total=%s",
-                     len(trial_ids), len(paid_ids), len(all_ids))
-    return all_ids
+    cohorts = [
+        _keyset_pages(app_db.trial_active_user_ids_page, now_utc, page_size),
+        _keyset_pages(billing_db.active_subscription_user_ids_page, now_utc, page_size),
+    ]
+    heads: List[Tuple[int, int]] = []
+    for i, it in enumerate(cohorts):
+        uid = await anext(it, None)
+        if uid is not None:
+            heapq.heappush(heads, (uid, i))
+    last = None
+    while heads:
+        uid, i = heapq.heappop(heads)
+        if uid != last:
+            yield uid
+            last = uid
+        nxt = await anext(cohorts[i], None)
+        if nxt is not None:
+            heapq.heappush(heads, (nxt, i))
+
+
+async def _keyset_pages(fetch_page, now_utc: datetime, page_size: int) -> AsyncIterator[int]:
+    after = 0
+    while True:
+        page = await run_db(fetch_page, now_utc, after_user_id=after, limit=page_size)
+        for uid in page:
+            yield uid
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+
+def count_recipients(now_utc: datetime) -> int:
+    """Оценка числа получателей для прогресса/ETA (сверху: пересечение когорт не вычитается)."""
+    return app_db.count_trial_active(now_utc) + billing_db.count_active_subscription_users(now_utc)
@@ -0,0 +1,230 @@
+# smart_agent/bot/utils/membership_enforcer.py
+"""
+Удаление из чата пользователей, у которых закончился доступ.
+
+Раньше membership_enforcer_loop раз в 15 минут обходил ВСЕ активные подписки.
+На каждого пользователя шло 2+ запроса (is_trial_active,
+_has_active_paid_period_strict), удаления выполнялись последовательно, а кулдаун
+жил в dict процесса и терялся при рестарте. Теперь:
+  — сроки окончания доступа лежат в Redis ZSET (redis_repo.membership_expiry).
+    Их кладут места записи: set_trial, subscription_upsert, продление подписки;
+  — цикл забирает только наступившие сроки (pop_due) пачками до MEMBERSHIP_BATCH
+    и перепроверяет их двумя запросами на всю пачку: подписки (billing_db) и триалы (app_db);
+  — кому доступ продлили, тот перепланируется на новый срок. Кто без активной
+    подписки, тот из очереди выпадает (как и раньше, enforcer трогает только
+    пользователей с подпиской 'active', у которой закончился оплаченный период и нет триала);
+  — удаление идёт через membership-service с параллелизмом до
+    MEMBERSHIP_REMOVE_CONCURRENCY. Кулдаун MEMBERSHIP_REMOVAL_COOLDOWN_HOURS
+    хранится в Redis; неудачное удаление повторяется после кулдауна;
+  — раз в MEMBERSHIP_RECONCILE_SEC (и при старте) сроки всех активных подписок
+    перезаписываются в ZSET. Это страховка от потерянных событий и заполнение
+    очереди при первом запуске.
+
+В простое цикл спит до ближайшего срока, но не дольше MEMBERSHIP_POLL_SEC
+(сроки из других процессов попадают в общий ZSET).
+
+ENV:
+  MEMBERSHIP_BASE_URL=http://127.0.0.1:6000
+  MEMBERSHIP_BATCH=200 / MEMBERSHIP_REMOVE_CONCURRENCY=5 / MEMBERSHIP_POLL_SEC=60
+  MEMBERSHIP_RECONCILE_SEC=21600 / MEMBERSHIP_REMOVAL_COOLDOWN_HOURS=24
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+import bot.utils.billing_db as billing_db
+import bot.utils.database as db
+from bot.utils.async_db import run_db
+from bot.utils.redis_repo import MembershipExpiryRepo, membership_expiry
+from bot.utils.time_helpers import now_msk
+
+LOG = logging.getLogger(__name__)
+
+MEMBERSHIP_BASE_URL = os.getenv("MEMBERSHIP_BASE_URL", "http://127.0.0.1:6000")
+BATCH = int(os.getenv("MEMBERSHIP_BATCH", "200"))
+REMOVE_CONCURRENCY = int(os.getenv("MEMBERSHIP_REMOVE_CONCURRENCY", "5"))
+POLL_SEC = float(os.getenv("MEMBERSHIP_POLL_SEC", "60"))
+RECONCILE_SEC = float(os.getenv("MEMBERSHIP_RECONCILE_SEC", "21600"))
+REMOVAL_COOLDOWN_HOURS = int(os.getenv("MEMBERSHIP_REMOVAL_COOLDOWN_HOURS", "24"))
+
+
+class MembershipEnforcer:
+    def __init__(
+        self,
+        expiry: MembershipExpiryRepo,
+        *,
+        base_url: str = MEMBERSHIP_BASE_URL,
+        batch: int = BATCH,
+        concurrency: int = REMOVE_CONCURRENCY,
+        poll_sec: float = POLL_SEC,
+        reconcile_sec: float = RECONCILE_SEC,
+        cooldown_sec: int = REMOVAL_COOLDOWN_HOURS * 3600,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.expiry = expiry
+        self.base_url = base_url.rstrip("/")
+        self.batch = max(1, batch)
+        self.concurrency = max(1, concurrency)
+        self.poll_sec = poll_sec
+        self.reconcile_sec = reconcile_sec
+        self.cooldown_sec = max(1, int(cooldown_sec))
+        self._transport = transport
+        self._http: Optional[httpx.AsyncClient] = None
+        self._next_reconcile = 0.0
+        self.counters: Dict[str, int] = {
+            "popped": 0, "rescheduled": 0, "dropped": 0,
+            "removed": 0, "remove_failed": 0, "cooldown": 0,
+        }
+
+    # ---------- HTTP ----------
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            # один пул соединений на все удаления вместо AsyncClient на каждый вызов
+            self._http = httpx.AsyncClient(
+                timeout=10,
+                transport=self._transport,
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            )
+        return self._http
+
+    async def close(self) -> None:
+        http, self._http = self._http, None
+        if http is not None:
+            await http.aclose()
+
+    async def remove_http(self, user_id: int) -> bool:
+        """POST /members/remove. True при HTTP 2xx."""
+        try:
+            r = await self._client().post(f"{self.base_url}/members/remove", json={"user_id": int(user_id)})
+            if 200 <= r.status_code < 300:
+                return True
+            LOG.warning("membership remove failed: user_id=%s status=%s body=%s",
+                        user_id, r.status_code, r.text)
+            return False
+        except (httpx.ConnectError, httpx.TimeoutException, httpx.NetworkError) as e:
+            # сетевые ошибки — без traceback: сервис может быть недоступен
+            LOG.warning("membership remove connection error for user_id=%s: %s (service may be unavailable)",
+                        user_id, e)
+            return False
+        except Exception as e:
+            LOG.exception("membership remove unexpected error for user_id=%s: %s", user_id, e)
+            return False
+
+    # ---------- сроки ----------
+
+    async def reconcile(self) -> int:
+        """Перезаписывает в ZSET сроки всех пользователей с активной подпиской."""
+        paid = await run_db(billing_db.membership_paid_until_map)
+        trials = await run_db(db.trial_until_map, list(paid)) if paid else {}
+        items = {
+            uid: max(paid_until, trials[uid]).timestamp() if uid in trials else paid_until.timestamp()
+            for uid, paid_until in paid.items()
+        }
+        uids = list(items)
+        for i in range(0, len(uids), 1000):
+            await self.expiry.schedule_many({u: items[u] for u in uids[i:i + 1000]})
+        self._next_reconcile = time.time() + self.reconcile_sec
+        return len(items)
+
+    async def verify(self, user_ids: List[int]) -> Dict[str, Any]:
+        """
+        Перепроверка пачки в БД: кого удалять, кого перепланировать ({uid: unix-время}),
+        кого выбросить из очереди (нет активной подписки).
+        """
+        now = now_msk()
+        paid = await run_db(billing_db.membership_paid_until_map, user_ids)
+        trials = await run_db(db.trial_until_map, list(paid)) if paid else {}
+        expired: List[int] = []
+        reschedule: Dict[int, float] = {}
+        for uid in user_ids:
+            paid_until = paid.get(uid)
+            if paid_until is None:
+                continue
+            access_until = max(paid_until, trials[uid]) if uid in trials else paid_until
+            if access_until > now:
+                reschedule[uid] = access_until.timestamp()
+            else:
+                expired.append(uid)
+        dropped = [uid for uid in user_ids if uid not in paid]
+        return {"expired": expired, "reschedule": reschedule, "dropped": dropped}
+
+    # ---------- обработка ----------
+
+    async def process_due(self, now_ts: Optional[float] = None) -> int:
+        """Одна пачка наступивших сроков. Возвращает, сколько пользователей забрано."""
+        now_ts = now_ts if now_ts is not None else time.time()
+        user_ids = await self.expiry.pop_due(now_ts, limit=self.batch)
+        if not user_ids:
+            return 0
+        self.counters["popped"] += len(user_ids)
+        try:
+            checked = await self.verify(user_ids)
+        except Exception as e:
+            # БД недоступна — вернуть пачку в очередь и попробовать позже
+            LOG.warning("membership verify failed for %s users: %s", len(user_ids), e)
+            await self.expiry.schedule_many({uid: now_ts + self.poll_sec for uid in user_ids})
+            return len(user_ids)
+
+        later = dict(checked["reschedule"])
+        self.counters["rescheduled"] += len(later)
+        self.counters["dropped"] += len(checked["dropped"])
+
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _one(uid: int) -> None:
+            if not await self.expiry.cooldown_acquire(uid, self.cooldown_sec):
+                # удаляли недавно — перепроверим, когда кулдаун закончится
+                self.counters["cooldown"] += 1
+                later[uid] = now_ts + max(1, await self.expiry.cooldown_left(uid))
+                return
+            async with sem:
+                ok = await self.remove_http(uid)
+            if ok:
+                self.counters["removed"] += 1
+                LOG.info("membership_enforcer: removed user %s from chat", uid)
+            else:
+                self.counters["remove_failed"] += 1
+                later[uid] = now_ts + self.cooldown_sec
+                LOG.warning("membership_enforcer: failed to remove user %s", uid)
+
+        await asyncio.gather(*(_one(uid) for uid in checked["expired"]))
+        await self.expiry.schedule_many(later)
+        return len(user_ids)
+
+    async def run(self, shutdown: asyncio.Event) -> None:
+        self.expiry.bind_loop()
+        try:
+            while not shutdown.is_set():
+                try:
+                    if time.time() >= self._next_reconcile:
+                        n = await self.reconcile()
+                        LOG.info("membership_enforcer: reconciled %s subscriptions", n)
+                    if await self.process_due() >= self.batch:
+                        continue                      # пачка полная — сразу следующая
+                except Exception:
+                    LOG.exception("membership_enforcer_loop error")
+                    self._next_reconcile = max(self._next_reconcile, time.time() + self.poll_sec)
+
+                next_due = await self.expiry.next_due()
+                delay = min(self.poll_sec, max(0.0, self._next_reconcile - time.time()))
+                if next_due is not None:
+                    delay = min(delay, max(0.0, next_due - time.time()))
+                try:
+                    await asyncio.wait_for(shutdown.wait(), timeout=max(delay, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.counters)
+
+
+membership_enforcer = MembershipEnforcer(membership_expiry)
@@ -2,7 +2,9 @@
 from __future__ import annotations
 
 import logging
-from typing import Dict, List, Optional, Tuple
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal, InvalidOperation
 from pathlib import Path
@@ -15,7 +17,9 @@ from sqlalchemy import func
 from bot.utils import database as app_db
 from bot.utils import billing_db
 from bot.utils.mailing import send_last_published_to_chat  # обёртка на "последний пост"
-from bot.utils.redis_repo import set_nx_with_ttl
+from bot.utils.async_db import run_db
+from bot.utils.redis_repo import NotificationScheduleRepo, notification_schedule, set_nx_with_ttl
+from bot.utils.tg_shaper import Priority, send_priority
 from bot.utils.time_helpers import from_db_naive
 from bot.config import get_file_path
 
@@ -143,37 +147,17 @@ def _tariff_name(plan_code: str | None, interval_months: int | None) -> str:
 def _utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
-def _hours_since(dt: Optional[datetime], now: Optional[datetime] = None) -> float:
-    if dt is None:
-        return -1.0
-    now = now or _utcnow()
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    else:
-        dt = dt.astimezone(timezone.utc)
-    return (now - dt).total_seconds() / 3600.0
 
-def _within_window(hours_since_baseline: float, threshold_h: float, window_h: float = _SEND_WINDOW_HOURS) -> bool:
-    """
-    True, если с момента baseline прошло >= threshold_h и < threshold_h + window_h.
-    Используем как второй щит от «повторных» пушей при исчезновении Redis-ключа.
-    """
-    return (hours_since_baseline >= threshold_h) and (hours_since_baseline < (threshold_h + window_h))
-
-async def _send_text_once(bot: Bot, user_id: int, key: str, text: str,
-                          *, ttl: int = _ANTI_SPAM_TTL_SEC, disable_preview: bool = False) -> bool:
-    """
-    Идемпотентная отправка ОДНОГО текстового сообщения (антиспам через Redis).
-    """
+async def _claim_once(key: str, ttl: int = _ANTI_SPAM_TTL_SEC) -> bool:
+    """Антидубль одного шага (SET NX EX). Ошибка Redis — не отправляем."""
     try:
-        need_send = await set_nx_with_ttl(key, "1", ttl)
+        return bool(await set_nx_with_ttl(key, "1", ttl))
     except Exception:
         logging.exception("[notif] redis setnx failed for key=%s", key)
-        need_send = False
-
-    if not need_send:
         return False
 
+async def _deliver_text(bot: Bot, user_id: int, text: str, *, disable_preview: bool = False) -> bool:
+    """Отправка ОДНОГО текстового сообщения (без антидубля — его ставит вызывающий)."""
     try:
         # Явно используем HTML, чтобы корректно отображать <a href="...">...</a>
         await bot.send_message(
@@ -187,21 +171,20 @@ async def _send_text_once(bot: Bot, user_id: int, key: str, text: str,
         logging.warning("[notif] send_message to %s failed: %s", user_id, e)
         return False
 
-async def _send_unsub_d1_with_post(bot: Bot, user_id: int) -> bool:
+async def _send_text_once(bot: Bot, user_id: int, key: str, text: str,
+                          *, ttl: int = _ANTI_SPAM_TTL_SEC, disable_preview: bool = False) -> bool:
     """
-    D1 (unsub): шлём текст, затем — последний опубликованный пост из Mailings.
-    Антидубль — один ключ на весь этап.
+    Идемпотентная отправка ОДНОГО текстового сообщения (антиспам через Redis).
     """
-    key = f"notif:unsub:{user_id}:d1"
-    try:
-        need_send = await set_nx_with_ttl(key, "1", _ANTI_SPAM_TTL_SEC)
-    except Exception:
-        logging.exception("[notif] redis setnx failed for key=%s", key)
-        need_send = False
-
-    if not need_send:
+    if not await _claim_once(key, ttl):
         return False
+    return await _deliver_text(bot, user_id, text, disable_preview=disable_preview)
 
+async def _deliver_unsub_d1(bot: Bot, user_id: int) -> bool:
+    """
+    D1 (unsub): шлём текст, затем — последний опубликованный пост из Mailings.
+    Антидубль — один ключ на весь этап (notif:unsub:{uid}:d1).
+    """
     ok = True
     try:
         await bot.send_message(user_id, TXT_UNSUB_D1)
@@ -219,54 +202,28 @@ async def _send_unsub_d1_with_post(bot: Bot, user_id: int) -> bool:
     return ok
 
 
-async def _send_trial_d2_once(bot: Bot, user_id: int) -> bool:
+async def _deliver_trial_d2(bot: Bot, user_id: int) -> bool:
     """
     ЕДИНЫЙ шаг D2 для триала: отправляем РОВНО ОДНО сообщение.
     Сначала пытаемся фото+текст про «генератор интерьеров», если не получилось — текст про описания.
     Антидубль: общий ключ notif:trial:{uid}:d2:any.
     """
-    bundle_key = f"notif:trial:{user_id}:d2:any"
-    try:
-        need_send = await set_nx_with_ttl(bundle_key, "1", _ANTI_SPAM_TTL_SEC)
-    except Exception:
-        logging.exception("[notif] redis setnx failed for key=%s", bundle_key)
-        need_send = False
-    if not need_send:
-        return False
-
-    # Пытаемся «интерьеры» (фото+caption); если не вышло — текст про описания.
-    sent = await _send_text_with_image_once(
-        bot, user_id, f"{bundle_key}:img", TXT_TRIAL_D2_1, image_rel_path=_BEFORE_AFTER_IMG_REL_DESIGN
-    )
-    if sent:
+    if await _deliver_text_with_image(bot, user_id, TXT_TRIAL_D2_1, _BEFORE_AFTER_IMG_REL_DESIGN):
         return True
+    return await _deliver_text(bot, user_id, TXT_TRIAL_D2_2)
 
-    sent = await _send_text_once(bot, user_id, f"{bundle_key}:txt", TXT_TRIAL_D2_2)
-    return bool(sent)
 
-
-async def _send_text_with_image_once(
+async def _deliver_text_with_image(
     bot: Bot,
     user_id: int,
-    key: str,
     text: str,
     image_rel_path: str = _BEFORE_AFTER_IMG_REL_DESIGN,
-    *,
-    ttl: int = _ANTI_SPAM_TTL_SEC,
 ) -> bool:
     """
-    Идемпотентно шлёт ОДНО сообщение: фото + подпись (caption) с текстом.
+    ОДНО сообщение: фото + подпись (caption) с текстом.
     Плейсхолдер "/пример контента было-стало/" из текста вырезается.
     Если файл изображения недоступен — шлём один текст как fallback.
     """
-    try:
-        need_send = await set_nx_with_ttl(key, "1", ttl)
-    except Exception:
-        logging.exception("[notif] redis setnx failed for key=%s", key)
-        need_send = False
-    if not need_send:
-        return False
-
     clean = (text or "").replace("/пример контента было-стало/", "").strip()
 
     # Резолвим путь к изображению
@@ -337,20 +294,12 @@ def _compose_trial_d3_text(
     )
 
 
-async def _send_trial_d3_pay_once(bot: Bot, user_id: int) -> bool:
+
+async def _deliver_trial_d3_pay(bot: Bot, user_id: int) -> bool:
     """
-    Идемпотентный отправитель D3-pay для триала с реальными параметрами подписки.
+    D3-pay для триала с реальными параметрами подписки (антидубль notif:trial:{uid}:d3:pay).
     Берём ближайшую (по next_charge_at) активную подписку пользователя.
     """
-    key = f"notif:trial:{user_id}:d3:pay"
-    try:
-        need_send = await set_nx_with_ttl(key, "1", _ANTI_SPAM_TTL_SEC)
-    except Exception:
-        logging.exception("[notif] redis setnx failed for key=%s", key)
-        need_send = False
-    if not need_send:
-        return False
-
     now = _utcnow()
     # ищем ближайшую активную подписку с будущим next_charge_at
     Session = billing_db.SessionLocal
@@ -395,6 +344,7 @@ async def _send_trial_d3_pay_once(bot: Bot, user_id: int) -> bool:
         logging.warning("[notif] trial d3 pay send to %s failed: %s", user_id, e)
         return False
 
+
 def _last_lifecycle_state(user_id: int, now: Optional[datetime] = None) -> str:
     """
     Возвращает 'paid' | 'trial' | 'unsub' по последнему релевантному created_at.
@@ -448,226 +398,324 @@ async def send_contextual_nudge(bot: Bot, user_id: int) -> bool:
     return await _send_text_once(bot, user_id, key, text)
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Движок кампаний
+# Шаг кампании — данные: от какого момента считать (baseline), смещение, окно отправки,
+# ключ антидубля и что отправить. Срок ближайшего шага каждого пользователя лежит в
+# Redis ZSET (redis_repo.NotificationScheduleRepo), поэтому тик трогает только тех,
+# у кого срок наступил, а не всю базу. Сроки ставят:
+#   — сам движок после обработки пользователя (следующий шаг / повтор);
+#   — хуки записи в БД (первое событие, триал, подписка) — schedule_notification_nowait;
+#   — периодическая сверка (reconcile) — на случай потерянного ZSET или хука.
+# ──────────────────────────────────────────────────────────────────────────────
+
+@dataclass(frozen=True)
+class Step:
+    name: str                     # имя шага (счётчик в логе)
+    baseline: str                 # поле строки пользователя (aware datetime), от которого считаем
+    offset_h: float               # шаг открывается через offset_h часов после baseline
+    key: str                      # ключ антидубля: key.format(uid=..., **row)
+    text: Optional[str] = None
+    image: Optional[str] = None   # text + картинка одним сообщением
+    deliver: Optional[Callable[[Bot, int], Awaitable[bool]]] = None  # особая отправка вместо text/image
+    window_h: float = _SEND_WINDOW_HOURS
+    guard: Optional[Callable[[Dict[str, Any], datetime], bool]] = None  # False — отложить шаг
+
+    def opens_at(self, row: Dict[str, Any]) -> Optional[datetime]:
+        base = row.get(self.baseline)
+        return base + timedelta(hours=self.offset_h) if base is not None else None
+
+    def is_open(self, row: Dict[str, Any], now: datetime) -> bool:
+        start = self.opens_at(row)
+        return start is not None and start <= now < start + timedelta(hours=self.window_h)
+
+    async def send(self, bot: Bot, user_id: int) -> bool:
+        if self.deliver is not None:
+            return await self.deliver(bot, user_id)
+        if self.image:
+            return await _deliver_text_with_image(bot, user_id, self.text, self.image)
+        return await _deliver_text(bot, user_id, self.text)
+
+
+@dataclass(frozen=True)
+class Campaign:
+    name: str                     # он же суффикс ZSET и имя для schedule_notification_nowait
+    steps: Tuple[Step, ...]       # порядок = приоритет: за тик не больше одного шага на пользователя
+    # синхронные загрузчики (идут через run_db):
+    # load(user_ids, now) -> {uid: row}; нет в ответе — выбыл из кампании; row["blocked"] — отложить
+    load: Callable[[List[int], datetime], Dict[int, Dict[str, Any]]]
+    # population(now) -> кто сейчас должен быть в расписании (для сверки)
+    population: Callable[[datetime], List[int]]
+
+
+class CampaignEngine:
+    """
+    Тик кампании: pop_due из ZSET пачками → загрузка строк пачки (константа запросов) →
+    антидубль всех шагов пачки одним pipeline (claim_many) → отправка → следующий срок.
+    Стоимость тика — O(пользователей с наступившим сроком).
+    """
+
+    def __init__(
+        self,
+        schedule: NotificationScheduleRepo,
+        *,
+        batch: int = 500,
+        retry_sec: float = 600,
+        reconcile_sec: float = 6 * 3600,
+        ttl: int = _ANTI_SPAM_TTL_SEC,
+    ):
+        self.schedule = schedule
+        self.batch = batch
+        self.retry_sec = retry_sec
+        self.reconcile_sec = reconcile_sec
+        self.ttl = ttl
+        self._reconciled_at: Dict[str, float] = {}
+
+    async def reconcile_if_due(self, campaign: Campaign) -> int:
+        """
+        Раз в reconcile_sec (и на первом тике) дописывает в ZSET всех из population,
+        кого там нет, со сроком «сейчас». Уже запланированные сроки не трогает.
+        """
+        mono = time.monotonic()
+        last = self._reconciled_at.get(campaign.name)
+        if last is not None and mono - last < self.reconcile_sec:
+            return 0
+        self._reconciled_at[campaign.name] = mono
+        now = _utcnow()
+        uids = await run_db(campaign.population, now)
+        await self.schedule.schedule_many(
+            campaign.name, {uid: now.timestamp() for uid in uids}, only_new=True,
+        )
+        logging.info("[notif][%s] reconcile: %s users", campaign.name, len(uids))
+        return len(uids)
+
+    def _next_due(self, campaign: Campaign, row: Dict[str, Any], now: datetime, retry: bool) -> Optional[float]:
+        """Ближайшее открытие шага в будущем; retry — есть открытый, но не отправленный шаг."""
+        starts = [t for t in (s.opens_at(row) for s in campaign.steps) if t is not None and t > now]
+        due = min(starts).timestamp() if starts else None
+        if retry:
+            retry_at = now.timestamp() + self.retry_sec
+            due = retry_at if due is None else min(due, retry_at)
+        return due
+
+    async def run_campaign(
+        self, bot: Bot, campaign: Campaign, *, sent_in_run: Optional[set[int]] = None,
+    ) -> Dict[str, int]:
+        self.schedule.bind_loop()
+        now = _utcnow()
+        sent = {s.name: 0 for s in campaign.steps}
+        while True:
+            uids = await self.schedule.pop_due(campaign.name, now.timestamp(), self.batch)
+            if not uids:
+                break
+            rows = await run_db(campaign.load, uids, now)
+            await self._process(bot, campaign, rows, now, sent, sent_in_run)
+            if len(uids) < self.batch:
+                break
+        logging.info("[notif][%s] done: %s", campaign.name, sent)
+        return sent
+
+    async def _process(
+        self,
+        bot: Bot,
+        campaign: Campaign,
+        rows: Dict[int, Dict[str, Any]],
+        now: datetime,
+        sent: Dict[str, int],
+        sent_in_run: Optional[set[int]],
+    ) -> None:
+        deferred: set[int] = set()          # открытый шаг остался неотправленным — повтор через retry_sec
+        pending: Dict[int, List[Step]] = {}
+        for uid, row in rows.items():
+            open_steps = [s for s in campaign.steps if s.is_open(row, now)]
+            if not open_steps:
+                continue
+            # уже получил сообщение в этом прогоне шедулера / сейчас вне кампании (например, купил)
+            if row.get("blocked") or (sent_in_run is not None and uid in sent_in_run):
+                deferred.add(uid)
+                continue
+            ready = [s for s in open_steps if s.guard is None or s.guard(row, now)]
+            if len(ready) < len(open_steps):
+                deferred.add(uid)
+            if ready:
+                pending[uid] = ready
+
+        # Антидубль: первый открытый шаг каждого пользователя одним pipeline;
+        # шаг уже был отправлен раньше — в следующем раунде пробуем следующий открытый
+        winners: Dict[int, Step] = {}
+        while pending:
+            order = list(pending)
+            keys = [pending[uid][0].key.format(uid=uid, **rows[uid]) for uid in order]
+            claimed = await self.schedule.claim_many(keys, self.ttl)
+            for uid, ok in zip(order, claimed):
+                steps = pending.pop(uid)
+                if ok:
+                    winners[uid] = steps[0]
+                    if len(steps) > 1:
+                        deferred.add(uid)
+                elif len(steps) > 1:
+                    pending[uid] = steps[1:]
+
+        for uid, step in winners.items():
+            if await step.send(bot, uid):
+                sent[step.name] += 1
+                if sent_in_run is not None:
+                    sent_in_run.add(uid)
+
+        due: Dict[int, float] = {}
+        for uid, row in rows.items():
+            ts = self._next_due(campaign, row, now, uid in deferred)
+            if ts is not None:
+                due[uid] = ts
+        await self.schedule.schedule_many(campaign.name, due)
+
+
+campaign_engine = CampaignEngine(notification_schedule)
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # 1) «Взаимодействовал, но не подписался»
-# baseline = минимальный app_db.EventLog.created_at; исключаем активные trial/paid
+# baseline = users.first_seen_at (первое событие в event_log); активные trial/paid — откладываем
 # пороги: D1=24h, D2=48h, D3=72h, D4=96h
 # ──────────────────────────────────────────────────────────────────────────────
 
-async def run_unsubscribed_nurture(bot: Bot, *, sent_in_run: Optional[set[int]] = None) -> None:
-    now = _utcnow()
+def _load_unsub(user_ids: List[int], now: datetime) -> Dict[int, Dict[str, Any]]:
+    first_seen = app_db.first_seen_map(user_ids)
+    if not first_seen:
+        return {}
+    ids = list(first_seen)
+    trials = app_db.trial_until_map(ids)
+    paid = billing_db.membership_paid_until_map(ids)
+    return {
+        uid: {
+            "first_seen_at": first_at,
+            "blocked": (uid in trials and trials[uid] > now) or (uid in paid and paid[uid] > now),
+        }
+        for uid, first_at in first_seen.items()
+    }
 
-    active_trial_ids = set(app_db.list_trial_active_user_ids(now))
-    active_paid_ids = set(billing_db.list_active_subscription_user_ids(now))
 
-    Session = app_db.SessionLocal
-    with Session() as s:
-        rows: List[Tuple[int, datetime]] = (
-            s.query(app_db.EventLog.user_id, func.min(app_db.EventLog.created_at))
-             .group_by(app_db.EventLog.user_id)
-             .all()
-        )
+def _unsub_population(now: datetime) -> List[int]:
+    horizon_h = max(s.offset_h + s.window_h for s in UNSUB_CAMPAIGN.steps)
+    return [uid for uid, _ in app_db.list_first_seen_in_windows(now, [0], horizon_h)]
 
-    sent = dict(d1=0, d2=0, d3=0, d4=0)
-    for uid, first_at in rows:
-        # если этому пользователю уже что-то отправили в рамках ЭТОГО запуска шедулера — пропускаем
-        if sent_in_run is not None and uid in sent_in_run:
-            continue
-        if uid in active_trial_ids or uid in active_paid_ids:
-            continue
-        h = _hours_since(first_at, now)
-        if h < 0:
-            continue
-
-        if _within_window(h, 24):
-            if await _send_unsub_d1_with_post(bot, uid):
-                sent["d1"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 48):
-            if await _send_text_once(bot, uid, f"notif:unsub:{uid}:d2", TXT_UNSUB_D2):
-                sent["d2"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 72):
-            # D3: «Генератор интерьеров» → отправляем «design»
-            if await _send_text_with_image_once(
-                bot, uid, f"notif:unsub:{uid}:d3", TXT_UNSUB_D3, image_rel_path=_BEFORE_AFTER_IMG_REL_DESIGN
-            ):
-                sent["d3"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 96):
-            if await _send_text_once(bot, uid, f"notif:unsub:{uid}:d4", TXT_UNSUB_D4):
-                sent["d4"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
 
-    logging.info("[notif][unsub] done: %s", sent)
+UNSUB_CAMPAIGN = Campaign(
+    name="unsub",
+    steps=(
+        Step("d1", "first_seen_at", 24, "notif:unsub:{uid}:d1", deliver=_deliver_unsub_d1),
+        Step("d2", "first_seen_at", 48, "notif:unsub:{uid}:d2", text=TXT_UNSUB_D2),
+        # D3: «Генератор интерьеров» → отправляем «design»
+        Step("d3", "first_seen_at", 72, "notif:unsub:{uid}:d3", text=TXT_UNSUB_D3,
+             image=_BEFORE_AFTER_IMG_REL_DESIGN),
+        Step("d4", "first_seen_at", 96, "notif:unsub:{uid}:d4", text=TXT_UNSUB_D4),
+    ),
+    load=_load_unsub,
+    population=_unsub_population,
+)
+
+
+async def run_unsubscribed_nurture(bot: Bot, *, sent_in_run: Optional[set[int]] = None) -> None:
+    await campaign_engine.run_campaign(bot, UNSUB_CAMPAIGN, sent_in_run=sent_in_run)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 2) «Оформил тестовую подписку» (trial)
-# baseline = app_db.Trial.created_at; пороги: D1_onboard>=1h, D1_2>=24h, D2_1>=48h, D2_2>=48h, D3_pay>=72h
+# baseline = app_db.Trial.created_at (только активные триалы);
+# пороги: D1_onboard>=1h, D1_2>=24h, D2>=48h, D3_pay>=72h
 # ──────────────────────────────────────────────────────────────────────────────
 
-async def run_trial_onboarding(bot: Bot, *, sent_in_run: Optional[set[int]] = None) -> None:
-    now = _utcnow()
-    trial_ids = app_db.list_trial_active_user_ids(now)
-    if not trial_ids:
-        logging.info("[notif][trial] no active trial users")
-        return
+def _load_trial(user_ids: List[int], now: datetime) -> Dict[int, Dict[str, Any]]:
+    return {
+        uid: {"created_at": created_at}
+        for uid, (created_at, until_at) in app_db.trial_rows_map(user_ids).items()
+        if until_at > now
+    }
 
-    Session = app_db.SessionLocal
-    with Session() as s:
-        rows = (
-            s.query(app_db.Trial.user_id, app_db.Trial.created_at)
-             .filter(app_db.Trial.user_id.in_(trial_ids))
-             .all()
-        )
 
-    sent = dict(d1_onboard=0, d1_2=0, d2=0, d3_pay=0)
-    for uid, created_at in rows:
-        if sent_in_run is not None and uid in sent_in_run:
-            continue
-        h = _hours_since(created_at, now)
-        if h < 0:
-            continue
-
-        if _within_window(h, 1):
-            if await _send_text_once(bot, uid, f"notif:trial:{uid}:d1:onboard", TXT_TRIAL_D1_ONBOARD):
-                sent["d1_onboard"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 24):
-            # D1_2: «планировки» → отправляем «plan»
-            if await _send_text_with_image_once(
-                bot, uid, f"notif:trial:{uid}:d1:2", TXT_TRIAL_D1_2, image_rel_path=_BEFORE_AFTER_IMG_REL_PLANS
-            ):
-                sent["d1_2"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 48):
-            # ЕДИНЫЙ D2 (либо «интерьеры», либо «описания»)
-            if await _send_trial_d2_once(bot, uid):
-                sent["d2"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 72):
-            if await _send_trial_d3_pay_once(bot, uid):
-                sent["d3_pay"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
+TRIAL_CAMPAIGN = Campaign(
+    name="trial",
+    steps=(
+        Step("d1_onboard", "created_at", 1, "notif:trial:{uid}:d1:onboard", text=TXT_TRIAL_D1_ONBOARD),
+        # D1_2: «планировки» → отправляем «plan»
+        Step("d1_2", "created_at", 24, "notif:trial:{uid}:d1:2", text=TXT_TRIAL_D1_2,
+             image=_BEFORE_AFTER_IMG_REL_PLANS),
+        # ЕДИНЫЙ D2 (либо «интерьеры», либо «описания»)
+        Step("d2", "created_at", 48, "notif:trial:{uid}:d2:any", deliver=_deliver_trial_d2),
+        Step("d3_pay", "created_at", 72, "notif:trial:{uid}:d3:pay", deliver=_deliver_trial_d3_pay),
+    ),
+    load=_load_trial,
+    population=lambda now: app_db.list_trial_active_user_ids(now),
+)
+
 
-    logging.info("[notif][trial] done: %s", sent)
+async def run_trial_onboarding(bot: Bot, *, sent_in_run: Optional[set[int]] = None) -> None:
+    await campaign_engine.run_campaign(bot, TRIAL_CAMPAIGN, sent_in_run=sent_in_run)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 3) «Подписался» (оплаченная подписка)
 # baseline = billing_db.Subscription.created_at (последняя активная); пороги: D3=72h, D5=120h, D7=168h, D10=240h
-# pre_renew: 0 < (next_charge_at - now) <= 24h
+# pre_renew: 0 < (next_charge_at - now) <= 24h — первым, чтобы не было «трёх сообщений в один момент»
 # ──────────────────────────────────────────────────────────────────────────────
 
-async def run_paid_lifecycle(bot: Bot, *, sent_in_run: Optional[set[int]] = None) -> None:
-    now = _utcnow()
-    active_ids = billing_db.list_active_subscription_user_ids(now)
-    if not active_ids:
-        logging.info("[notif][paid] no active subscribers")
-        return
+def _load_paid(user_ids: List[int], now: datetime) -> Dict[int, Dict[str, Any]]:
+    out: Dict[int, Dict[str, Any]] = {}
+    for uid, sub in billing_db.paid_lifecycle_map(user_ids, now).items():
+        nca = sub["next_charge_at"]
+        # epoch — в ключе антидубля pre_renew: одно напоминание на каждое списание
+        out[uid] = dict(sub, epoch=int(nca.timestamp()))
+    return out
 
-    Session = billing_db.SessionLocal
-    with Session() as s:
-        subs: List[Tuple[int, datetime, datetime, Optional[datetime]]] = (
-            s.query(
-                billing_db.Subscription.user_id,
-                billing_db.Subscription.created_at,
-                billing_db.Subscription.next_charge_at,
-                billing_db.Subscription.last_charge_at,
-            )
-            .filter(
-                billing_db.Subscription.user_id.in_(active_ids),
-                billing_db.Subscription.status == "active",
-                billing_db.Subscription.next_charge_at != None,  # noqa: E711
-                billing_db.Subscription.next_charge_at > now,
-            )
-            .order_by(
-                billing_db.Subscription.user_id.asc(),
-                billing_db.Subscription.created_at.desc(),
-            )
-            .all()
-        )
 
-    by_user: Dict[int, Tuple[datetime, datetime, Optional[datetime]]] = {}
-    for uid, created_at, next_charge_at, last_charge_at in subs:
-        if uid not in by_user:
-            by_user[uid] = (created_at, next_charge_at, last_charge_at)
-
-    sent = dict(d3=0, d5=0, d7=0, d10=0, pre=0)
-    for uid, (created_at, next_charge_at, last_charge_at) in by_user.items():
-        if sent_in_run is not None and uid in sent_in_run:
-            continue
-        h = _hours_since(created_at, now)
-        if h < 0:
-            continue
-        # 0) СНАЧАЛА проверяем pre_renew (чтобы не было «трёх сообщений в один момент»)
-        # ВАЖНО: Не отправляем pre_renew уведомление, если был недавний успешный платёж (в пределах 2 часов)
-        # Это предотвращает отправку "скоро списание" сразу после успешного списания
-        should_skip_pre_renew = False
-        if last_charge_at is not None:
-            last_charge_msk = from_db_naive(last_charge_at)
-            if last_charge_msk:
-                hours_since_charge = (now - last_charge_msk).total_seconds() / 3600
-                if hours_since_charge < 2:
-                    should_skip_pre_renew = True
-                    logging.debug(
-                        "[notif][paid] Skipping pre_renew for user %s: last_charge_at was %s hours ago (too recent)",
-                        uid, hours_since_charge
-                    )
-        
-        if next_charge_at is not None and not should_skip_pre_renew:
-            nca = from_db_naive(next_charge_at) if next_charge_at else None
-            delta_s = (nca - now).total_seconds()
-            if 0 < delta_s <= 24 * 3600:
-                epoch_key = int(nca.timestamp())
-                if await _send_text_once(bot, uid, f"notif:paid:{uid}:pre:{epoch_key}", TXT_PAID_PRE_RENEW):
-                    sent["pre"] += 1
-                    if sent_in_run is not None: sent_in_run.add(uid)
-                    continue
-
-        # 1) Этапные сообщения: отправляем только ОДНО за проход
-        if _within_window(h, 72):
-            if await _send_text_with_image_once(
-                bot, uid, f"notif:paid:{uid}:d3", TXT_PAID_D3, image_rel_path=_BEFORE_AFTER_IMG_REL_DESIGN
-            ):
-                sent["d3"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 120):
-            if await _send_text_once(bot, uid, f"notif:paid:{uid}:d5", TXT_PAID_D5):
-                sent["d5"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 168):
-            if await _send_text_with_image_once(
-                bot, uid, f"notif:paid:{uid}:d7", TXT_PAID_D7, image_rel_path=_BEFORE_AFTER_IMG_REL_PLANS
-            ):
-                sent["d7"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
-        if _within_window(h, 240):
-            if await _send_text_once(bot, uid, f"notif:paid:{uid}:d10", TXT_PAID_D10):
-                sent["d10"] += 1
-                if sent_in_run is not None: sent_in_run.add(uid)
-                continue
+def _charged_long_ago(row: Dict[str, Any], now: datetime) -> bool:
+    """
+    Не отправляем pre_renew, если был недавний успешный платёж (в пределах 2 часов):
+    иначе «скоро списание» приходит сразу после успешного списания.
+    """
+    last_charge_at = row.get("last_charge_at")
+    return last_charge_at is None or now - last_charge_at >= timedelta(hours=2)
+
+
+PAID_CAMPAIGN = Campaign(
+    name="paid",
+    steps=(
+        Step("pre", "next_charge_at", -24, "notif:paid:{uid}:pre:{epoch}", text=TXT_PAID_PRE_RENEW,
+             window_h=24, guard=_charged_long_ago),
+        Step("d3", "created_at", 72, "notif:paid:{uid}:d3", text=TXT_PAID_D3, image=_BEFORE_AFTER_IMG_REL_DESIGN),
+        Step("d5", "created_at", 120, "notif:paid:{uid}:d5", text=TXT_PAID_D5),
+        Step("d7", "created_at", 168, "notif:paid:{uid}:d7", text=TXT_PAID_D7, image=_BEFORE_AFTER_IMG_REL_PLANS),
+        Step("d10", "created_at", 240, "notif:paid:{uid}:d10", text=TXT_PAID_D10),
+    ),
+    load=_load_paid,
+    population=lambda now: billing_db.list_active_subscription_user_ids(now),
+)
+
 
-    logging.info("[notif][paid] done: %s", sent)
+async def run_paid_lifecycle(bot: Bot, *, sent_in_run: Optional[set[int]] = None) -> None:
+    await campaign_engine.run_campaign(bot, PAID_CAMPAIGN, sent_in_run=sent_in_run)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Единый шедулер
 # ──────────────────────────────────────────────────────────────────────────────
 
+CAMPAIGNS: Tuple[Campaign, ...] = (UNSUB_CAMPAIGN, TRIAL_CAMPAIGN, PAID_CAMPAIGN)
+
+
 async def run_notification_scheduler(bot: Bot) -> None:
     """
     Запускайте по cron/APScheduler каждые 10–30 минут.
+    Отправки идут с приоритетом LIFECYCLE (tg_shaper): после ответов и оплат, до рассылок.
     """
+    with send_priority(Priority.LIFECYCLE):
+        await _run_campaigns(bot)
+
+
+async def _run_campaigns(bot: Bot) -> None:
+    for campaign in CAMPAIGNS:
+        try:
+            await campaign_engine.reconcile_if_due(campaign)
+        except Exception:
+            logging.exception("[notif] %s reconcile failed", campaign.name)
+
     # За один прогон шедулера — НЕ более одного сообщения на пользователя.
     sent_in_run: set[int] = set()
     try:
@@ -2,11 +2,13 @@
 
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import os
 import time
 from bot.config import REDIS_PREFIX
+from bot.utils.time_helpers import to_utc_for_db
 from typing import Any, Dict, List, Optional, Tuple
 from contextlib import asynccontextmanager
 
@@ -157,15 +159,23 @@ class FeedbackRedisRepo:
         return h
 
     # ---- buffers (опционально) ----
-    async def append_chunk(self, user_id: int, chunk: str, *, buf_name: str = "buffer") -> int:
+    async def append_chunk(self, user_id: int, chunk: str, *, buf_name: str = "buffer", ttl: int = 86400) -> int:
         """
         RPUSH в буфер (например, для стриминга генерации).
         Возвращает новую длину списка.
         """
-        n = await self.r.rpush(self._buf_key(user_id, buf_name), chunk or "")
-        await self.r.hset(self._key(user_id), mapping={"updated_at": int(time.time())})
+        bk = self._buf_key(user_id, buf_name)
+        pipe = self.r.pipeline()
+        pipe.rpush(bk, chunk or "")
+        pipe.expire(bk, ttl)
+        pipe.hset(self._key(user_id), mapping={"updated_at": int(time.time())})
+        n, _, _ = await pipe.execute()
         return n
 
+    async def reset_buffer(self, user_id: int, *, buf_name: str = "buffer") -> None:
+        """Очистить буфер перед новой потоковой генерацией."""
+        await self.r.delete(self._buf_key(user_id, buf_name))
+
     async def read_buffer(self, user_id: int, *, buf_name: str = "buffer") -> List[str]:
         return await self.r.lrange(self._buf_key(user_id, buf_name), 0, -1)
 
@@ -358,6 +368,98 @@ class QuotaRedisRepo:
         return True, remaining, reset_at
 
 
+# === Access snapshot cache (решение «есть ли доступ») =========================
+class AccessCacheRepo:
+    """
+    Двухуровневый кэш снимка доступа пользователя (AccessSnapshot из payment_handler):
+      1) in-process dict с TTL local_ttl_sec — без сетевых вызовов на горячем пути;
+      2) Redis: {prefix}:access:{user_id} (JSON) с TTL redis_ttl_sec — общий для процессов.
+    Значение — готовый dict (сериализацией занимается вызывающая сторона).
+
+    Инвалидация явная (вебхук, subscription_upsert/cancel, set_trial); короткие TTL
+    лишь ограничивают устаревание, если какой-то путь записи её пропустил.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "sa", local_ttl_sec: int = 15, redis_ttl_sec: int = 60):
+        self.r = redis
+        self.prefix = prefix
+        self.local_ttl = local_ttl_sec
+        self.redis_ttl = redis_ttl_sec
+        self._local: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+        # event loop бота: нужен, чтобы удалить Redis-ключ из синхронного кода (пул потоков БД)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}:access:{user_id}"
+
+    def get_local(self, user_id: int) -> Optional[Dict[str, Any]]:
+        item = self._local.get(int(user_id))
+        if item is None:
+            return None
+        expires_at, data = item
+        if expires_at < time.monotonic():
+            self._local.pop(int(user_id), None)
+            return None
+        return data
+
+    def set_local(self, user_id: int, data: Dict[str, Any]) -> None:
+        self._local[int(user_id)] = (time.monotonic() + self.local_ttl, data)
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        self._loop = asyncio.get_running_loop()
+        data = self.get_local(user_id)
+        if data is not None:
+            return data
+        try:
+            raw = await self.r.get(self._key(user_id))
+        except Exception as e:
+            LOG.warning("access cache get failed for user %s: %s", user_id, e)
+            return None
+        if not raw:
+            return None
+        try:
+            data = json.loads(raw)
+        except Exception:
+            return None
+        self.set_local(user_id, data)
+        return data
+
+    async def set(self, user_id: int, data: Dict[str, Any]) -> None:
+        self._loop = asyncio.get_running_loop()
+        self.set_local(user_id, data)
+        try:
+            await self.r.set(self._key(user_id), json.dumps(data, ensure_ascii=False), ex=self.redis_ttl)
+        except Exception as e:
+            LOG.warning("access cache set failed for user %s: %s", user_id, e)
+
+    async def invalidate(self, user_id: int) -> None:
+        self._local.pop(int(user_id), None)
+        try:
+            await self.r.delete(self._key(user_id))
+        except Exception as e:
+            LOG.warning("access cache invalidate failed for user %s: %s", user_id, e)
+
+    def invalidate_nowait(self, user_id: int) -> None:
+        """
+        Инвалидация из синхронного кода (репозитории БД).
+        Локальный кэш чистится сразу; удаление Redis-ключа ставится в event loop бота —
+        из его потока через create_task, из пула потоков БД — через run_coroutine_threadsafe.
+        Без работающего loop'а (скрипты, синхронные тесты) остаётся только TTL Redis.
+        """
+        self._local.pop(int(user_id), None)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        try:
+            if running is not None:
+                running.create_task(self.invalidate(user_id))
+            elif self._loop is not None and self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(self.invalidate(user_id), self._loop)
+        except Exception as e:
+            LOG.warning("access cache invalidate_nowait failed for user %s: %s", user_id, e)
+
+
 # === YooKassa Webhook Idempotency ============================================
 class YooWebhookDedupRepo:
     """
@@ -430,8 +532,329 @@ class YooWebhookDedupRepo:
             return False
 
 
+class MembershipExpiryRepo:
+    """
+    Очередь отложенных удалений из чата (membership enforcer).
+    ZSET {prefix}:membership:expiry: member=user_id, score=unix-время, когда у
+    пользователя может закончиться доступ (конец триала или оплаченного периода).
+    Сроки кладут сами места записи (set_trial, subscription_upsert, продление).
+    Потребитель забирает только наступившие сроки и перепроверяет их в БД, поэтому
+    срок «раньше, чем надо» безопасен: пользователь с доступом просто перепланируется.
+
+    Кулдаун удаления: {prefix}:membership:rm_cd:{user_id} (SET NX EX), переживает рестарт.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "sa"):
+        self.r = redis
+        self.prefix = prefix
+        # event loop бота: нужен, чтобы планировать из синхронного кода (пул потоков БД)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.prefix}:membership:expiry"
+
+    def _cooldown_key(self, user_id: int) -> str:
+        return f"{self.prefix}:membership:rm_cd:{user_id}"
+
+    def bind_loop(self) -> None:
+        self._loop = asyncio.get_running_loop()
+
+    async def schedule_many(self, items: Dict[int, float]) -> None:
+        """{user_id: unix-время} → ZADD (новый срок заменяет старый)."""
+        if not items:
+            return
+        try:
+            pipe = self.r.pipeline()
+            pipe.zadd(self.key, {str(int(uid)): float(ts) for uid, ts in items.items()})
+            await pipe.execute()
+        except Exception as e:
+            LOG.warning("membership expiry schedule failed for %s users: %s", len(items), e)
+
+    def schedule_nowait(self, user_id: int, ts: float) -> None:
+        """
+        То же из синхронного кода (репозитории app_db/billing_db), как
+        AccessCacheRepo.invalidate_nowait. Если loop не запущен, срок подхватит
+        ближайшая сверка enforcer'а.
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        try:
+            if running is not None:
+                running.create_task(self.schedule_many({user_id: ts}))
+            elif self._loop is not None and self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(self.schedule_many({user_id: ts}), self._loop)
+        except Exception as e:
+            LOG.warning("membership expiry schedule_nowait failed for user %s: %s", user_id, e)
+
+    async def pop_due(self, now_ts: float, limit: int = 200) -> List[int]:
+        """
+        Забирает наступившие сроки. ZREM делается по одному: при нескольких
+        потребителях пользователь достаётся тому, чей ZREM вернул 1.
+        """
+        try:
+            members = await self.r.zrangebyscore(self.key, "-inf", now_ts, start=0, num=int(limit))
+            if not members:
+                return []
+            pipe = self.r.pipeline()
+            for m in members:
+                pipe.zrem(self.key, m)
+            removed = await pipe.execute()
+        except Exception as e:
+            LOG.warning("membership expiry pop failed: %s", e)
+            return []
+        return [int(m) for m, ok in zip(members, removed) if ok]
+
+    async def next_due(self) -> Optional[float]:
+        """unix-время ближайшего срока; None, если очередь пуста или Redis недоступен."""
+        try:
+            head = await self.r.zrange(self.key, 0, 0, withscores=True)
+        except Exception as e:
+            LOG.warning("membership expiry peek failed: %s", e)
+            return None
+        return float(head[0][1]) if head else None
+
+    async def size(self) -> int:
+        try:
+            return int(await self.r.zcard(self.key))
+        except Exception:
+            return 0
+
+    async def cooldown_acquire(self, user_id: int, ttl_sec: int) -> bool:
+        """True — удалять можно (кулдаун поставлен), False — удаляли недавно."""
+        try:
+            return bool(await self.r.set(self._cooldown_key(user_id), "1", ex=int(ttl_sec), nx=True))
+        except Exception as e:
+            LOG.warning("membership cooldown check failed for user %s: %s", user_id, e)
+            return False
+
+    async def cooldown_left(self, user_id: int) -> int:
+        """Секунд до конца кулдауна (0 — кулдауна нет)."""
+        try:
+            return max(0, int(await self.r.ttl(self._cooldown_key(user_id))))
+        except Exception:
+            return 0
+
+
+class NotificationScheduleRepo:
+    """
+    Расписание сценарных уведомлений (bot/utils/notification.py, движок кампаний).
+    ZSET {prefix}:notif:next:{campaign}: member=user_id, score=unix-время ближайшего
+    шага кампании. Тик забирает только наступившие сроки. Срок «раньше, чем надо»
+    безопасен: движок перечитывает пользователя из БД и перепланирует.
+
+    Антидубль шагов — прежние ключи notif:{...} (SET NX EX, без префикса).
+    claim_many ставит их пачкой за один round-trip.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "sa"):
+        self.r = redis
+        self.prefix = prefix
+        # event loop бота: нужен, чтобы планировать из синхронного кода (пул потоков БД)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def key(self, campaign: str) -> str:
+        return f"{self.prefix}:notif:next:{campaign}"
+
+    def bind_loop(self) -> None:
+        self._loop = asyncio.get_running_loop()
+
+    async def schedule_many(self, campaign: str, items: Dict[int, float], *, only_new: bool = False) -> None:
+        """
+        {user_id: unix-время} → ZADD (новый срок заменяет старый).
+        only_new — только тех, кого в расписании нет (сверка не сдвигает уже известные сроки).
+        """
+        if not items:
+            return
+        try:
+            pipe = self.r.pipeline()
+            mapping = {str(int(uid)): float(ts) for uid, ts in items.items()}
+            if only_new:
+                pipe.zadd(self.key(campaign), mapping, nx=True)
+            else:
+                pipe.zadd(self.key(campaign), mapping)
+            await pipe.execute()
+        except Exception as e:
+            LOG.warning("notification schedule failed for %s/%s users: %s", campaign, len(items), e)
+
+    def schedule_nowait(self, campaign: str, user_id: int, ts: float) -> None:
+        """То же из синхронного кода, как MembershipExpiryRepo.schedule_nowait."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        try:
+            if running is not None:
+                running.create_task(self.schedule_many(campaign, {user_id: ts}))
+            elif self._loop is not None and self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(self.schedule_many(campaign, {user_id: ts}), self._loop)
+        except Exception as e:
+            LOG.warning("notification schedule_nowait failed for %s/%s: %s", campaign, user_id, e)
+
+    async def pop_due(self, campaign: str, now_ts: float, limit: int = 500) -> List[int]:
+        """Забирает наступившие сроки (ZREM по одному, как MembershipExpiryRepo.pop_due)."""
+        key = self.key(campaign)
+        try:
+            members = await self.r.zrangebyscore(key, "-inf", now_ts, start=0, num=int(limit))
+            if not members:
+                return []
+            pipe = self.r.pipeline()
+            for m in members:
+                pipe.zrem(key, m)
+            removed = await pipe.execute()
+        except Exception as e:
+            LOG.warning("notification pop failed for %s: %s", campaign, e)
+            return []
+        return [int(m) for m, ok in zip(members, removed) if ok]
+
+    async def size(self, campaign: str) -> int:
+        try:
+            return int(await self.r.zcard(self.key(campaign)))
+        except Exception:
+            return 0
+
+    async def claim_many(self, keys: List[str], ttl_sec: int) -> List[bool]:
+        """
+        SET key 1 NX EX ttl для пачки ключей одним pipeline.
+        True — ключ поставлен (шаг можно отправлять), False — уже был или Redis недоступен.
+        """
+        if not keys:
+            return []
+        try:
+            pipe = self.r.pipeline()
+            for k in keys:
+                pipe.set(k, "1", ex=int(ttl_sec), nx=True)
+            return [bool(x) for x in await pipe.execute()]
+        except Exception as e:
+            LOG.warning("notification claim failed for %s keys: %s", len(keys), e)
+            return [False] * len(keys)
+
+
+class TelegramRateRepo:
+    """
+    Общий для всех процессов бота лимит исходящих сообщений Bot API (bot/utils/tg_shaper.py):
+      {prefix}:tg:rate:{unix-секунда} — сколько сообщений отправлено в эту секунду (INCRBY + EXPIRE);
+      {prefix}:tg:pause_until          — unix-время, до которого никто не шлёт (ответ RetryAfter).
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "sa"):
+        self.r = redis
+        self.prefix = prefix
+        self.pause_key = f"{prefix}:tg:pause_until"
+
+    async def take(self, weight: int = 1) -> Tuple[int, float]:
+        """
+        Занимает weight отправок в текущей секунде одним round-trip.
+        Возвращает (отправок в этой секунде с учётом своей, pause_until). Redis недоступен — (0, 0).
+        """
+        key = f"{self.prefix}:tg:rate:{int(time.time())}"
+        try:
+            pipe = self.r.pipeline()
+            pipe.incrby(key, int(weight))
+            pipe.expire(key, 2)
+            pipe.get(self.pause_key)
+            count, _, pause_until = await pipe.execute()
+        except Exception as e:
+            LOG.warning("telegram rate take failed: %s", e)
+            return 0, 0.0
+        return int(count), float(pause_until or 0)
+
+    async def pause(self, until_ts: float) -> None:
+        """RetryAfter: остановить отправку во всех процессах до until_ts."""
+        try:
+            ttl = max(1, int(until_ts - time.time()) + 1)
+            await self.r.set(self.pause_key, f"{until_ts:.3f}", ex=ttl)
+        except Exception as e:
+            LOG.warning("telegram rate pause failed: %s", e)
+
+
+class TelegramFileIdRepo:
+    """
+    file_id файлов, уже загруженных ботом в Telegram (bot/utils/tg_assets.py):
+      {prefix}:tg:file:{bot_id} — HASH sha256 содержимого файла → file_id.
+    file_id действителен только для загрузившего бота, поэтому ключ — на бота.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "sa"):
+        self.r = redis
+        self.prefix = prefix
+
+    def key(self, bot_id: int) -> str:
+        return f"{self.prefix}:tg:file:{bot_id}"
+
+    async def get_many(self, bot_id: int, digests: List[str]) -> Dict[str, str]:
+        """Известные file_id по хэшам содержимого. Redis недоступен — пусто (файлы загрузятся заново)."""
+        if not digests:
+            return {}
+        try:
+            values = await self.r.hmget(self.key(bot_id), digests)
+        except Exception as e:
+            LOG.warning("telegram file_id get failed: %s", e)
+            return {}
+        return {d: v for d, v in zip(digests, values) if v}
+
+    async def put_many(self, bot_id: int, mapping: Dict[str, str]) -> None:
+        if not mapping:
+            return
+        try:
+            await self.r.hset(self.key(bot_id), mapping=mapping)
+        except Exception as e:
+            LOG.warning("telegram file_id put failed: %s", e)
+
+    async def drop(self, bot_id: int, digests: List[str]) -> None:
+        """Telegram отверг file_id — забываем, следующая отправка загрузит файл."""
+        if not digests:
+            return
+        try:
+            await self.r.hdel(self.key(bot_id), *digests)
+        except Exception as e:
+            LOG.warning("telegram file_id drop failed: %s", e)
+
+
 # Глобальные экземпляры
 feedback_repo = FeedbackRedisRepo(_redis, prefix=REDIS_PREFIX)
 summary_repo = SummaryRedisRepo(_redis, prefix=REDIS_PREFIX)
 quota_repo = QuotaRedisRepo(_redis, prefix=REDIS_PREFIX)
 yookassa_dedup = YooWebhookDedupRepo(_redis, prefix=REDIS_PREFIX)
+membership_expiry = MembershipExpiryRepo(_redis, prefix=REDIS_PREFIX)
+notification_schedule = NotificationScheduleRepo(_redis, prefix=REDIS_PREFIX)
+tg_rate = TelegramRateRepo(_redis, prefix=REDIS_PREFIX)
+tg_file_ids = TelegramFileIdRepo(_redis, prefix=REDIS_PREFIX)
+access_cache = AccessCacheRepo(
+    _redis,
+    prefix=REDIS_PREFIX,
+    local_ttl_sec=int(os.getenv("ACCESS_CACHE_LOCAL_TTL_SEC", "15")),
+    redis_ttl_sec=int(os.getenv("ACCESS_CACHE_REDIS_TTL_SEC", "60")),
+)
+
+
+async def invalidate_access_cache(user_id: int) -> None:
+    """Сбрасывает кэш снимка доступа (in-process + Redis) — по аналогии с invalidate_payment_ok_cache."""
+    await access_cache.invalidate(user_id)
+
+
+def invalidate_access_cache_nowait(user_id: int) -> None:
+    """То же из синхронного кода (репозитории app_db/billing_db)."""
+    access_cache.invalidate_nowait(user_id)
+
+
+def schedule_membership_expiry_nowait(user_id: int, at: Optional[Any]) -> None:
+    """
+    Срок доступа пользователя изменился (at — datetime, naive трактуется как МСК).
+    Вызывается из синхронных репозиториев.
+    """
+    if at is None:
+        return
+    membership_expiry.schedule_nowait(int(user_id), to_utc_for_db(at).timestamp())
+
+
+def schedule_notification_nowait(campaign: str, user_id: int, at: Optional[Any] = None) -> None:
+    """
+    Данные пользователя для кампании изменились (первое событие, триал, подписка):
+    посетить его в тике не позже at (None — сразу). Движок сам рассчитает следующий шаг.
+    Вызывается из синхронных репозиториев.
+    """
+    ts = to_utc_for_db(at).timestamp() if at is not None else time.time()
+    notification_schedule.schedule_nowait(campaign, int(user_id), ts)
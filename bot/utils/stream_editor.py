@@ -0,0 +1,171 @@
+# smart_agent/bot/utils/stream_editor.py
+"""
+Прогрессивный вывод генерации в Telegram: якорное сообщение «⏳ Генерирую...»
+редактируется по мере прихода текста от executor'а (SSE / partial-колбэки).
+
+Telegram ограничивает частоту правок (~1 в секунду на чат, при превышении — 429
+с retry_after), поэтому правки склеиваются: не чаще EDIT_INTERVAL_SEC на чат,
+промежуточные куски между правками просто копятся, в сообщение уходит последний текст.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+LOG = logging.getLogger(__name__)
+
+EDIT_INTERVAL_SEC = float(os.getenv("TG_STREAM_EDIT_INTERVAL_SEC", "1.5"))
+# Курсор в конце промежуточного текста — видно, что генерация ещё идёт
+CURSOR = " ▌"
+_TEXT_LIMIT = 4096
+_CAPTION_LIMIT = 1024
+
+_TAG_RE = re.compile(r"<[^>]*>?")
+
+
+def strip_partial_html(text: str) -> str:
+    """
+    Промежуточный HTML может оборваться посреди тега — Telegram такой не распарсит.
+    Пока текст не готов, показываем его без разметки (финальная правка — уже с HTML).
+    """
+    return _TAG_RE.sub("", text or "")
+
+
+class ChatEditThrottle:
+    """Минимальный интервал между правками сообщений в одном чате."""
+
+    def __init__(self, interval: float = EDIT_INTERVAL_SEC):
+        self.interval = interval
+        self._next_at: Dict[int, float] = {}
+
+    def ready(self, chat_id: int) -> bool:
+        return time.monotonic() >= self._next_at.get(chat_id, 0.0)
+
+    def mark(self, chat_id: int, *, delay: Optional[float] = None) -> None:
+        self._next_at[chat_id] = time.monotonic() + (self.interval if delay is None else delay)
+
+    async def wait(self, chat_id: int) -> None:
+        """Дождаться, когда в чате снова можно править (перед финальной правкой)."""
+        left = self._next_at.get(chat_id, 0.0) - time.monotonic()
+        if left > 0:
+            await asyncio.sleep(left)
+
+    def forget(self, chat_id: int) -> None:
+        self._next_at.pop(chat_id, None)
+
+
+edit_throttle = ChatEditThrottle()
+
+
+class StreamingMessage:
+    """
+    Склейка потока текста в редкие правки одного сообщения.
+
+      sm = StreamingMessage(bot, chat_id, message_id, render=strip_partial_html)
+      await executor_client.stream_text(..., on_text=sm.update)
+      await sm.finish()        # дождаться интервала, дальше — обычная финальная правка
+
+    on_flush(chunk) вызывается с текстом, добавленным с прошлой правки
+    (например, для FeedbackRedisRepo.append_chunk).
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: int,
+        message_id: int,
+        *,
+        throttle: ChatEditThrottle = edit_throttle,
+        render: Callable[[str], str] = lambda s: s,
+        on_flush: Optional[Callable[[str], Awaitable[None]]] = None,
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.throttle = throttle
+        self.render = render
+        self.on_flush = on_flush
+        self.edits = 0
+        self._text = ""
+        self._flushed_len = 0
+        self._shown = ""
+        self._caption = False
+        self._disabled = False
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    async def update(self, text: str) -> bool:
+        """Новый накопленный текст. Правит сообщение, только если интервал чата истёк."""
+        self._text = text
+        if self._disabled or not self.throttle.ready(self.chat_id):
+            return False
+        return await self._flush()
+
+    async def finish(self) -> None:
+        """Сбросить хвост в буфер и дождаться, когда чат можно будет править финальным текстом."""
+        await self._notify_flush()
+        await self.throttle.wait(self.chat_id)
+
+    async def _notify_flush(self) -> None:
+        if self.on_flush is None or len(self._text) <= self._flushed_len:
+            return
+        chunk = self._text[self._flushed_len:]
+        self._flushed_len = len(self._text)
+        try:
+            await self.on_flush(chunk)
+        except Exception as e:
+            LOG.warning("stream on_flush failed: %s", e)
+
+    async def _flush(self) -> bool:
+        await self._notify_flush()
+        limit = _CAPTION_LIMIT if self._caption else _TEXT_LIMIT
+        shown = self.render(self._text).strip()
+        if not shown:
+            return False
+        if len(shown) + len(CURSOR) > limit:
+            shown = shown[: limit - len(CURSOR) - 1].rstrip() + "…"
+        shown += CURSOR
+        if shown == self._shown:
+            return False
+
+        self.throttle.mark(self.chat_id)
+        try:
+            if self._caption:
+                await self.bot.edit_message_caption(
+                    chat_id=self.chat_id, message_id=self.message_id, caption=shown, parse_mode=None,
+                )
+            else:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id, message_id=self.message_id, text=shown, parse_mode=None,
+                )
+        except TelegramRetryAfter as e:
+            # Telegram сам сказал, сколько ждать — до этого момента правки в чате не шлём
+            self.throttle.mark(self.chat_id, delay=float(e.retry_after))
+            return False
+        except TelegramBadRequest as e:
+            msg = str(e).lower()
+            if "not modified" in msg:
+                return False
+            if not self._caption and "no text" in msg:
+                # якорь — медиа с подписью: дальше правим caption
+                self._caption = True
+                return await self._flush()
+            LOG.info("stream edit disabled for chat %s: %s", self.chat_id, e)
+            self._disabled = True
+            return False
+        except Exception as e:
+            LOG.warning("stream edit failed for chat %s: %s", self.chat_id, e)
+            return False
+
+        self._shown = shown
+        self.edits += 1
+        return True
@@ -0,0 +1,202 @@
+# smart_agent/bot/utils/tg_assets.py
+"""
+Повторное использование file_id для файлов с диска.
+
+Меню плейбуков (design/plans/description/objection/...), стартовый экран main_handler
+и сценарные уведомления notification.py отправляют статичные картинки из data/img/bot/
+через FSInputFile — и каждый раз заново загружают байты файла в Telegram. Теперь
+request-middleware сессии бота (FileIdCacheMiddleware):
+  — для FSInputFile в send_photo/send_document/... , send_media_group и edit_message_media
+    считает sha256 содержимого (один раз на файл, пересчёт — при смене mtime/размера);
+  — если для этого содержимого уже есть file_id (память процесса → Redis,
+    redis_repo.tg_file_ids) — отправляет file_id вместо файла;
+  — после загрузки берёт file_id из ответа Telegram и запоминает;
+  — если Telegram отверг file_id (неверный/просроченный идентификатор) — забывает его
+    и повторяет запрос с загрузкой файла.
+
+Хендлеры ничего не меняют: кэш работает для любого FSInputFile. BufferedInputFile
+(сгенерированные на лету файлы) не кэшируется.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import methods as tg
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from bot.utils.redis_repo import TelegramFileIdRepo, tg_file_ids
+
+LOG = logging.getLogger(__name__)
+
+# Метод → поле с файлом (одиночные отправки)
+_FILE_FIELDS: Dict[type, str] = {
+    tg.SendPhoto: "photo",
+    tg.SendDocument: "document",
+    tg.SendVideo: "video",
+    tg.SendAnimation: "animation",
+    tg.SendAudio: "audio",
+    tg.SendVoice: "voice",
+    tg.SendSticker: "sticker",
+    tg.SendVideoNote: "video_note",
+}
+
+# Ответы Telegram на неприменимый file_id
+_FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference",
+    "file_id",
+    "media_empty",
+    "wrong type of the web page content",
+)
+
+
+def _uploads(method: Any) -> List[Any]:
+    """Файлы запроса по позициям: одиночная отправка — [файл], альбом — по элементу на медиа."""
+    field = _FILE_FIELDS.get(type(method))
+    if field:
+        return [getattr(method, field)]
+    if isinstance(method, tg.SendMediaGroup):
+        return [m.media for m in method.media]
+    if isinstance(method, tg.EditMessageMedia):
+        return [method.media.media]
+    return []
+
+
+def _with_file_ids(method: Any, ids: List[Optional[str]]) -> Any:
+    """Копия запроса, где файлы с известным file_id заменены им."""
+    field = _FILE_FIELDS.get(type(method))
+    if field:
+        return method.model_copy(update={field: ids[0]}) if ids[0] else method
+    if isinstance(method, tg.SendMediaGroup):
+        media = [m.model_copy(update={"media": fid}) if fid else m for m, fid in zip(method.media, ids)]
+        return method.model_copy(update={"media": media})
+    if isinstance(method, tg.EditMessageMedia) and ids[0]:
+        return method.model_copy(update={"media": method.media.model_copy(update={"media": ids[0]})})
+    return method
+
+
+def _message_file_id(msg: Any) -> Optional[str]:
+    if not isinstance(msg, Message):
+        return None
+    if msg.photo:
+        return msg.photo[-1].file_id                  # самый большой размер — исходная картинка
+    for attr in ("document", "video", "animation", "audio", "voice", "sticker", "video_note"):
+        obj = getattr(msg, attr, None)
+        if obj is not None:
+            return obj.file_id
+    return None
+
+
+def _result_file_ids(result: Any) -> List[Optional[str]]:
+    if isinstance(result, list):                      # альбом: сообщения в порядке медиа
+        return [_message_file_id(m) for m in result]
+    return [_message_file_id(result)]
+
+
+def _is_file_id_error(e: TelegramBadRequest) -> bool:
+    text = str(e).lower()
+    return any(marker in text for marker in _FILE_ID_ERRORS)
+
+
+class AssetRegistry:
+    def __init__(self, repo: Optional[TelegramFileIdRepo] = None):
+        self.repo = repo
+        self._digests: Dict[str, Tuple[float, int, str]] = {}      # path → (mtime, size, sha256)
+        self._file_ids: Dict[Tuple[int, str], str] = {}            # (bot_id, sha256) → file_id
+        self.counters: Dict[str, int] = {"reused": 0, "uploaded": 0, "rejected": 0}
+
+    async def digest(self, path: str) -> str:
+        """sha256 содержимого файла; пересчитывается, только если файл изменился."""
+        st = os.stat(path)
+        known = self._digests.get(path)
+        if known and known[0] == st.st_mtime and known[1] == st.st_size:
+            return known[2]
+        sha = await asyncio.to_thread(_sha256_file, path)
+        self._digests[path] = (st.st_mtime, st.st_size, sha)
+        return sha
+
+    async def lookup(self, bot_id: int, digests: List[str]) -> Dict[str, str]:
+        found = {d: self._file_ids[(bot_id, d)] for d in digests if (bot_id, d) in self._file_ids}
+        missing = [d for d in digests if d not in found]
+        if missing and self.repo is not None:
+            remote = await self.repo.get_many(bot_id, missing)
+            for d, fid in remote.items():
+                self._file_ids[(bot_id, d)] = fid
+            found.update(remote)
+        return found
+
+    async def remember(self, bot_id: int, mapping: Dict[str, str]) -> None:
+        for d, fid in mapping.items():
+            self._file_ids[(bot_id, d)] = fid
+        if self.repo is not None:
+            await self.repo.put_many(bot_id, mapping)
+
+    async def forget(self, bot_id: int, digests: List[str]) -> None:
+        for d in digests:
+            self._file_ids.pop((bot_id, d), None)
+        if self.repo is not None:
+            await self.repo.drop(bot_id, digests)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "known": len(self._file_ids)}
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FileIdCacheMiddleware(BaseRequestMiddleware):
+    """Подключение: bot.session.middleware(FileIdCacheMiddleware(asset_registry))."""
+
+    def __init__(self, registry: AssetRegistry):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        files = _uploads(method)
+        if not any(isinstance(f, FSInputFile) for f in files):
+            return await make_request(bot, method)
+        try:
+            digests = [await self.registry.digest(str(f.path)) if isinstance(f, FSInputFile) else None for f in files]
+        except OSError as e:
+            # файла нет/не читается — пусть ошибку вернёт обычная отправка
+            LOG.debug("asset digest failed: %s", e)
+            return await make_request(bot, method)
+
+        known = await self.registry.lookup(bot.id, [d for d in digests if d])
+        ids = [known.get(d) if d else None for d in digests]
+        request = _with_file_ids(method, ids)
+        try:
+            result = await make_request(bot, request)
+        except TelegramBadRequest as e:
+            if request is method or not _is_file_id_error(e):
+                raise
+            reused = [d for d, fid in zip(digests, ids) if fid]
+            LOG.warning("telegram rejected cached file_id for %s: %s — re-uploading", type(method).__name__, e)
+            self.registry.counters["rejected"] += 1
+            await self.registry.forget(bot.id, reused)
+            ids = [None] * len(files)
+            result = await make_request(bot, method)
+
+        self.registry.counters["reused"] += sum(1 for fid in ids if fid)
+        uploaded = {
+            d: fid for d, cached, fid in zip(digests, ids, _result_file_ids(result))
+            if d and not cached and fid
+        }
+        self.registry.counters["uploaded"] += len(uploaded)
+        if uploaded:
+            await self.registry.remember(bot.id, uploaded)
+        return result
+
+
+asset_registry = AssetRegistry(tg_file_ids)
@@ -0,0 +1,280 @@
+# smart_agent/bot/utils/tg_shaper.py
+"""
+Общий слой исходящих сообщений Bot API.
+
+Рассылки (mailing.py), сценарные уведомления (notification.py), уведомления об
+оплате и ответы хендлеров шли в Telegram каждый сам по себе: без общего темпа,
+а TelegramRetryAfter где-то ловили, а где-то нет. Под нагрузкой бот то упирался
+в лимиты Telegram (~30 сообщений/с на бота, ~1/с в личный чат, ~20/мин в группу),
+то слал заметно медленнее возможного. Теперь все отправки проходят через
+request-middleware сессии бота (TrafficShaperMiddleware):
+  — глобальный темп TG_GLOBAL_RATE в секунду (ровный, без всплесков); ожидающие обслуживаются
+    по классам приоритета: ответы хендлерам > оплаты > сценарные уведомления > рассылки.
+    Класс задаётся контекстом: with send_priority(Priority.BROADCAST): ...
+    (по умолчанию — INTERACTIVE, т.е. обычные хендлеры ничего указывать не должны);
+  — на каждый чат — своя «корзина»: TG_CHAT_INTERVAL секунд между сообщениями
+    в личку (TG_GROUP_INTERVAL — в группы/каналы) и запас TG_CHAT_BURST подряд;
+  — между процессами темп согласуется через Redis (redis_repo.tg_rate):
+    общий счётчик отправок в текущей секунде и общая пауза по RetryAfter;
+  — на TelegramRetryAfter запрос повторяется, до TG_RETRY_AFTER_RETRIES раз. Пауза —
+    только у чата, если общий темп ни при чём (группа упёрлась в ~20/мин); общая пауза
+    (все отправки во всех процессах) — на ответ в личный чат или когда счётчик темпа
+    близок к TG_GLOBAL_RATE: один шумный чат не останавливает бота.
+
+Редактирования и chat action не ограничиваются: они не считаются сообщениями,
+а stream_editor сам держит темп правок.
+
+ENV:
+  TG_GLOBAL_RATE=28 / TG_CHAT_INTERVAL=1.0 / TG_GROUP_INTERVAL=3.0 / TG_CHAT_BURST=3
+  TG_RETRY_AFTER_RETRIES=3
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+from aiogram import methods as tg
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from bot.utils.redis_repo import TelegramRateRepo, tg_rate
+
+LOG = logging.getLogger(__name__)
+
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "28"))
+CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", "1.0"))
+GROUP_INTERVAL = float(os.getenv("TG_GROUP_INTERVAL", "3.0"))
+CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+RETRY_AFTER_RETRIES = int(os.getenv("TG_RETRY_AFTER_RETRIES", "3"))
+# Доля TG_GLOBAL_RATE за последнюю секунду, при которой RetryAfter считается общим
+NEAR_LIMIT_SHARE = 0.8
+
+# Методы, которые Telegram считает отправкой сообщения в чат
+_SHAPED_METHODS = (
+    tg.SendMessage, tg.SendPhoto, tg.SendVideo, tg.SendAudio, tg.SendAnimation,
+    tg.SendDocument, tg.SendVoice, tg.SendVideoNote, tg.SendSticker, tg.SendMediaGroup,
+    tg.SendLocation, tg.SendVenue, tg.SendContact, tg.SendPoll, tg.SendDice,
+    tg.SendInvoice, tg.SendPaidMedia, tg.CopyMessage, tg.CopyMessages,
+    tg.ForwardMessage, tg.ForwardMessages,
+)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0   # ответы пользователю в хендлерах
+    PAYMENT = 1       # уведомления по вебхукам YooKassa
+    LIFECYCLE = 2     # сценарные уведомления (notification.py)
+    BROADCAST = 3     # рассылки (mailing.py)
+
+
+_priority: ContextVar[Priority] = ContextVar("tg_send_priority", default=Priority.INTERACTIVE)
+
+
+@contextmanager
+def send_priority(priority: Priority) -> Iterator[None]:
+    """Класс приоритета для всех отправок внутри блока (наследуется задачами, созданными в нём)."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _is_private(chat_id: Union[int, str]) -> bool:
+    return isinstance(chat_id, int) and chat_id > 0
+
+
+class TrafficShaper:
+    def __init__(
+        self,
+        rate_repo: Optional[TelegramRateRepo] = None,
+        *,
+        global_rate: float = GLOBAL_RATE,
+        chat_interval: float = CHAT_INTERVAL,
+        group_interval: float = GROUP_INTERVAL,
+        chat_burst: int = CHAT_BURST,
+        max_retries: int = RETRY_AFTER_RETRIES,
+        max_chats: int = 100_000,
+    ):
+        self.rate_repo = rate_repo
+        self.global_rate = float(global_rate)
+        self.chat_interval = float(chat_interval)
+        self.group_interval = float(group_interval)
+        self.chat_burst = max(1, int(chat_burst))
+        self.max_retries = max(0, int(max_retries))
+        self.max_chats = max(1, int(max_chats))
+
+        self._next_at = 0.0                # monotonic-время, с которого можно следующую отправку
+        self._paused_until = 0.0
+        # (priority, seq, weight, future) — очередь ожидающих глобальный токен
+        self._waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+        # chat_id → теоретическое время следующей отправки (GCRA)
+        self._chat_tat: "OrderedDict[Union[int, str], float]" = OrderedDict()
+        # выдачи глобальных токенов за последнюю секунду и последний общий счётчик из Redis
+        self._granted: Deque[Tuple[float, int]] = deque()
+        self._cluster_count: Tuple[int, int] = (0, 0)          # (unix-секунда, отправок)
+
+        self.counters: Dict[str, Any] = {
+            "sent": {p.name.lower(): 0 for p in Priority},
+            "wait_sec": {p.name.lower(): 0.0 for p in Priority},
+            "retry_after": 0,
+            "global_pauses": 0,
+            "cluster_waits": 0,
+        }
+
+    # ---------- per-chat ----------
+
+    def _chat_wait(self, chat_id: Union[int, str], weight: int) -> float:
+        """Резервирует слот в чате и возвращает, сколько ждать до него."""
+        now = time.monotonic()
+        interval = self._interval(chat_id)
+        tat = max(self._chat_tat.get(chat_id, 0.0), now)
+        wait = max(0.0, tat - now - (self.chat_burst - 1) * interval)
+        self._chat_tat[chat_id] = tat + interval * weight
+        self._chat_tat.move_to_end(chat_id)
+        while len(self._chat_tat) > self.max_chats:
+            self._chat_tat.popitem(last=False)
+        return wait
+
+    def _interval(self, chat_id: Union[int, str]) -> float:
+        return self.chat_interval if _is_private(chat_id) else self.group_interval
+
+    # ---------- глобальный темп ----------
+
+    async def _cluster_wait(self, weight: int) -> float:
+        """Сколько ждать по общему (между процессами) счётчику и паузе в Redis."""
+        if self.rate_repo is None:
+            return 0.0
+        count, pause_until = await self.rate_repo.take(weight)
+        now = time.time()
+        self._cluster_count = (int(now), count)
+        if pause_until > now:
+            return pause_until - now
+        if count > self.global_rate:
+            return 1.0 - (now % 1.0)
+        return 0.0
+
+    async def _pump(self) -> None:
+        """Выдаёт глобальные токены ожидающим в порядке (приоритет, очередь)."""
+        while self._waiters:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            _, _, weight, fut = self._waiters[0]
+            if fut.done():                                # ожидающего отменили
+                heapq.heappop(self._waiters)
+                continue
+            if self._next_at > now:
+                await asyncio.sleep(self._next_at - now)
+                continue
+            wait = await self._cluster_wait(weight)
+            if wait > 0:
+                self.counters["cluster_waits"] += 1
+                await asyncio.sleep(wait)
+                continue
+            # голова очереди могла смениться за round-trip к Redis — токен получает текущая
+            _, _, weight, fut = heapq.heappop(self._waiters)
+            now = time.monotonic()
+            self._next_at = max(self._next_at, now) + weight / self.global_rate
+            self._granted.append((now, weight))
+            self._prune_granted(now)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def acquire(self, chat_id: Union[int, str], weight: int = 1) -> None:
+        """Дождаться права отправить weight сообщений в chat_id."""
+        priority = _priority.get()
+        started = time.monotonic()
+        wait = self._chat_wait(chat_id, weight)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._seq), weight, fut))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump(), name="tg_shaper_pump")
+        await fut
+        name = priority.name.lower()
+        self.counters["sent"][name] += weight
+        self.counters["wait_sec"][name] += time.monotonic() - started
+
+    def _prune_granted(self, now: float) -> None:
+        while self._granted and self._granted[0][0] <= now - 1.0:
+            self._granted.popleft()
+
+    def _near_global_limit(self) -> bool:
+        """Темп за последнюю секунду (свой или общий по Redis) близок к global_rate."""
+        self._prune_granted(time.monotonic())
+        threshold = self.global_rate * NEAR_LIMIT_SHARE
+        if sum(w for _, w in self._granted) >= threshold:
+            return True
+        sec, count = self._cluster_count
+        return sec >= int(time.time()) - 1 and count >= threshold
+
+    async def on_retry_after(self, chat_id: Union[int, str], retry_after: float) -> None:
+        """
+        Telegram ответил RetryAfter. По ответу не видно, какой лимит сработал:
+        личный чат шейпер и так держит в ~1/с, поэтому там (и при темпе у предела)
+        это общий лимит — пауза всем отправкам во всех процессах (через Redis).
+        Иначе — лимит чата (группа ~20/мин): отодвигается только слот этого чата.
+        """
+        self.counters["retry_after"] += 1
+        now = time.monotonic()
+        # следующая отправка в чат — не раньше чем через retry_after (с учётом запаса burst)
+        tat = now + retry_after + (self.chat_burst - 1) * self._interval(chat_id)
+        self._chat_tat[chat_id] = max(self._chat_tat.get(chat_id, 0.0), tat)
+        if not (_is_private(chat_id) or self._near_global_limit()):
+            return
+        self.counters["global_pauses"] += 1
+        self._paused_until = max(self._paused_until, now + retry_after)
+        if self.rate_repo is not None:
+            await self.rate_repo.pause(time.time() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "wait_sec": {k: round(v, 2) for k, v in self.counters["wait_sec"].items()},
+            "queued": len(self._waiters),
+            "chats": len(self._chat_tat),
+        }
+
+
+class TrafficShaperMiddleware(BaseRequestMiddleware):
+    """Подключение: bot.session.middleware(TrafficShaperMiddleware(traffic_shaper))."""
+
+    def __init__(self, shaper: TrafficShaper):
+        self.shaper = shaper
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not isinstance(method, _SHAPED_METHODS):
+            return await make_request(bot, method)
+        # альбом Telegram считает по числу сообщений в нём
+        weight = len(method.media) if isinstance(method, tg.SendMediaGroup) else 1
+        attempt = 0
+        while True:
+            await self.shaper.acquire(chat_id, weight)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                LOG.warning(
+                    "telegram RetryAfter %ss on %s to %s (attempt %s)",
+                    e.retry_after, type(method).__name__, chat_id, attempt,
+                )
+                await self.shaper.on_retry_after(chat_id, e.retry_after)
+                if attempt > self.shaper.max_retries:
+                    raise
+
+
+traffic_shaper = TrafficShaper(tg_rate)
@@ -0,0 +1,252 @@
+# smart_agent/bot/utils/webhook_queue.py
+"""
+Пул воркеров входящей очереди вебхуков YooKassa.
+
+Раньше POST /payment выполнял process_yookassa_webhook прямо в запросе:
+Redis, несколько запросов к БД и сообщения в Telegram. Всё это время YooKassa
+ждала ответа и при таймауте слала событие повторно. Теперь хендлер только
+пишет сырое событие в webhook_inbox (billing_db.webhook_enqueue) и сразу
+отвечает 200. Обработкой занимаются воркеры:
+  — N воркеров (WEBHOOK_WORKERS) забирают события через billing_db.webhook_claim.
+    Аренда действует WEBHOOK_LEASE_SEC. Для одного платежа событие не выдаётся,
+    пока не завершено предыдущее, поэтому порядок внутри платежа сохраняется
+    и при нескольких процессах бота;
+  — результат 200 → done, 400 (событие некорректно) → сразу dead;
+    500/исключение → повтор с экспоненциальной паузой, после WEBHOOK_MAX_ATTEMPTS → dead;
+  — dead-события видны админу (/webhook_dead) и возвращаются в очередь (/webhook_retry <id>);
+  — обработанные события старше WEBHOOK_KEEP_DONE_DAYS удаляются раз в час.
+
+Приём — групповой коммит: одновременные enqueue() пишутся одной транзакцией
+(billing_db.webhook_enqueue_many), 200 уходит только после коммита.
+
+Воркеры будятся после каждого приёма. Без событий они проверяют очередь раз в
+WEBHOOK_POLL_SEC: так подхватываются ретраи и события, принятые другим процессом.
+
+Повтор имеет смысл для сбоев ДО дедупликации в Redis (Redis/БД недоступны):
+если yookassa_dedup уже отметил статус, повтор вернёт «duplicate» и событие будет done.
+
+ENV:
+  WEBHOOK_WORKERS=4 / WEBHOOK_CLAIM_BATCH=10 / WEBHOOK_POLL_SEC=5 / WEBHOOK_LEASE_SEC=120
+  WEBHOOK_MAX_ATTEMPTS=8 / WEBHOOK_RETRY_BASE_SEC=5 / WEBHOOK_RETRY_MAX_SEC=3600
+  WEBHOOK_KEEP_DONE_DAYS=7
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import bot.utils.billing_db as billing_db
+from bot.utils.async_db import run_db
+from bot.utils.time_helpers import now_msk
+
+LOG = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+CLAIM_BATCH = int(os.getenv("WEBHOOK_CLAIM_BATCH", "10"))
+POLL_SEC = float(os.getenv("WEBHOOK_POLL_SEC", "5"))
+LEASE_SEC = int(os.getenv("WEBHOOK_LEASE_SEC", "120"))
+MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+RETRY_BASE_SEC = float(os.getenv("WEBHOOK_RETRY_BASE_SEC", "5"))
+RETRY_MAX_SEC = float(os.getenv("WEBHOOK_RETRY_MAX_SEC", "3600"))
+KEEP_DONE_DAYS = int(os.getenv("WEBHOOK_KEEP_DONE_DAYS", "7"))
+_PURGE_EVERY_SEC = 3600.0
+
+# (payload) -> (HTTP-подобный статус, сообщение) — как process_yookassa_webhook
+WebhookHandler = Callable[[Dict[str, Any]], Awaitable[Tuple[int, str]]]
+
+
+def retry_delay(attempts: int) -> float:
+    """Пауза перед повтором после attempts-й неудачной попытки."""
+    return min(RETRY_BASE_SEC * (2 ** max(0, attempts - 1)), RETRY_MAX_SEC)
+
+
+class WebhookQueue:
+    def __init__(
+        self,
+        *,
+        workers: int = WORKERS,
+        claim_batch: int = CLAIM_BATCH,
+        poll_sec: float = POLL_SEC,
+        lease_sec: int = LEASE_SEC,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.workers = max(1, workers)
+        self.claim_batch = max(1, claim_batch)
+        self.poll_sec = poll_sec
+        self.lease_sec = lease_sec
+        self.max_attempts = max(1, max_attempts)
+        self.worker_id = os.getenv("WEBHOOK_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+        self._handler: Optional[WebhookHandler] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._last_purge = 0.0
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self.counters: Dict[str, int] = {
+            "enqueued": 0, "flushes": 0,
+            "claimed": 0, "done": 0, "retried": 0, "dead": 0, "errors": 0,
+        }
+
+    # ---------- жизненный цикл ----------
+
+    def start(self, handler: WebhookHandler) -> None:
+        if self._tasks:
+            return
+        self._handler = handler
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"webhook_worker_{i}")
+            for i in range(self.workers)
+        ]
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """
+        Даёт воркерам доделать текущие события, не начатые возвращает в очередь.
+        Прерванные по таймауту подберёт другой процесс после аренды.
+        """
+        self._stopping = True
+        if self._wake is not None:
+            self._wake.set()
+        tasks, self._tasks = self._tasks, []
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    # ---------- приём ----------
+
+    async def enqueue(self, payload: Dict[str, Any]) -> Optional[int]:
+        """
+        Сохраняет событие (для хендлера /payment). Возвращает id в webhook_inbox
+        или None для повторной доставки. Исключение — событие НЕ сохранено.
+
+        Пока идёт коммит предыдущей пачки, новые события копятся в _pending;
+        следующий, кто получит lock, пишет их все одной транзакцией.
+        """
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._pending.append((payload, fut))
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not fut.done():
+                batch, self._pending = self._pending, []
+                try:
+                    ids = await run_db(billing_db.webhook_enqueue_many, payloads=[p for p, _ in batch])
+                except Exception as e:
+                    for _, f in batch:
+                        f.set_exception(e)
+                else:
+                    for (_, f), event_id in zip(batch, ids):
+                        f.set_result(event_id)
+                    self.counters["flushes"] += 1
+                    self.counters["enqueued"] += sum(1 for i in ids if i is not None)
+                    self.wake()
+        return await fut
+
+    def wake(self) -> None:
+        """Новое событие в очереди (вызывать в loop'е бота)."""
+        if self._wake is not None:
+            self._wake.set()
+
+    # ---------- воркеры ----------
+
+    async def _worker(self, n: int) -> None:
+        worker_id = f"{self.worker_id}/{n}"
+        while not self._stopping:
+            try:
+                claimed = await run_db(
+                    billing_db.webhook_claim,
+                    worker_id=worker_id, limit=self.claim_batch, lease_sec=self.lease_sec,
+                )
+            except Exception as e:
+                LOG.warning("webhook_claim failed: %s", e)
+                claimed = []
+            if claimed:
+                for i, item in enumerate(claimed):
+                    if self._stopping:
+                        await self._release(claimed[i:], worker_id)
+                        break
+                    await self._process(item, worker_id)
+                continue
+            if n == 0:
+                await self._purge_if_due()
+            await self._idle()
+
+    async def _idle(self) -> None:
+        wake = self._wake
+        if wake is None or self._stopping:
+            return
+        try:
+            await asyncio.wait_for(wake.wait(), timeout=self.poll_sec)
+        except asyncio.TimeoutError:
+            pass
+        # set() уже разбудил всех ждущих; сбрасываем, чтобы следующий сон снова ждал
+        wake.clear()
+
+    async def _process(self, item: Dict[str, Any], worker_id: str) -> None:
+        self.counters["claimed"] += 1
+        event_id = item["id"]
+        try:
+            status, msg = await self._handler(item["payload"])
+        except Exception as e:
+            LOG.exception("webhook %s (payment %s) handler crashed", event_id, item["payment_id"])
+            status, msg = 500, f"error: {e}"
+
+        try:
+            if status == 200:
+                await run_db(billing_db.webhook_done, event_id=event_id, worker_id=worker_id)
+                self.counters["done"] += 1
+                return
+            # 400 — событие некорректно, повтор не поможет
+            final = status == 400 or item["attempts"] >= self.max_attempts
+            delay = None if final else retry_delay(item["attempts"])
+            await run_db(
+                billing_db.webhook_failed,
+                event_id=event_id, worker_id=worker_id, error=f"{status}: {msg}", retry_in_sec=delay,
+            )
+            if final:
+                self.counters["dead"] += 1
+                LOG.error("webhook %s (payment %s) moved to dead letters after %s attempts: %s",
+                          event_id, item["payment_id"], item["attempts"], msg)
+            else:
+                self.counters["retried"] += 1
+                LOG.warning("webhook %s (payment %s) failed (%s), retry in %.0fs",
+                            event_id, item["payment_id"], msg, delay)
+        except Exception as e:
+            # статус не записан — событие вернётся в работу по истечении аренды
+            self.counters["errors"] += 1
+            LOG.warning("webhook %s: failed to store result: %s", event_id, e)
+
+    async def _release(self, items: List[Dict[str, Any]], worker_id: str) -> None:
+        try:
+            await run_db(billing_db.webhook_release, event_ids=[x["id"] for x in items], worker_id=worker_id)
+        except Exception as e:
+            LOG.warning("webhook release failed (events return after lease): %s", e)
+
+    async def _purge_if_due(self) -> None:
+        if time.monotonic() - self._last_purge < _PURGE_EVERY_SEC:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            removed = await run_db(
+                billing_db.webhook_purge_done, older_than=now_msk() - timedelta(days=KEEP_DONE_DAYS),
+            )
+            if removed:
+                LOG.info("webhook_inbox: purged %s processed events", removed)
+        except Exception as e:
+            LOG.warning("webhook_inbox purge failed: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "workers": len(self._tasks)}
+
+
+webhook_queue = WebhookQueue()
@@ -0,0 +1,176 @@
+# smart_agent/bot/utils/yookassa_client.py
+"""
+Асинхронный клиент YooKassa API v3 для рекуррентных списаний.
+
+Официальный SDK (yookassa.Payment) синхронный: каждый вызов — requests-сессия,
+новый TLS-handshake и блокировка event loop'а бота на весь HTTP round-trip.
+Здесь одна aiohttp-сессия на процесс:
+  — пул keep-alive соединений (YOOKASSA_HTTP_LIMIT / YOOKASSA_KEEPALIVE_SEC);
+  — Idempotence-Key задаёт вызывающий: повтор с тем же ключом YooKassa
+    не превращает в второй платёж, поэтому ретраи (202 «в обработке», 429, 5xx,
+    обрыв соединения) безопасны;
+  — счётчики запросов/ошибок/задержек (stats()).
+
+Жизненный цикл: сессия создаётся лениво, await yookassa_client.close() при остановке бота.
+
+ENV:
+  YOOKASSA_API_URL=https://api.yookassa.ru/v3
+  YOOKASSA_HTTP_LIMIT=20 / YOOKASSA_KEEPALIVE_SEC=30
+  YOOKASSA_TIMEOUT_SEC=30 / YOOKASSA_CONNECT_TIMEOUT_SEC=5 / YOOKASSA_RETRIES=3
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from bot.config import YOUMONEY_SHOP_ID, YOUMONEY_SECRET_KEY
+
+LOG = logging.getLogger(__name__)
+
+API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+HTTP_LIMIT = int(os.getenv("YOOKASSA_HTTP_LIMIT", "20"))
+HTTP_KEEPALIVE_SEC = float(os.getenv("YOOKASSA_KEEPALIVE_SEC", "30"))
+TIMEOUT_SEC = float(os.getenv("YOOKASSA_TIMEOUT_SEC", "30"))
+CONNECT_TIMEOUT_SEC = float(os.getenv("YOOKASSA_CONNECT_TIMEOUT_SEC", "5"))
+RETRIES = int(os.getenv("YOOKASSA_RETRIES", "3"))
+
+# 202 — запрос с этим ключом ещё обрабатывается, ответ надо запросить повторно
+_RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+_RETRY_BACKOFF_SEC = 0.5
+_RETRY_AFTER_CAP_SEC = 10.0
+
+
+class YooKassaError(RuntimeError):
+    """YooKassa ответила ошибкой (4xx/5xx) или не ответила после всех повторов."""
+
+    def __init__(self, status: int, code: str = "", description: str = ""):
+        super().__init__(f"YooKassa HTTP {status}: {code} {description}".strip())
+        self.status = status
+        self.code = code
+        self.description = description
+
+    @property
+    def is_bad_request(self) -> bool:
+        return self.status == 400
+
+
+class YooKassaClient:
+    def __init__(
+        self,
+        shop_id: Optional[str],
+        secret_key: Optional[str],
+        *,
+        base_url: str = API_URL,
+        limit: int = HTTP_LIMIT,
+        keepalive_sec: float = HTTP_KEEPALIVE_SEC,
+        timeout_sec: float = TIMEOUT_SEC,
+        connect_timeout_sec: float = CONNECT_TIMEOUT_SEC,
+        retries: int = RETRIES,
+    ):
+        self.shop_id = str(shop_id or "")
+        self.secret_key = str(secret_key or "")
+        self.base_url = base_url.rstrip("/")
+        self.limit = max(1, limit)
+        self.keepalive_sec = keepalive_sec
+        self.timeout_sec = timeout_sec
+        self.connect_timeout_sec = connect_timeout_sec
+        self.retries = max(0, retries)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.counters: Dict[str, float] = {
+            "requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0,
+        }
+
+    # --- жизненный цикл ---
+    async def close(self) -> None:
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    def _session_or_init(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit,
+                keepalive_timeout=self.keepalive_sec,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                auth=aiohttp.BasicAuth(self.shop_id, self.secret_key),
+                timeout=aiohttp.ClientTimeout(total=self.timeout_sec, connect=self.connect_timeout_sec),
+            )
+        return self._session
+
+    # --- запросы ---
+    async def create_payment(self, body: Dict[str, Any], idempotence_key: str) -> Dict[str, Any]:
+        """POST /payments; возвращает JSON платежа или бросает YooKassaError."""
+        return await self._request("POST", "/payments", body, idempotence_key)
+
+    async def _request(self, method: str, path: str, body: Dict[str, Any], idempotence_key: str) -> Dict[str, Any]:
+        session = self._session_or_init()
+        headers = {"Idempotence-Key": idempotence_key}
+        c = self.counters
+        attempt = 0
+        while True:
+            c["requests"] += 1
+            t0 = time.perf_counter()
+            retry_delay: Optional[float] = None
+            try:
+                async with session.request(method, self.base_url + path, json=body, headers=headers) as resp:
+                    try:
+                        data = await resp.json(content_type=None)
+                    except Exception:
+                        data = {}
+                    data = data if isinstance(data, dict) else {}
+                    if resp.status == 200:
+                        return data
+                    c["errors"] += 1
+                    err: Exception = YooKassaError(resp.status, data.get("code") or "", data.get("description") or "")
+                    if resp.status in _RETRY_STATUSES:
+                        retry_delay = _retry_after(resp, data, attempt)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                # ключ идемпотентности тот же — повтор не создаст второй платёж
+                c["errors"] += 1
+                err = e
+                retry_delay = _RETRY_BACKOFF_SEC * (2 ** attempt)
+            finally:
+                elapsed_ms = (time.perf_counter() - t0) * 1000
+                c["total_ms"] += elapsed_ms
+                c["max_ms"] = max(c["max_ms"], elapsed_ms)
+
+            if retry_delay is None or attempt >= self.retries:
+                raise err
+            attempt += 1
+            c["retries"] += 1
+            LOG.warning("YooKassa %s %s failed (%s), retry %s/%s in %.1fs", method, path, err, attempt, self.retries, retry_delay)
+            await asyncio.sleep(retry_delay)
+
+    def stats(self) -> Dict[str, Any]:
+        c = self.counters
+        return {
+            "requests": int(c["requests"]),
+            "errors": int(c["errors"]),
+            "retries": int(c["retries"]),
+            "avg_ms": round(c["total_ms"] / c["requests"], 1) if c["requests"] else 0.0,
+            "max_ms": round(c["max_ms"], 1),
+        }
+
+
+def _retry_after(resp: aiohttp.ClientResponse, data: Dict[str, Any], attempt: int) -> float:
+    # 202: {"type": "processing", "retry_after": <мс>}; 429/5xx: заголовок Retry-After (сек)
+    try:
+        if data.get("retry_after") is not None:
+            return min(float(data["retry_after"]) / 1000.0, _RETRY_AFTER_CAP_SEC)
+        header = resp.headers.get("Retry-After")
+        if header is not None:
+            return min(float(header), _RETRY_AFTER_CAP_SEC)
+    except (TypeError, ValueError):
+        pass
+    return _RETRY_BACKOFF_SEC * (2 ** attempt)
+
+
+yookassa_client = YooKassaClient(YOUMONEY_SHOP_ID, YOUMONEY_SECRET_KEY)
@@ -9,6 +9,7 @@ from yookassa.domain.exceptions.forbidden_error import ForbiddenError
 from yookassa import Configuration, Payment
 from bot.config import YOUMONEY_SHOP_ID, YOUMONEY_SECRET_KEY
 import bot.utils.billing_db as billing_db
+from bot.utils.yookassa_client import YooKassaError, yookassa_client
 
 logger = logging.getLogger(__name__)
 
@@ -138,6 +139,39 @@ def create_pay_ex(
     return confirmation_url
 
 
+def _recurring_body(
+    *,
+    user_id: int,
+    payment_method_id: str,
+    amount_rub: str,
+    description: str,
+    metadata: Optional[Dict[str, str]],
+    subscription_id: Optional[int],
+) -> dict:
+    """Тело запроса повторного списания (с валидацией входных данных)."""
+    validate_payment_method_id(payment_method_id)
+    validate_amount(amount_rub)
+
+    md = {
+        "user_id": str(user_id),
+        "kind": "recurring",
+        "is_recurring": "1",
+        "phase": "renewal",
+    }
+    if metadata:
+        md.update({k: str(v) for k, v in metadata.items()})
+    if subscription_id is not None:
+        md["subscription_id"] = str(subscription_id)
+
+    return {
+        "amount": {"value": amount_rub, "currency": "RUB"},
+        "capture": True,
+        "payment_method_id": payment_method_id,
+        "description": description[:128],
+        "metadata": md,
+    }
+
+
 # Повторные списания по сохранённому способу оплаты (подписка)
 def charge_saved_method(
     *,
@@ -167,28 +201,14 @@ def charge_saved_method(
     
     attempt_id: опциональный ID попытки для пометки как failed при ошибке
     """
-    # Валидация входных данных
-    validate_payment_method_id(payment_method_id)
-    validate_amount(amount_rub)
-    
-    md = {
-        "user_id": str(user_id),
-        "kind": "recurring",
-        "is_recurring": "1",
-        "phase": "renewal",
-    }
-    if metadata:
-        md.update({k: str(v) for k, v in metadata.items()})
-    if subscription_id is not None:
-        md["subscription_id"] = str(subscription_id)
-
-    body = {
-        "amount": {"value": amount_rub, "currency": "RUB"},
-        "capture": True,
-        "payment_method_id": payment_method_id,
-        "description": description[:128],
-        "metadata": md,
-    }
+    body = _recurring_body(
+        user_id=user_id,
+        payment_method_id=payment_method_id,
+        amount_rub=amount_rub,
+        description=description,
+        metadata=metadata,
+        subscription_id=subscription_id,
+    )
     
     try:
         payment = Payment.create(body, uuid.uuid4())
@@ -252,4 +272,54 @@ def charge_saved_method(
         except Exception as e:
             logger.warning("Failed to record charge attempt for subscription %s: %s", subscription_id, e)
     
-    return payment_id
\ No newline at end of file
+    return payment_id
+
+
+def charge_idempotence_key(attempt_id: Optional[int]) -> str:
+    """
+    Ключ идемпотентности списания: один на попытку (ChargeAttempt), чтобы повтор
+    запроса после таймаута/обрыва не создал второй платёж.
+    """
+    return f"sa-recurring-{attempt_id}" if attempt_id is not None else str(uuid.uuid4())
+
+
+async def charge_saved_method_async(
+    *,
+    user_id: int,
+    payment_method_id: str,
+    amount_rub: str,
+    description: str,
+    metadata: Optional[Dict[str, str]] = None,
+    subscription_id: Optional[int] = None,
+    attempt_id: Optional[int] = None,
+) -> str:
+    """
+    Асинхронный вариант charge_saved_method для billing_loop: тот же body,
+    запрос через общий пул yookassa_client, Idempotence-Key по attempt_id.
+    Попытку НЕ записывает и не помечает — это делает вызывающий
+    (precharge_guard_and_attempt / link_payment_to_attempt / mark_attempt_failed).
+    Ошибки валидации (в т.ч. 400 от YooKassa) → ValueError.
+    """
+    body = _recurring_body(
+        user_id=user_id,
+        payment_method_id=payment_method_id,
+        amount_rub=amount_rub,
+        description=description,
+        metadata=metadata,
+        subscription_id=subscription_id,
+    )
+    try:
+        payment = await yookassa_client.create_payment(body, charge_idempotence_key(attempt_id))
+    except YooKassaError as e:
+        logger.error(
+            "YooKassa error creating recurring charge for user %s, subscription %s: %s",
+            user_id, subscription_id, e
+        )
+        if e.is_bad_request:
+            raise ValueError(f"Payment validation error: {str(e)}") from e
+        raise
+
+    payment_id = payment.get("id")
+    if not payment_id:
+        raise ValueError(f"Payment created but id is missing: {payment}")
+    return payment_id
@@ -2,15 +2,21 @@
 import logging
 import os
 import sys
-from flask import Flask
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
 from executor.config import *
 from executor.controller import api
+from executor import hedging, limits
+from executor.llm_gateway import gateway
+from executor.response_cache import objection_cache
+
+LOG = logging.getLogger(__name__)
 
-def create_app() -> Flask:
-    sa_executor = Flask(__name__)
 
-    # --- logging ---
+def _setup_logging() -> None:
     root_level = os.getenv("LOG_LEVEL", "INFO").upper()
     logging.basicConfig(
         level=getattr(logging, root_level, logging.INFO),
@@ -22,20 +28,61 @@ def create_app() -> Flask:
     logging.getLogger("replicate").setLevel(logging.INFO)
     HTTP_DEBUG = os.getenv("HTTP_DEBUG", "0") == "1"
     logging.getLogger("httpx").setLevel(logging.INFO if HTTP_DEBUG else logging.WARNING)
-    logging.getLogger("werkzeug").setLevel(logging.INFO)
+    logging.getLogger("uvicorn.access").setLevel(logging.INFO)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    limits.reset()
+    yield
+    # graceful drain: новые запросы → 503, принятые и фоновые (callback-описания) дорабатывают
+    drained = await limits.drain()
+    await gateway.aclose()
+    LOG.info("Executor stopped (drained=%s)", drained)
+
 
+def create_app() -> FastAPI:
+    _setup_logging()
+
+    sa_executor = FastAPI(title="Smart Agent Executor", lifespan=lifespan)
+
+    @sa_executor.exception_handler(limits.Overloaded)
+    async def _overloaded(_: Request, exc: limits.Overloaded):
+        return JSONResponse(
+            {"error": exc.detail, "endpoint": exc.endpoint, "retry_after": exc.retry_after},
+            status_code=exc.status_code,
+            headers={"Retry-After": str(exc.retry_after)},
+        )
 
     # маршруты
-    sa_executor.register_blueprint(api)
+    sa_executor.include_router(api)
 
     @sa_executor.get("/")
-    def root():
-        return {"ok": True, "service": "executor"}, 200
+    async def root():
+        return {"ok": True, "service": "executor"}
+
+    @sa_executor.get("/health")
+    async def health():
+        return {
+            "ok": True,
+            **limits.stats(),
+            "hedging": hedging.stats(),
+            "llm": gateway.stats(),
+            "objection_cache": objection_cache.stats(),
+        }
 
     return sa_executor
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     app = create_app()
-    app.logger.info("Webhook server started on http://%s:%s", EXECUTOR_HOST, EXECUTOR_PORT)
-    app.run(host=EXECUTOR_HOST, port=EXECUTOR_PORT)
+    LOG.info("Executor server started on http://%s:%s", EXECUTOR_HOST, EXECUTOR_PORT)
+    uvicorn.run(
+        app,
+        host=EXECUTOR_HOST,
+        port=EXECUTOR_PORT,
+        # uvicorn перестаёт принимать соединения и ждёт активные запросы, затем — lifespan drain
+        timeout_graceful_shutdown=int(limits.DRAIN_TIMEOUT_SEC),
+    )
@@ -3,11 +3,14 @@ from __future__ import annotations
 
 import os
 import logging
+import time
 from typing import Any, Dict, List, Optional, Tuple
-from flask import jsonify, Request
-from executor.config import OPENAI_API_KEY
-import threading
-import requests
+from fastapi.responses import JSONResponse
+from starlette.requests import Request
+from executor.asgi_utils import read_form, read_json
+from executor import limits
+from executor.llm_gateway import default_api_key, gateway
+import httpx
 import json
 import re
 from urllib.parse import urlparse
@@ -16,86 +19,22 @@ import bot.utils.logging_config as logging_config
 log = logging_config.logger
 
 
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
-
-_FALLBACK_MODELS: List[str] = ["gpt-5", "gpt-4o", "gpt-4.1", "gpt-4o-mini", "gpt-4.1-mini"]
-
-_client_default: Any = None
-
-
 # =========================
-# OpenAI helpers (client + send)
+# OpenAI helpers (клиенты по ключам, пул, fallback — в executor/llm_gateway.py)
 # =========================
-def _extract_text(resp: Any) -> str:
-    """
-    Безопасно достаём текст из Chat Completions ответа.
-    """
-    try:
-        return (resp.choices[0].message.content or "").strip()
-    except Exception:
-        return ""
-
-
-def _client_or_init(api_key: Optional[str]) -> Any:
-    """
-    Возвращает OpenAI-клиент:
-      - если ключ per-request совпадает с дефолтным — используем и кешируем общий клиент;
-      - если пришёл иной ключ — создаём ephemeral клиент (без кеша).
-    """
-    if OpenAI is None:
-        raise RuntimeError("openai package is not installed")
-
-    default_key = _default_api_key()
-    req_key = (api_key or default_key or "").strip()
-    if not req_key:
-        raise RuntimeError("OPENAI_API_KEY is missing (config/env or request header/body)")
-
-    global _client_default
-    if req_key == default_key:
-        if _client_default is None:
-            _client_default = OpenAI(api_key=req_key)
-        return _client_default
-    # per-request «чужой» ключ — отдельный клиент
-    return OpenAI(api_key=req_key)
-
-
-def _send_with_fallback(payload: Dict[str, Any],
+async def _send_with_fallback(payload: Dict[str, Any],
                         default_model: str,
                         allow_fallback: bool,
                         api_key: Optional[str]) -> Tuple[str, str]:
     """
     Отправка Chat Completions с цепочкой fallback-моделей.
+    Per-request ключ получает свой клиент из LRU шлюза (общий пул соединений).
     Возвращает: (text, model_used).
     """
-    client = _client_or_init(api_key)
-    first_model = payload.get("model") or default_model
-    chain = [first_model] + ([m for m in _FALLBACK_MODELS if m != first_model] if allow_fallback else [])
-    last_err: Optional[Exception] = None
-
-    for i, model_name in enumerate(chain, start=1):
-        try:
-            req = dict(payload)
-            req["model"] = model_name
-            
-            # Логируем промпт перед отправкой в OpenAI
-            if "messages" in req:
-                log.info("OpenAI prompt: %s", json.dumps(req["messages"], ensure_ascii=False, indent=2))
-            resp = client.chat.completions.create(**req)
-            text = _extract_text(resp)
-            if text:
-                if i > 1:
-                    log.warning("Fallback model used: %s (requested %s)", model_name, first_model)
-                return text, model_name
-            last_err = RuntimeError("Empty completion text")
-        except Exception as e:
-            last_err = e
-            log.warning("OpenAI call failed on model %s: %s", model_name, e)
-
-    log.error("All OpenAI fallbacks failed. Last error: %s", last_err)
-    raise last_err or RuntimeError("OpenAI request failed")
+    # Логируем промпт перед отправкой в OpenAI (один раз — он одинаков для всех моделей цепочки)
+    if "messages" in payload:
+        log.info("OpenAI prompt: %s", json.dumps(payload["messages"], ensure_ascii=False, indent=2))
+    return await gateway.complete(payload, default_model=default_model, allow_fallback=allow_fallback, api_key=api_key)
 
 
 # =========================
@@ -107,6 +46,9 @@ OPENAI_FALLBACK = os.getenv("OPENAI_FALLBACK", "1") == "1"
 # Базовая модель
 DESCRIPTION_MODEL = os.getenv("DESCRIPTION_MODEL", "gpt-5")
 
+# Потоковый режим: как часто слать промежуточный текст на callback_url (сек)
+DESCRIPTION_PARTIAL_INTERVAL_SEC = float(os.getenv("DESCRIPTION_PARTIAL_INTERVAL_SEC", "1.5"))
+
 # ------------------ Карты лейблов для select-полей ------------------
 # NB: это единый источник «человекочитаемых» лейблов и для UI, и для сборки промпта
 DESCRIPTION_TYPES = {
@@ -527,13 +469,6 @@ def _sanitize_format_template(s: str) -> str:
             out.append(ch); i += 1
     return ''.join(out)
 
-def _default_api_key() -> str:
-    """
-    Ключ по умолчанию берём из config (приоритет) либо из окружения как бэкап.
-    """
-    return (OPENAI_API_KEY or os.getenv("OPENAI_API_KEY", "")).strip()
-
-
 def validate_config() -> List[str]:
     """
     Проверяем только базовые вещи. Тонкий контроллер:
@@ -541,7 +476,7 @@ def validate_config() -> List[str]:
     """
     issues: List[str] = []
     # soft check
-    if not _default_api_key():
+    if not default_api_key():
         issues.append("OPENAI_API_KEY not set (pass per-request key or set in config)")
     return issues
 
@@ -911,7 +846,7 @@ def compose_description_user_message(fields: Dict[str, Any]) -> str:
         return out
 
 
-def send_description_generate_request_from_fields(
+async def send_description_generate_request_from_fields(
         fields: Dict[str, Any],
         *,
         model: Optional[str] = None,
@@ -923,7 +858,7 @@ def send_description_generate_request_from_fields(
     """
     use_model = model or DESCRIPTION_MODEL
     payload = build_description_request_from_fields(fields=fields, model=use_model)
-    return _send_with_fallback(
+    return await _send_with_fallback(
         payload,
         default_model=use_model,
         allow_fallback=allow_fallback,
@@ -931,20 +866,49 @@ def send_description_generate_request_from_fields(
     )
 
 
-def _post_callback(callback_url: str, payload: Dict[str, Any]) -> None:
+async def stream_description_generate_request_from_fields(
+        fields: Dict[str, Any],
+        result: Dict[str, Any],
+        *,
+        model: Optional[str] = None,
+        allow_fallback: bool = OPENAI_FALLBACK,
+        api_key: Optional[str] = None,
+):
+    """
+    Потоковый вариант генерации описания: дельты текста, модель — в result["model"].
+    """
+    use_model = model or DESCRIPTION_MODEL
+    payload = build_description_request_from_fields(fields=fields, model=use_model)
+    async for delta in gateway.stream(payload, result, default_model=use_model,
+                                      allow_fallback=allow_fallback, api_key=api_key):
+        yield delta
+
+
+async def _post_callback(callback_url: str,
+                         payload: Dict[str, Any],
+                         *,
+                         http: Optional[httpx.AsyncClient] = None) -> None:
     """
     Безопасно шлём результат на callback_url. Не бросаем исключения наружу.
+    http — общий клиент (потоковый режим шлёт несколько промежуточных колбэков подряд).
     """
-    log.info("Sending callback to URL: %s", callback_url)
-    log.info("Callback payload: %s", json.dumps(payload, ensure_ascii=False, indent=2))
+    partial = bool(payload.get("partial"))
+    if not partial:
+        log.info("Sending callback to URL: %s", callback_url)
+        log.info("Callback payload: %s", json.dumps(payload, ensure_ascii=False, indent=2))
     try:
         # небольшая валидация URL
         pr = urlparse(callback_url)
         if pr.scheme not in {"http", "https"}:
             raise ValueError("callback_url must be http/https")
         headers = {"Content-Type": "application/json"}
-        response = requests.post(callback_url, data=json.dumps(payload), headers=headers, timeout=30)
-        log.info("Callback sent successfully, status: %s, response: %s", response.status_code, response.text)
+        if http is not None:
+            response = await http.post(callback_url, content=json.dumps(payload), headers=headers)
+        else:
+            async with httpx.AsyncClient(timeout=30) as client:
+                response = await client.post(callback_url, content=json.dumps(payload), headers=headers)
+        if not partial:
+            log.info("Callback sent successfully, status: %s, response: %s", response.status_code, response.text)
     except Exception as e:
         log.warning("Callback POST failed: %s", e)
 
@@ -952,11 +916,15 @@ def _post_callback(callback_url: str, payload: Dict[str, Any]) -> None:
 # =====================================================================================
 # PUBLIC ENTRYPOINT for thin controller
 # =====================================================================================
-def description_generate(req: Request):
+async def description_generate(req: Request):
     """
     Тонкий вход: разбираем запрос (JSON/form), берём per-request API ключ (если есть),
-    вызываем локальный OpenAI-сервис и возвращаем Flask-совместимый ответ.
-    Контроллер просто делегирует сюда: return description_module.description_generate(request).
+    вызываем локальный OpenAI-сервис и возвращаем JSONResponse.
+    Контроллер просто делегирует сюда: return await description_module.description_generate(request).
+
+    В async-callback режиме генерация уходит в фоновую задачу (limits.spawn), которая
+    занимает слот лимитера "description" — так число одновременных генераций ограничено,
+    а при остановке сервиса задачи дорабатывают в рамках graceful drain.
     """
     # Логируем входящие данные по API
     log.info("API request received - Method: %s, URL: %s", req.method, req.url)
@@ -964,24 +932,24 @@ def description_generate(req: Request):
     
     # мягкая проверка конфигурации: если нет env-ключа и не передан per-request ключ — 500
     issues = validate_config()
-    data = req.get_json(silent=True) or {}
-    form = req.form or {}
+    data = await read_json(req)
+    form = await read_form(req)
     
     # Логируем данные запроса
     log.info("Request JSON data: %s", json.dumps(data, ensure_ascii=False, indent=2))
     log.info("Request form data: %s", dict(form))
-    log.info("Request args: %s", dict(req.args))
+    log.info("Request args: %s", dict(req.query_params))
 
     api_key = (
             req.headers.get("X-OpenAI-Api-Key")
             or (data.get("api_key") if isinstance(data, dict) else None)
-            or req.args.get("api_key")
+            or req.query_params.get("api_key")
     )
     # если валидация ругается и ключ явно не пришёл — попробуем взять из конфигурации
     if issues and not api_key:
-        fallback = _default_api_key()
+        fallback = default_api_key()
         if not fallback:
-            return jsonify({"error": "config", "detail": "; ".join(issues)}), 500
+            return JSONResponse({"error": "config", "detail": "; ".join(issues)}, status_code=500)
         api_key = fallback
 
     # Собираем поля анкеты. Поддерживаем оба формата:
@@ -1002,15 +970,17 @@ def description_generate(req: Request):
     # Минимальная валидация
     t = (fields.get("type") or "").strip()
     if not t:
-        return jsonify({"error": "bad_request", "detail": "field 'type' is required"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "field 'type' is required"}, status_code=400)
 
     # Параметры для обратного вызова
-    callback_url   = (data.get("callback_url") if isinstance(data, dict) else None) or req.args.get("callback_url")
-    callback_token = (data.get("callback_token") if isinstance(data, dict) else None) or req.args.get("callback_token")
-    cb_chat_id     = (data.get("chat_id") if isinstance(data, dict) else None) or req.args.get("chat_id")
-    cb_msg_id      = (data.get("msg_id") if isinstance(data, dict) else None) or req.args.get("msg_id")
+    callback_url   = (data.get("callback_url") if isinstance(data, dict) else None) or req.query_params.get("callback_url")
+    callback_token = (data.get("callback_token") if isinstance(data, dict) else None) or req.query_params.get("callback_token")
+    cb_chat_id     = (data.get("chat_id") if isinstance(data, dict) else None) or req.query_params.get("chat_id")
+    cb_msg_id      = (data.get("msg_id") if isinstance(data, dict) else None) or req.query_params.get("msg_id")
+    # stream=true: промежуточный текст уходит на callback_url с partial=true по мере генерации
+    stream_flag    = bool(data.get("stream")) if isinstance(data, dict) else False
 
-    debug_flag = req.args.get("debug") == "1"
+    debug_flag = req.query_params.get("debug") == "1"
 
     # Режим async callback
     if callback_url and cb_chat_id and cb_msg_id:
@@ -1018,17 +988,45 @@ def description_generate(req: Request):
             chat_id = int(cb_chat_id)
             msg_id  = int(cb_msg_id)
         except Exception:
-            return jsonify({"error": "bad_request", "detail": "chat_id and msg_id must be integers"}), 400
-
-        def _bg():
+            return JSONResponse({"error": "bad_request", "detail": "chat_id and msg_id must be integers"}, status_code=400)
+
+        async def _generate_streaming(http: httpx.AsyncClient) -> str:
+            """Генерация потоком: накопленный текст не чаще DESCRIPTION_PARTIAL_INTERVAL_SEC на callback_url."""
+            parts: List[str] = []
+            last_sent = time.monotonic()
+            async for delta in stream_description_generate_request_from_fields(
+                fields, {}, allow_fallback=True, api_key=api_key,
+            ):
+                parts.append(delta)
+                if time.monotonic() - last_sent >= DESCRIPTION_PARTIAL_INTERVAL_SEC:
+                    await _post_callback(callback_url, {
+                        "chat_id": chat_id,
+                        "msg_id": msg_id,
+                        "text": "".join(parts),
+                        "error": "",
+                        "token": callback_token or "",
+                        "partial": True,
+                    }, http=http)
+                    last_sent = time.monotonic()
+            text = "".join(parts).strip()
+            if not text:
+                raise RuntimeError("Empty completion text")
+            return text
+
+        async def _bg():
             """Фоновая генерация и POST результата на callback_url."""
             log.info("Starting async description generation for chat_id=%s, msg_id=%s", chat_id, msg_id)
             try:
-                text, used_model = send_description_generate_request_from_fields(
-                    fields=fields,
-                    allow_fallback=True,
-                    api_key=api_key,
-                )
+                async with limits.limiter("description").slot(admitted=True):
+                    if stream_flag:
+                        async with httpx.AsyncClient(timeout=30) as http:
+                            text = await _generate_streaming(http)
+                    else:
+                        text, used_model = await send_description_generate_request_from_fields(
+                            fields=fields,
+                            allow_fallback=True,
+                            api_key=api_key,
+                        )
                 payload = {
                     "chat_id": chat_id,
                     "msg_id": msg_id,
@@ -1040,7 +1038,7 @@ def description_generate(req: Request):
                 }
                 log.info("Async generation completed successfully, sending callback to: %s", callback_url)
                 log.info("Callback payload: %s", json.dumps(payload, ensure_ascii=False, indent=2))
-                _post_callback(callback_url, payload)
+                await _post_callback(callback_url, payload)
             except Exception as e:
                 log.exception("OpenAI error (description, async)")
                 payload = {
@@ -1052,30 +1050,34 @@ def description_generate(req: Request):
                     "fields": fields,
                 }
                 log.info("Async generation failed, sending error callback: %s", json.dumps(payload, ensure_ascii=False, indent=2))
-                _post_callback(callback_url, payload)
+                await _post_callback(callback_url, payload)
 
-        threading.Thread(target=_bg, daemon=True).start()
-        # Быстрый ACK, чтобы бот не «ждал»
+        # Быстрый ACK, чтобы бот не «ждал». Очередь уже полна — 429 сразу, а не после генерации.
+        limits.limiter("description").admit()
+        limits.spawn(_bg(), name=f"description:{chat_id}:{msg_id}")
         log.info("Async request accepted, returning 202")
-        return jsonify({"accepted": True}), 202
+        return JSONResponse({"accepted": True}, status_code=202)
 
     # Обычный синхронный режим (совместимость)
     log.info("Starting sync description generation")
     try:
-        text, used_model = send_description_generate_request_from_fields(
-            fields=fields,
-            allow_fallback=True,
-            api_key=api_key,
-        )
+        async with limits.limiter("description").slot():
+            text, used_model = await send_description_generate_request_from_fields(
+                fields=fields,
+                allow_fallback=True,
+                api_key=api_key,
+            )
         body: Dict[str, Any] = {"text": text}
         if debug_flag:
             body["debug"] = {"model_used": used_model}
         log.info("Sync generation completed successfully, response: %s", json.dumps(body, ensure_ascii=False, indent=2))
-        return jsonify(body), 200
+        return JSONResponse(body, status_code=200)
+    except limits.Overloaded:
+        raise
     except Exception as e:
         log.exception("OpenAI error (description)")
         body: Dict[str, Any] = {"error": "openai_error", "detail": str(e)}
         if debug_flag:
             body["debug"] = {"model": DESCRIPTION_MODEL}
         log.info("Sync generation failed, error response: %s", json.dumps(body, ensure_ascii=False, indent=2))
-        return jsonify(body), 502
\ No newline at end of file
+        return JSONResponse(body, status_code=502)
@@ -15,7 +15,11 @@ import hashlib
 import logging
 from typing import Any, Dict, Optional, List, Tuple
 
-from flask import jsonify, Request
+from fastapi.responses import JSONResponse
+from starlette.datastructures import FormData
+from starlette.requests import Request
+
+from executor.asgi_utils import read_form
 from executor.config import *  # BANANO_API_KEY_FALLBACK и т.п.
 
 __all__ = ["design_generate", "build_design_prompt", "build_refine_prompt"]
@@ -123,15 +127,15 @@ def _image_meta(img_bytes: bytes) -> Dict[str, Any]:
     }
 
 
-def _read_api_key(req: Request) -> str:
+def _read_api_key(req: Request, form: FormData) -> str:
     """
     Источник API-ключа (приоритет):
      1) из запроса: form['api_key'] либо Authorization: Bearer/ X-API-Key / X-Banano-Key
      2) из ENV (BANANO_API_KEY_FALLBACK / GOOGLE_API_KEY / GEMINI_API_KEY)
     """
     try:
-        if hasattr(req, "form") and req.form and "api_key" in req.form:
-            v = (req.form.get("api_key") or "").strip()
+        if form and "api_key" in form:
+            v = (form.get("api_key") or "").strip()
             if v:
                 return v
     except Exception:
@@ -162,7 +166,7 @@ def _detect_mime(b: bytes) -> str:
 def _to_data_url(img_bytes: bytes, mime: str = "image/png") -> str:
     return f"data:{mime};base64,{base64.b64encode(img_bytes).decode('ascii')}"
 
-def _genai_generate_image(*, api_key: str, model: str,
+async def _genai_generate_image(*, api_key: str, model: str,
                           prompt: str, images: List[bytes],
                           aspect_ratio: Optional[str],
                           images_only: bool) -> Dict[str, Any]:
@@ -185,11 +189,18 @@ def _genai_generate_image(*, api_key: str, model: str,
     if aspect_ratio:
         cfg_kwargs["image_config"] = types.ImageConfig(aspect_ratio=aspect_ratio)
 
-    resp = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=types.GenerateContentConfig(**cfg_kwargs) if cfg_kwargs else None,
-    )
+    # async-клиент google-genai: не держим поток экзекьютора на время генерации
+    try:
+        resp = await client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(**cfg_kwargs) if cfg_kwargs else None,
+        )
+    finally:
+        try:
+            await client.aio.aclose()
+        except Exception:
+            pass
 
     out_images: List[Tuple[bytes, str]] = []
     out_text: Optional[str] = None
@@ -280,9 +291,9 @@ def build_refine_prompt(*, base_prompt: str, is_zero: bool, extra: Optional[str]
 # HTTP Handler
 # ==============
 
-def design_generate(req: Request):
+async def design_generate(req: Request):
     """
-    Flask-совместимый обработчик.
+    ASGI-обработчик (Starlette Request).
     Ожидает multipart/form-data:
       - image: file (обязательно)
       - prompt: str (если нет — можно передать style/room_type/furniture, и мы соберём промпт сами)
@@ -295,20 +306,20 @@ def design_generate(req: Request):
     Ответ: JSON { images: [dataUrl,...], url?: http(s) } + debug при ?debug=1.
     """
     try:
-        files = getattr(req, "files", None)
-        form = getattr(req, "form", None)
-        if files is None or form is None:
-            return jsonify({"error": "bad_request", "detail": "multipart form-data expected"}), 400
+        if not (req.headers.get("content-type") or "").lower().startswith("multipart/form-data"):
+            return JSONResponse({"error": "bad_request", "detail": "multipart form-data expected"}, status_code=400)
+        form = await read_form(req)
 
-        debug_flag = (req.args.get("debug") == "1") if hasattr(req, "args") else False
+        debug_flag = req.query_params.get("debug") == "1"
         request_id = req.headers.get("X-Request-ID", "")
 
-        if "image" not in files:
-            return jsonify({"error": "bad_request", "detail": "field 'image' is required"}), 400
+        upload = form.get("image")
+        if upload is None or not hasattr(upload, "read"):
+            return JSONResponse({"error": "bad_request", "detail": "field 'image' is required"}, status_code=400)
 
-        img_bytes = files["image"].read()
+        img_bytes = await upload.read()
         if not img_bytes or len(img_bytes) < 64:
-            return jsonify({"error": "bad_request", "detail": "image is empty or too small"}), 400
+            return JSONResponse({"error": "bad_request", "detail": "image is empty or too small"}, status_code=400)
 
         # Либо берём готовый prompt, либо формируем из полей
         prompt = (form.get("prompt") or "").strip()
@@ -317,10 +328,10 @@ def design_generate(req: Request):
             room_type = (form.get("room_type") or "").strip() or None
             furniture = (form.get("furniture") or "").strip() or None
             if not style:
-                return jsonify({
+                return JSONResponse({
                     "error": "bad_request",
                     "detail": "either 'prompt' or ('style' [+ room_type / furniture]) is required",
-                }), 400
+                }, status_code=400)
             prompt = build_design_prompt(style=style, room_type=room_type, furniture=furniture)
         else:
             # если prompt пришёл готовый, всё равно определим режим для 2-го прохода
@@ -336,14 +347,14 @@ def design_generate(req: Request):
         is_zero = bool(room_type and (furniture is not None))
 
         # Ключ
-        api_key = _read_api_key(req)
+        api_key = _read_api_key(req, form)
         if not api_key:
-            return jsonify({"error": "auth_error", "detail": "API key is required (header/form or ENV)"}), 401
+            return JSONResponse({"error": "auth_error", "detail": "API key is required (header/form or ENV)"}, status_code=401)
 
         LOG.info("design_generate (genai) pass1 start req_id=%s model=%s", request_id, BANANO_MODEL)
 
         # 1-й проход — черновик
-        p1 = _genai_generate_image(
+        p1 = await _genai_generate_image(
             api_key=api_key,
             model=BANANO_MODEL,
             prompt=prompt,
@@ -359,7 +370,7 @@ def design_generate(req: Request):
                 draft_bytes, _mime = p1["images"][0]
                 refine_prompt = build_refine_prompt(base_prompt=prompt, is_zero=is_zero, extra=refine_extra)
                 LOG.info("design_generate (genai) pass2 start req_id=%s mode=%s", request_id, ("zero" if is_zero else "redesign"))
-                final_resp = _genai_generate_image(
+                final_resp = await _genai_generate_image(
                     api_key=api_key,
                     model=BANANO_MODEL,
                     prompt=refine_prompt,
@@ -391,8 +402,8 @@ def design_generate(req: Request):
                 "pass1_images_count": len(p1.get("images", [])),
                 "pass2_images_count": len(final_resp.get("images", [])) if second_pass_flag else 0,
             }
-        return jsonify(body), 200
+        return JSONResponse(body, status_code=200)
 
     except Exception as e:
         LOG.exception("Unhandled error in design_generate (genai)")
-        return jsonify({"error": "internal_error", "detail": str(e)}), 500
+        return JSONResponse({"error": "internal_error", "detail": str(e)}, status_code=500)
@@ -23,7 +23,11 @@ from executor.config import *
 from typing import Any, Dict, Optional, List, Tuple
 import os
 
-from flask import jsonify, Request
+from fastapi.responses import JSONResponse
+from starlette.datastructures import FormData
+from starlette.requests import Request
+
+from executor.asgi_utils import read_form
 
 # =========================
 #   Model / Runtime config
@@ -154,7 +158,7 @@ def build_refine_prompt(*, base_prompt: str, extra: Optional[str] = None) -> str
 #          Utils
 # ======================
 
-def _read_api_key(req: Request) -> str:
+def _read_api_key(req: Request, form: FormData) -> str:
     """
     Источник API-ключа (приоритет):
       1) из запроса: form['api_key'] либо Authorization: Bearer/ X-API-Key / X-Banano-Key
@@ -162,8 +166,8 @@ def _read_api_key(req: Request) -> str:
     """
     # multipart/form-data
     try:
-        if hasattr(req, "form") and req.form and "api_key" in req.form:
-            v = (req.form.get("api_key") or "").strip()
+        if form and "api_key" in form:
+            v = (form.get("api_key") or "").strip()
             if v:
                 return v
     except Exception:
@@ -209,7 +213,7 @@ def _to_data_url(img_bytes: bytes, mime: str = "image/png") -> str:
 #    google-genai client
 # ======================
 
-def _genai_generate_image(
+async def _genai_generate_image(
     *,
     api_key: str,
     model: str,
@@ -234,11 +238,18 @@ def _genai_generate_image(
     if aspect_ratio:
         cfg_kwargs["image_config"] = types.ImageConfig(aspect_ratio=aspect_ratio)
 
-    resp = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=types.GenerateContentConfig(**cfg_kwargs) if cfg_kwargs else None,
-    )
+    # async-клиент google-genai: не держим поток экзекьютора на время генерации
+    try:
+        resp = await client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(**cfg_kwargs) if cfg_kwargs else None,
+        )
+    finally:
+        try:
+            await client.aio.aclose()
+        except Exception:
+            pass
 
     out_images: List[Tuple[bytes, str]] = []
     out_text: Optional[str] = None
@@ -283,9 +294,9 @@ def build_plan_prompt(*, visualization_style: str, interior_style: str) -> str:
 #  HTTP handler
 # ==============
 
-def plan_generate(req: Request):
+async def plan_generate(req: Request):
     """
-    Flask-совместимый обработчик.
+    ASGI-обработчик (Starlette Request).
     Ожидает multipart/form-data:
       - image: file (обязательно)
       - prompt: str (обязательно в рамках ТЗ; но если не передали — попробуем собрать из стилей)
@@ -300,20 +311,20 @@ def plan_generate(req: Request):
       - ?debug=1 — вернуть отладочные поля
     """
     try:
-        files = getattr(req, "files", None)
-        form = getattr(req, "form", None)
-        if files is None or form is None:
-            return jsonify({"error": "bad_request", "detail": "multipart form-data expected"}), 400
+        if not (req.headers.get("content-type") or "").lower().startswith("multipart/form-data"):
+            return JSONResponse({"error": "bad_request", "detail": "multipart form-data expected"}, status_code=400)
+        form = await read_form(req)
 
-        debug_flag = (req.args.get("debug") == "1") if hasattr(req, "args") else False
+        debug_flag = req.query_params.get("debug") == "1"
         request_id = req.headers.get("X-Request-ID", "")
 
         # 1) Изображение
-        if "image" not in files:
-            return jsonify({"error": "bad_request", "detail": "field 'image' is required"}), 400
-        img_bytes = files["image"].read()
+        upload = form.get("image")
+        if upload is None or not hasattr(upload, "read"):
+            return JSONResponse({"error": "bad_request", "detail": "field 'image' is required"}, status_code=400)
+        img_bytes = await upload.read()
         if not img_bytes or len(img_bytes) < 64:
-            return jsonify({"error": "bad_request", "detail": "image is empty or too small"}), 400
+            return JSONResponse({"error": "bad_request", "detail": "image is empty or too small"}, status_code=400)
 
         # 2) Промпт
         prompt = (form.get("prompt") or "").strip()
@@ -322,10 +333,10 @@ def plan_generate(req: Request):
             visualization_style = (form.get("visualization_style") or "realistic").strip()
             interior_style = (form.get("interior_style") or "").strip()
             if not interior_style:
-                return jsonify({
+                return JSONResponse({
                     "error": "bad_request",
                     "detail": "either 'prompt' or ('interior_style' [+ visualization_style]) is required",
-                }), 400
+                }, status_code=400)
             prompt = build_plan_prompt(
                 visualization_style=visualization_style,
                 interior_style=interior_style
@@ -339,14 +350,14 @@ def plan_generate(req: Request):
         refine_prompt_extra = (form.get("refine_prompt") or "").strip()
 
         # 4) Ключ
-        api_key = _read_api_key(req)
+        api_key = _read_api_key(req, form)
         if not api_key:
-            return jsonify({"error": "auth_error", "detail": "API key is required (header or form, or ENV)"}), 401
+            return JSONResponse({"error": "auth_error", "detail": "API key is required (header or form, or ENV)"}, status_code=401)
 
         LOG.info("plan_generate (genai) start req_id=%s model=%s", request_id, BANANO_MODEL)
 
         # 5) 1-й проход: черновик
-        nb_resp = _genai_generate_image(
+        nb_resp = await _genai_generate_image(
             api_key=api_key,
             model=BANANO_MODEL,
             prompt=prompt,
@@ -362,7 +373,7 @@ def plan_generate(req: Request):
                 draft_img_bytes, draft_mime = nb_resp["images"][0]  # берём первое изображение черновика
                 refine_prompt = build_refine_prompt(base_prompt=prompt, extra=refine_prompt_extra)
                 LOG.info("plan_generate (genai) second pass start req_id=%s model=%s", request_id, BANANO_MODEL)
-                final_resp = _genai_generate_image(
+                final_resp = await _genai_generate_image(
                     api_key=api_key,
                     model=BANANO_MODEL,
                     prompt=refine_prompt,
@@ -397,17 +408,17 @@ def plan_generate(req: Request):
                 "pass2_images_count": len(final_resp.get("images", [])) if second_pass_flag else 0,
             }
 
-        return jsonify(body), 200
+        return JSONResponse(body, status_code=200)
 
     except Exception as e:
         LOG.exception("Unhandled error in plan_generate (genai)")
         body = {"error": "internal_error", "detail": str(e)}
         try:
-            if (req.args.get("debug") == "1"):
+            if (req.query_params.get("debug") == "1"):
                 body["debug"] = {
                     "model": BANANO_MODEL,
                     "lib": "google.genai",
                 }
         except Exception:
             pass
-        return jsonify(body), 500
+        return JSONResponse(body, status_code=500)
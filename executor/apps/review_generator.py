@@ -6,22 +6,19 @@ import os
 import logging
 import re
 
-from flask import jsonify, Request
-from openai import OpenAI
+from fastapi.responses import JSONResponse
+from starlette.requests import Request
 
-from executor.config import OPENAI_API_KEY
+from executor.asgi_utils import read_json
+from executor.limits import Overloaded
+from executor.llm_gateway import gateway
+from executor.streaming import sse_response
 
 LOG = logging.getLogger(__name__)
 
-# --- поведение HTTP-логгера и фолбэка можно управлять через ENV ---
-HTTP_DEBUG = os.getenv("HTTP_DEBUG", "0") == "1"
+# --- фолбэк по цепочке моделей можно выключить через ENV ---
 OPENAI_FALLBACK = os.getenv("OPENAI_FALLBACK", "1") == "1"
 
-# Сначала полноразмерные, затем «мини». Первый элемент будет заменён на FEEDBACK_MODEL.
-_FALLBACK_MODELS: List[str] = ["gpt-5", "gpt-4o", "gpt-4.1", "gpt-4o-mini", "gpt-4.1-mini"]
-
-_client: Optional[OpenAI] = None
-
 _DEAL_TITLES = {
     "sale": "Продажа",
     "buy": "Покупка",
@@ -113,98 +110,16 @@ FEEDBACK_MUTATE_USER_TEMPLATE_RU = '''
 '''
 
 # =========================
-#   OpenAI client helpers
+#   OpenAI helpers (клиент, пул и fallback — в executor/llm_gateway.py)
 # =========================
-def _client_or_init() -> OpenAI:
-    global _client
-    if _client is None:
-        if not OPENAI_API_KEY:
-            raise RuntimeError("OPENAI_API_KEY is missing")
-        _client = OpenAI(api_key=OPENAI_API_KEY)
-    return _client
-
-
-def _log_request(payload: Dict[str, Any]) -> None:
-    if HTTP_DEBUG:
-        LOG.info(
-            "OpenAI request: model=%s n=%s messages=%d",
-            payload.get("model"),
-            payload.get("n"),
-            len(payload.get("messages", [])),
-        )
-
-
-def _extract_text(resp) -> str:
-    try:
-        return (resp.choices[0].message.content or "").strip()
-    except Exception:
-        return ""
+async def _send_with_fallback(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[str, str]:
+    text, model_name = await gateway.complete(payload, default_model=default_model, allow_fallback=allow_fallback)
+    return _cleanup(text), model_name
 
 
-def _extract_texts(resp) -> List[str]:
-    out: List[str] = []
-    try:
-        for ch in getattr(resp, "choices", []) or []:
-            txt = (ch.message.content or "").strip()
-            if txt:
-                out.append(txt)
-    except Exception:
-        pass
-    return out
-
-
-def _send_with_fallback(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[str, str]:
-    client = _client_or_init()
-    _log_request(payload)
-
-    first_model = payload.get("model") or default_model
-    chain = [first_model] + ([m for m in _FALLBACK_MODELS if m != first_model] if allow_fallback else [])
-
-    last_err: Optional[Exception] = None
-    for i, model_name in enumerate(chain, start=1):
-        try:
-            req = dict(payload)
-            req["model"] = model_name
-            resp = client.chat.completions.create(**req)
-            text = _extract_text(resp)
-            if text:
-                if i > 1:
-                    LOG.warning("Fallback model used: %s (requested %s)", model_name, first_model)
-                return _cleanup(text), model_name
-            last_err = RuntimeError("Empty completion text")
-        except Exception as e:
-            last_err = e
-            LOG.warning("OpenAI call failed on model %s: %s", model_name, e)
-
-    LOG.error("All OpenAI fallbacks failed. Last error: %s", last_err)
-    raise last_err or RuntimeError("OpenAI request failed")
-
-
-def _send_with_fallback_list(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[List[str], str]:
-    client = _client_or_init()
-    _log_request(payload)
-
-    first_model = payload.get("model") or default_model
-    chain = [first_model] + ([m for m in _FALLBACK_MODELS if m != first_model] if allow_fallback else [])
-
-    last_err: Optional[Exception] = None
-    for i, model_name in enumerate(chain, start=1):
-        try:
-            req = dict(payload)
-            req["model"] = model_name
-            resp = client.chat.completions.create(**req)
-            texts = [_cleanup(t) for t in _extract_texts(resp)]
-            if texts:
-                if i > 1:
-                    LOG.warning("Fallback model used: %s (requested %s)", model_name, first_model)
-                return texts, model_name
-            last_err = RuntimeError("Empty completion list")
-        except Exception as e:
-            last_err = e
-            LOG.warning("OpenAI call failed on model %s: %s", model_name, e)
-
-    LOG.error("All OpenAI fallbacks failed. Last error: %s", last_err)
-    raise last_err or RuntimeError("OpenAI request failed")
+async def _send_with_fallback_list(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[List[str], str]:
+    texts, model_name = await gateway.complete_list(payload, default_model=default_model, allow_fallback=allow_fallback)
+    return [_cleanup(t) for t in texts], model_name
 
 
 # =========================
@@ -392,9 +307,9 @@ def _build_mutate_payload(
 
 
 # =========================
-#   Public Flask handlers
+#   Public ASGI handlers
 # =========================
-def review_generate(req: Request):
+async def review_generate(req: Request):
     """
     POST /review/generate
 
@@ -410,19 +325,19 @@ def review_generate(req: Request):
         num_variants # 1..5 (default=3)
       }
     """
-    data = req.get_json(silent=True) or {}
-    debug_flag = req.args.get("debug") == "1"
+    data = await read_json(req)
+    debug_flag = req.query_params.get("debug") == "1"
 
     situation = (data.get("situation") or "").strip()
     if len(situation) < 50:
-        return jsonify({"error": "bad_request", "detail": "field 'situation' must be >= 50 chars"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "field 'situation' must be >= 50 chars"}, status_code=400)
 
     try:
         num_variants = int(data.get("num_variants") or 3)
     except Exception:
-        return jsonify({"error": "bad_request", "detail": "field 'num_variants' must be integer"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "field 'num_variants' must be integer"}, status_code=400)
     if not (1 <= num_variants <= 5):
-        return jsonify({"error": "bad_request", "detail": "num_variants must be in range 1..5"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "num_variants must be in range 1..5"}, status_code=400)
 
     fields = {
         "client_name": data.get("client_name"),
@@ -440,22 +355,22 @@ def review_generate(req: Request):
 
     try:
         payload, debug_info = _build_generate_payload(fields=fields, num_variants=num_variants, model=FEEDBACK_MODEL)
-        texts, used_model = _send_with_fallback_list(payload, default_model=FEEDBACK_MODEL, allow_fallback=OPENAI_FALLBACK)
+        texts, used_model = await _send_with_fallback_list(payload, default_model=FEEDBACK_MODEL, allow_fallback=OPENAI_FALLBACK)
 
         body: Dict[str, Any] = {"variants": texts}
         if debug_flag:
             body["debug"] = {"model_used": used_model, **debug_info}
-        return jsonify(body), 200
+        return JSONResponse(body, status_code=200)
 
     except Exception as e:
         LOG.exception("OpenAI error (review_generate)")
         body = {"error": "openai_error", "detail": str(e)}
         if debug_flag:
             body["debug"] = {"model": FEEDBACK_MODEL}
-        return jsonify(body), 502
+        return JSONResponse(body, status_code=502)
 
 
-def review_mutate(req: Request):
+async def review_mutate(req: Request, *, stream: bool = False):
     """
     POST /review/mutate
     Ожидает JSON:
@@ -467,8 +382,9 @@ def review_mutate(req: Request):
         length:    str | None,   # target length (short|medium|long)
         context:   { опционально тот же набор полей, что и в generate }
       }
+    stream=True — ответ потоком SSE (см. executor/streaming.py).
     """
-    data = req.get_json(silent=True) or {}
+    data = await read_json(req)
 
     base_text = (data.get("base_text") or "").strip()
     operation = (data.get("operation") or "").strip()
@@ -476,12 +392,12 @@ def review_mutate(req: Request):
     tone = data.get("tone")
     length = data.get("length")
     context = data.get("context") or {}
-    debug_flag = req.args.get("debug") == "1"
+    debug_flag = req.query_params.get("debug") == "1"
 
     if not base_text:
-        return jsonify({"error": "bad_request", "detail": "field 'base_text' is required"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "field 'base_text' is required"}, status_code=400)
     if operation not in ("short", "long", "style"):
-        return jsonify({"error": "bad_request", "detail": "field 'operation' must be one of short|long|style"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "field 'operation' must be one of short|long|style"}, status_code=400)
 
     try:
         payload, debug_info = _build_mutate_payload(
@@ -493,16 +409,26 @@ def review_mutate(req: Request):
             context=context,
             model=FEEDBACK_MODEL,
         )
-        text, used_model = _send_with_fallback(payload, default_model=FEEDBACK_MODEL, allow_fallback=OPENAI_FALLBACK)
+        if stream:
+            return sse_response(
+                "review",
+                lambda result: gateway.stream(
+                    payload, result, default_model=FEEDBACK_MODEL, allow_fallback=OPENAI_FALLBACK,
+                ),
+                finalize=_cleanup,
+            )
+        text, used_model = await _send_with_fallback(payload, default_model=FEEDBACK_MODEL, allow_fallback=OPENAI_FALLBACK)
 
         body: Dict[str, Any] = {"text": text}
         if debug_flag:
             body["debug"] = {"model_used": used_model, **debug_info}
-        return jsonify(body), 200
+        return JSONResponse(body, status_code=200)
 
+    except Overloaded:
+        raise
     except Exception as e:
         LOG.exception("OpenAI error (review_mutate)")
         body = {"error": "openai_error", "detail": str(e)}
         if debug_flag:
             body["debug"] = {"model": FEEDBACK_MODEL}
-        return jsonify(body), 502
+        return JSONResponse(body, status_code=502)
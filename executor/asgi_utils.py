@@ -0,0 +1,38 @@
+# smart_agent/executor/asgi_utils.py
+"""
+Мелкие помощники для разбора запросов Starlette/FastAPI в обработчиках экзекьютора
+(аналоги flask request.get_json(silent=True) / request.form).
+"""
+from __future__ import annotations
+
+import logging
+from typing import Any, Dict
+
+from starlette.datastructures import FormData
+from starlette.requests import Request
+
+LOG = logging.getLogger(__name__)
+
+
+async def read_json(req: Request) -> Dict[str, Any]:
+    """JSON-тело запроса или {} (если тело пустое/не JSON/не объект)."""
+    ctype = (req.headers.get("content-type") or "").lower()
+    if "json" not in ctype:
+        return {}
+    try:
+        data = await req.json()
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def read_form(req: Request) -> FormData:
+    """Поля form-data/x-www-form-urlencoded или пустая форма."""
+    ctype = (req.headers.get("content-type") or "").lower()
+    if not ctype.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        return FormData()
+    try:
+        return await req.form()
+    except Exception as e:
+        LOG.warning("Failed to parse form data: %s", e)
+        return FormData()
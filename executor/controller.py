@@ -1,8 +1,15 @@
 # smart_agent/executor/controller.py
 from __future__ import annotations
-from flask import Blueprint, request, jsonify
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
 
 from executor.openai_service import *
+from executor.asgi_utils import read_form, read_json
+from executor.limits import Overloaded, limiter
+from executor.response_cache import CacheHit, objection_cache, wants_bypass
+from executor.streaming import sse_response, wants_stream
 import executor.apps.plan_generate as plan_module
 import executor.apps.design_generate as design_module
 import executor.apps.review_generator as review_module
@@ -10,61 +17,95 @@ import executor.apps.review_generator as review_module
 
 import executor.apps.description_generate as description_module
 
-api = Blueprint("api", __name__, url_prefix="/api/v1")
+api = APIRouter(prefix="/api/v1")
 LOG = logging.getLogger(__name__)
 
 
 @api.post("/review/generate")
-def review_generate():
-    return review_module.review_generate(request)
+async def review_generate(request: Request):
+    async with limiter("review").slot():
+        return await review_module.review_generate(request)
 
 @api.post("/review/mutate")
-def review_mutate():
-    return review_module.review_mutate(request)
+async def review_mutate(request: Request):
+    if wants_stream(request):
+        # слот лимитера держит сам SSE-поток, а не хендлер
+        return await review_module.review_mutate(request, stream=True)
+    async with limiter("review").slot():
+        return await review_module.review_mutate(request)
 
 
 @api.post("/description/generate")
-def description_generate():
-    return description_module.description_generate(request)
+async def description_generate(request: Request):
+    # лимитер "description" применяется внутри: в async-callback режиме слот держит фоновая задача
+    return await description_module.description_generate(request)
 
 
 @api.post("/design/generate")
-def design_generate():
-    return design_module.design_generate(request)
+async def design_generate(request: Request):
+    async with limiter("design").slot():
+        return await design_module.design_generate(request)
 
 
 @api.post("/plan/generate")
-def plan_generate():
-    return plan_module.plan_generate(request)
+async def plan_generate(request: Request):
+    async with limiter("plan").slot():
+        return await plan_module.plan_generate(request)
 
 
 
 @api.post("/objection/generate")
-def objection_generate():
-    data = request.get_json(silent=True) or {}
-    question = (data.get("question") or request.form.get("question") or "").strip()
+async def objection_generate(request: Request):
+    data = await read_json(request)
+    question = (data.get("question") or (await read_form(request)).get("question") or "").strip()
     if not question:
-        return jsonify({"error": "bad_request", "detail": "field 'question' is required"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "field 'question' is required"}, status_code=400)
+
+    debug_flag = request.query_params.get("debug") == "1"
 
-    debug_flag = request.args.get("debug") == "1"
+    # кеш ответов отдаётся мимо лимитера: слот нужен только походу в LLM
+    hit: Optional[CacheHit] = None
+    if wants_bypass(request.query_params, data, request.headers):
+        objection_cache.bypass()
+    else:
+        hit = await objection_cache.lookup(question)
+
+    if wants_stream(request):
+        if hit is not None:
+            return sse_response("objection", lambda result: _replay_cached(hit, result), limited=False)
+        return sse_response("objection", lambda result: stream_objection_generate_request(question, result, True))
+
+    if hit is not None:
+        body = {"text": hit.text}
+        if debug_flag:
+            body["debug"] = {"model_used": hit.model, "cache": hit.tier, "score": round(hit.score, 3)}
+        return JSONResponse(body, status_code=200)
 
     try:
-        text, used_model = send_objection_generate_request(question, True)
+        async with limiter("objection").slot():
+            text, used_model = await send_objection_generate_request(question, True)
         body = {"text": text}
         if debug_flag:
-            body["debug"] = {"model_used": used_model}
-        return jsonify(body), 200
+            body["debug"] = {"model_used": used_model, "cache": "miss"}
+        return JSONResponse(body, status_code=200)
 
+    except Overloaded:
+        raise
     except Exception as e:
         LOG.exception("OpenAI error (objection)")
         body = {"error": "openai_error", "detail": str(e)}
         if debug_flag:
             body["debug"] = {"model": OBJECTION_MODEL}
-        return jsonify(body), 502
+        return JSONResponse(body, status_code=502)
+
+
+async def _replay_cached(hit: CacheHit, result: Dict[str, Any]):
+    result["model"] = hit.model
+    yield hit.text
 
 
 @api.post("/summary/analyze")
-def summary_analyze():
+async def summary_analyze(request: Request):
     """
     Принимает payload:
       { "user_id": ..., "source": {...}, "created_at": "...",
@@ -73,18 +114,19 @@ def summary_analyze():
       { "summary": "...", "strengths": [...], "mistakes": [...], "decisions": [...] }
     """
 
-    if not request.is_json:
-        return jsonify({"error": "bad_request", "detail": "JSON body required"}), 400
-    data = request.get_json(silent=True) or {}
-    debug_flag = request.args.get("debug") == "1"
+    if "json" not in (request.headers.get("content-type") or "").lower():
+        return JSONResponse({"error": "bad_request", "detail": "JSON body required"}, status_code=400)
+    data = await read_json(request)
+    debug_flag = request.query_params.get("debug") == "1"
 
     input_obj = data.get("input") or {}
     in_type = (input_obj.get("type") or "").strip().lower()
     if in_type not in ("text", "audio"):
-        return jsonify({"error": "bad_request", "detail": "input.type must be 'text' or 'audio'"}), 400
+        return JSONResponse({"error": "bad_request", "detail": "input.type must be 'text' or 'audio'"}, status_code=400)
 
     try:
-        result_dict, used_model, debug_meta = summarize_from_input(input_obj, allow_fallback=True)
+        async with limiter("summary").slot():
+            result_dict, used_model, debug_meta = await summarize_from_input(input_obj, allow_fallback=True)
 
         body = {
             "summary":   result_dict.get("summary", "") or "",
@@ -94,12 +136,14 @@ def summary_analyze():
         }
         if debug_flag:
             body["debug"] = {"model_used": used_model, **debug_meta}
-        return jsonify(body), 200
+        return JSONResponse(body, status_code=200)
 
+    except Overloaded:
+        raise
     except FileNotFoundError as e:
-        return jsonify({"error": "bad_request", "detail": str(e)}), 400
+        return JSONResponse({"error": "bad_request", "detail": str(e)}, status_code=400)
     except ValueError as e:
-        return jsonify({"error": "bad_request", "detail": str(e)}), 400
+        return JSONResponse({"error": "bad_request", "detail": str(e)}, status_code=400)
     except Exception as e:
         LOG.exception("Unhandled error (summary_analyze)")
         body = {"error": "internal_error", "detail": str(e)}
@@ -109,4 +153,4 @@ def summary_analyze():
                 body["debug"] = {"model": _SUMMARY_MODEL}
             except Exception:
                 body["debug"] = {"model": "summary"}
-        return jsonify(body), 500
\ No newline at end of file
+        return JSONResponse(body, status_code=500)
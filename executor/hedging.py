@@ -0,0 +1,215 @@
+# smart_agent/executor/hedging.py
+"""
+Hedged requests для цепочки fallback-моделей.
+
+Раньше цепочка ["gpt-5", "gpt-4o", ...] проходилась строго последовательно: зависший
+первичный запрос съедал весь таймаут, прежде чем пробовалась следующая модель.
+Теперь, если модель не ответила за hedge-задержку, следующая модель запускается
+параллельно; берётся первый непустой ответ, остальные запросы отменяются.
+Ошибка модели, как и раньше, сразу запускает следующую.
+
+Hedge-задержка адаптивная: квантиль (по умолчанию p95) латентности успешных
+ответов модели за последнее окно, в пределах [MIN, MAX]. Пока статистики мало —
+OPENAI_HEDGE_DELAY_SEC.
+
+Хедж — лишний платный вызов LLM, поэтому на него есть бюджет (token bucket):
+каждый вызов добавляет OPENAI_HEDGE_BUDGET токена, хедж тратит один, запас —
+не больше OPENAI_HEDGE_BURST. При деградации провайдера (медленно всё) хеджи
+не удваивают нагрузку, а упираются в бюджет.
+
+ENV:
+  OPENAI_HEDGE=1|0                 — включить/выключить (0 — последовательная цепочка)
+  OPENAI_HEDGE_DELAY_SEC=10        — задержка до накопления статистики
+  OPENAI_HEDGE_MIN_SEC=1 / OPENAI_HEDGE_MAX_SEC=30
+  OPENAI_HEDGE_QUANTILE=0.95
+  OPENAI_HEDGE_BUDGET=0.1 / OPENAI_HEDGE_BURST=10
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Sequence, Tuple, TypeVar
+
+LOG = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class HedgePolicy:
+    enabled: bool = True
+    default_delay: float = 10.0
+    min_delay: float = 1.0
+    max_delay: float = 30.0
+    quantile: float = 0.95
+    min_samples: int = 20
+    window: int = 200
+    budget: float = 0.1
+    burst: float = 10.0
+
+    @classmethod
+    def from_env(cls) -> "HedgePolicy":
+        return cls(
+            enabled=os.getenv("OPENAI_HEDGE", "1") == "1",
+            default_delay=float(os.getenv("OPENAI_HEDGE_DELAY_SEC", "10")),
+            min_delay=float(os.getenv("OPENAI_HEDGE_MIN_SEC", "1")),
+            max_delay=float(os.getenv("OPENAI_HEDGE_MAX_SEC", "30")),
+            quantile=float(os.getenv("OPENAI_HEDGE_QUANTILE", "0.95")),
+            budget=float(os.getenv("OPENAI_HEDGE_BUDGET", "0.1")),
+            burst=float(os.getenv("OPENAI_HEDGE_BURST", "10")),
+        )
+
+
+policy = HedgePolicy.from_env()
+
+
+class LatencyTracker:
+    """Скользящее окно латентностей успешных ответов по моделям + счётчики хеджирования."""
+
+    def __init__(self) -> None:
+        self._samples: Dict[str, Deque[float]] = {}
+        self.calls = 0
+        self.hedges = 0        # сколько раз запускали параллельную модель по таймеру
+        self.hedge_wins = 0    # сколько раз победил запрос, запущенный по hedge-таймеру
+        self.hedge_denied = 0  # таймер сработал, но бюджет исчерпан
+        self._tokens: Optional[float] = None
+
+    def on_call(self) -> None:
+        self.calls += 1
+        tokens = policy.burst if self._tokens is None else self._tokens
+        self._tokens = min(policy.burst, tokens + policy.budget)
+
+    def has_budget(self) -> bool:
+        return (policy.burst if self._tokens is None else self._tokens) >= 1.0
+
+    def spend(self) -> None:
+        self.hedges += 1
+        self._tokens = (policy.burst if self._tokens is None else self._tokens) - 1.0
+
+    def record(self, model: str, seconds: float) -> None:
+        buf = self._samples.get(model)
+        if buf is None or buf.maxlen != policy.window:
+            buf = deque(buf or (), maxlen=policy.window)
+            self._samples[model] = buf
+        buf.append(seconds)
+
+    def quantile(self, model: str, q: float) -> Optional[float]:
+        buf = self._samples.get(model)
+        if not buf:
+            return None
+        data = sorted(buf)
+        idx = min(len(data) - 1, max(0, math.ceil(q * len(data)) - 1))
+        return data[idx]
+
+    def hedge_delay(self, model: str) -> float:
+        buf = self._samples.get(model)
+        if not buf or len(buf) < policy.min_samples:
+            return policy.default_delay
+        q = self.quantile(model, policy.quantile) or policy.default_delay
+        return min(policy.max_delay, max(policy.min_delay, q))
+
+    def stats(self) -> Dict[str, Any]:
+        models = {}
+        for model, buf in self._samples.items():
+            models[model] = {
+                "samples": len(buf),
+                "p50": round(self.quantile(model, 0.5) or 0.0, 3),
+                "p95": round(self.quantile(model, 0.95) or 0.0, 3),
+                "hedge_delay": round(self.hedge_delay(model), 3),
+            }
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_denied": self.hedge_denied,
+            "models": models,
+        }
+
+    def reset(self) -> None:
+        self.__init__()
+
+
+tracker = LatencyTracker()
+
+
+async def hedged_call(
+    chain: Sequence[str],
+    call: Callable[[str], Awaitable[T]],
+    *,
+    is_ok: Callable[[T], bool] = bool,
+    empty_error: str = "Empty completion text",
+) -> Tuple[T, str]:
+    """
+    Вызывает call(model) по цепочке моделей с хеджированием.
+    Возвращает (результат, модель) первого непустого ответа; иначе — последнюю ошибку.
+    """
+    tracker.on_call()
+    # task → (модель, время старта, запущена ли по hedge-таймеру)
+    pending: Dict[asyncio.Task, Tuple[str, float, bool]] = {}
+    next_idx = 0
+    last_err: Optional[BaseException] = None
+
+    def _launch(*, hedge: bool = False) -> str:
+        nonlocal next_idx
+        model = chain[next_idx]
+        next_idx += 1
+        task = asyncio.ensure_future(call(model))
+        pending[task] = (model, time.monotonic(), hedge)
+        return model
+
+    last_model = _launch()
+    try:
+        while pending:
+            can_hedge = policy.enabled and next_idx < len(chain)
+            timeout = tracker.hedge_delay(last_model) if can_hedge else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done and not tracker.has_budget():
+                # бюджет хеджей исчерпан — просто ждём уже запущенные запросы
+                tracker.hedge_denied += 1
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # модель «задумалась» дольше обычного — подстрахуемся следующей, не отменяя текущую
+                tracker.spend()
+                LOG.info("Hedging: %s slower than %.1fs, starting %s", last_model, timeout, chain[next_idx])
+                last_model = _launch(hedge=True)
+                continue
+
+            for task in done:
+                model, started, hedged = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    last_err = e
+                    LOG.warning("OpenAI call failed on model %s: %s", model, e)
+                    continue
+                if not is_ok(result):
+                    last_err = RuntimeError(empty_error)
+                    continue
+                tracker.record(model, time.monotonic() - started)
+                if model != chain[0]:
+                    LOG.warning("Fallback model used: %s (requested %s)", model, chain[0])
+                if hedged:
+                    tracker.hedge_wins += 1
+                return result, model
+
+            # все завершившиеся — с ошибкой: следующая модель сразу (как в последовательной цепочке)
+            if next_idx < len(chain):
+                last_model = _launch()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    LOG.error("All OpenAI fallbacks failed. Last error: %s", last_err)
+    raise last_err or RuntimeError("OpenAI request failed")
+
+
+def stats() -> Dict[str, Any]:
+    return tracker.stats()
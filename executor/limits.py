@@ -0,0 +1,220 @@
+# smart_agent/executor/limits.py
+"""
+Ограничение конкурентности и очередей для ASGI-экзекьютора.
+
+Каждый эндпоинт получает свой EndpointLimiter:
+  — semaphore на MAX_CONCURRENCY одновременных вызовов LLM/GenAI;
+  — ограничение глубины очереди (сколько запросов может ждать слот);
+  — при переполнении очереди — Overloaded → HTTP 429 + Retry-After.
+
+Фоновые задачи (async-callback режим описаний) запускаются через spawn()
+и учитываются при graceful drain: на остановке новые запросы получают 503,
+а уже принятые и фоновые — дорабатывают до DRAIN_TIMEOUT_SEC.
+
+Лимиты переопределяются через ENV: EXECUTOR_LIMIT_<ENDPOINT>="<concurrency>/<queue>",
+например EXECUTOR_LIMIT_DESIGN="2/8".
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Coroutine, Dict, Optional, Set, Tuple
+
+LOG = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT_SEC = float(os.getenv("EXECUTOR_DRAIN_TIMEOUT_SEC", "120"))
+RETRY_AFTER_SEC = int(os.getenv("EXECUTOR_RETRY_AFTER_SEC", "5"))
+
+# endpoint → (max_concurrency, max_queue, retry_after_sec)
+_DEFAULT_LIMITS: Dict[str, Tuple[int, int, int]] = {
+    "objection":   (32, 256, RETRY_AFTER_SEC),
+    "summary":     (8, 64, RETRY_AFTER_SEC * 2),
+    "review":      (16, 128, RETRY_AFTER_SEC),
+    "description": (16, 128, RETRY_AFTER_SEC),
+    # двухпроходная генерация изображений — минуты на запрос
+    "design":      (4, 16, RETRY_AFTER_SEC * 6),
+    "plan":        (4, 16, RETRY_AFTER_SEC * 6),
+}
+
+
+class Overloaded(Exception):
+    """Очередь эндпоинта переполнена (или сервис останавливается)."""
+
+    def __init__(self, endpoint: str, retry_after: int, *, status_code: int = 429, detail: str = "too_many_requests"):
+        super().__init__(f"{endpoint}: {detail}")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        self.status_code = status_code
+        self.detail = detail
+
+
+class EndpointLimiter:
+    def __init__(self, name: str, *, max_concurrency: int, max_queue: int, retry_after: int = RETRY_AFTER_SEC):
+        self.name = name
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.retry_after = max(1, int(retry_after))
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def check(self) -> None:
+        """Проверка допуска без резервирования (Overloaded, если запрос сейчас не примут)."""
+        if _registry.draining:
+            self.rejected += 1
+            raise Overloaded(self.name, self.retry_after, status_code=503, detail="shutting_down")
+        if self.active + self.waiting >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.name, self.retry_after)
+
+    def admit(self) -> None:
+        """
+        Синхронная проверка допуска: резервирует место в очереди ожидающих.
+        Если все слоты заняты и очередь уже MAX_QUEUE — сразу Overloaded (без ожидания).
+        """
+        self.check()
+        self.waiting += 1
+
+    @asynccontextmanager
+    async def slot(self, *, admitted: bool = False) -> AsyncIterator[None]:
+        """
+        Занимает слот эндпоинта. admitted=True — место уже зарезервировано через admit()
+        (фоновые задачи: 429 отдаётся сразу в хендлере, а не после старта задачи).
+        """
+        if not admitted:
+            self.admit()
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        self.accepted += 1
+        _registry.inflight += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            _registry.inflight -= 1
+            self._sem.release()
+            _registry.notify()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+
+class _Registry:
+    def __init__(self) -> None:
+        self.limiters: Dict[str, EndpointLimiter] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.inflight = 0
+        self.draining = False
+        self._idle: Optional[asyncio.Event] = None
+
+    def notify(self) -> None:
+        if self._idle is not None and self.inflight == 0 and not self.tasks:
+            self._idle.set()
+
+
+_registry = _Registry()
+
+
+def _parse_limit(raw: str) -> Optional[Tuple[int, int]]:
+    try:
+        conc, _, queue = raw.partition("/")
+        return int(conc), int(queue or 0)
+    except Exception:
+        LOG.warning("Bad executor limit value %r (expected '<concurrency>/<queue>')", raw)
+        return None
+
+
+def limiter(name: str) -> EndpointLimiter:
+    """Лимитер эндпоинта (создаётся лениво, внутри работающего event loop)."""
+    lim = _registry.limiters.get(name)
+    if lim is None:
+        conc, queue, retry_after = _DEFAULT_LIMITS.get(name, (8, 64, RETRY_AFTER_SEC))
+        override = os.getenv(f"EXECUTOR_LIMIT_{name.upper()}")
+        if override and (parsed := _parse_limit(override)):
+            conc, queue = parsed
+        lim = EndpointLimiter(name, max_concurrency=conc, max_queue=queue, retry_after=retry_after)
+        _registry.limiters[name] = lim
+    return lim
+
+
+def configure(name: str, *, max_concurrency: int, max_queue: int, retry_after: Optional[int] = None) -> EndpointLimiter:
+    """Явно задаёт лимиты эндпоинта (заменяет существующий лимитер)."""
+    lim = EndpointLimiter(
+        name,
+        max_concurrency=max_concurrency,
+        max_queue=max_queue,
+        retry_after=retry_after if retry_after is not None else _DEFAULT_LIMITS.get(name, (0, 0, RETRY_AFTER_SEC))[2],
+    )
+    _registry.limiters[name] = lim
+    return lim
+
+
+def spawn(coro: Coroutine[Any, Any, Any], *, name: Optional[str] = None) -> asyncio.Task:
+    """
+    Запускает фоновую задачу, которую дождётся graceful drain.
+    Исключения задачи логируются, наружу не пробрасываются.
+    """
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    _registry.tasks.add(task)
+
+    def _done(t: asyncio.Task) -> None:
+        _registry.tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            LOG.error("Background task %s failed: %s", t.get_name(), t.exception())
+        _registry.notify()
+
+    task.add_done_callback(_done)
+    return task
+
+
+async def drain(timeout: float = DRAIN_TIMEOUT_SEC) -> bool:
+    """
+    Graceful drain: запрещает приём новых запросов и ждёт завершения
+    активных запросов и фоновых задач. Возвращает True, если всё успело
+    доработать; иначе отменяет оставшиеся фоновые задачи.
+    """
+    _registry.draining = True
+    _registry._idle = asyncio.Event()
+    _registry.notify()
+    LOG.info("Executor drain: inflight=%s background=%s", _registry.inflight, len(_registry.tasks))
+    try:
+        await asyncio.wait_for(_registry._idle.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        pending = list(_registry.tasks)
+        LOG.warning("Executor drain timeout (%.0fs): inflight=%s, cancelling %s background tasks",
+                    timeout, _registry.inflight, len(pending))
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return False
+
+
+def reset() -> None:
+    """Сбрасывает состояние (новый старт приложения / тесты)."""
+    global _registry
+    _registry = _Registry()
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "draining": _registry.draining,
+        "inflight": _registry.inflight,
+        "background": len(_registry.tasks),
+        "endpoints": {name: lim.stats() for name, lim in _registry.limiters.items()},
+    }
@@ -0,0 +1,402 @@
+# smart_agent/executor/llm_gateway.py
+"""
+Единый шлюз к OpenAI для всех приложений executor'а.
+
+Раньше openai_service, review_generator и description_generate держали по своей
+копии клиента и fallback-цепочки, а description создавал новый клиент (и новый
+пул соединений) на каждый запрос с «чужим» API-ключом. Теперь:
+
+  — один httpx-пул на процесс (keep-alive к api.openai.com переиспользуется);
+  — AsyncOpenAI-клиенты кешируются в LRU по API-ключу и разделяют этот пул;
+  — единые таймауты и число ретраев SDK;
+  — circuit breaker на модель: после N ошибок подряд модель выпадает из цепочки
+    на COOLDOWN секунд, затем пропускается один пробный запрос (half-open), остальные
+    получают отказ, пока проба не вернёт результат;
+  — метрики по моделям (вызовы, ошибки, латентность) — в /health.
+
+ENV:
+  OPENAI_BASE_URL                      — свой endpoint (прокси/совместимый API)
+  OPENAI_TIMEOUT_SEC=180 / OPENAI_CONNECT_TIMEOUT_SEC=10
+  OPENAI_MAX_RETRIES=1                 — ретраи SDK (дальше — следующая модель цепочки)
+  OPENAI_POOL_MAX_CONNECTIONS=100 / OPENAI_POOL_MAX_KEEPALIVE=20 / OPENAI_POOL_KEEPALIVE_SEC=30
+  OPENAI_CLIENT_CACHE=16               — сколько клиентов (API-ключей) держать в LRU
+  OPENAI_BREAKER_FAILURES=5 / OPENAI_BREAKER_COOLDOWN_SEC=30
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from executor.config import OPENAI_API_KEY
+from executor.hedging import hedged_call
+from executor.streaming import stream_chat_with_fallback
+
+LOG = logging.getLogger(__name__)
+
+HTTP_DEBUG = os.getenv("HTTP_DEBUG", "0") == "1"
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+OPENAI_TIMEOUT_SEC = float(os.getenv("OPENAI_TIMEOUT_SEC", "180"))
+OPENAI_CONNECT_TIMEOUT_SEC = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SEC", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+OPENAI_POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "100"))
+OPENAI_POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_MAX_KEEPALIVE", "20"))
+OPENAI_POOL_KEEPALIVE_SEC = float(os.getenv("OPENAI_POOL_KEEPALIVE_SEC", "30"))
+OPENAI_CLIENT_CACHE = int(os.getenv("OPENAI_CLIENT_CACHE", "16"))
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_COOLDOWN_SEC = float(os.getenv("OPENAI_BREAKER_COOLDOWN_SEC", "30"))
+
+# сначала полноразмерные, потом мини
+FALLBACK_MODELS: List[str] = ["gpt-5", "gpt-4o", "gpt-4.1", "gpt-4o-mini", "gpt-4.1-mini"]
+
+# Ошибки запроса/ключа, а не здоровья модели — breaker их не считает
+_CALLER_ERRORS = (openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError)
+
+
+class ModelsUnavailable(RuntimeError):
+    """Все модели цепочки выключены circuit breaker'ом."""
+
+
+def default_api_key() -> str:
+    """Ключ по умолчанию: config (приоритет), затем окружение."""
+    return (OPENAI_API_KEY or os.getenv("OPENAI_API_KEY", "")).strip()
+
+
+def extract_text(resp: Any) -> str:
+    try:
+        return (resp.choices[0].message.content or "").strip()
+    except Exception:
+        return ""
+
+
+def extract_texts(resp: Any) -> List[str]:
+    out: List[str] = []
+    try:
+        for ch in getattr(resp, "choices", []) or []:
+            txt = (ch.message.content or "").strip()
+            if txt:
+                out.append(txt)
+    except Exception:
+        pass
+    return out
+
+
+class CircuitBreaker:
+    """
+    closed → (N ошибок подряд) → open → (cooldown) → half_open → успех: closed / ошибка: open.
+    В half_open пропускается ровно одна проба; до её success()/failure()/release() — отказ.
+    """
+
+    def __init__(self, failures: int = OPENAI_BREAKER_FAILURES, cooldown: float = OPENAI_BREAKER_COOLDOWN_SEC):
+        self.max_failures = max(1, failures)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def release(self) -> None:
+        """Проба не дала результата о здоровье модели (отмена, ошибка запроса, не понадобилась)."""
+        self.probing = False
+
+    def success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.max_failures:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class _ModelStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.empty = 0
+        self.cancelled = 0
+        self.skipped = 0       # модель пропущена: breaker открыт
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        ok = self.calls - self.errors - self.cancelled
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "empty": self.empty,
+            "cancelled": self.cancelled,
+            "skipped": self.skipped,
+            "avg_ms": round(self.total_ms / ok, 1) if ok > 0 else 0.0,
+            "max_ms": round(self.max_ms, 1),
+        }
+
+
+class LLMGateway:
+    def __init__(self, *, cache_size: int = OPENAI_CLIENT_CACHE, base_url: Optional[str] = OPENAI_BASE_URL):
+        self.cache_size = max(1, cache_size)
+        self.base_url = base_url
+        self._http: Optional[httpx.AsyncClient] = None
+        self._clients: "OrderedDict[str, Any]" = OrderedDict()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._stats: Dict[str, _ModelStats] = {}
+
+    # ---------- клиенты ----------
+
+    def _http_or_init(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=OPENAI_POOL_KEEPALIVE_SEC,
+                ),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT_SEC, connect=OPENAI_CONNECT_TIMEOUT_SEC),
+            )
+        return self._http
+
+    def client(self, api_key: Optional[str] = None) -> Any:
+        """
+        Клиент для ключа (по умолчанию — ключ из конфига). Все клиенты делят один
+        httpx-пул, поэтому вытеснение из LRU не закрывает соединения.
+        """
+        key = (api_key or default_api_key()).strip()
+        cached = self._clients.get(key)
+        if cached is not None:
+            self._clients.move_to_end(key)
+            return cached
+        if not key:
+            raise RuntimeError("OPENAI_API_KEY is missing (config/env or request header/body)")
+
+        cli = AsyncOpenAI(
+            api_key=key,
+            base_url=self.base_url,
+            http_client=self._http_or_init(),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT_SEC, connect=OPENAI_CONNECT_TIMEOUT_SEC),
+            max_retries=OPENAI_MAX_RETRIES,
+        )
+        self._clients[key] = cli
+        while len(self._clients) > self.cache_size:
+            self._clients.popitem(last=False)
+        return cli
+
+    def set_client(self, client: Any, api_key: Optional[str] = None) -> None:
+        """Подменить клиент для ключа (локальный прокси, тесты)."""
+        self._clients[(api_key or default_api_key()).strip()] = client
+
+    # ---------- цепочка моделей ----------
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        br = self._breakers.get(model)
+        if br is None:
+            br = self._breakers[model] = CircuitBreaker()
+        return br
+
+    def _model_stats(self, model: str) -> _ModelStats:
+        st = self._stats.get(model)
+        if st is None:
+            st = self._stats[model] = _ModelStats()
+        return st
+
+    def chain(self, first_model: str, allow_fallback: bool) -> List[str]:
+        """Цепочка fallback-моделей без тех, чей breaker сейчас открыт."""
+        models = [first_model] + ([m for m in FALLBACK_MODELS if m != first_model] if allow_fallback else [])
+        out: List[str] = []
+        for m in models:
+            if self.breaker(m).allow():
+                out.append(m)
+            else:
+                self._model_stats(m).skipped += 1
+        if not out:
+            raise ModelsUnavailable(f"all models are circuit-open: {', '.join(models)}")
+        if out[0] != first_model:
+            LOG.warning("Model %s is circuit-open, starting chain from %s", first_model, out[0])
+        return out
+
+    def _probes(self, chain: List[str]) -> Set[str]:
+        """Модели цепочки, пробу которых (half_open) держит этот запрос — сразу после chain()."""
+        return {m for m in chain if self.breaker(m).state == "half_open"}
+
+    def _release_probes(self, probes: Set[str], reported: Set[str]) -> None:
+        # проба, не дошедшая до success()/failure(), не должна навсегда закрыть модель
+        for m in probes - reported:
+            self.breaker(m).release()
+
+    def _observe(self, model: str, err: Optional[BaseException], started: float) -> bool:
+        """Метрики попытки; True — результат засчитан breaker'у (success/failure)."""
+        st = self._model_stats(model)
+        st.calls += 1
+        if err is None:
+            ms = (time.monotonic() - started) * 1000
+            st.total_ms += ms
+            st.max_ms = max(st.max_ms, ms)
+            self.breaker(model).success()
+            return True
+        st.errors += 1
+        if isinstance(err, _CALLER_ERRORS):
+            return False
+        br = self.breaker(model)
+        br.failure()
+        if br.state == "open":
+            LOG.warning("Circuit opened for model %s (%s failures): %s", model, br.failures, err)
+        return True
+
+    @staticmethod
+    def _log_request(payload: Dict[str, Any]) -> None:
+        if HTTP_DEBUG:
+            LOG.info(
+                "OpenAI request: model=%s n=%s temp=%s max_tokens=%s messages=%d",
+                payload.get("model"), payload.get("n"), payload.get("temperature"),
+                payload.get("max_tokens"), len(payload.get("messages", [])),
+            )
+
+    # ---------- вызовы ----------
+
+    async def complete(
+        self,
+        payload: Dict[str, Any],
+        *,
+        default_model: str,
+        allow_fallback: bool,
+        api_key: Optional[str] = None,
+        extract: Callable[[Any], Any] = extract_text,
+        empty_error: str = "Empty completion text",
+    ) -> Tuple[Any, str]:
+        """
+        Chat Completions по цепочке моделей (с хеджированием, см. executor/hedging.py).
+        Возвращает (extract(resp), model_used).
+        """
+        client = self.client(api_key)
+        self._log_request(payload)
+        chain = self.chain(payload.get("model") or default_model, allow_fallback)
+        probes, reported = self._probes(chain), set()
+
+        async def _call(model_name: str) -> Any:
+            req = dict(payload)
+            req["model"] = model_name
+            started = time.monotonic()
+            try:
+                resp = await client.chat.completions.create(**req)
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    if self._observe(model_name, e, started):
+                        reported.add(model_name)
+                else:
+                    # проигравший хедж / отмена запроса — не ошибка модели
+                    self._model_stats(model_name).calls += 1
+                    self._model_stats(model_name).cancelled += 1
+                raise
+            self._observe(model_name, None, started)
+            reported.add(model_name)
+            out = extract(resp)
+            if not out:
+                self._model_stats(model_name).empty += 1
+            return out
+
+        try:
+            return await hedged_call(chain, _call, empty_error=empty_error)
+        finally:
+            self._release_probes(probes, reported)
+
+    async def complete_list(
+        self,
+        payload: Dict[str, Any],
+        *,
+        default_model: str,
+        allow_fallback: bool,
+        api_key: Optional[str] = None,
+    ) -> Tuple[List[str], str]:
+        """То же, что complete, но список вариантов (параметр n в Chat Completions)."""
+        return await self.complete(
+            payload,
+            default_model=default_model,
+            allow_fallback=allow_fallback,
+            api_key=api_key,
+            extract=extract_texts,
+            empty_error="Empty completion list",
+        )
+
+    async def stream(
+        self,
+        payload: Dict[str, Any],
+        result: Dict[str, Any],
+        *,
+        default_model: str,
+        allow_fallback: bool,
+        api_key: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """Потоковый вариант: дельты текста; использованная модель — в result["model"]."""
+        client = self.client(api_key)
+        self._log_request(payload)
+        chain = self.chain(payload.get("model") or default_model, allow_fallback)
+        probes, reported = self._probes(chain), set()
+
+        def _observe(model: str, err: Optional[BaseException], started: float) -> None:
+            if self._observe(model, err, started):
+                reported.add(model)
+
+        try:
+            async for delta in stream_chat_with_fallback(client, payload, chain, result, observe=_observe):
+                yield delta
+        finally:
+            self._release_probes(probes, reported)
+
+    async def transcribe(self, path: str, *, model: str, language: Optional[str] = None,
+                         api_key: Optional[str] = None) -> str:
+        client = self.client(api_key)
+        started = time.monotonic()
+        try:
+            with open(path, "rb") as f:
+                tr = await client.audio.transcriptions.create(model=model, file=f, language=language)
+        except Exception as e:
+            self._observe(model, e, started)
+            raise
+        self._observe(model, None, started)
+        return (getattr(tr, "text", "") or "").strip()
+
+    # ---------- служебное ----------
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "clients": len(self._clients),
+            "models": {
+                m: {**st.as_dict(), "breaker": self.breaker(m).state}
+                for m, st in self._stats.items()
+            },
+        }
+
+    async def aclose(self) -> None:
+        """Закрывает общий пул (остановка executor'а / тесты); клиенты пересоздаются лениво."""
+        self._clients.clear()
+        self._breakers.clear()
+        self._stats.clear()
+        if self._http is not None:
+            try:
+                await self._http.aclose()
+            except Exception as e:
+                LOG.warning("OpenAI http pool close failed: %s", e)
+            self._http = None
+
+
+gateway = LLMGateway()
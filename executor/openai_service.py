@@ -1,83 +1,27 @@
 # smart_agent/executor/openai_service.py
 from __future__ import annotations
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
 import os, logging
-from openai import OpenAI
 import json, re
 
-from executor.config import OPENAI_API_KEY
 from executor.ai_config import OBJECTION_MODEL, SUMMARY_MODEL, WHISPER_MODEL
+from executor.llm_gateway import gateway
 from executor.prompt_factory import (
     build_objection_request,
     build_summary_analyze_request,
 )
+from executor.response_cache import objection_cache
 
 LOG = logging.getLogger(__name__)
-HTTP_DEBUG = os.getenv("HTTP_DEBUG", "0") == "1"
 OPENAI_FALLBACK = os.getenv("OPENAI_FALLBACK", "1") == "1"
 
-_client: Optional[OpenAI] = None
+# ответы, записанные под другой моделью/системным промптом, из кеша не читаются
+objection_cache.set_namespace(OBJECTION_MODEL, build_objection_request(question="")["messages"][0]["content"])
 
-def _client_or_init() -> OpenAI:
-    global _client
-    if _client is None:
-        if not OPENAI_API_KEY:
-            raise RuntimeError("OPENAI_API_KEY is missing")
-        _client = OpenAI(api_key=OPENAI_API_KEY)
-    return _client
 
-# сначала полноразмерные, потом мини
-_FALLBACK_MODELS: List[str] = ["gpt-5", "gpt-4o", "gpt-4.1", "gpt-4o-mini", "gpt-4.1-mini"]
-
-def _log_request(payload: Dict[str, Any]) -> None:
-    if HTTP_DEBUG:
-        LOG.info(
-            "OpenAI request: model=%s temp=%s max_tokens=%s messages=%d",
-            payload.get("model"), payload.get("temperature"),
-            payload.get("max_tokens"), len(payload.get("messages", [])),
-        )
-
-def _extract_text(resp) -> str:
-    try:
-        return (resp.choices[0].message.content or "").strip()
-    except Exception:
-        return ""
-
-def _extract_texts(resp) -> List[str]:
-    try:
-        texts: List[str] = []
-        for ch in getattr(resp, "choices", []) or []:
-            txt = (ch.message.content or "").strip()
-            if txt:
-                texts.append(txt)
-        return texts
-    except Exception:
-        return []
-
-def _send_with_fallback(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[str, str]:
-    client = _client_or_init()
-    _log_request(payload)
-
-    first_model = payload.get("model") or default_model
-    chain = [first_model] + ([m for m in _FALLBACK_MODELS if m != first_model] if allow_fallback else [])
-
-    last_err: Optional[Exception] = None
-    for i, model_name in enumerate(chain, start=1):
-        try:
-            req = dict(payload); req["model"] = model_name
-            resp = client.chat.completions.create(**req)
-            text = _extract_text(resp)
-            if text:
-                if i > 1:
-                    LOG.warning("Fallback model used: %s (requested %s)", model_name, first_model)
-                return text, model_name
-            last_err = RuntimeError("Empty completion text")
-        except Exception as e:
-            last_err = e
-            LOG.warning("OpenAI call failed on model %s: %s", model_name, e)
-
-    LOG.error("All OpenAI fallbacks failed. Last error: %s", last_err)
-    raise last_err or RuntimeError("OpenAI request failed")
+async def _send_with_fallback(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[str, str]:
+    # клиент, пул соединений, цепочка моделей и хеджирование — в executor/llm_gateway.py
+    return await gateway.complete(payload, default_model=default_model, allow_fallback=allow_fallback)
 
 # --- helpers for JSON response parsing (модель может вернуть ```json ... ``` и т.п.) ---
 def _extract_json_obj(s: str) -> dict:
@@ -104,53 +48,48 @@ def _extract_json_obj(s: str) -> dict:
             pass
     return {}
 
-def _send_with_fallback_list(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[List[str], str]:
+async def _send_with_fallback_list(payload: Dict[str, Any], default_model: str, allow_fallback: bool) -> Tuple[List[str], str]:
     """
     То же, что _send_with_fallback, но возвращает список вариантов (использует параметр n в Chat Completions).
     """
-    client = _client_or_init()
-    _log_request(payload)
-
-    first_model = payload.get("model") or default_model
-    chain = [first_model] + ([m for m in _FALLBACK_MODELS if m != first_model] if allow_fallback else [])
-
-    last_err: Optional[Exception] = None
-    for i, model_name in enumerate(chain, start=1):
-        try:
-            req = dict(payload); req["model"] = model_name
-            resp = client.chat.completions.create(**req)
-            texts = _extract_texts(resp)
-            if texts:
-                if i > 1:
-                    LOG.warning("Fallback model used: %s (requested %s)", model_name, first_model)
-                return texts, model_name
-            last_err = RuntimeError("Empty completion list")
-        except Exception as e:
-            last_err = e
-            LOG.warning("OpenAI call failed on model %s: %s", model_name, e)
-
-    LOG.error("All OpenAI fallbacks failed. Last error: %s", last_err)
-    raise last_err or RuntimeError("OpenAI request failed")
+    return await gateway.complete_list(payload, default_model=default_model, allow_fallback=allow_fallback)
 
 # ---- public ----
 
-def send_objection_generate_request(question: str, allow_fallback: bool = OPENAI_FALLBACK) -> Tuple[str, str]:
+async def send_objection_generate_request(question: str, allow_fallback: bool = OPENAI_FALLBACK) -> Tuple[str, str]:
     payload = build_objection_request(
         question=question,
         model=OBJECTION_MODEL
     )
-    return _send_with_fallback(
+    text, used_model = await _send_with_fallback(
         payload,
         default_model=OBJECTION_MODEL,
         allow_fallback=allow_fallback
     )
+    await objection_cache.store(question, text, used_model)
+    return text, used_model
+
+
+async def stream_objection_generate_request(question: str,
+                                            result: Dict[str, Any],
+                                            allow_fallback: bool = OPENAI_FALLBACK) -> AsyncIterator[str]:
+    """Потоковый вариант: дельты текста; использованная модель — в result["model"]."""
+    payload = build_objection_request(
+        question=question,
+        model=OBJECTION_MODEL
+    )
+    parts: List[str] = []
+    async for delta in gateway.stream(payload, result, default_model=OBJECTION_MODEL, allow_fallback=allow_fallback):
+        parts.append(delta)
+        yield delta
+    await objection_cache.store(question, "".join(parts).strip(), result.get("model") or OBJECTION_MODEL)
 
 
 
 # smart_agent/executor/openai_service.py
 # -------- NEW: SUMMARY --------
 
-def summarize_from_input(input_obj: Dict[str, Any],
+async def summarize_from_input(input_obj: Dict[str, Any],
                          allow_fallback: bool = OPENAI_FALLBACK
                          ) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
     """
@@ -180,12 +119,12 @@ def summarize_from_input(input_obj: Dict[str, Any],
         local_path = input_obj.get("local_path")
         if not local_path or not os.path.exists(local_path):
             raise FileNotFoundError("audio.local_path not found")
-        transcript_text, detected_lang = transcribe_audio_from_path(local_path)
+        transcript_text, detected_lang = await transcribe_audio_from_path(local_path)
         if not transcript_text or len(transcript_text.strip()) < 5:
             raise ValueError("empty transcript")
 
     # 2) анализ
-    result_dict, used_model, debug_prompt = send_summary_analyze_request(
+    result_dict, used_model, debug_prompt = await send_summary_analyze_request(
         transcript_text=transcript_text,
         prefer_language=detected_lang,
         allow_fallback=allow_fallback,
@@ -200,7 +139,7 @@ def summarize_from_input(input_obj: Dict[str, Any],
 
 
 # -------- NEW: SUMMARY --------
-def send_summary_analyze_request(
+async def send_summary_analyze_request(
     transcript_text: str,
     prefer_language: Optional[str] = None,
     allow_fallback: bool = OPENAI_FALLBACK,
@@ -214,7 +153,7 @@ def send_summary_analyze_request(
         prefer_language=prefer_language,
         model=SUMMARY_MODEL,
     )
-    text, used_model = _send_with_fallback(
+    text, used_model = await _send_with_fallback(
         payload,
         default_model=SUMMARY_MODEL,
         allow_fallback=allow_fallback
@@ -229,16 +168,9 @@ def send_summary_analyze_request(
     return result, used_model, debug_prompt
 
 
-def transcribe_audio_from_path(path: str, language: Optional[str] = None) -> Tuple[str, Optional[str]]:
+async def transcribe_audio_from_path(path: str, language: Optional[str] = None) -> Tuple[str, Optional[str]]:
     """
     Транскрибация через Whisper. Возвращает (text, detected_lang|None).
     """
-    client = _client_or_init()
-    with open(path, "rb") as f:
-        tr = client.audio.transcriptions.create(
-            model=WHISPER_MODEL,
-            file=f,
-            language=language
-        )
-    text = getattr(tr, "text", "") or ""
-    return text.strip(), None
+    text = await gateway.transcribe(path, model=WHISPER_MODEL, language=language)
+    return text, None
@@ -0,0 +1,299 @@
+# smart_agent/executor/response_cache.py
+"""
+Кеш ответов LLM на короткие повторяющиеся вопросы (возражения клиентов).
+
+Большая часть возражений — почти дубликаты («дорого», «Дорого!», «это дорого»),
+а промпт одинаковый, поэтому ответ можно переиспользовать:
+
+  1) точный уровень — sha1 от нормализованного текста (регистр, ё/е, пунктуация, пробелы);
+  2) похожий уровень — коэффициент Жаккара по символьным триграммам с порогом
+     (индекс вопросов держится в памяти процесса, периодически перечитывается из Redis).
+
+На ключ хранится до VARIANTS разных ответов: пока их меньше — запрос всё равно
+уходит в LLM и ответ дописывается («заполнение»), дальше отдаётся случайный вариант,
+чтобы одинаковые вопросы не получали дословно один и тот же текст.
+
+Redis:
+  {prefix}:rc:{name}:{ns}:v:{hash}  — List вариантов (JSON), TTL
+  {prefix}:rc:{name}:{ns}:q         — Hash hash → нормализованный вопрос
+  {prefix}:rc:{name}:{ns}:idx       — ZSet hash → время записи (лимит размера + чистка по TTL)
+ns — версия (модель + системный промпт): смена промпта не отдаёт старые ответы.
+
+Любая ошибка Redis = промах; после ошибки кеш молчит REDIS_BACKOFF_SEC секунд.
+
+ENV:
+  OBJECTION_CACHE=1|0
+  OBJECTION_CACHE_TTL_SEC=604800 / OBJECTION_CACHE_MAX_ENTRIES=5000
+  OBJECTION_CACHE_VARIANTS=3 / OBJECTION_CACHE_SIMILARITY=0.8 (0 — только точный уровень)
+  REDIS_URL, REDIS_PREFIX
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+LOG = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "sa")
+REDIS_BACKOFF_SEC = 30.0
+INDEX_REFRESH_SEC = 60.0
+
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    s = (text or "").lower().replace("ё", "е")
+    s = _PUNCT_RE.sub(" ", s)
+    return _SPACE_RE.sub(" ", s).strip()
+
+
+def trigrams(norm: str) -> FrozenSet[str]:
+    padded = f"  {norm} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _make_redis() -> Any:
+    from redis.asyncio import Redis
+
+    return Redis.from_url(
+        REDIS_URL,
+        decode_responses=True,
+        socket_timeout=1,
+        socket_connect_timeout=1,
+    )
+
+
+@dataclass
+class CacheHit:
+    text: str
+    model: str
+    tier: str            # "exact" | "similar"
+    score: float = 1.0
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        name: str,
+        *,
+        enabled: bool = True,
+        ttl: int = 7 * 86400,
+        max_entries: int = 5000,
+        variants: int = 3,
+        similarity: float = 0.8,
+        redis: Any = None,
+        prefix: str = REDIS_PREFIX,
+    ):
+        self.name = name
+        self.enabled = enabled
+        self.ttl = max(1, int(ttl))
+        self.max_entries = max(1, int(max_entries))
+        self.variants = max(1, int(variants))
+        self.similarity = similarity
+        self.prefix = prefix
+        self.namespace = "v0"
+        self._r = redis
+        self._down_until = 0.0
+        # локальная копия индекса вопросов: hash → триграммы
+        self._index: Dict[str, FrozenSet[str]] = {}
+        self._index_loaded_at = 0.0
+        self.counters: Dict[str, int] = {
+            "lookups": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0,
+            "fills": 0, "bypass": 0, "stores": 0, "evicted": 0, "errors": 0,
+        }
+
+    # ---------- ключи ----------
+
+    def set_namespace(self, *parts: str) -> None:
+        """Версия кеша: ответы, записанные под другой моделью/промптом, не читаются."""
+        self.namespace = hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()[:10]
+        self._index = {}
+        self._index_loaded_at = 0.0
+
+    def _base(self) -> str:
+        return f"{self.prefix}:rc:{self.name}:{self.namespace}"
+
+    def _vkey(self, h: str) -> str:
+        return f"{self._base()}:v:{h}"
+
+    @staticmethod
+    def _hash(norm: str) -> str:
+        return hashlib.sha1(norm.encode("utf-8")).hexdigest()
+
+    def _redis(self) -> Optional[Any]:
+        if not self.enabled or time.monotonic() < self._down_until:
+            return None
+        if self._r is None:
+            self._r = _make_redis()
+        return self._r
+
+    def _failed(self, op: str, e: Exception) -> None:
+        self.counters["errors"] += 1
+        self._down_until = time.monotonic() + REDIS_BACKOFF_SEC
+        LOG.warning("Response cache %s: %s failed, bypassing for %.0fs: %s", self.name, op, REDIS_BACKOFF_SEC, e)
+
+    # ---------- чтение ----------
+
+    async def _load_index(self, r: Any) -> None:
+        if self.similarity <= 0 or time.monotonic() - self._index_loaded_at < INDEX_REFRESH_SEC:
+            return
+        raw = await r.hgetall(f"{self._base()}:q")
+        self._index = {h: trigrams(q) for h, q in (raw or {}).items()}
+        self._index_loaded_at = time.monotonic()
+
+    def _nearest(self, norm: str, exclude: str) -> Tuple[Optional[str], float]:
+        grams = trigrams(norm)
+        best, best_score = None, 0.0
+        for h, other in self._index.items():
+            if h == exclude:
+                continue
+            score = jaccard(grams, other)
+            if score > best_score:
+                best, best_score = h, score
+        if best_score < self.similarity:
+            return None, best_score
+        return best, best_score
+
+    async def lookup(self, question: str) -> Optional[CacheHit]:
+        """
+        Ответ из кеша или None (промах / ключ ещё копит варианты / Redis недоступен).
+        """
+        r = self._redis()
+        if r is None:
+            return None
+        self.counters["lookups"] += 1
+        norm = normalize(question)
+        if not norm:
+            self.counters["misses"] += 1
+            return None
+        h = self._hash(norm)
+        try:
+            tier, score = "exact", 1.0
+            items = await r.lrange(self._vkey(h), 0, -1)
+            if not items and self.similarity > 0:
+                await self._load_index(r)
+                near, score = self._nearest(norm, exclude=h)
+                if near is not None:
+                    tier = "similar"
+                    items = await r.lrange(self._vkey(near), 0, -1)
+                    if not items:
+                        # варианты истекли по TTL — вопрос больше не индексируем
+                        self._index.pop(near, None)
+        except Exception as e:
+            self._failed("lookup", e)
+            return None
+
+        if not items:
+            self.counters["misses"] += 1
+            return None
+        if tier == "exact" and len(items) < self.variants:
+            # копим разнообразие: этот запрос уйдёт в LLM и допишет новый вариант
+            self.counters["fills"] += 1
+            return None
+
+        try:
+            item = json.loads(random.choice(items))
+        except Exception:
+            self.counters["misses"] += 1
+            return None
+        self.counters["exact_hits" if tier == "exact" else "similar_hits"] += 1
+        return CacheHit(text=item.get("text") or "", model=item.get("model") or "", tier=tier, score=score)
+
+    def bypass(self) -> None:
+        self.counters["bypass"] += 1
+
+    # ---------- запись ----------
+
+    async def store(self, question: str, text: str, model: str) -> None:
+        r = self._redis()
+        norm = normalize(question)
+        if r is None or not norm or not (text or "").strip():
+            return
+        h = self._hash(norm)
+        base = self._base()
+        now = time.time()
+        item = json.dumps({"text": text, "model": model, "ts": int(now)}, ensure_ascii=False)
+        try:
+            pipe = r.pipeline()
+            pipe.lpush(self._vkey(h), item)
+            pipe.ltrim(self._vkey(h), 0, self.variants - 1)
+            pipe.expire(self._vkey(h), self.ttl)
+            pipe.hset(f"{base}:q", h, norm)
+            pipe.zadd(f"{base}:idx", {h: now})
+            pipe.zcard(f"{base}:idx")
+            res = await pipe.execute()
+            self.counters["stores"] += 1
+            self._index[h] = trigrams(norm)
+
+            # вопросы старше TTL и сверх лимита — вон (варианты к этому моменту уже истекли или удаляются)
+            stale = await r.zrangebyscore(f"{base}:idx", "-inf", now - self.ttl)
+            overflow = int(res[-1]) - len(stale) - self.max_entries
+            if overflow > 0:
+                oldest = await r.zrange(f"{base}:idx", 0, len(stale) + overflow - 1)
+                stale = list(dict.fromkeys(list(stale) + list(oldest)))
+            if stale:
+                await self._evict(r, stale)
+        except Exception as e:
+            self._failed("store", e)
+
+    async def _evict(self, r: Any, hashes: List[str]) -> None:
+        base = self._base()
+        pipe = r.pipeline()
+        pipe.zrem(f"{base}:idx", *hashes)
+        pipe.hdel(f"{base}:q", *hashes)
+        for h in hashes:
+            pipe.delete(self._vkey(h))
+        await pipe.execute()
+        for h in hashes:
+            self._index.pop(h, None)
+        self.counters["evicted"] += len(hashes)
+
+    # ---------- метрики ----------
+
+    def stats(self) -> Dict[str, Any]:
+        c = self.counters
+        hits = c["exact_hits"] + c["similar_hits"]
+        return {
+            "enabled": self.enabled,
+            **c,
+            "hit_rate": round(hits / c["lookups"], 3) if c["lookups"] else 0.0,
+            "indexed": len(self._index),
+        }
+
+    def reset_stats(self) -> None:
+        for k in self.counters:
+            self.counters[k] = 0
+
+
+objection_cache = ResponseCache(
+    "objection",
+    enabled=os.getenv("OBJECTION_CACHE", "1") == "1",
+    ttl=int(os.getenv("OBJECTION_CACHE_TTL_SEC", str(7 * 86400))),
+    max_entries=int(os.getenv("OBJECTION_CACHE_MAX_ENTRIES", "5000")),
+    variants=int(os.getenv("OBJECTION_CACHE_VARIANTS", "3")),
+    similarity=float(os.getenv("OBJECTION_CACHE_SIMILARITY", "0.8")),
+)
+
+
+def wants_bypass(query: Dict[str, Any], data: Dict[str, Any], headers: Dict[str, Any]) -> bool:
+    """Запрос просит свежий ответ: ?cache=0, {"cache": false} или Cache-Control: no-cache."""
+    if str(query.get("cache", "")).strip() in ("0", "false", "no"):
+        return True
+    if isinstance(data, dict) and data.get("cache") is False:
+        return True
+    return "no-cache" in str(headers.get("cache-control") or "").lower()
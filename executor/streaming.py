@@ -0,0 +1,143 @@
+# smart_agent/executor/streaming.py
+"""
+Потоковая выдача Chat Completions (SSE) для бота.
+
+Вместо ожидания полного ответа модели executor отдаёт дельты по мере генерации:
+    event: delta  data: {"text": "<кусок>"}
+    event: done   data: {"text": "<весь текст>", "model": "<модель>"}
+    event: error  data: {"error": "...", "detail": "..."}
+
+Fallback по цепочке моделей возможен только до первого токена — после этого
+клиент уже показал часть текста, и ошибка отдаётся событием error.
+
+Режим включается параметром ?stream=1 или заголовком Accept: text/event-stream.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from contextlib import nullcontext
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi.responses import StreamingResponse
+from starlette.requests import Request
+
+from executor import limits
+
+LOG = logging.getLogger(__name__)
+
+
+def wants_stream(req: Request) -> bool:
+    if req.query_params.get("stream") == "1":
+        return True
+    return "text/event-stream" in (req.headers.get("accept") or "").lower()
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _delta_text(chunk: Any) -> str:
+    try:
+        return chunk.choices[0].delta.content or ""
+    except Exception:
+        return ""
+
+
+async def stream_chat_with_fallback(
+    client: Any,
+    payload: Dict[str, Any],
+    chain: List[str],
+    result: Dict[str, Any],
+    *,
+    observe: Optional[Callable[[str, Optional[BaseException], float], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    Дельты текста от первой модели цепочки, которая начала отвечать.
+    Имя модели кладётся в result["model"] (генератор не может вернуть значение).
+    observe(model, err|None, t_start) — итог попытки на модели (метрики/breaker шлюза).
+    """
+    last_err: Optional[Exception] = None
+    for i, model_name in enumerate(chain, start=1):
+        started = False
+        t_start = time.monotonic()
+        try:
+            req = dict(payload)
+            req["model"] = model_name
+            req["stream"] = True
+            stream = await client.chat.completions.create(**req)
+            try:
+                async for chunk in stream:
+                    delta = _delta_text(chunk)
+                    if not delta:
+                        continue
+                    if not started:
+                        started = True
+                        result["model"] = model_name
+                        if i > 1:
+                            LOG.warning("Fallback model used (stream): %s (requested %s)", model_name, chain[0])
+                    yield delta
+            finally:
+                await stream.close()
+            if observe is not None:
+                observe(model_name, None, t_start)
+            if started:
+                return
+            last_err = RuntimeError("Empty completion text")
+        except Exception as e:
+            if observe is not None:
+                observe(model_name, e, t_start)
+            if started:
+                raise
+            last_err = e
+            LOG.warning("OpenAI stream failed on model %s: %s", model_name, e)
+
+    LOG.error("All OpenAI fallbacks failed (stream). Last error: %s", last_err)
+    raise last_err or RuntimeError("OpenAI request failed")
+
+
+def sse_response(
+    endpoint: str,
+    make_stream: Callable[[Dict[str, Any]], AsyncIterator[str]],
+    *,
+    finalize: Callable[[str], str] = str.strip,
+    on_close: Optional[Callable[[], Any]] = None,
+    limited: bool = True,
+) -> StreamingResponse:
+    """
+    SSE-ответ: поток дельт под слотом лимитера эндпоинта.
+
+    Слот занимается внутри тела ответа (его держит сам поток, а не хендлер).
+    Переполнение очереди проверяется заранее, чтобы в обычном случае отдать
+    честный 429 + Retry-After; если слот «уплыл» между проверкой и стартом — событие error.
+    limited=False — поток без слота (ответ из кеша: LLM не вызывается).
+    """
+    lim = limits.limiter(endpoint) if limited else None
+    if lim is not None:
+        lim.check()
+
+    async def _body() -> AsyncIterator[bytes]:
+        result: Dict[str, Any] = {}
+        parts: List[str] = []
+        try:
+            async with (lim.slot() if lim is not None else nullcontext()):
+                async for delta in make_stream(result):
+                    parts.append(delta)
+                    yield sse_event("delta", {"text": delta})
+            yield sse_event("done", {"text": finalize("".join(parts)), "model": result.get("model")})
+        except limits.Overloaded as e:
+            yield sse_event("error", {"error": e.detail, "retry_after": e.retry_after})
+        except Exception as e:
+            LOG.exception("OpenAI error (%s, stream)", endpoint)
+            yield sse_event("error", {"error": "openai_error", "detail": str(e)})
+        finally:
+            if on_close is not None:
+                await on_close()
+
+    return StreamingResponse(
+        _body(),
+        media_type="text/event-stream",
+        # nginx не должен буферизовать поток
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,264 @@
+# smart_agent/membership/batch_jobs.py
+"""
+Очередь пакетных заданий membership-сервиса и общий темп MTProto-запросов.
+
+Все запросы user-бота к Telegram (инвайт, бан/анбан, экспорт ссылки) идут
+через TokenBucket: не чаще rate в секунду, с запасом burst. FloodWaitError
+останавливает ВСЕ запросы на присланные Telegram секунды, а не только упавший.
+
+Пакетные /members/invite_batch и /members/remove_batch не выполняются в запросе.
+Они создают Job, и единственный воркер JobQueue обрабатывает задания по очереди.
+Внутри задания пользователи обрабатываются с параллелизмом до concurrency.
+Пользователь, упавший на FloodWait, повторяется после паузы, но не больше
+max_flood_retries раз. Остальные ошибки фиксируются в job.errors, и задание идёт дальше.
+
+Задания живут в памяти процесса: после рестарта сервиса /jobs/{id} вернёт 404,
+вызывающий отправляет пакет заново (операции идемпотентны).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telethon import errors
+
+logger = logging.getLogger(__name__)
+
+
+def flood_wait_seconds(exc: BaseException) -> Optional[int]:
+    """Сколько секунд Telegram просит подождать; None — это не FloodWait."""
+    if isinstance(exc, errors.FloodWaitError):
+        return max(1, int(getattr(exc, "seconds", 0) or 0))
+    return None
+
+
+class TokenBucket:
+    """
+    Token bucket для запросов одного аккаунта: rate токенов в секунду, не больше burst.
+    pause() — ответ на FloodWait: до его конца acquire() никого не пропускает,
+    после — ведро начинает с нуля, чтобы не выстрелить сразу всем запасом.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = max(float(rate), 1e-6)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        if now > self._stamp:
+            self._tokens = min(float(self.burst), self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+
+    async def acquire(self) -> None:
+        # lock — очередь ждущих: токены выдаются в порядке прихода
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        until = time.monotonic() + max(0.0, float(seconds))
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._stamp = until
+
+    def wait_left(self) -> float:
+        """Секунд до конца текущего FloodWait (0 — паузы нет)."""
+        return max(0.0, self._paused_until - time.monotonic())
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    items: List[Dict[str, Any]]
+    status: str = "queued"               # queued → running → done | failed | interrupted
+    error: Optional[str] = None          # почему задание не выполнялось (нет доступа к чату и т.п.)
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    results: Dict[int, str] = field(default_factory=dict)   # user_id → итог
+    errors: Dict[int, str] = field(default_factory=dict)    # user_id → текст ошибки
+    flood_waits: int = 0
+    flood_wait_sec: int = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "total": len(self.items),
+            "processed": len(self.results),
+            "counts": dict(Counter(self.results.values())),
+            "results": {str(uid): res for uid, res in self.results.items()},
+            "errors": {str(uid): err for uid, err in self.errors.items()},
+            "flood_waits": self.flood_waits,
+            "flood_wait_sec": self.flood_wait_sec,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+# (item, ctx) -> итог для пользователя ("removed", "added", ...); исключение — ошибка
+ItemHandler = Callable[[Dict[str, Any], Any], Awaitable[str]]
+# (job) -> ctx, общий для всех пользователей задания (например, резолв чата)
+PrepareHook = Callable[[Job], Awaitable[Any]]
+FinishHook = Callable[[Job], Awaitable[None]]
+
+
+class JobQueue:
+    def __init__(
+        self,
+        bucket: TokenBucket,
+        *,
+        concurrency: int = 2,
+        max_flood_retries: int = 5,
+        keep_sec: float = 86400,
+        max_jobs: int = 1000,
+    ):
+        self.bucket = bucket
+        self.concurrency = max(1, concurrency)
+        self.max_flood_retries = max(0, max_flood_retries)
+        self.keep_sec = keep_sec
+        self.max_jobs = max(1, max_jobs)
+        self._kinds: Dict[str, Tuple[ItemHandler, Optional[PrepareHook]]] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.on_finished: Optional[FinishHook] = None
+
+    def register(self, kind: str, handler: ItemHandler, prepare: Optional[PrepareHook] = None) -> None:
+        self._kinds[kind] = (handler, prepare)
+
+    # ---------- жизненный цикл ----------
+
+    def start(self) -> None:
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run_forever(), name="membership_jobs")
+
+    async def stop(self) -> None:
+        worker, self._worker = self._worker, None
+        if worker is None:
+            return
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    # ---------- API ----------
+
+    def submit(self, kind: str, items: List[Dict[str, Any]]) -> Job:
+        if kind not in self._kinds:
+            raise ValueError(f"unknown job kind: {kind}")
+        if self._queue is None:
+            raise RuntimeError("job queue is not started")
+        self._gc()
+        job = Job(id=uuid.uuid4().hex, kind=kind, items=list(items))
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "jobs": dict(Counter(j.status for j in self._jobs.values())),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "flood_wait_left_sec": round(self.bucket.wait_left(), 1),
+        }
+
+    def _gc(self) -> None:
+        """Забывает завершённые задания старше keep_sec и самые старые сверх max_jobs."""
+        cutoff = time.time() - self.keep_sec
+        done = [j for j in self._jobs.values() if j.finished]
+        for j in done:
+            if j.finished_at < cutoff:
+                self._jobs.pop(j.id, None)
+        extra = len(self._jobs) - self.max_jobs + 1
+        if extra > 0:
+            for j in sorted((j for j in done if j.id in self._jobs), key=lambda j: j.finished_at)[:extra]:
+                self._jobs.pop(j.id, None)
+
+    # ---------- выполнение ----------
+
+    async def _run_forever(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self.run_job(job)
+            except asyncio.CancelledError:
+                job.status, job.finished_at = "interrupted", time.time()
+                raise
+            except Exception:
+                logger.exception("membership job %s crashed", job.id)
+                job.status, job.finished_at = "failed", time.time()
+
+    async def run_job(self, job: Job) -> None:
+        handler, prepare = self._kinds[job.kind]
+        job.status, job.started_at = "running", time.time()
+        try:
+            ctx = await prepare(job) if prepare is not None else None
+        except Exception as e:
+            logger.warning("membership job %s (%s) not started: %s", job.id, job.kind, e)
+            job.status, job.error, job.finished_at = "failed", str(e), time.time()
+            return
+
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _one(item: Dict[str, Any]) -> None:
+            async with sem:
+                await self._run_item(job, handler, ctx, item)
+
+        await asyncio.gather(*(_one(item) for item in job.items))
+        job.status, job.finished_at = "done", time.time()
+        logger.info("membership job %s (%s) done: %s", job.id, job.kind, dict(Counter(job.results.values())))
+        if self.on_finished is not None:
+            try:
+                await self.on_finished(job)
+            except Exception as e:
+                logger.warning("membership job %s finish hook failed: %s", job.id, e)
+
+    async def _run_item(self, job: Job, handler: ItemHandler, ctx: Any, item: Dict[str, Any]) -> None:
+        user_id = int(item["user_id"])
+        retries = 0
+        while True:
+            try:
+                job.results[user_id] = await handler(item, ctx)
+                return
+            except Exception as e:
+                wait = flood_wait_seconds(e)
+                if wait is None or retries >= self.max_flood_retries:
+                    job.results[user_id] = "failed"
+                    job.errors[user_id] = str(e) or type(e).__name__
+                    logger.warning("membership job %s: user %s failed: %s", job.id, user_id, e)
+                    return
+                # обычно пауза уже выставлена на уровне запроса; повторная — no-op
+                self.bucket.pause(wait)
+                retries += 1
+                job.flood_waits += 1
+                job.flood_wait_sec += wait
+                logger.warning("membership job %s: FloodWait %ss on user %s, retry %s",
+                               job.id, wait, user_id, retries)
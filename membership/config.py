@@ -23,6 +23,18 @@ class Settings:
     # Прочие настройки
     INVITE_TTL_HOURS_DEFAULT: int = int(os.getenv("INVITE_TTL_HOURS_DEFAULT", "24"))
 
+    # Темп MTProto-запросов user-бота и пакетные задания (batch_jobs.py)
+    TG_RPC_PER_SEC: float = float(os.getenv("TG_RPC_PER_SEC", "1"))
+    TG_RPC_BURST: int = int(os.getenv("TG_RPC_BURST", "5"))
+    BATCH_MAX_USERS: int = int(os.getenv("BATCH_MAX_USERS", "1000"))
+    BATCH_CONCURRENCY: int = int(os.getenv("BATCH_CONCURRENCY", "2"))
+    BATCH_FLOOD_RETRIES: int = int(os.getenv("BATCH_FLOOD_RETRIES", "5"))
+
+    # Кэш access_hash пользователей (peer_cache.py); пустой путь — без файла
+    PEER_CACHE_PATH: str = os.getenv("PEER_CACHE_PATH", "peer_cache.json")
+    PEER_CACHE_SIZE: int = int(os.getenv("PEER_CACHE_SIZE", "50000"))
+    PEER_CACHE_TTL_HOURS: int = int(os.getenv("PEER_CACHE_TTL_HOURS", "168"))
+
     def validate(self):
         """Проверка обязательных настроек"""
         if not self.ADMIN_ID:
@@ -1,7 +1,7 @@
 #C:\Users\alexr\Desktop\dev\super_bot\smart_agent\membership\membership_service.py
 import asyncio
 import logging
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List
 from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
 
@@ -14,6 +14,8 @@ from telethon.sessions import StringSession
 from telethon.tl import functions, types
 
 from config import settings
+from batch_jobs import Job, JobQueue, TokenBucket, flood_wait_seconds
+from peer_cache import ChatPeerCache, UserPeerCache
 from telethon.tl.types import InputPeerChat, InputChannel
 
 logger = logging.getLogger(__name__)
@@ -45,6 +47,14 @@ class RemoveRequest(BaseModel):
     user_id: int = Field(..., description="Telegram user_id")
 
 
+class InviteBatchRequest(BaseModel):
+    users: List[InviteRequest] = Field(..., description="Кого пригласить (invite_ttl_hours — у каждого свой)")
+
+
+class RemoveBatchRequest(BaseModel):
+    user_ids: List[int] = Field(..., description="Telegram user_id для удаления")
+
+
 class SendMessageRequest(BaseModel):
     chat_id: int = Field(..., description="ID чата или пользователя")
     text: str = Field(..., description="Текст сообщения")
@@ -73,6 +83,63 @@ def _make_client() -> TelegramClient:
 
 client = _make_client()
 
+# Общий темп запросов аккаунта: одиночные и пакетные операции делят одни лимиты Telegram
+rpc_bucket = TokenBucket(settings.TG_RPC_PER_SEC, settings.TG_RPC_BURST)
+jobs = JobQueue(
+    rpc_bucket,
+    concurrency=settings.BATCH_CONCURRENCY,
+    max_flood_retries=settings.BATCH_FLOOD_RETRIES,
+)
+
+
+# Резолв пиров (peer_cache.py): целевой чат — один раз, пользователи — LRU в файле
+chat_peer = ChatPeerCache()
+user_peers = UserPeerCache(
+    settings.PEER_CACHE_PATH,
+    max_size=settings.PEER_CACHE_SIZE,
+    ttl_sec=settings.PEER_CACHE_TTL_HOURS * 3600,
+)
+_PEER_CACHE_FLUSH_SEC = 60
+
+# Ошибки, после которых закэшированный пир считается негодным
+_CHAT_PEER_ERRORS = (
+    errors.ChannelInvalidError,
+    errors.ChannelPrivateError,
+    errors.ChatIdInvalidError,
+)
+_USER_PEER_ERRORS = (
+    errors.UserIdInvalidError,
+    errors.PeerIdInvalidError,
+)
+
+
+async def _rpc(request, user_id: Optional[int] = None):
+    """
+    MTProto-запрос через общий token bucket. На FloodWait ставит паузу для всех
+    запросов и пробрасывает ошибку дальше (одиночный вызов упадёт, задание — повторит).
+    Ошибка доступа к чату или невалидный пользователь сбрасывают соответствующий кэш.
+    """
+    await rpc_bucket.acquire()
+    try:
+        return await client(request)
+    except errors.FloodWaitError as e:
+        rpc_bucket.pause(flood_wait_seconds(e))
+        logger.warning("FloodWait %ss on %s", e.seconds, type(request).__name__)
+        raise
+    except _CHAT_PEER_ERRORS:
+        chat_peer.invalidate()
+        raise
+    except _USER_PEER_ERRORS:
+        if user_id is not None:
+            user_peers.discard(user_id)
+        raise
+
+
+async def _peer_cache_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(_PEER_CACHE_FLUSH_SEC)
+        user_peers.save()
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Lifespan (startup/shutdown)
@@ -81,7 +148,10 @@ client = _make_client()
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     # Безинтерактивный старт: подключаемся и убеждаемся, что сессия авторизована.
+    loaded = user_peers.load()
+    logger.info("peer cache: %s users loaded from %s", loaded, settings.PEER_CACHE_PATH)
     await client.connect()
+    flush_task = None
     try:
         authorized = await client.is_user_authorized()
         if not authorized:
@@ -91,17 +161,25 @@ async def lifespan(_: FastAPI):
                 "для текущих TG_API_ID/TG_API_HASH."
             )
             
-        # Дополнительная проверка доступа к целевому чату
+        # Дополнительная проверка доступа к целевому чату (и резолв чата в кэш)
         chat_accessible = await _ensure_chat_access()
-        
+        if chat_accessible:
+            await _get_input_chat()
+
         # Запускаем прослушивание сообщений
         await start_message_listener()
-        
+
+        jobs.start()
+        flush_task = asyncio.create_task(_peer_cache_flush_loop())
     except Exception as e:
         logger.exception("Telethon startup failed: %s", e)
         raise
     yield
-    # Ничего особого при завершении
+    await jobs.stop()
+    if flush_task is not None:
+        flush_task.cancel()
+    user_peers.save()
+    await _close_bot_http()
     try:
         await client.disconnect()
     except Exception:
@@ -124,7 +202,9 @@ async def health_check():
         return {
             "status": "healthy",
             "chat_accessible": True,
-            "chat_info": chat_info
+            "chat_info": chat_info,
+            "jobs": jobs.stats(),
+            "peer_cache": {"chat": chat_peer.stats(), "users": user_peers.stats()},
         }
     except Exception as e:
         return {
@@ -134,6 +214,18 @@ async def health_check():
         }
 
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Счётчики сервиса: попадания в кэш пиров, пакетные задания, пауза FloodWait.
+    """
+    return {
+        "peer_cache": {"chat": chat_peer.stats(), "users": user_peers.stats()},
+        "user_resolve": dict(_resolve_counters),
+        "jobs": jobs.stats(),
+    }
+
+
 @app.get("/debug/chat")
 async def debug_chat():
     """
@@ -162,6 +254,27 @@ async def debug_chat():
 # Утилиты Bot API
 # ──────────────────────────────────────────────────────────────────────────────
 
+# Один пул соединений к api.telegram.org вместо AsyncClient на каждое сообщение
+_bot_http: Optional[httpx.AsyncClient] = None
+
+
+def _bot_client() -> httpx.AsyncClient:
+    global _bot_http
+    if _bot_http is None or _bot_http.is_closed:
+        _bot_http = httpx.AsyncClient(
+            timeout=15,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _bot_http
+
+
+async def _close_bot_http() -> None:
+    global _bot_http
+    http, _bot_http = _bot_http, None
+    if http is not None:
+        await http.aclose()
+
+
 async def bot_send_message(
     chat_id: int,
     text: str,
@@ -181,13 +294,12 @@ async def bot_send_message(
     if parse_mode:
         payload["parse_mode"] = parse_mode
 
-    async with httpx.AsyncClient(timeout=15) as http:
-        r = await http.post(f"{BOT_API}/sendMessage", json=payload)
-        try:
-            data = r.json()
-        except Exception:
-            return False
-        return bool(data.get("ok"))
+    r = await _bot_client().post(f"{BOT_API}/sendMessage", json=payload)
+    try:
+        data = r.json()
+    except Exception:
+        return False
+    return bool(data.get("ok"))
 
 
 async def bot_send_invite_dm(user_id: int, invite_url: str) -> bool:
@@ -216,8 +328,7 @@ async def bot_notify_admin_incident(user_id: int, username: Optional[str], full_
         "Вероятно, пользователь не писал боту или ограничил ЛС."
     )
     payload = {"chat_id": settings.ADMIN_ID, "text": txt, "parse_mode": "HTML"}
-    async with httpx.AsyncClient(timeout=15) as http:
-        await http.post(f"{BOT_API}/sendMessage", json=payload)
+    await _bot_client().post(f"{BOT_API}/sendMessage", json=payload)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -285,9 +396,13 @@ async def send_message_to_target_chat(text: str, parse_mode: Optional[str] = Non
 
 async def _get_entity_chat():
     """
-    Возвращает high-level entity (Chat|Channel) по TARGET_CHAT_ID.
+    Возвращает high-level entity (Chat|Channel) по TARGET_CHAT_ID (из chat_peer).
     Требует, чтобы аккаунт из TG_SESSION состоял в группе/канале.
     """
+    return await chat_peer.get("entity", _resolve_entity_chat)
+
+
+async def _resolve_entity_chat():
     try:
         return await client.get_entity(settings.TARGET_CHAT_ID)
     except (ValueError, errors.ChannelInvalidError) as e:
@@ -302,9 +417,13 @@ async def _get_user_entity(user_id: int):
 
 async def _get_input_peer_for_chat():
     """
-    InputPeer* для таргет-чата (InputPeerChannel или InputPeerChat).
+    InputPeer* для таргет-чата (InputPeerChannel или InputPeerChat), из chat_peer.
     Нужен, например, для messages.ExportChatInviteRequest(peer=...).
     """
+    return await chat_peer.get("input_peer", _resolve_input_peer_for_chat)
+
+
+async def _resolve_input_peer_for_chat():
     try:
         return await client.get_input_entity(settings.TARGET_CHAT_ID)
     except (ValueError, errors.ChannelInvalidError) as e:
@@ -335,7 +454,12 @@ async def _get_input_chat() -> tuple[str, InputPeerChat | InputChannel]:
     Универсально получаем Input-* пира и сразу помечаем тип:
       - ('channel', InputChannel)  — супергруппа/канал
       - ('chat',    InputPeerChat) — обычная группа
+    Резолвится один раз (chat_peer), сбрасывается ошибкой доступа к чату в _rpc.
     """
+    return await chat_peer.get("input_chat", _resolve_input_chat)
+
+
+async def _resolve_input_chat() -> tuple[str, InputPeerChat | InputChannel]:
     inp = await _get_input_peer_for_chat()
     if inp is None:
         raise RuntimeError(f"Нет доступа к целевому чату {settings.TARGET_CHAT_ID}")
@@ -356,55 +480,87 @@ async def _get_input_chat() -> tuple[str, InputPeerChat | InputChannel]:
     raise RuntimeError("TARGET_CHAT_ID не резолвится ни в Chat, ни в Channel")
 
 
+_resolve_counters: Dict[str, int] = {"cache": 0, "session": 0, "rpc": 0}
+
+
 async def _get_input_user(user_id: int) -> types.InputUser:
     """
     Гарантировано возвращает InputUser (а не InputPeerUser).
+    Порядок: user_peers (без запросов) → кэш сессии Telethon (get_input_entity,
+    обычно без запросов) → get_entity (users.GetUsers через _rpc).
     """
-    ent = await client.get_entity(user_id)
-    if isinstance(ent, types.User):
-        return types.InputUser(ent.id, ent.access_hash)
-    # На всякий случай fallback
-    ipeer = await client.get_input_entity(user_id)
+    access_hash = user_peers.get(user_id)
+    if access_hash is not None:
+        _resolve_counters["cache"] += 1
+        return types.InputUser(int(user_id), access_hash)
+
+    try:
+        ipeer = await client.get_input_entity(user_id)
+    except ValueError:
+        ipeer = None
     if isinstance(ipeer, types.InputPeerUser):
+        _resolve_counters["session"] += 1
+        user_peers.put(ipeer.user_id, ipeer.access_hash)
         return types.InputUser(ipeer.user_id, ipeer.access_hash)
+
+    # get_entity сам ходит в Telegram — через общий темп запросов
+    await rpc_bucket.acquire()
+    try:
+        ent = await client.get_entity(user_id)
+    except errors.FloodWaitError as e:
+        rpc_bucket.pause(flood_wait_seconds(e))
+        raise
+    if isinstance(ent, types.User):
+        _resolve_counters["rpc"] += 1
+        user_peers.put(ent.id, ent.access_hash)
+        return types.InputUser(ent.id, ent.access_hash)
     raise RuntimeError("Не удалось получить InputUser для user_id=%s" % user_id)
 
 
-async def try_direct_invite(user_id: int) -> bool:
+# Любая из этих ошибок означает, что напрямую добавить не вышло — переходим к инвайту
+_DIRECT_INVITE_ERRORS = (
+    errors.UserPrivacyRestrictedError,
+    errors.UserNotMutualContactError,
+    errors.UserChannelsTooMuchError,
+    errors.ChatAdminRequiredError,
+    errors.PeerFloodError,
+    errors.UserAlreadyParticipantError,
+    errors.FloodWaitError,
+    errors.ChatWriteForbiddenError,
+    errors.RPCError,
+    ValueError,
+)
+
+
+async def _direct_invite(kind: str, ichat, user_id: int) -> None:
     """
-    Пробуем добавить напрямую (как админ-пользователь).
+    Прямое добавление (как админ-пользователь), ошибки пробрасываются.
     Для мегагруппы/канала: channels.InviteToChannel(users=[InputUser])
     Для обычных чатов: messages.AddChatUser(user_id=InputUser)
     """
+    iuser = await _get_input_user(user_id)
+    if kind == "channel":  # супергруппа
+        await _rpc(functions.channels.InviteToChannelRequest(
+            channel=ichat,  # InputChannel
+            users=[iuser],  # list[InputUser]
+        ), user_id=user_id)
+    else:                  # обычный чат
+        await _rpc(functions.messages.AddChatUserRequest(
+            chat_id=ichat.chat_id,  # int
+            user_id=iuser,          # InputUser
+            fwd_limit=0
+        ), user_id=user_id)
+
+
+async def try_direct_invite(user_id: int) -> bool:
+    """
+    Пробуем добавить напрямую. False — не вышло (в т.ч. FloodWait), нужен инвайт.
+    """
     try:
         kind, ichat = await _get_input_chat()
-        iuser = await _get_input_user(user_id)
-
-        if kind == "channel":  # супергруппа
-            await client(functions.channels.InviteToChannelRequest(
-                channel=ichat,  # InputChannel
-                users=[iuser],  # list[InputUser]
-            ))
-        else:                  # обычный чат
-            await client(functions.messages.AddChatUserRequest(
-                chat_id=ichat.chat_id,  # int
-                user_id=iuser,          # InputUser
-                fwd_limit=0
-            ))
+        await _direct_invite(kind, ichat, user_id)
         return True
-    except (
-        errors.UserPrivacyRestrictedError,
-        errors.UserNotMutualContactError,
-        errors.UserChannelsTooMuchError,
-        errors.ChatAdminRequiredError,
-        errors.PeerFloodError,
-        errors.UserAlreadyParticipantError,
-        errors.FloodWaitError,
-        errors.ChatWriteForbiddenError,
-        errors.RPCError,
-        ValueError,
-    ) as e:
-        # Любая из этих ошибок означает, что мы не смогли напрямую добавить — переходим к инвайту
+    except _DIRECT_INVITE_ERRORS as e:
         logger.warning("Direct invite failed: %s", e)
         return False
 
@@ -415,7 +571,7 @@ async def create_single_use_invite(ttl_hours: int) -> str:
     """
     peer = await _get_input_peer_for_chat()  # InputPeerChannel | InputPeerChat
     expire_date = datetime.utcnow() + timedelta(seconds=max(60, ttl_hours * 3600))
-    res = await client(functions.messages.ExportChatInviteRequest(
+    res = await _rpc(functions.messages.ExportChatInviteRequest(
         peer=peer,
         expire_date=expire_date,
         usage_limit=1,
@@ -438,39 +594,42 @@ async def create_single_use_invite(ttl_hours: int) -> str:
     raise RuntimeError(f"Не удалось получить ссылку-приглашение (тип ответа: {type(res).__name__})")
 
 
-async def kick_then_unban(user_id: int) -> bool:
+async def _kick(kind: str, ichat, user_id: int) -> None:
     """
     «Полное удаление»: для каналов — ban→unban (EditBanned),
     для обычных чатов — DeleteChatUser. После этого пользователя можно снова звать.
-    """
+    Ошибки пробрасываются. Паузу между баном и анбаном задаёт rpc_bucket.
+    """
+    iuser = await _get_input_user(user_id)
+    if kind == "channel":
+        # Супергруппа: бан → анбан
+        rights_ban = types.ChatBannedRights(
+            until_date=None,      # бессрочно
+            view_messages=True,   # исключение
+        )
+        await _rpc(functions.channels.EditBannedRequest(
+            channel=ichat, participant=iuser, banned_rights=rights_ban
+        ), user_id=user_id)
+        rights_unban = types.ChatBannedRights(
+            until_date=0,         # явный unban
+            view_messages=False,
+        )
+        await _rpc(functions.channels.EditBannedRequest(
+            channel=ichat, participant=iuser, banned_rights=rights_unban
+        ), user_id=user_id)
+    else:
+        # Обычная группа: DeleteChatUser — удаляет без помещения в бан-лист.
+        await _rpc(functions.messages.DeleteChatUserRequest(
+            chat_id=ichat.chat_id,
+            user_id=iuser,
+            revoke_history=False,  # историю не трогаем
+        ), user_id=user_id)
+
+
+async def kick_then_unban(user_id: int) -> bool:
     try:
         kind, ichat = await _get_input_chat()
-        iuser = await _get_input_user(user_id)
-
-        if kind == "channel":
-            # Супергруппа: бан → анбан
-            rights_ban = types.ChatBannedRights(
-                until_date=None,      # бессрочно
-                view_messages=True,   # исключение
-            )
-            await client(functions.channels.EditBannedRequest(
-                channel=ichat, participant=iuser, banned_rights=rights_ban
-            ))
-            await asyncio.sleep(0.2)
-            rights_unban = types.ChatBannedRights(
-                until_date=0,         # явный unban
-                view_messages=False,
-            )
-            await client(functions.channels.EditBannedRequest(
-                channel=ichat, participant=iuser, banned_rights=rights_unban
-            ))
-        else:
-            # Обычная группа: DeleteChatUser — удаляет без помещения в бан-лист.
-            await client(functions.messages.DeleteChatUserRequest(
-                chat_id=ichat.chat_id,
-                user_id=iuser,
-                revoke_history=False,  # историю не трогаем
-            ))
+        await _kick(kind, ichat, user_id)
         return True
     except ValueError as e:
         # Пользователь не найден (удалён аккаунт, заблокировал бота и т.д.)
@@ -485,6 +644,77 @@ async def kick_then_unban(user_id: int) -> bool:
         return False
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Пакетные задания (batch_jobs.JobQueue)
+# ──────────────────────────────────────────────────────────────────────────────
+
+async def _batch_prepare(job: Job):
+    """Доступ к чату проверяется и чат резолвится один раз на задание."""
+    if not await _ensure_chat_access():
+        raise RuntimeError("Нет доступа к целевому чату")
+    return await _get_input_chat()
+
+
+async def _batch_invite_one(item: Dict[str, Any], chat) -> str:
+    kind, ichat = chat
+    user_id = int(item["user_id"])
+    try:
+        await _direct_invite(kind, ichat, user_id)
+        return "added"
+    except errors.FloodWaitError:
+        raise                                  # JobQueue повторит после паузы
+    except _DIRECT_INVITE_ERRORS as e:
+        logger.warning("Direct invite failed for %s: %s", user_id, e)
+
+    invite_url = await create_single_use_invite(item["invite_ttl_hours"])
+    if await bot_send_invite_dm(user_id, invite_url):
+        return "invited_link_sent"
+    # админу — одно сообщение на всё задание (_report_batch)
+    return "incident_reported_to_admin"
+
+
+async def _batch_remove_one(item: Dict[str, Any], chat) -> str:
+    kind, ichat = chat
+    try:
+        await _kick(kind, ichat, int(item["user_id"]))
+    except ValueError:
+        # Пользователь не найден (удалён аккаунт и т.п.) — в чате его уже нет
+        return "not_found"
+    return "removed"
+
+
+async def _report_batch(job: Job) -> None:
+    """Сводка админу вместо сообщения на каждого пользователя."""
+    incidents = [uid for uid, res in job.results.items() if res == "incident_reported_to_admin"]
+    failed = list(job.errors)
+    if not incidents and not failed:
+        return
+    lines = [f"⚠️ Пакетное задание {job.kind} <code>{job.id}</code>: {len(job.items)} пользователей"]
+    if incidents:
+        lines.append(f"• не удалось отправить ссылку в ЛС ({len(incidents)}): "
+                     + ", ".join(f"<code>{uid}</code>" for uid in incidents[:50]))
+    if failed:
+        lines.append(f"• ошибки ({len(failed)}): "
+                     + ", ".join(f"<code>{uid}</code>" for uid in failed[:50]))
+    await bot_send_message(settings.ADMIN_ID, "\n".join(lines), parse_mode="HTML")
+
+
+jobs.register("invite", _batch_invite_one, prepare=_batch_prepare)
+jobs.register("remove", _batch_remove_one, prepare=_batch_prepare)
+jobs.on_finished = _report_batch
+
+
+def _submit_batch(kind: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # повтор user_id в пакете — одна операция
+    unique = list({int(x["user_id"]): x for x in items}.values())
+    if not unique:
+        raise HTTPException(status_code=400, detail="Пустой пакет")
+    if len(unique) > settings.BATCH_MAX_USERS:
+        raise HTTPException(status_code=413, detail=f"Не больше {settings.BATCH_MAX_USERS} пользователей в пакете")
+    job = jobs.submit(kind, unique)
+    return {"job_id": job.id, "status": job.status, "total": len(unique)}
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Контроллеры
 # ──────────────────────────────────────────────────────────────────────────────
@@ -530,6 +760,30 @@ async def remove_member(req: RemoveRequest):
     return {"status": "removed"}
 
 
+@app.post("/members/invite_batch", status_code=202)
+async def invite_members_batch(req: InviteBatchRequest):
+    """
+    Ставит пакет приглашений в очередь. Прогресс и итог по каждому — GET /jobs/{job_id}.
+    """
+    return _submit_batch("invite", [u.model_dump() for u in req.users])
+
+
+@app.post("/members/remove_batch", status_code=202)
+async def remove_members_batch(req: RemoveBatchRequest):
+    """
+    Ставит пакет удалений (бан/анбан) в очередь. Прогресс — GET /jobs/{job_id}.
+    """
+    return _submit_batch("remove", [{"user_id": uid} for uid in req.user_ids])
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job.snapshot()
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Контроллеры для работы с сообщениями
 # ──────────────────────────────────────────────────────────────────────────────
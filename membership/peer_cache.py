@@ -0,0 +1,167 @@
+# smart_agent/membership/peer_cache.py
+"""
+Кэш резолва пиров для membership-сервиса.
+
+Раньше каждый запрос заново резолвил целевой чат (get_entity/get_input_entity)
+и пользователя (client.get_entity, а для пользователей это всегда users.GetUsers).
+Каждый такой запрос — лишний MTProto round-trip, и он расходует лимиты аккаунта.
+
+  — ChatPeerCache: целевой чат резолвится один раз (на старте) и живёт, пока
+    Telegram не ответит ошибкой доступа к чату, — тогда invalidate() и повторный резолв;
+  — UserPeerCache: user_id → access_hash (для InputUser), LRU до max_size с TTL.
+    Сохраняется в JSON-файл (атомарная запись через .tmp), поэтому после рестарта
+    кэш уже тёплый. StringSession сущности не хранит.
+
+access_hash привязан к аккаунту user-бота: при смене TG_SESSION файл нужно удалить.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _hit_rate(hits: int, misses: int) -> Optional[float]:
+    total = hits + misses
+    return round(hits / total, 4) if total else None
+
+
+class ChatPeerCache:
+    """
+    Резолв целевого чата: значения по имени ("input_chat", "input_peer", "entity").
+    None (нет доступа) не кэшируется. invalidate() сбрасывает все сразу.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Any] = {}
+        self.resolved_at: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, name: str, resolver: Callable[[], Awaitable[Any]]) -> Any:
+        value = self._values.get(name)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await resolver()
+        if value is not None:
+            self._values[name] = value
+            self.resolved_at = time.time()
+        return value
+
+    def invalidate(self) -> None:
+        if self._values:
+            self.invalidations += 1
+        self._values.clear()
+        self.resolved_at = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "resolved": sorted(self._values),
+            "resolved_at": self.resolved_at,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": _hit_rate(self.hits, self.misses),
+        }
+
+
+class UserPeerCache:
+    """LRU user_id → access_hash с TTL и сохранением в файл."""
+
+    def __init__(self, path: Optional[str], *, max_size: int = 50000, ttl_sec: float = 7 * 86400):
+        self.path = path
+        self.max_size = max(1, int(max_size))
+        self.ttl_sec = ttl_sec
+        self._items: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[int]:
+        """access_hash или None (нет в кэше/устарел)."""
+        user_id = int(user_id)
+        item = self._items.get(user_id)
+        if item is not None and time.time() - item[1] > self.ttl_sec:
+            del self._items[user_id]
+            self._dirty = True
+            self.expired += 1
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return item[0]
+
+    def put(self, user_id: int, access_hash: int) -> None:
+        user_id = int(user_id)
+        self._items[user_id] = (int(access_hash), time.time())
+        self._items.move_to_end(user_id)
+        self._dirty = True
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, user_id: int) -> None:
+        """access_hash отвергнут Telegram — резолвим заново при следующем обращении."""
+        if self._items.pop(int(user_id), None) is not None:
+            self._dirty = True
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    # ---------- файл ----------
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except Exception as e:
+            logger.warning("peer cache %s is unreadable, starting cold: %s", self.path, e)
+            return 0
+        now = time.time()
+        # в файле — от старых к новым, как в LRU
+        for uid, (access_hash, stored_at) in raw.items():
+            if now - stored_at <= self.ttl_sec:
+                self._items[int(uid)] = (int(access_hash), float(stored_at))
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        self._dirty = False
+        return len(self._items)
+
+    def save(self) -> bool:
+        """Пишет кэш, если он менялся. True — файл обновлён."""
+        if not self.path or not self._dirty:
+            return False
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({str(uid): [h, ts] for uid, (h, ts) in self._items.items()}, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning("peer cache save to %s failed: %s", self.path, e)
+            return False
+        self._dirty = False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": _hit_rate(self.hits, self.misses),
+        }
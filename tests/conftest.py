@@ -171,14 +171,14 @@ def patch_redis(monkeypatch, mock_redis_client):
 
 
 @pytest.fixture
-def in_memory_db():
-    """Create in-memory SQLite database for testing real logic."""
+def in_memory_db(tmp_path):
+    """SQLite database for testing real logic (billing DB calls go through run_db threads)."""
     from sqlalchemy import create_engine
     from sqlalchemy.orm import sessionmaker
     from bot.utils.billing_db import Base, BillingRepository
     
-    # In-memory SQLite (fast, isolated)
-    engine = create_engine("sqlite:///:memory:", echo=False)
+    # Файл на тест (fast, isolated): у каждого потока run_db своё соединение
+    engine = create_engine(f"sqlite:///{tmp_path / 'billing.db'}", echo=False)
     Base.metadata.create_all(engine)
     
     SessionLocal_test = sessionmaker(
@@ -192,6 +192,67 @@ def in_memory_db():
     
     # Cleanup after test
     Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def shared_db(tmp_path):
+    """
+    Файловая SQLite для конкурентных тестов биллинга: у каждого потока (run_db, воркеры)
+    своё соединение. WAL — чтения не блокируют вставки (ближе к InnoDB в проде).
+    Модульный _repo billing_db подменён на репозиторий этой базы.
+    """
+    from sqlalchemy import create_engine, event as sa_event
+    from sqlalchemy.orm import sessionmaker
+    from bot.utils.billing_db import Base, BillingRepository
+
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'billing.db'}",
+        connect_args={"timeout": 30, "check_same_thread": False},
+    )
+
+    @sa_event.listens_for(engine, "connect")
+    def _wal(dbapi_conn, _):
+        dbapi_conn.execute("PRAGMA journal_mode=WAL")
+        dbapi_conn.execute("PRAGMA synchronous=NORMAL")
+
+    Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    repo = BillingRepository(SessionLocal)
+    try:
+        with patch("bot.utils.billing_db._repo", repo):
+            yield repo, SessionLocal
+    finally:
+        engine.dispose()
+
+
+@pytest.fixture
+def in_memory_app_db():
+    """In-memory SQLite for the app DB (users/event_log), shared across threads (run_db)."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from bot.utils.database import Base, AppRepository
+
+    engine = create_engine(
+        "sqlite://",
+        echo=False,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(engine)
+
+    SessionLocal_test = sessionmaker(
+        bind=engine,
+        autoflush=False,
+        autocommit=False,
+        expire_on_commit=False,
+    )
+    repo = AppRepository(SessionLocal_test)
+
+    yield repo, SessionLocal_test
+
+    Base.metadata.drop_all(engine)
 
 
 @pytest.fixture
@@ -0,0 +1,151 @@
+"""
+Tests for the unified access decision (AccessSnapshot) and its cache invalidation.
+"""
+import asyncio
+from datetime import timedelta
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from bot.handlers.payment_handler import (
+    AccessSnapshot,
+    compute_access_snapshot,
+    ensure_access,
+    format_access_text,
+    get_access_snapshot,
+)
+from bot.utils.redis_repo import AccessCacheRepo
+from bot.utils.time_helpers import now_msk
+
+
+@pytest.fixture
+def access_cache():
+    redis = MagicMock()
+    redis.get = AsyncMock(return_value=None)
+    redis.set = AsyncMock(return_value=True)
+    redis.delete = AsyncMock(return_value=1)
+    cache = AccessCacheRepo(redis, prefix="test", local_ttl_sec=60, redis_ttl_sec=60)
+    with patch('bot.handlers.payment_handler.access_cache', cache):
+        yield cache
+
+
+def test_snapshot_access_rules():
+    now = now_msk()
+    trial = AccessSnapshot(user_id=1, trial_until=now + timedelta(hours=5))
+    assert trial.has_access(now) and trial.had_trial and not trial.had_sub
+    assert trial.trial_hours_left(now) in (4, 5)
+
+    paid = AccessSnapshot(user_id=1, sub_status="active", next_charge_at=now + timedelta(days=3))
+    assert paid.paid_active(now) and paid.has_access(now)
+
+    grace = AccessSnapshot(user_id=1, sub_status="active", next_charge_at=now - timedelta(hours=1), failures=2)
+    assert grace.in_grace(now) and grace.has_access(now)
+
+    expired = AccessSnapshot(user_id=1, sub_status="active", next_charge_at=now - timedelta(hours=1), failures=3)
+    assert not expired.has_access(now)
+
+    canceled = AccessSnapshot(user_id=1, trial_until=now - timedelta(days=1), sub_status="canceled")
+    assert not canceled.has_access(now) and canceled.had_sub and canceled.had_trial
+
+
+def test_snapshot_roundtrip():
+    now = now_msk()
+    snap = AccessSnapshot(user_id=5, trial_until=now, sub_status="active", next_charge_at=now, failures=1)
+    assert AccessSnapshot.from_dict(snap.to_dict()) == snap
+
+
+def test_get_access_subscription_prefers_active(in_memory_db):
+    repo, _ = in_memory_db
+    nxt = now_msk() + timedelta(days=10)
+    repo.subscription_upsert(
+        user_id=77, plan_code="3m", interval_months=3, amount_value="6490.00",
+        amount_currency="RUB", payment_method_id=None, next_charge_at=nxt, status="active",
+    )
+    repo.subscription_upsert(
+        user_id=77, plan_code="1m", interval_months=1, amount_value="2490.00",
+        amount_currency="RUB", payment_method_id=None, next_charge_at=nxt + timedelta(days=30),
+        status="canceled",
+    )
+
+    row = repo.get_access_subscription(77)
+    assert row["status"] == "active"
+    assert abs((row["next_charge_at"] - nxt).total_seconds()) < 1
+    assert repo.get_access_subscription(78) is None
+
+
+def test_compute_snapshot_uses_one_query_per_db():
+    until = now_msk() + timedelta(hours=2)
+    with patch('bot.handlers.payment_handler.app_db') as mock_app_db, \
+         patch('bot.handlers.payment_handler.billing_db') as mock_billing:
+        mock_app_db.get_trial_until.return_value = until
+        mock_billing.get_access_subscription.return_value = {
+            "status": "active", "next_charge_at": None, "consecutive_failures": 1,
+        }
+        snap = compute_access_snapshot(9)
+
+    mock_app_db.get_trial_until.assert_called_once_with(9)
+    mock_billing.get_access_subscription.assert_called_once_with(9)
+    assert snap.trial_until == until and snap.sub_active and snap.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_ensure_access_hits_db_once_then_cache(access_cache, mock_user):
+    msg = MagicMock()
+    msg.from_user = mock_user
+    snap = AccessSnapshot(user_id=mock_user.id, trial_until=now_msk() + timedelta(hours=1))
+    with patch('bot.handlers.payment_handler.compute_access_snapshot', return_value=snap) as mock_compute:
+        assert await ensure_access(msg)
+        assert await ensure_access(msg)
+        assert "Бесплатный доступ активен" in format_access_text(mock_user.id)
+
+    mock_compute.assert_called_once_with(mock_user.id)
+    access_cache.r.set.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_is_read_from_redis(access_cache):
+    snap = AccessSnapshot(user_id=3, sub_status="active", next_charge_at=now_msk() + timedelta(days=1))
+    import json
+    access_cache.r.get = AsyncMock(return_value=json.dumps(snap.to_dict()))
+    with patch('bot.handlers.payment_handler.compute_access_snapshot') as mock_compute:
+        assert await get_access_snapshot(3) == snap
+    mock_compute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_billing_and_trial_writes_invalidate_snapshot(access_cache):
+    import bot.utils.billing_db as billing_db
+    import bot.utils.database as app_db
+
+    with patch('bot.utils.redis_repo.access_cache', access_cache), \
+         patch.object(billing_db, '_repo') as mock_billing_repo, \
+         patch.object(app_db, '_repo') as mock_app_repo:
+        mock_billing_repo.subscription_upsert.return_value = 1
+        mock_app_repo.set_trial.return_value = now_msk()
+
+        for call in (
+            lambda: billing_db.subscription_upsert(
+                user_id=11, plan_code="1m", interval_months=1, amount_value="1.00",
+                amount_currency="RUB", payment_method_id=None, next_charge_at=None,
+            ),
+            lambda: billing_db.subscription_cancel_for_user(user_id=11),
+            lambda: app_db.set_trial(11, hours=1),
+        ):
+            access_cache.set_local(11, {"user_id": 11})
+            access_cache.r.delete.reset_mock()
+            call()
+            assert access_cache.get_local(11) is None
+            await asyncio.sleep(0)
+            access_cache.r.delete.assert_awaited_once_with("test:access:11")
+
+
+@pytest.mark.asyncio
+async def test_invalidate_nowait_from_db_thread_reaches_redis(access_cache):
+    from bot.utils.async_db import run_db
+
+    await access_cache.set(21, {"user_id": 21})
+    await run_db(access_cache.invalidate_nowait, 21)
+    await asyncio.sleep(0.05)
+
+    assert access_cache.get_local(21) is None
+    access_cache.r.delete.assert_awaited_with("test:access:21")
@@ -0,0 +1,102 @@
+"""
+Разбор подписок несколькими воркерами биллинга (BillingRepository.claim_due_subscriptions):
+каждая подписка забирается ровно одним воркером, попытка пишется в той же транзакции.
+"""
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from bot.utils.billing_db import ChargeAttempt, Subscription
+from bot.utils.time_helpers import now_msk, to_utc_for_db
+
+
+def _add_due(repo, n, now):
+    return [
+        repo.subscription_upsert(
+            user_id=uid, plan_code="1m", interval_months=1, amount_value="2490.00",
+            amount_currency="RUB", payment_method_id=f"pm_token_{uid:08d}",
+            next_charge_at=now - timedelta(days=1), status="active",
+        )
+        for uid in range(1, n + 1)
+    ]
+
+
+def test_workers_never_claim_the_same_subscription(shared_db):
+    repo, SessionLocal = shared_db
+    now = now_msk()
+    sub_ids = _add_due(repo, 600, now)
+
+    claims = {}
+    errors = []
+    start = threading.Barrier(8)
+
+    def worker(name):
+        got = claims.setdefault(name, [])
+        try:
+            start.wait()
+            while repo.subscriptions_due(now=now, limit=1):
+                got.extend(repo.claim_due_subscriptions(now=now, worker_id=name, limit=5))
+                # «обработка» пачки: без паузы SQLite может отдать все записи одному потоку
+                time.sleep(0.005)
+        except Exception as e:          # pragma: no cover — упавший поток = провал теста
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(f"w{i}",)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=120)
+
+    assert not errors
+    claimed_ids = Counter(c["id"] for got in claims.values() for c in got)
+    assert sorted(claimed_ids) == sorted(sub_ids)
+    assert max(claimed_ids.values()) == 1
+    assert sum(1 for got in claims.values() if got) > 1      # работу действительно делили
+
+    with SessionLocal() as s:
+        per_sub = Counter(sid for (sid,) in s.query(ChargeAttempt.subscription_id))
+        owners = {sid: by for sid, by in s.query(Subscription.id, Subscription.claimed_by)}
+    # ровно одна попытка на подписку, аренда — у забравшего воркера
+    assert per_sub == Counter(sub_ids)
+    for name, got in claims.items():
+        assert all(owners[c["id"]] == name for c in got)
+
+
+def test_claim_respects_lease_and_open_attempts(shared_db):
+    repo, SessionLocal = shared_db
+    now = now_msk()
+    a, b, c = _add_due(repo, 3, now)
+
+    # b: платёж уже создан и ждёт вебхука (попытка старше 12ч — правило паузы её не видит)
+    with SessionLocal() as s, s.begin():
+        s.add(ChargeAttempt(subscription_id=b, user_id=2, payment_id="pay_wait", status="created",
+                            attempted_at=to_utc_for_db(now - timedelta(days=1))))
+    # c: арендована другим воркером
+    with SessionLocal() as s, s.begin():
+        s.get(Subscription, c).claimed_by = "other"
+        s.get(Subscription, c).claimed_until = to_utc_for_db(now + timedelta(hours=1))
+
+    claimed = repo.claim_due_subscriptions(now=now, worker_id="w1")
+    assert [x["id"] for x in claimed] == [a]
+    assert claimed[0]["attempt_id"]
+
+    # аренда истекла — подписку можно забрать
+    later = now + timedelta(hours=2)
+    assert [x["id"] for x in repo.claim_due_subscriptions(now=later, worker_id="w1")] == [c]
+
+
+def test_release_claim_restores_subscription(shared_db):
+    repo, SessionLocal = shared_db
+    now = now_msk()
+    (sub_id,) = _add_due(repo, 1, now)
+
+    (claim,) = repo.claim_due_subscriptions(now=now, worker_id="w1")
+    assert repo.claim_due_subscriptions(now=now, worker_id="w2") == []
+
+    repo.release_claim(subscription_id=sub_id, attempt_id=claim["attempt_id"],
+                       prev_last_attempt_at=claim["prev_last_attempt_at"])
+    with SessionLocal() as s:
+        assert s.query(ChargeAttempt).count() == 0
+        assert s.get(Subscription, sub_id).last_attempt_at is None
+    assert [x["id"] for x in repo.claim_due_subscriptions(now=now, worker_id="w2")] == [sub_id]
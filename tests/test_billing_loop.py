@@ -3,9 +3,9 @@ Tests for billing loop and charge attempts.
 """
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-from bot.utils.billing_db import precharge_guard_and_attempt, subscriptions_due, Subscription
+from bot.utils.billing_db import precharge_guard_and_attempt, subscriptions_due, Subscription, ChargeAttempt
 from bot.utils.time_helpers import now_msk, TIMEZONE
 
 
@@ -445,77 +445,39 @@ def test_subscriptions_due_only_includes_due_subscriptions(mock_time):
         assert due[0]["id"] == 1
 
 
-def test_subscriptions_due_no_repeat_charge_within_12h(mock_time):
-    """Test that subscription is not charged again within 12 hours after successful charge."""
-    from bot.utils.billing_db import _repo
-    
-    # Создаем мок сессии
-    mock_session = MagicMock()
-    
-    # Создаем мок session_factory
-    mock_session_factory = MagicMock()
-    mock_session_factory.return_value.__enter__.return_value = mock_session
-    
-    # Патчим _session_factory репозитория
-    with patch.object(_repo, '_session_factory', mock_session_factory), \
-         patch('bot.utils.billing_db.now_msk', return_value=mock_time), \
-         patch('bot.utils.billing_db.to_utc_for_db') as mock_to_utc, \
-         patch('bot.utils.billing_db.to_aware_msk') as mock_to_aware, \
-         patch('bot.utils.billing_db.from_db_naive') as mock_from_db:
-        
-        # Настраиваем конвертацию времени
-        mock_to_aware.return_value = mock_time
-        mock_time_utc = datetime(2025, 1, 15, 9, 0, 0)  # UTC время
-        mock_to_utc.return_value = mock_time_utc
-        
-        # Сценарий: 
-        # 1. Подписка со сроком наступившим (next_charge_at <= now)
-        # 2. Но была успешная попытка списания 6 часов назад
-        # 3. Проверяем, что подписка блокируется правилом 12h gap
-        
-        # Подписка со сроком наступившим
-        mock_sub = MagicMock()
-        mock_sub.id = 1
-        mock_sub.user_id = 7833048230
-        mock_sub.plan_code = "1m"
-        mock_sub.interval_months = 1
-        mock_sub.amount_value = "2500.00"
-        mock_sub.amount_currency = "RUB"
-        mock_sub.payment_method_id = "pm_token_123"
-        mock_sub.consecutive_failures = 0
-        mock_sub.next_charge_at = mock_time - timedelta(days=1)  # Срок наступил
-        
-        # Настраиваем from_db_naive
-        mock_from_db.return_value = mock_time - timedelta(days=1)
-        
-        # Настраиваем query для subscriptions
-        mock_query = MagicMock()
-        mock_query.filter.return_value.order_by.return_value.limit.return_value = [mock_sub]
-        
-        # Setup charge attempt queries
-        # blocked_ids_day2: нет 2 попыток за 24 часа
-        mock_attempt_query1 = MagicMock()
-        mock_attempt_query1.filter.return_value.group_by.return_value.having.return_value.all.return_value = []
-        
-        # blocked_ids_gap12h: есть попытка 6 часов назад (в пределах 12h окна)
-        mock_attempt_query2 = MagicMock()
-        # Возвращаем subscription_id=1, т.к. есть попытка в пределах 12 часов
-        mock_attempt_query2.filter.return_value.group_by.return_value.all.return_value = [(1,)]
-        
-        # failed_counts: нет неуспешных попыток
-        mock_attempt_query3 = MagicMock()
-        mock_attempt_query3.filter.return_value.group_by.return_value.all.return_value = []
-        
-        from bot.utils.billing_db import Subscription, ChargeAttempt
-        mock_session.query.side_effect = [
-            mock_query,  # Первый запрос для subscriptions
-            mock_attempt_query1,  # Для blocked_ids_day2
-            mock_attempt_query2,  # Для blocked_ids_gap12h (блокирует!)
-            mock_attempt_query3,  # Для failed_counts
-        ]
-        
-        # Execute
-        due = subscriptions_due(now=mock_time, limit=100)
-        
-        # Should be blocked by 12h gap rule - не должно быть повторного списания
-        assert len(due) == 0
+def test_subscriptions_due_no_repeat_charge_within_12h(in_memory_db, mock_time):
+    """Test that subscription is not charged again within 12 hours after a charge attempt."""
+    repo, SessionLocal = in_memory_db
+
+    # Сценарий:
+    # 1. Подписка со сроком наступившим (next_charge_at <= now)
+    # 2. Но была попытка списания 6 часов назад
+    # 3. Проверяем, что подписка блокируется правилом 12h gap (фильтр теперь в SQL)
+    sub_id = repo.subscription_upsert(
+        user_id=7833048230,
+        plan_code="1m",
+        interval_months=1,
+        amount_value="2500.00",
+        amount_currency="RUB",
+        payment_method_id="pm_token_123",
+        next_charge_at=mock_time - timedelta(days=1),  # Срок наступил
+        status="active"
+    )
+    with SessionLocal() as s, s.begin():
+        s.add(ChargeAttempt(
+            subscription_id=sub_id,
+            user_id=7833048230,
+            payment_id="pay_6h_ago",
+            status="canceled",
+            attempted_at=(mock_time - timedelta(hours=6)).astimezone(timezone.utc).replace(tzinfo=None),
+        ))
+
+    # Execute
+    due = repo.subscriptions_due(now=mock_time, limit=100)
+
+    # Should be blocked by 12h gap rule - не должно быть повторного списания
+    assert len(due) == 0
+
+    # Через 13 часов после попытки подписка снова в выборке
+    due = repo.subscriptions_due(now=mock_time + timedelta(hours=7), limit=100)
+    assert [d["id"] for d in due] == [sub_id]
@@ -42,7 +42,7 @@ async def test_billing_loop_full_cycle(in_memory_db, mock_bot):
          patch('bot.run.billing_db.subscriptions_due', repo.subscriptions_due), \
          patch('bot.run.billing_db.precharge_guard_and_attempt', repo.precharge_guard_and_attempt), \
          patch('bot.run.billing_db.link_payment_to_attempt', repo.link_payment_to_attempt), \
-         patch('bot.run.youmoney.charge_saved_method') as mock_charge:
+         patch('bot.run.youmoney.charge_saved_method_async', new_callable=AsyncMock) as mock_charge:
         
         mock_charge.return_value = "payment_123"
         
@@ -104,7 +104,7 @@ async def test_billing_loop_handles_errors(in_memory_db, mock_bot):
     with patch('bot.run.billing_db._repo', repo), \
          patch('bot.run.billing_db.subscriptions_due', repo.subscriptions_due), \
          patch('bot.run.billing_db.precharge_guard_and_attempt', repo.precharge_guard_and_attempt), \
-         patch('bot.run.youmoney.charge_saved_method') as mock_charge:
+         patch('bot.run.youmoney.charge_saved_method_async', new_callable=AsyncMock) as mock_charge:
         
         # Simulate error
         mock_charge.side_effect = ValueError("Invalid payment method")
@@ -168,7 +168,7 @@ async def test_billing_loop_skips_duplicates(in_memory_db, mock_bot):
     
     with patch('bot.run.billing_db._repo', repo), \
          patch('bot.run.billing_db.subscriptions_due', repo.subscriptions_due), \
-         patch('bot.run.youmoney.charge_saved_method') as mock_charge:
+         patch('bot.run.youmoney.charge_saved_method_async', new_callable=AsyncMock) as mock_charge:
         
         # Call billing_loop
         from bot.run import billing_loop
@@ -186,7 +186,7 @@ async def test_billing_loop_skips_duplicates(in_memory_db, mock_bot):
             except asyncio.CancelledError:
                 pass
         
-        # Check that charge_saved_method was NOT called (duplicate skipped)
+        # Check that charge_saved_method_async was NOT called (duplicate skipped)
         mock_charge.assert_not_called()
         
         # Check that no new attempt was created
@@ -226,7 +226,7 @@ async def test_billing_loop_respects_guard_rules(in_memory_db, mock_bot):
     
     with patch('bot.run.billing_db._repo', repo), \
          patch('bot.run.billing_db.subscriptions_due', repo.subscriptions_due), \
-         patch('bot.run.youmoney.charge_saved_method') as mock_charge:
+         patch('bot.run.youmoney.charge_saved_method_async', new_callable=AsyncMock) as mock_charge:
         
         # Call billing_loop
         from bot.run import billing_loop
@@ -244,7 +244,7 @@ async def test_billing_loop_respects_guard_rules(in_memory_db, mock_bot):
             except asyncio.CancelledError:
                 pass
         
-        # Check that charge_saved_method was NOT called (blocked by guard)
+        # Check that charge_saved_method_async was NOT called (blocked by guard)
         mock_charge.assert_not_called()
         
         # Check that no attempt was created
@@ -277,7 +277,7 @@ async def test_billing_loop_skips_no_payment_method(in_memory_db, mock_bot):
     
     with patch('bot.run.billing_db._repo', repo), \
          patch('bot.run.billing_db.subscriptions_due', repo.subscriptions_due), \
-         patch('bot.run.youmoney.charge_saved_method') as mock_charge:
+         patch('bot.run.youmoney.charge_saved_method_async', new_callable=AsyncMock) as mock_charge:
         
         # Call billing_loop
         from bot.run import billing_loop
@@ -295,7 +295,7 @@ async def test_billing_loop_skips_no_payment_method(in_memory_db, mock_bot):
             except asyncio.CancelledError:
                 pass
         
-        # Check that charge_saved_method was NOT called
+        # Check that charge_saved_method_async was NOT called
         mock_charge.assert_not_called()
 
 
@@ -335,7 +335,7 @@ async def test_billing_loop_handles_multiple_subscriptions(in_memory_db, mock_bo
          patch('bot.run.billing_db.subscriptions_due', repo.subscriptions_due), \
          patch('bot.run.billing_db.precharge_guard_and_attempt', repo.precharge_guard_and_attempt), \
          patch('bot.run.billing_db.link_payment_to_attempt', repo.link_payment_to_attempt), \
-         patch('bot.run.youmoney.charge_saved_method') as mock_charge, \
+         patch('bot.run.youmoney.charge_saved_method_async', new_callable=AsyncMock) as mock_charge, \
          patch('bot.run.shutdown_event', shutdown_event):
         
         mock_charge.side_effect = ["payment_123", "payment_456"]
@@ -0,0 +1,96 @@
+"""
+Планировщик биллинга (bot/utils/billing_scheduler.py): billing_loop спит до ближайшего
+срока, просыпается по событиям подписок и не ходит в БД в простое.
+"""
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from sqlalchemy import event as sa_event
+
+import bot.utils.billing_db as billing_db
+from bot.utils.billing_db import ChargeAttempt
+from bot.utils.billing_scheduler import BillingScheduler, billing_scheduler
+from bot.utils.time_helpers import now_msk
+
+
+async def test_heap_and_sweep_bookkeeping():
+    sch = BillingScheduler(sweep_sec=60)
+    sch.start()
+    t = time.time()
+    assert sch.sweep_due(t)                      # первая сверка — сразу
+
+    now = now_msk()
+    sch.reload([(1, now + timedelta(seconds=30)), (2, now - timedelta(seconds=1)), (3, now + timedelta(seconds=5))], now=t)
+    assert not sch.sweep_due(t)
+    assert sch.pop_due(t) == [2]
+    assert sch.next_wakeup() == pytest.approx((now + timedelta(seconds=5)).timestamp())
+
+    sch.notify_nowait(4, now + timedelta(seconds=1))
+    assert sch.pop_due(t + 6) == [4, 3]
+    sch.notify_nowait(None)                      # срок неизвестен — внеочередная сверка
+    assert sch.sweep_due(t)
+    sch.stop()
+
+
+async def test_notify_from_db_thread_wakes_waiter():
+    sch = BillingScheduler(sweep_sec=3600)
+    sch.start()
+    sch.reload([])
+    shutdown = asyncio.Event()
+
+    waiter = asyncio.create_task(sch.wait(shutdown))
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    # как из run_db: вызов из другого потока
+    threading.Thread(target=sch.notify_nowait, args=(7, now_msk())).start()
+    await asyncio.wait_for(waiter, timeout=1.0)
+    assert sch.pop_due() == [7]
+    sch.stop()
+
+
+async def test_billing_loop_fires_on_time_and_idles_without_queries(in_memory_db, monkeypatch):
+    from bot.run import billing_loop
+
+    repo, SessionLocal = in_memory_db
+    monkeypatch.setattr(billing_scheduler, "sweep_sec", 3600)
+    engine = SessionLocal.kw["bind"]
+    queries = []
+    sa_event.listen(engine, "before_cursor_execute", lambda *a: queries.append(time.time()))
+
+    fired_at = []
+
+    async def charge(**kw):
+        fired_at.append(time.time())
+        return f"pay_{kw['attempt_id']}"
+
+    shutdown = asyncio.Event()
+    with patch('bot.run.billing_db._repo', repo), \
+         patch('bot.run.youmoney.charge_saved_method_async', new=AsyncMock(side_effect=charge)):
+        task = asyncio.create_task(billing_loop(shutdown))
+        await asyncio.sleep(0.2)                  # стартовая сверка
+
+        # простой: ни одного запроса к БД
+        idle_from = time.time()
+        await asyncio.sleep(1.0)
+        assert [q for q in queries if q >= idle_from] == []
+
+        # новая подписка со сроком через 1.5с: цикл спит ровно до срока
+        due_at = now_msk() + timedelta(seconds=1.5)
+        sub_id = billing_db.subscription_upsert(
+            user_id=1, plan_code="1m", interval_months=1, amount_value="2490.00",
+            amount_currency="RUB", payment_method_id="pm_token_12345678",
+            next_charge_at=due_at, status="active",
+        )
+        await asyncio.sleep(2.5)
+        shutdown.set()
+        await asyncio.wait_for(task, timeout=2.0)
+
+    assert len(fired_at) == 1
+    assert 0 <= fired_at[0] - due_at.timestamp() < 1.0
+    with SessionLocal() as s:
+        attempt = s.query(ChargeAttempt).filter(ChargeAttempt.subscription_id == sub_id).one()
+        assert attempt.payment_id == f"pay_{attempt.id}"
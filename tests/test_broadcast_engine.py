@@ -0,0 +1,146 @@
+"""
+Индивидуальная рассылка с докачкой (bot/utils/broadcast_engine.py): журнал доставки
+пачками в mailing_events, курсор задания, продолжение после остановки и темп
+против заглушки Bot API с сетевой задержкой.
+"""
+import asyncio
+import os
+import time
+from collections import Counter
+from datetime import datetime
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import bot.utils.admin_db as adb
+from bot.utils.admin_db import AdminRepository, Base, MailingEvent
+from bot.utils.broadcast_engine import BroadcastEngine
+from bot.utils.mailing import send_to_user
+
+MAILING = {"id": 7, "content_type": "text", "caption": None, "payload": {"text": "hi"}}
+
+
+class StubTelegram(BaseSession):
+    """Bot API с задержкой ответа; chat_id из fail_for отвечают ошибкой (бот заблокирован)."""
+
+    def __init__(self, latency=0.02, fail_for=()):
+        super().__init__()
+        self.latency = latency
+        self.fail_for = set(fail_for)
+        self.delivered = Counter()
+
+    async def make_request(self, bot, method, timeout=None):
+        await asyncio.sleep(self.latency)
+        if method.chat_id in self.fail_for:
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+        self.delivered[method.chat_id] += 1
+        return Message(message_id=1, date=datetime.now(),
+                       chat=Chat(id=method.chat_id, type="private"), text=method.text)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+@pytest.fixture
+def admin_repo(monkeypatch):
+    engine = create_engine("sqlite://", future=True, poolclass=StaticPool,
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    repo = AdminRepository(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
+    monkeypatch.setattr(adb, "_repo", repo)
+    yield repo
+    engine.dispose()
+
+
+def _events(repo, mailing_id):
+    with repo._s() as s:
+        rows = s.execute(select(MailingEvent.user_id, MailingEvent.success)
+                         .where(MailingEvent.mailing_post_id == mailing_id)).all()
+    return Counter(uid for uid, _ in rows), {uid: ok for uid, ok in rows}
+
+
+async def test_results_are_logged_in_bulk_with_failures(admin_repo):
+    api = StubTelegram(latency=0.001, fail_for={1005, 1010})
+    bot = Bot(token="42:TEST", session=api)
+    engine = BroadcastEngine(concurrency=8, flush_every=50, flush_sec=10)
+    flushes = []
+    orig = admin_repo.mailing_job_flush
+    admin_repo.mailing_job_flush = lambda *a: (flushes.append(len(a[2])), orig(*a))[1]
+
+    ids = list(range(1000, 1300))
+    summary = await engine.run(bot, MAILING, ids + ids[:10], send_to_user)   # дубли получателей не шлются дважды
+
+    counts, status = _events(admin_repo, 7)
+    assert set(counts) == set(ids) and max(counts.values()) == 1
+    assert status[1005] == 0 and status[1010] == 0 and status[1006] == 1
+    assert sum(flushes) == 300 and len(flushes) <= 300 // 50 + 1             # пачками, не по строке
+    job = adb.get_mailing_job(7)
+    assert (job["status"], job["sent"], job["failed"], job["last_user_id"]) == ("done", 298, 2, 1299)
+    assert summary["sent"] == 298 and engine.progress(7) is None
+
+    # повторный запуск завершённого задания ничего не шлёт
+    await engine.run(bot, MAILING, ids, send_to_user)
+    assert sum(api.delivered.values()) == 298
+
+
+async def test_restart_resumes_from_cursor_without_duplicates(admin_repo):
+    api = StubTelegram(latency=0.005)
+    bot = Bot(token="42:TEST", session=api)
+    ids = list(range(1, 2001))
+
+    first = BroadcastEngine(concurrency=10, flush_every=100, flush_sec=0.05)
+    task = asyncio.create_task(first.run(bot, MAILING, ids, send_to_user))
+    while sum(api.delivered.values()) < 700:
+        await asyncio.sleep(0.01)
+    assert first.progress(7)["done"] >= 700 and first.progress(7)["rate"] > 0
+    task.cancel()                                                           # «рестарт» посреди рассылки
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    job = adb.get_mailing_job(7)
+    assert job["status"] == "running" and 0 < job["last_user_id"] < 2000
+    logged, _ = _events(admin_repo, 7)
+    # всё, что доставлено к остановке, записано финальной пачкой
+    assert set(logged) == set(api.delivered)
+
+    second = BroadcastEngine(concurrency=10, flush_every=100, flush_sec=0.05)
+    await second.run(bot, MAILING, ids, send_to_user)
+
+    counts, _ = _events(admin_repo, 7)
+    assert set(counts) == set(ids) and max(counts.values()) == 1
+    assert set(api.delivered) == set(ids) and max(api.delivered.values()) == 1
+    job = adb.get_mailing_job(7)
+    assert (job["status"], job["sent"], job["failed"]) == ("done", 2000, 0)
+
+
+def _bench_size():
+    # 100k получателей ~ 3.5 мин; полный прогон — BROADCAST_BENCH_FULL=1
+    return 100_000 if os.getenv("BROADCAST_BENCH_FULL") == "1" else 3_000
+
+
+async def test_throughput_against_stub_api(admin_repo):
+    n = _bench_size()
+    latency = 0.05                                   # 50 мс на запрос: последовательно — не больше 20/с
+    api = StubTelegram(latency=latency)
+    bot = Bot(token="42:TEST", session=api)
+    engine = BroadcastEngine(concurrency=25, flush_every=200, flush_sec=2)
+
+    t0 = time.perf_counter()
+    await engine.run(bot, {**MAILING, "id": 8}, range(1, n + 1), send_to_user)
+    elapsed = time.perf_counter() - t0
+    rate = n / elapsed
+    print(f"\nbroadcast: {n} recipients in {elapsed:.1f} s → {rate:.0f} msg/s "
+          f"(sequential at {latency * 1000:.0f} ms/request ≤ {1 / latency:.0f} msg/s)")
+
+    assert sum(api.delivered.values()) == n
+    with admin_repo._s() as s:
+        assert s.scalar(select(func.count()).select_from(MailingEvent)) == n
+    assert rate >= 25
@@ -0,0 +1,108 @@
+"""
+Tests for the write-behind event logger (clicklog middlewares → event_log).
+"""
+import asyncio
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from aiogram.types import CallbackQuery
+from sqlalchemy import func, select
+
+from bot.utils.database import User, EventLog
+from bot.utils.event_logger import EventLogWriter
+from bot.utils.time_helpers import now_msk
+
+
+def _count(SessionLocal, model) -> int:
+    with SessionLocal() as s:
+        return s.execute(select(func.count()).select_from(model)).scalar_one()
+
+
+@pytest.fixture
+def app_repo(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    with patch('bot.utils.event_logger.app_db') as mock_app_db:
+        mock_app_db.events_add_bulk = MagicMock(side_effect=repo.events_add_bulk)
+        yield repo, SessionLocal, mock_app_db
+
+
+def test_events_add_bulk_inserts_missing_users_once(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    repo.ensure_user(1, username="known")
+
+    ts = now_msk()
+    written = repo.events_add_bulk([(1, "CB:a", ts), (2, "CB:b", ts), (2, "TEXT:c", ts)])
+
+    assert written == 3
+    assert _count(SessionLocal, User) == 2
+    assert _count(SessionLocal, EventLog) == 3
+    with SessionLocal() as s:
+        # существующий пользователь не перезаписан
+        assert s.get(User, 1).username == "known"
+
+
+def test_event_add_keeps_single_event_interface(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    repo.event_add(42, "MSG:PHOTO")
+    repo.event_add(42, "MSG:VOICE")
+    assert _count(SessionLocal, User) == 1
+    assert _count(SessionLocal, EventLog) == 2
+
+
+@pytest.mark.asyncio
+async def test_writer_flushes_in_batches(app_repo):
+    repo, SessionLocal, mock_app_db = app_repo
+    writer = EventLogWriter(flush_interval_ms=20, batch_size=50, max_queue=1000)
+
+    for i in range(120):
+        assert writer.log(i % 7, f"CB:{i}")
+    await asyncio.sleep(0.2)
+    await writer.stop()
+
+    assert _count(SessionLocal, EventLog) == 120
+    assert writer.stats()["written"] == 120
+    # 120 событий → не больше ceil(120/50) пачек по ≤50 строк, а не 120 round-trip'ов
+    assert all(len(c.args[0]) <= 50 for c in mock_app_db.events_add_bulk.call_args_list)
+    assert mock_app_db.events_add_bulk.call_count <= 3
+
+
+@pytest.mark.asyncio
+async def test_writer_drops_when_queue_full(app_repo):
+    writer = EventLogWriter(flush_interval_ms=1000, batch_size=100, max_queue=5)
+
+    # без await фоновая задача не успевает разобрать очередь
+    accepted = [writer.log(1, f"CB:{i}") for i in range(8)]
+
+    assert accepted.count(True) == 5
+    assert writer.stats()["dropped"] == 3
+    await writer.stop()
+
+
+@pytest.mark.asyncio
+async def test_flush_sync_writes_pending_events(app_repo):
+    repo, SessionLocal, _ = app_repo
+    writer = EventLogWriter(flush_interval_ms=10_000, batch_size=100, max_queue=100)
+    for i in range(10):
+        writer.log(5, f"TEXT:{i}")
+
+    # обработчик сигнала: без await, синхронно
+    assert writer.flush_sync() == 10
+    assert _count(SessionLocal, EventLog) == 10
+    await writer.stop()
+    assert _count(SessionLocal, EventLog) == 10
+
+
+@pytest.mark.asyncio
+async def test_middleware_enqueues_instead_of_writing(mock_user):
+    from bot.handlers.clicklog_mw import CallbackClickLogger
+
+    cb = MagicMock(spec=CallbackQuery)
+    cb.from_user = mock_user
+    cb.data = "menu:open"
+    handler = AsyncMock(return_value="handled")
+
+    with patch('bot.handlers.clicklog_mw.event_logger') as mock_logger:
+        assert await CallbackClickLogger()(handler, cb, {}) == "handled"
+
+    mock_logger.log.assert_called_once_with(mock_user.id, "CB:menu:open")
@@ -0,0 +1,153 @@
+"""
+Тесты общего HTTP-клиента бота к executor'у: пул соединений, ретраи, таймауты,
+счётчики по эндпоинтам и однократное определение пути plan/generate.
+"""
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from bot.utils.executor_client import ExecutorClient, ExecutorHTTPError
+
+
+class StubExecutor:
+    """Локальный executor: считает запросы и TCP-соединения, отвечает по сценарию."""
+
+    def __init__(self, *, plan_prefixed: bool = True):
+        self.plan_prefixed = plan_prefixed
+        self.connections = set()
+        self.hits = {}
+        self.script = []  # очередь статусов для /objection/generate
+        self.delay = 0.0
+        self._runner = None
+        self.base_url = ""
+
+    def _count(self, request: web.Request) -> None:
+        self.hits[request.path] = self.hits.get(request.path, 0) + 1
+        self.connections.add(request.transport.get_extra_info("peername"))
+
+    async def _objection(self, request: web.Request) -> web.Response:
+        self._count(request)
+        body = await request.json()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        status = self.script.pop(0) if self.script else 200
+        if status != 200:
+            return web.json_response({"error": "busy"}, status=status, headers={"Retry-After": "0"})
+        return web.json_response({"text": f"ответ: {body['question']}"})
+
+    async def _plan(self, request: web.Request) -> web.Response:
+        self._count(request)
+        form = await request.post()
+        return web.json_response({"url": f"https://cdn/{form['image'].filename}"})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/api/v1/objection/generate", self._objection)
+        plan_path = "/api/v1/plan/generate" if self.plan_prefixed else "/plan/generate"
+        app.router.add_post(plan_path, self._plan)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+@pytest.fixture
+async def stub():
+    s = StubExecutor()
+    await s.start()
+    try:
+        yield s
+    finally:
+        await s.stop()
+
+
+@pytest.fixture
+async def client(stub):
+    c = ExecutorClient(stub.base_url)
+    await c.start()
+    try:
+        yield c
+    finally:
+        await c.close()
+
+
+async def test_sequential_calls_reuse_one_connection(stub, client):
+    for i in range(20):
+        data = await client.post_json("objection/generate", {"question": f"дорого {i}"})
+        assert data["text"] == f"ответ: дорого {i}"
+
+    assert stub.hits["/api/v1/objection/generate"] == 20
+    # keep-alive: все запросы прошли по одному TCP-соединению
+    assert len(stub.connections) == 1
+
+    st = client.stats()["objection/generate"]
+    assert st["requests"] == 20
+    assert st["errors"] == 0
+    assert st["last_status"] == 200
+
+
+async def test_retries_on_overload_then_succeeds(stub, client):
+    stub.script = [503]
+    data = await client.post_json("objection/generate", {"question": "подумаю"})
+
+    assert data["text"] == "ответ: подумаю"
+    st = client.stats()["objection/generate"]
+    assert st["requests"] == 2
+    assert st["retries"] == 1
+    assert st["errors"] == 1
+
+
+async def test_error_status_raises_after_retries(stub, client):
+    stub.script = [429, 429, 429]
+    with pytest.raises(ExecutorHTTPError) as ei:
+        await client.post_json("objection/generate", {"question": "дорого"})
+
+    assert ei.value.status == 429
+    assert ei.value.detail == "busy"
+    # политика objection: 1 повтор
+    assert stub.hits["/api/v1/objection/generate"] == 2
+
+
+async def test_timeout_is_counted_and_not_retried(stub, client):
+    stub.delay = 0.5
+    with pytest.raises(asyncio.TimeoutError):
+        await client.post_json("objection/generate", {"question": "дорого"}, timeout=0.1)
+
+    st = client.stats()["objection/generate"]
+    assert st["timeouts"] == 1
+    assert st["retries"] == 0
+
+
+async def test_plan_url_resolved_once_at_start(stub, client):
+    url = await client.plan_url()
+    assert url == f"{stub.base_url}/api/v1/plan/generate"
+
+    def build():
+        form = aiohttp.FormData()
+        form.add_field("image", b"png", filename="plan.png", content_type="image/png")
+        return form
+
+    for _ in range(3):
+        data = await client.post_form("plan/generate", build, url=await client.plan_url())
+        assert data["url"] == "https://cdn/plan.png"
+    # пробы только при старте, дальше — сразу рабочий путь
+    assert stub.hits["/api/v1/plan/generate"] == 3
+
+
+async def test_plan_url_falls_back_to_legacy_path():
+    s = StubExecutor(plan_prefixed=False)
+    await s.start()
+    c = ExecutorClient(s.base_url)
+    try:
+        await c.start()
+        assert await c.plan_url() == f"{s.base_url}/plan/generate"
+    finally:
+        await c.close()
+        await s.stop()
@@ -0,0 +1,223 @@
+"""
+Load tests for the async executor (ASGI): concurrency caps, 429 + Retry-After, graceful drain.
+
+LLM подменён локальным stub-сервером (aiohttp), который отвечает в формате
+Chat Completions с заданной задержкой (или потоком чанков при stream=true);
+экзекьютор ходит в него настоящим AsyncOpenAI.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+os.environ.setdefault("EXECUTOR_PORT", "5055")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import httpx
+import pytest
+from aiohttp import web
+from openai import AsyncOpenAI
+
+from executor import hedging, limits
+from executor.hedging import HedgePolicy
+from executor.llm_gateway import gateway
+from executor.response_cache import objection_cache
+from executor.app import create_app
+
+
+STUB_LATENCY_SEC = (0.1, 0.2)
+OBJECTION_CONCURRENCY = 64
+
+
+class StubLLM:
+    """Локальный «OpenAI»: /v1/chat/completions с инъекцией задержки и счётчиком конкурентности."""
+
+    def __init__(self, latency=STUB_LATENCY_SEC):
+        self.latency = latency
+        self.inflight = 0
+        self.max_inflight = 0
+        self.calls = 0
+        self.callbacks = []
+        # потоковый режим (stream=true)
+        self.stream_tokens = ["Понимаю ", "вас. ", "Давайте ", "сравним ", "условия."]
+        self.token_delay = 0.05
+        self._runner = None
+        self.base_url = ""
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if body.get("stream"):
+            return await self._completions_stream(request, body)
+        self.calls += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(random.uniform(*self.latency))
+        finally:
+            self.inflight -= 1
+        return web.json_response({
+            "id": f"chatcmpl-{self.calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "Понимаю вас. Давайте сравним условия."},
+            }],
+        })
+
+    async def _completions_stream(self, request: web.Request, body: dict) -> web.StreamResponse:
+        """stream=true: ответ токенами (SSE chat.completion.chunk) с задержкой token_delay."""
+        self.calls += 1
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+
+        async def _chunk(delta: dict, finish_reason=None) -> None:
+            data = {
+                "id": f"chatcmpl-{self.calls}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            await resp.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        await _chunk({"role": "assistant", "content": ""})
+        for token in self.stream_tokens:
+            await asyncio.sleep(self.token_delay)
+            await _chunk({"content": token})
+        await _chunk({}, finish_reason="stop")
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def _callback(self, request: web.Request) -> web.Response:
+        self.callbacks.append(await request.json())
+        return web.json_response({"ok": True})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._completions)
+        app.router.add_post("/callback", self._callback)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+@pytest.fixture
+async def stub_llm(monkeypatch):
+    stub = StubLLM()
+    await stub.start()
+    client = AsyncOpenAI(api_key="sk-test", base_url=f"{stub.base_url}/v1", max_retries=0)
+    gateway.set_client(client)
+    # нагрузочные тесты меряют путь до LLM, а не кеш ответов
+    monkeypatch.setattr(objection_cache, "enabled", False)
+    limits.reset()
+    try:
+        yield stub
+    finally:
+        await gateway.aclose()
+        limits.reset()
+        await client.close()
+        await stub.stop()
+
+
+@pytest.fixture
+async def executor_client():
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://executor", timeout=60) as client:
+        yield client
+
+
+async def _run_load(client: httpx.AsyncClient, concurrency: int):
+    latencies = []
+
+    async def one(i: int):
+        t0 = time.perf_counter()
+        r = await client.post("/api/v1/objection/generate", json={"question": f"дорого #{i}"})
+        latencies.append(time.perf_counter() - t0)
+        return r.status_code
+
+    t0 = time.perf_counter()
+    codes = await asyncio.gather(*(one(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return codes, concurrency / elapsed, p99
+
+
+@pytest.mark.parametrize("concurrency", [50, 200, 500])
+async def test_objection_throughput_and_p99(stub_llm, executor_client, concurrency, monkeypatch):
+    """
+    Бенчмарк: N одновременных запросов к /objection/generate при задержке LLM 100–200 мс.
+    Базовая линия — тот же стек с лимитом 1 (как однопоточный dev-сервер): ~1 / 150 мс.
+    Async-стек с лимитом 64 обслуживает запросы волнами, не превышая лимит вызовов LLM.
+    Хеджирование выключено: хедж — осознанный лишний вызов LLM сверх лимита слотов.
+    """
+    monkeypatch.setattr(hedging, "policy", HedgePolicy(enabled=False))
+    limits.configure("objection", max_concurrency=1, max_queue=1000)
+    _, serial_rps, _ = await _run_load(executor_client, 8)
+
+    limits.configure("objection", max_concurrency=OBJECTION_CONCURRENCY, max_queue=1000)
+    stub_llm.max_inflight = 0
+    codes, rps, p99 = await _run_load(executor_client, concurrency)
+    print(f"\nconcurrency={concurrency}: throughput={rps:.0f} rps (serial {serial_rps:.1f} rps), "
+          f"p99={p99 * 1000:.0f} ms, llm_max_inflight={stub_llm.max_inflight}")
+
+    assert codes.count(200) == concurrency
+    assert stub_llm.max_inflight <= OBJECTION_CONCURRENCY
+    assert stub_llm.max_inflight >= min(concurrency, OBJECTION_CONCURRENCY) // 2
+    assert rps > serial_rps * 3
+    # последний запрос в однопоточном сервере ждал бы N * latency
+    assert p99 < 0.5 * concurrency / serial_rps
+
+
+async def test_queue_overflow_returns_429_with_retry_after(stub_llm, executor_client):
+    stub_llm.latency = (0.2, 0.2)
+    limits.configure("objection", max_concurrency=2, max_queue=3, retry_after=7)
+
+    responses = await asyncio.gather(*(
+        executor_client.post("/api/v1/objection/generate", json={"question": "подумаю"})
+        for _ in range(10)
+    ))
+    codes = [r.status_code for r in responses]
+
+    assert codes.count(200) == 5
+    assert codes.count(429) == 5
+    rejected = next(r for r in responses if r.status_code == 429)
+    assert rejected.headers["Retry-After"] == "7"
+    assert stub_llm.max_inflight <= 2
+
+
+async def test_description_callbacks_are_bounded_and_drained(stub_llm, executor_client):
+    limits.configure("description", max_concurrency=3, max_queue=20)
+    payload = {
+        "fields": {"type": "flat", "deal_type": "sale"},
+        "callback_url": f"{stub_llm.base_url}/callback",
+        "chat_id": 1,
+    }
+
+    responses = await asyncio.gather(*(
+        executor_client.post("/api/v1/description/generate", json={**payload, "msg_id": i})
+        for i in range(1, 11)
+    ))
+    assert [r.status_code for r in responses] == [202] * 10
+
+    assert await limits.drain(timeout=10)
+    assert sorted(cb["msg_id"] for cb in stub_llm.callbacks) == list(range(1, 11))
+    assert all(cb["text"] and not cb["error"] for cb in stub_llm.callbacks)
+    # фоновая генерация ограничена лимитом эндпоинта, а не числом запросов
+    assert stub_llm.max_inflight <= 3
+
+    # после drain новые запросы отклоняются
+    r = await executor_client.post("/api/v1/objection/generate", json={"question": "дорого"})
+    assert r.status_code == 503
+    assert "Retry-After" in r.headers
@@ -0,0 +1,162 @@
+"""
+Hedged requests по цепочке моделей (executor/hedging.py).
+
+Фейковый AsyncOpenAI-клиент с заданными распределениями латентности по моделям:
+у первичной модели тяжёлый хвост (10% ответов — 2 с), у запасной — стабильно быстро.
+Сравниваем p99 последовательной цепочки и цепочки с хеджированием.
+"""
+import asyncio
+import os
+import random
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("EXECUTOR_PORT", "5055")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import pytest
+
+from executor import hedging, llm_gateway, openai_service
+from executor.hedging import HedgePolicy, hedged_call
+from executor.llm_gateway import gateway
+
+
+def _fast_or_stalled(rnd: random.Random) -> float:
+    return 2.0 if rnd.random() < 0.10 else rnd.uniform(0.02, 0.04)
+
+
+class FakeCompletions:
+    def __init__(self, latency, errors=()):
+        self.latency = latency          # model → callable() -> секунды
+        self.errors = set(errors)       # модели, которые отвечают ошибкой
+        self.started = []
+        self.cancelled = []
+
+    async def create(self, **req):
+        model = req["model"]
+        self.started.append(model)
+        try:
+            await asyncio.sleep(self.latency[model]())
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        if model in self.errors:
+            raise RuntimeError(f"{model} is down")
+        msg = SimpleNamespace(content=f"ответ от {model}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=msg)])
+
+
+class FakeClient:
+    def __init__(self, completions):
+        self.chat = SimpleNamespace(completions=completions)
+
+
+@pytest.fixture
+async def fake_openai(monkeypatch):
+    rnd = random.Random(7)
+    completions = FakeCompletions({
+        "gpt-5": lambda: _fast_or_stalled(rnd),
+        "gpt-4o": lambda: rnd.uniform(0.03, 0.05),
+        "gpt-4o-mini": lambda: rnd.uniform(0.03, 0.05),
+    })
+    gateway.set_client(FakeClient(completions))
+    monkeypatch.setattr(llm_gateway, "FALLBACK_MODELS", ["gpt-4o", "gpt-4o-mini"])
+    monkeypatch.setattr(hedging, "policy", hedging.policy)
+    hedging.tracker.reset()
+    yield completions
+    hedging.tracker.reset()
+    await gateway.aclose()
+
+
+async def _latencies(n: int):
+    out = []
+    for _ in range(n):
+        t0 = time.monotonic()
+        text, _ = await openai_service._send_with_fallback(
+            {"model": "gpt-5", "messages": []}, default_model="gpt-5", allow_fallback=True,
+        )
+        assert text
+        out.append(time.monotonic() - t0)
+    return out
+
+
+def _p(data, q):
+    data = sorted(data)
+    return data[min(len(data) - 1, int(q * len(data)))]
+
+
+async def test_hedging_cuts_tail_latency(fake_openai):
+    hedging.policy = HedgePolicy(enabled=False)
+    plain = await _latencies(60)
+
+    hedging.tracker.reset()
+    hedging.policy = HedgePolicy(enabled=True, default_delay=0.1, min_delay=0.05, max_delay=1.0, min_samples=10)
+    hedged = await _latencies(60)
+
+    print(f"\nplain p50={_p(plain, .5) * 1000:.0f} ms p99={_p(plain, .99) * 1000:.0f} ms; "
+          f"hedged p50={_p(hedged, .5) * 1000:.0f} ms p99={_p(hedged, .99) * 1000:.0f} ms; "
+          f"{hedging.stats()}")
+    assert _p(plain, 0.99) >= 1.9
+    assert _p(hedged, 0.99) < 0.5
+    # медиана не страдает: хедж запускается только на хвосте
+    assert _p(hedged, 0.5) < 0.1
+
+    st = hedging.stats()
+    assert st["hedges"] > 0 and st["hedge_wins"] > 0
+    # хеджируется только хвост, а не каждый запрос (дополнительная нагрузка ограничена)
+    assert st["hedges"] < 60 * 0.3
+    # каждый проигравший запрос отменён, висящих нет
+    assert len(fake_openai.cancelled) == st["hedges"]
+
+
+async def test_hedge_budget_caps_extra_calls(fake_openai):
+    # деградация: первичная модель медленная всегда — хеджей не больше бюджета
+    fake_openai.latency["gpt-5"] = lambda: 0.15
+    hedging.policy = HedgePolicy(enabled=True, default_delay=0.02, min_delay=0.01, budget=0.1, burst=2)
+    await _latencies(20)
+
+    st = hedging.stats()
+    assert st["hedges"] <= 2 + 20 * 0.1
+    assert st["hedge_denied"] > 0
+
+
+async def test_adaptive_delay_tracks_primary_p95(fake_openai):
+    hedging.policy = HedgePolicy(enabled=True, default_delay=0.5, min_delay=0.01, max_delay=1.0, min_samples=10)
+    for _ in range(30):
+        hedging.tracker.record("gpt-5", 0.03)
+    assert hedging.tracker.hedge_delay("gpt-5") == pytest.approx(0.03)
+    # до накопления статистики — задержка по умолчанию
+    assert hedging.tracker.hedge_delay("gpt-4o") == 0.5
+    # и не ниже минимальной
+    hedging.policy = HedgePolicy(enabled=True, min_delay=0.2, min_samples=10)
+    assert hedging.tracker.hedge_delay("gpt-5") == 0.2
+
+
+async def test_failure_falls_through_without_waiting(fake_openai):
+    fake_openai.errors.add("gpt-5")
+    fake_openai.latency["gpt-5"] = lambda: 0.01
+    hedging.policy = HedgePolicy(enabled=True, default_delay=5.0)
+
+    t0 = time.monotonic()
+    text, model = await openai_service._send_with_fallback(
+        {"model": "gpt-5", "messages": []}, default_model="gpt-5", allow_fallback=True,
+    )
+    assert model == "gpt-4o" and "gpt-4o" in text
+    assert time.monotonic() - t0 < 1.0
+    assert hedging.stats()["hedges"] == 0
+
+
+async def test_all_failed_raises_last_error():
+    async def call(model):
+        raise RuntimeError(f"{model} down")
+
+    with pytest.raises(RuntimeError, match="b down"):
+        await hedged_call(["a", "b"], call)
+
+
+async def test_empty_results_raise_empty_error():
+    async def call(model):
+        return []
+
+    with pytest.raises(RuntimeError, match="Empty completion list"):
+        await hedged_call(["a"], call, empty_error="Empty completion list")
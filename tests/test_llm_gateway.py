@@ -0,0 +1,142 @@
+"""
+Единый шлюз к OpenAI (executor/llm_gateway.py): LRU клиентов по ключам с общим пулом,
+circuit breaker по моделям, метрики.
+"""
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("EXECUTOR_PORT", "5055")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import httpx
+import openai
+import pytest
+
+from executor import hedging, llm_gateway
+from executor.hedging import HedgePolicy
+from executor.llm_gateway import CircuitBreaker, LLMGateway, ModelsUnavailable
+
+
+class FakeCompletions:
+    def __init__(self, failing=(), error=None):
+        self.failing = set(failing)
+        self.error = error or RuntimeError("upstream 503")
+        self.calls = []
+
+    async def create(self, **req):
+        self.calls.append(req["model"])
+        if req["model"] in self.failing:
+            raise self.error
+        msg = SimpleNamespace(content=f"ответ {req['model']}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=msg)])
+
+
+@pytest.fixture
+async def gw(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "FALLBACK_MODELS", ["gpt-5", "gpt-4o"])
+    monkeypatch.setattr(hedging, "policy", HedgePolicy(enabled=False))
+    g = LLMGateway(cache_size=2)
+    try:
+        yield g
+    finally:
+        await g.aclose()
+
+
+async def test_clients_are_cached_per_key_and_share_one_pool(gw):
+    a = gw.client("key-a")
+    assert gw.client("key-a") is a
+    b = gw.client("key-b")
+    assert b is not a
+    # все клиенты ходят через один httpx-пул
+    assert a._client is b._client is gw._http
+
+    gw.client("key-a")           # key-a — самый свежий
+    gw.client("key-c")           # вытесняет key-b
+    assert set(gw._clients) == {"key-a", "key-c"}
+    assert not gw._http.is_closed
+
+
+async def test_missing_key_raises(gw, monkeypatch):
+    monkeypatch.setattr(llm_gateway, "default_api_key", lambda: "")
+    with pytest.raises(RuntimeError, match="OPENAI_API_KEY is missing"):
+        gw.client()
+
+
+async def test_breaker_drops_failing_model_from_chain(gw):
+    fake = FakeCompletions(failing={"gpt-5"})
+    gw.set_client(SimpleNamespace(chat=SimpleNamespace(completions=fake)))
+    gw._breakers["gpt-5"] = CircuitBreaker(failures=3, cooldown=60)
+
+    for _ in range(5):
+        text, model = await gw.complete({"model": "gpt-5", "messages": []}, default_model="gpt-5", allow_fallback=True)
+        assert model == "gpt-4o"
+
+    # после 3 ошибок подряд gpt-5 больше не вызывается
+    assert fake.calls.count("gpt-5") == 3
+    st = gw.stats()["models"]
+    assert st["gpt-5"]["breaker"] == "open"
+    assert st["gpt-5"]["skipped"] == 2
+    assert st["gpt-4o"]["calls"] == 5 and st["gpt-4o"]["errors"] == 0
+
+    # без fallback открытый breaker — быстрый отказ, без похода в сеть
+    with pytest.raises(ModelsUnavailable):
+        await gw.complete({"model": "gpt-5", "messages": []}, default_model="gpt-5", allow_fallback=False)
+
+
+async def test_breaker_half_open_probe():
+    br = CircuitBreaker(failures=2, cooldown=0.0)
+    br.failure(); br.failure()
+    assert br.state == "open"
+    # cooldown истёк — один пробный запрос, остальные ждут его результата
+    assert br.allow() and br.state == "half_open"
+    assert not br.allow() and not br.allow()
+    br.failure()
+    assert br.state == "open"
+    assert br.allow()
+    br.release()                                     # проба отменена — следующая может пойти
+    assert br.allow() and not br.allow()
+    br.success()
+    assert br.state == "closed" and br.failures == 0
+    assert br.allow() and br.allow()
+
+
+async def test_half_open_lets_one_probe_through_a_burst(gw):
+    import asyncio
+
+    class SlowProbe(FakeCompletions):
+        async def create(self, **req):
+            if req["model"] == "gpt-5":
+                await asyncio.sleep(0.05)
+            return await super().create(**req)
+
+    fake = SlowProbe(failing={"gpt-5"})
+    gw.set_client(SimpleNamespace(chat=SimpleNamespace(completions=fake)))
+    br = gw._breakers["gpt-5"] = CircuitBreaker(failures=1, cooldown=0.0)
+    br.failure()
+
+    req = {"model": "gpt-5", "messages": []}
+    results = await asyncio.gather(*(gw.complete(req, default_model="gpt-5", allow_fallback=True) for _ in range(20)))
+
+    # модель всё ещё падает: пробу получил один запрос, остальные сразу ушли на fallback
+    assert fake.calls.count("gpt-5") == 1
+    assert all(model == "gpt-4o" for _, model in results)
+    assert br.state == "open" and not br.probing
+
+    # fallback-модель в half_open, но запросу не понадобилась — проба возвращается
+    fake.failing.clear()
+    gw._breakers["gpt-4o"] = fb = CircuitBreaker(failures=1, cooldown=0.0)
+    fb.failure()
+    assert (await gw.complete(req, default_model="gpt-5", allow_fallback=True))[1] == "gpt-5"
+    assert fb.state == "half_open" and not fb.probing
+
+
+async def test_bad_request_does_not_open_breaker(gw):
+    resp = httpx.Response(400, request=httpx.Request("POST", "http://openai/v1/chat/completions"))
+    fake = FakeCompletions(failing={"gpt-5"}, error=openai.BadRequestError("bad", response=resp, body=None))
+    gw.set_client(SimpleNamespace(chat=SimpleNamespace(completions=fake)))
+
+    for _ in range(10):
+        with pytest.raises(openai.BadRequestError):
+            await gw.complete({"model": "gpt-5", "messages": []}, default_model="gpt-5", allow_fallback=False)
+    assert gw.breaker("gpt-5").state == "closed"
+    assert gw.stats()["models"]["gpt-5"]["errors"] == 10
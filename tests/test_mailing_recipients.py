@@ -0,0 +1,128 @@
+"""
+Потоковая выборка получателей рассылки (mailing.iter_recipients): keyset-страницы
+триалов и подписок из разных БД, слияние без повторов и подача прямо в broadcast_engine.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from aiogram import Bot
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import bot.utils.billing_db as billing_db
+import bot.utils.database as app_db
+import bot.utils.mailing as mailing
+from bot.utils.billing_db import BillingRepository, Subscription
+from bot.utils.database import Trial, User
+from tests.test_broadcast_engine import MAILING, StubTelegram, admin_repo  # noqa: F401
+
+NOW = datetime.now(timezone.utc)
+
+
+def _sqlite(base):
+    engine = create_engine("sqlite://", future=True, poolclass=StaticPool,
+                           connect_args={"check_same_thread": False})
+    base.metadata.create_all(engine)
+    return engine, sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+
+@pytest.fixture
+def cohorts(monkeypatch, in_memory_app_db):
+    app_repo, app_session = in_memory_app_db
+    engine, billing_session = _sqlite(billing_db.Base)
+    monkeypatch.setattr(app_db, "_repo", app_repo)
+    monkeypatch.setattr(billing_db, "_repo", BillingRepository(billing_session))
+
+    def fill(trial_ids, expired_trial_ids, paid_ids, canceled_ids):
+        naive = NOW.replace(tzinfo=None)
+        with app_session() as s, s.begin():
+            users = sorted(set(trial_ids) | set(expired_trial_ids))
+            if users:
+                s.execute(insert(User), [{"user_id": u} for u in users])
+                s.execute(insert(Trial), [
+                    {"user_id": u, "until_at": naive + timedelta(hours=1 if u in trial_ids else -1),
+                     "created_at": naive, "updated_at": naive}
+                    for u in users
+                ])
+        with billing_session() as s, s.begin():
+            rows = [(u, "active") for u in paid_ids] + [(u, "canceled") for u in canceled_ids]
+            # у части оплативших — две активные подписки: получатель всё равно один
+            rows += [(u, "active") for u in list(paid_ids)[::7]]
+            if rows:
+                s.execute(insert(Subscription), [
+                    {"user_id": u, "plan_code": "1m", "interval_months": 1, "amount_value": "2490.00",
+                     "status": st, "next_charge_at": naive + timedelta(days=3),
+                     "created_at": naive, "updated_at": naive}
+                    for u, st in rows
+                ])
+
+    yield fill
+    engine.dispose()
+
+
+async def _collect(it):
+    return [uid async for uid in it]
+
+
+async def test_stream_is_sorted_union_without_duplicates(cohorts):
+    trial = set(range(1, 3000, 2))
+    paid = set(range(1500, 6000, 3))
+    cohorts(trial, expired_trial_ids=range(6000, 6100), paid_ids=paid, canceled_ids=range(7000, 7050))
+
+    got = await _collect(mailing.iter_recipients(NOW, page_size=100))
+
+    assert got == sorted(trial | paid)
+    legacy = set(app_db.list_trial_active_user_ids(NOW)) | set(billing_db.list_active_subscription_user_ids(NOW))
+    assert set(got) == legacy
+    assert mailing.count_recipients(NOW) >= len(got)
+
+
+async def test_pages_are_fetched_lazily(cohorts, monkeypatch):
+    cohorts(range(1, 10_001), expired_trial_ids=[], paid_ids=range(5_000, 15_001), canceled_ids=[])
+    calls = []
+    for mod, name in ((app_db, "trial_active_user_ids_page"), (billing_db, "active_subscription_user_ids_page")):
+        orig = getattr(mod, name)
+        monkeypatch.setattr(mod, name, lambda *a, _o=orig, _n=name, **kw: (calls.append((_n, kw["after_user_id"])), _o(*a, **kw))[1])
+
+    it = mailing.iter_recipients(NOW, page_size=500)
+    assert await anext(it) == 1
+    assert len(calls) == 2                                   # по первой странице на когорту, не вся база
+
+    assert len(await _collect(it)) == 15_000 - 1
+    trial_afters = [after for name, after in calls if name == "trial_active_user_ids_page"]
+    assert trial_afters[:3] == [0, 500, 1000]                # keyset по последнему user_id страницы
+
+
+async def test_broadcast_streams_recipients_into_engine(cohorts, admin_repo, monkeypatch):
+    # 30k на триале, 20k с подпиской, 5k — в обеих когортах
+    cohorts(range(1, 30_001), expired_trial_ids=[], paid_ids=range(25_001, 45_001), canceled_ids=[])
+    expected = 45_000
+    monkeypatch.setattr(mailing, "MAILING_DB_TO_GROUP", False)
+
+    api = StubTelegram(latency=0)
+    first_send = []
+    orig_request = api.make_request
+
+    async def make_request(bot, method, timeout=None):
+        if not first_send:
+            first_send.append(time.perf_counter())
+        return await orig_request(bot, method, timeout)
+
+    api.make_request = make_request
+    bot = Bot(token="42:TEST", session=api)
+
+    t0 = time.perf_counter()
+    task = asyncio.create_task(mailing.broadcast(bot, MAILING, mailing.iter_recipients(NOW)))
+    while not first_send:
+        await asyncio.sleep(0.001)
+    live = mailing.broadcast_engine.progress(MAILING["id"])
+    assert first_send[0] - t0 < 1.0
+    assert live["total"] >= expected                         # оценка для ETA до конца выборки
+    await task
+
+    assert sum(api.delivered.values()) == expected and max(api.delivered.values()) == 1
+    job = mailing.adb.get_mailing_job(MAILING["id"])
+    assert (job["status"], job["total"], job["sent"]) == ("done", expected, expected)
@@ -0,0 +1,221 @@
+"""
+Mailings.publish_at как DATETIME (UTC) с индексами: миграция со строкового формата,
+выборка «пора слать» по индексу, кэш счётчиков календаря и замер на 100k рассылок.
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine, event, insert, inspect, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import bot.handlers.calendar_picker as calendar_picker
+import bot.utils.admin_db as adb
+import bot.utils.mailing as mailing
+from bot.utils.admin_db import AdminRepository, Mailing
+
+UTC = timezone.utc
+
+
+def _engine():
+    return create_engine("sqlite://", future=True, poolclass=StaticPool,
+                         connect_args={"check_same_thread": False})
+
+
+@pytest.fixture
+def repo(monkeypatch):
+    engine = _engine()
+    r = AdminRepository(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
+    r.init_schema(engine)
+    monkeypatch.setattr(adb, "_repo", r)
+    monkeypatch.setattr(adb, "_session", r._sf)
+    yield r, engine
+    engine.dispose()
+
+
+def _count_selects(engine):
+    seen = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cur, stmt, *a: seen.append(stmt) if stmt.lstrip().upper().startswith("SELECT") else None)
+    return seen
+
+
+def test_string_publish_at_is_migrated_to_utc_datetime():
+    engine = _engine()
+    with engine.begin() as c:
+        c.execute(text(
+            "CREATE TABLE Mailings (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at VARCHAR(19), "
+            "publish_at VARCHAR(16), mailing_on INTEGER, mailing_completed INTEGER, "
+            "content_type VARCHAR(32), caption TEXT, payload TEXT)"
+        ))
+        c.execute(text(
+            "INSERT INTO Mailings (created_at, publish_at, mailing_on, mailing_completed, content_type, payload) VALUES "
+            "('2026-01-01 10:00:00', '2026-03-01 09:30', 1, 0, 'text', '{\"text\": \"a\"}'),"
+            "('2026-01-01 10:00:00', '2026-03-01 00:15', 0, 1, 'text', '{}'),"
+            "('2026-02-02 12:00:00', 'garbage', 1, 0, 'text', '{}')"
+        ))
+    r = AdminRepository(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
+    r.init_schema(engine)
+
+    assert "DATETIME" in str({c["name"]: c["type"] for c in inspect(engine).get_columns("Mailings")}["publish_at"])
+    assert {"idx_mailings_due", "idx_mailings_publish_at"} <= {ix["name"] for ix in inspect(engine).get_indexes("Mailings")}
+    with engine.connect() as c:
+        raw = dict(c.execute(text("SELECT id, publish_at FROM Mailings")).all())
+    assert raw[1].startswith("2026-03-01 06:30")                      # МСК 09:30 → UTC 06:30
+    assert raw[2].startswith("2026-02-28 21:15")                      # через полночь UTC
+    # наружу — по-прежнему МСК строкой; битая дата заменена временем создания
+    assert r.get_mailing_by_id(1)["publish_at"] == "2026-03-01 09:30"
+    assert r.get_mailing_by_id(2)["publish_at"] == "2026-03-01 00:15"
+    assert r.get_mailing_by_id(3)["publish_at"] == "2026-02-02 12:00"
+    assert r.get_mailing_counts_map("2026-03-01", "2026-03-31", only_pending=False) == {"2026-03-01": 2}
+
+    r.init_schema(engine)                                             # повторный запуск — без изменений
+    assert r.get_mailing_by_id(1)["publish_at"] == "2026-03-01 09:30"
+    engine.dispose()
+
+
+def test_interrupted_migration_resumes():
+    engine = _engine()
+    with engine.begin() as c:
+        c.execute(text(
+            "CREATE TABLE Mailings (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at VARCHAR(19), "
+            "publish_at VARCHAR(16), mailing_on INTEGER, mailing_completed INTEGER, "
+            "content_type VARCHAR(32), caption TEXT, payload TEXT)"
+        ))
+        c.execute(text(
+            "INSERT INTO Mailings (created_at, publish_at, mailing_on, mailing_completed, content_type, payload) VALUES "
+            "('2026-01-01 10:00:00', '2026-03-01 09:30', 1, 0, 'text', '{}'),"
+            "('2026-01-01 10:00:00', '2026-03-02 09:30', 1, 0, 'text', '{}'),"
+            "('garbage', 'garbage', 1, 0, 'text', '{}')"
+        ))
+        # прошлый запуск упал после ADD COLUMN и части заполнения
+        c.execute(text("ALTER TABLE Mailings ADD COLUMN publish_at_utc DATETIME NULL"))
+        c.execute(text("UPDATE Mailings SET publish_at_utc = '2026-03-01 06:30:00.000000' WHERE id = 1"))
+    r = AdminRepository(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
+    r.init_schema(engine)
+
+    assert "DATETIME" in str({c["name"]: c["type"] for c in inspect(engine).get_columns("Mailings")}["publish_at"])
+    assert r.get_mailing_by_id(1)["publish_at"] == "2026-03-01 09:30"
+    assert r.get_mailing_by_id(2)["publish_at"] == "2026-03-02 09:30"
+    assert r.get_mailing_by_id(3)["publish_at"]                       # битые обе даты — текущее время
+    engine.dispose()
+
+    # упал между DROP и RENAME
+    engine = _engine()
+    with engine.begin() as c:
+        c.execute(text(
+            "CREATE TABLE Mailings (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at VARCHAR(19), "
+            "publish_at_utc DATETIME, mailing_on INTEGER, mailing_completed INTEGER, "
+            "content_type VARCHAR(32), caption TEXT, payload TEXT)"
+        ))
+        c.execute(text(
+            "INSERT INTO Mailings (created_at, publish_at_utc, mailing_on, mailing_completed, content_type, payload) "
+            "VALUES ('', '2026-03-01 06:30:00.000000', 1, 0, 'text', '{}')"
+        ))
+    r = AdminRepository(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
+    r.init_schema(engine)
+    assert r.get_mailing_by_id(1)["publish_at"] == "2026-03-01 09:30"
+    engine.dispose()
+
+
+def test_due_selection_and_next_due(repo):
+    r, _ = repo
+    now = datetime(2026, 10, 17, 9, 0, tzinfo=UTC)                  # 12:00 МСК
+    due = r.create_scheduled_mailing(content_type="text", caption=None, payload={"text": "x"},
+                                     publish_at="2026-10-17 12:00")
+    later = r.create_scheduled_mailing(content_type="text", caption=None, payload={"text": "y"},
+                                       publish_at="2026-10-17 12:05")
+    assert [m["id"] for m in r.get_pending_mailings(now)] == [due]
+    assert r.get_pending_mailings(now)[0]["publish_at"] == "2026-10-17 12:00"
+    assert r.get_next_mailing_due() == datetime(2026, 10, 17, 9, 0, tzinfo=UTC)
+    # просроченная не заслоняет следующую по расписанию
+    assert r.get_next_mailing_due(after=now) == datetime(2026, 10, 17, 9, 5, tzinfo=UTC)
+    assert r.get_next_mailing_due(after=now + timedelta(minutes=5)) is None
+
+    r.mark_mailing_completed(due)
+    assert r.get_pending_mailings(now) == []
+    assert r.get_next_mailing_due() == datetime(2026, 10, 17, 9, 5, tzinfo=UTC)
+    assert r.get_last_publish_at() == "2026-10-17 12:05"
+    assert adb.get_last_published_mailing(now + timedelta(minutes=5))["id"] == later
+
+
+def test_calendar_counts_are_cached_until_mailings_change(repo):
+    r, engine = repo
+    ids = [r.create_scheduled_mailing(content_type="text", caption=None, payload={}, publish_at=at)
+           for at in ("2026-11-03 10:00", "2026-11-03 23:30", "2026-11-04 00:10", "2026-12-01 01:00")]
+    selects = _count_selects(engine)
+
+    def counts():
+        return r.get_mailing_counts_map("2026-11-01", "2026-11-30")
+
+    # дни — по МСК: 23:30 и 00:10 МСК попадают в разные дни, хотя в UTC это одни сутки
+    assert counts() == {"2026-11-03": 2, "2026-11-04": 1}
+    assert counts() == {"2026-11-03": 2, "2026-11-04": 1}
+    assert len(selects) == 1                                          # второй раз — из кэша
+
+    new = r.create_scheduled_mailing(content_type="text", caption=None, payload={}, publish_at="2026-11-20 10:00")
+    assert counts() == {"2026-11-03": 2, "2026-11-04": 1, "2026-11-20": 1}
+    r.update_mailing_publish_at(ids[3], "2026-11-20T18:00")
+    assert counts()["2026-11-20"] == 2
+    r.delete_mailing(new)
+    assert counts()["2026-11-20"] == 1
+    r.mark_mailing_completed(ids[0])
+    assert counts() == {"2026-11-03": 1, "2026-11-04": 1, "2026-11-20": 1}
+    assert r.get_mailing_counts_map("2026-11-01", "2026-11-30", only_pending=False)["2026-11-03"] == 2
+
+
+def test_calendar_and_due_scan_with_100k_history(repo):
+    r, engine = repo
+    rnd = random.Random(3)
+    now = datetime(2026, 10, 17, 9, 0)
+    rows = []
+    for i in range(100_000):                                          # ~3 года истории, всё уже отправлено
+        at = now - timedelta(minutes=rnd.randint(60, 3 * 365 * 24 * 60))
+        rows.append({"created_at": "", "publish_at": at, "mailing_on": 0, "mailing_completed": 1,
+                     "content_type": "text", "payload": "{}"})
+    for i in range(300):                                              # запланированные на ближайший год
+        at = now + timedelta(minutes=rnd.randint(10, 365 * 24 * 60))
+        rows.append({"created_at": "", "publish_at": at, "mailing_on": 1, "mailing_completed": 0,
+                     "content_type": "text", "payload": "{}"})
+    with engine.begin() as c:
+        c.execute(insert(Mailing), rows)
+        c.execute(text("ANALYZE"))
+
+    def best(fn, before=None, n=5):
+        out = float("inf")
+        for _ in range(n):
+            if before:
+                before()
+            t0 = time.perf_counter()
+            fn()
+            out = min(out, time.perf_counter() - t0)
+        return out
+
+    month = (2026, 8)
+    render_cold = best(lambda: calendar_picker._build_month_markup(*month), before=r._mailings_changed)
+    render_warm = best(lambda: calendar_picker._build_month_markup(*month))
+    # месяц истории целиком (~2.8k строк) — не только ждущие, как в календаре
+    history_cold = best(lambda: r.get_mailing_counts_map("2025-03-01", "2025-03-31", only_pending=False),
+                        before=r._mailings_changed)
+    due_scan = best(lambda: r.get_pending_mailings(now.replace(tzinfo=UTC)))
+    print(f"\nmailings 100k: calendar render {render_cold * 1000:.2f} ms cold / {render_warm * 1000:.2f} ms cached, "
+          f"history month counts {history_cold * 1000:.2f} ms, due scan {due_scan * 1000:.2f} ms")
+
+    assert r.get_pending_mailings(now.replace(tzinfo=UTC)) == []
+    assert sum(r.get_mailing_counts_map("2025-03-01", "2025-03-31", only_pending=False).values()) > 2000
+    assert render_cold < 0.01 and render_warm < 0.01 and history_cold < 0.01 and due_scan < 0.01
+
+
+async def test_next_mailing_delay_skips_overdue(repo, monkeypatch):
+    r, _ = repo
+    now = datetime.now(UTC)
+    msk = timezone(timedelta(hours=3))
+    # рассылка, отправка которой всё время падает, — «созрела» час назад
+    r.create_scheduled_mailing(content_type="text", caption=None, payload={},
+                               publish_at=(now - timedelta(hours=1)).astimezone(msk).strftime("%Y-%m-%d %H:%M"))
+    assert await mailing.next_mailing_delay(120) == 120
+    r.create_scheduled_mailing(content_type="text", caption=None, payload={},
+                               publish_at=(now + timedelta(minutes=2)).astimezone(msk).strftime("%Y-%m-%d %H:%M"))
+    assert 0 < await mailing.next_mailing_delay(300) <= 120
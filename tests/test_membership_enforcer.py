@@ -0,0 +1,236 @@
+"""
+Удаление из чата по сработавшим срокам (bot/utils/membership_enforcer.py):
+сроки в Redis ZSET, перепроверка пачки постоянным числом запросов,
+ограниченный параллелизм удалений и кулдаун в Redis.
+"""
+import asyncio
+import time
+from datetime import timedelta
+
+import httpx
+import pytest
+from sqlalchemy import create_engine, event as sa_event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import bot.utils.redis_repo as redis_repo
+from bot.utils.billing_db import Base as BillingBase, BillingRepository
+from bot.utils.membership_enforcer import MembershipEnforcer
+from bot.utils.redis_repo import MembershipExpiryRepo
+from bot.utils.time_helpers import now_msk
+
+
+class MemoryRedis:
+    """Минимальный in-memory Redis для команд очереди сроков и кулдауна."""
+
+    def __init__(self):
+        self.zsets, self.keys = {}, {}
+
+    async def zrangebyscore(self, key, lo, hi, start=0, num=None):
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])
+        due = [m for m, s in items if s <= hi]
+        return due[start:start + num] if num is not None else due[start:]
+
+    async def zrange(self, key, start, end, withscores=False):
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])[start:end + 1]
+        return items if withscores else [m for m, _ in items]
+
+    async def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    async def set(self, key, value, ex=None, nx=False):
+        now = time.time()
+        cur = self.keys.get(key)
+        if nx and cur is not None and cur[1] > now:
+            return None
+        self.keys[key] = (value, now + ex if ex else float("inf"))
+        return True
+
+    async def ttl(self, key):
+        cur = self.keys.get(key)
+        return int(cur[1] - time.time()) if cur and cur[1] > time.time() else -2
+
+    def pipeline(self):
+        return _Pipe(self)
+
+
+class _Pipe:
+    def __init__(self, r):
+        self.r, self.ops = r, []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self.ops.append((name, a, kw))
+
+    async def execute(self):
+        return [getattr(self, "_" + name)(*a, **kw) for name, a, kw in self.ops]
+
+    def _zadd(self, k, mapping):
+        self.r.zsets.setdefault(k, {}).update(mapping)
+
+    def _zrem(self, k, m):
+        return 1 if self.r.zsets.get(k, {}).pop(m, None) is not None else 0
+
+
+@pytest.fixture
+def billing_repo(monkeypatch):
+    """Billing DB на одном соединении: enforcer ходит в неё из пула потоков run_db."""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    BillingBase.metadata.create_all(engine)
+    repo = BillingRepository(sessionmaker(bind=engine, autoflush=False, autocommit=False))
+    monkeypatch.setattr("bot.utils.billing_db._repo", repo)
+    yield repo, engine
+    engine.dispose()
+
+
+@pytest.fixture
+def app_repo(in_memory_app_db, monkeypatch):
+    repo, SessionLocal = in_memory_app_db
+    monkeypatch.setattr("bot.utils.database._repo", repo)
+    return repo, SessionLocal.kw["bind"]
+
+
+@pytest.fixture
+def expiry(monkeypatch):
+    repo = MembershipExpiryRepo(MemoryRedis(), prefix="t")
+    monkeypatch.setattr(redis_repo, "membership_expiry", repo)
+    return repo
+
+
+class MembershipService:
+    """Заглушка membership-service: считает удаления и одновременные запросы."""
+
+    def __init__(self, fail=()):
+        self.removed, self.fail = [], set(fail)
+        self.in_flight = self.max_in_flight = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        uid = int(request.read().decode().split(":")[1].strip(" }"))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        if uid in self.fail:
+            return httpx.Response(503, text="unavailable")
+        self.removed.append(uid)
+        return httpx.Response(200, json={"ok": True})
+
+
+def _subscribe(repo, user_id, next_charge_at):
+    return repo.subscription_upsert(
+        user_id=user_id, plan_code="1m", interval_months=1, amount_value="2490.00",
+        amount_currency="RUB", payment_method_id=f"pm_token_{user_id:08d}",
+        next_charge_at=next_charge_at, status="active",
+    )
+
+
+async def test_writers_push_expiry_moments(billing_repo, app_repo, expiry):
+    import bot.utils.billing_db as billing_db
+    import bot.utils.database as db
+
+    expiry.bind_loop()
+    until = db.set_trial(1, hours=72)
+    next_at = now_msk() + timedelta(days=30)
+    billing_db.subscription_upsert(
+        user_id=2, plan_code="1m", interval_months=1, amount_value="2490.00",
+        amount_currency="RUB", payment_method_id="pm_token_12345678",
+        next_charge_at=next_at, status="active",
+    )
+    await asyncio.sleep(0)                                   # задачи schedule_nowait
+    await asyncio.sleep(0)
+    scores = expiry.r.zsets[expiry.key]
+    assert scores["1"] == pytest.approx(until.timestamp())
+    assert scores["2"] == pytest.approx(next_at.timestamp())
+
+
+async def test_only_due_users_are_verified_and_removed(billing_repo, app_repo, expiry):
+    repo, billing_engine = billing_repo
+    app, app_engine = app_repo
+    now = now_msk()
+    expired = list(range(1, 31))
+    for uid in range(1, 1001):
+        _subscribe(repo, uid, now - timedelta(days=1) if uid in expired else now + timedelta(days=10))
+    with_trial = expired[:5]                                 # оплата не прошла, но идёт триал
+    for uid in with_trial:
+        app.set_trial(uid, hours=48)
+
+    service = MembershipService()
+    enf = MembershipEnforcer(expiry, concurrency=4, transport=httpx.MockTransport(service))
+    assert await enf.reconcile() == 1000
+    assert await expiry.size() == 1000
+    # сверка учла триал; хук продления мог записать более ранний срок — он безопасен
+    await expiry.schedule_many({uid: time.time() - 60 for uid in with_trial})
+
+    queries = []
+    for engine in (billing_engine, app_engine):
+        sa_event.listen(engine, "before_cursor_execute", lambda *a: queries.append(a[2]))
+
+    assert await enf.process_due() == 30
+    # перепроверка пачки — один запрос подписок и один запрос триалов, а не 2 на пользователя
+    assert len(queries) == 2
+    assert sorted(service.removed) == expired[5:]
+    assert service.max_in_flight <= 4
+
+    # остальные 970 не тронуты, с триалом — перепланированы на конец триала
+    assert await expiry.pop_due(time.time()) == []
+    scores = expiry.r.zsets[expiry.key]
+    assert len(scores) == 975
+    assert scores["1"] == pytest.approx((now + timedelta(hours=48)).timestamp(), abs=5)
+    await enf.close()
+
+
+async def test_cooldown_survives_restart_and_failures_retry(billing_repo, app_repo, expiry):
+    repo, _ = billing_repo
+    now = now_msk()
+    _subscribe(repo, 1, now - timedelta(days=1))
+    _subscribe(repo, 2, now - timedelta(days=1))
+    _subscribe(repo, 3, now - timedelta(days=1))
+    repo.subscription_cancel_for_user(user_id=3)              # без активной подписки — не трогаем
+
+    service = MembershipService(fail={2})
+    enf = MembershipEnforcer(expiry, cooldown_sec=3600, transport=httpx.MockTransport(service))
+    await expiry.schedule_many({1: 0, 2: 0, 3: 0})
+    assert await enf.process_due() == 3
+    assert service.removed == [1]
+    assert enf.counters["remove_failed"] == 1 and enf.counters["dropped"] == 1
+    # неудача — повтор после кулдауна; выбывший из подписки пропал из очереди
+    scores = expiry.r.zsets[expiry.key]
+    assert set(scores) == {"2"} and scores["2"] == pytest.approx(time.time() + 3600, abs=5)
+    await enf.close()
+
+    # «рестарт»: новый процесс видит кулдаун в Redis и не дёргает сервис повторно
+    service2 = MembershipService()
+    enf2 = MembershipEnforcer(expiry, cooldown_sec=3600, transport=httpx.MockTransport(service2))
+    await expiry.schedule_many({1: 0, 2: 0})
+    assert await enf2.process_due() == 2
+    assert service2.removed == []
+    assert enf2.counters["cooldown"] == 2
+    assert all(s > time.time() + 3500 for s in expiry.r.zsets[expiry.key].values())
+    await enf2.close()
+
+
+async def test_run_sleeps_until_next_expiry(billing_repo, app_repo, expiry):
+    repo, _ = billing_repo
+    due_at = now_msk() + timedelta(seconds=0.5)
+    _subscribe(repo, 7, due_at)
+    _subscribe(repo, 8, now_msk() + timedelta(days=30))
+
+    removed_at = []
+    service = MembershipService()
+
+    async def handler(request):
+        removed_at.append(time.time())
+        return await service(request)
+
+    enf = MembershipEnforcer(expiry, poll_sec=30, transport=httpx.MockTransport(handler))
+    shutdown = asyncio.Event()
+    task = asyncio.create_task(enf.run(shutdown))
+    await asyncio.sleep(1.5)
+    shutdown.set()
+    await asyncio.wait_for(task, timeout=2)
+
+    # стартовая сверка положила оба срока; цикл проснулся ровно к сроку 7-го, не раньше
+    assert service.removed == [7]
+    assert 0 <= removed_at[0] - due_at.timestamp() < 0.5
+    assert list(expiry.r.zsets[expiry.key]) == ["8"]
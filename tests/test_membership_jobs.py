@@ -0,0 +1,104 @@
+"""
+Пакетные задания membership-сервиса (membership/batch_jobs.py):
+общий token bucket, пауза всех запросов на FloodWait и повтор пользователя.
+"""
+import asyncio
+import time
+
+from telethon import errors
+
+from membership.batch_jobs import JobQueue, TokenBucket
+
+
+def _flood(seconds):
+    return errors.FloodWaitError(request=None, capture=seconds)
+
+
+async def test_bucket_paces_after_burst():
+    bucket = TokenBucket(rate=20, burst=3)
+    t0 = time.monotonic()
+    for _ in range(3):
+        await bucket.acquire()
+    assert time.monotonic() - t0 < 0.02                    # запас выдаётся сразу
+    for _ in range(4):
+        await bucket.acquire()
+    assert 0.18 <= time.monotonic() - t0 < 0.35            # дальше — 20 в секунду
+
+
+async def test_flood_wait_pauses_everyone_and_retries_user(monkeypatch):
+    # Telegram присылает секунды; в тесте секунда — 0.1
+    monkeypatch.setattr("membership.batch_jobs.flood_wait_seconds",
+                        lambda e: 0.3 if isinstance(e, errors.FloodWaitError) else None)
+    bucket = TokenBucket(rate=100, burst=5)
+    queue = JobQueue(bucket, concurrency=3)
+    calls = []
+    flooded = set()
+
+    async def remove(item, chat):
+        await bucket.acquire()
+        uid = item["user_id"]
+        calls.append((uid, time.monotonic()))
+        if uid == 3 and uid not in flooded:
+            flooded.add(uid)
+            raise _flood(3)
+        if uid == 5:
+            raise errors.ChatAdminRequiredError(request=None)
+        return "removed"
+
+    prepared = []
+
+    async def prepare(job):
+        prepared.append(job.id)
+        return ("channel", object())
+
+    queue.register("remove", remove, prepare=prepare)
+    queue.start()
+    try:
+        job = queue.submit("remove", [{"user_id": uid} for uid in range(1, 21)])
+        assert queue.get(job.id).snapshot()["status"] == "queued"
+        deadline = time.monotonic() + 5
+        while not job.finished and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        await queue.stop()
+
+    snap = job.snapshot()
+    assert snap["status"] == "done" and snap["processed"] == 20
+    assert snap["counts"] == {"removed": 19, "failed": 1}
+    assert list(snap["errors"]) == ["5"]
+    assert snap["flood_waits"] == 1
+    assert prepared == [job.id]                            # чат резолвится один раз на задание
+
+    # после FloodWait никто не ходил в Telegram до конца паузы, пользователь 3 повторён
+    flood_at = next(t for uid, t in calls if uid == 3)
+    after = [t for _, t in calls if t > flood_at]
+    assert after and min(after) - flood_at >= 0.28
+    assert [uid for uid, _ in calls].count(3) == 2
+
+
+async def test_prepare_failure_and_retention():
+    queue = JobQueue(TokenBucket(rate=100, burst=1), keep_sec=60, max_jobs=2)
+
+    async def no_chat(job):
+        raise RuntimeError("Нет доступа к целевому чату")
+
+    async def never(item, chat):
+        raise AssertionError("не должен вызываться")
+
+    queue.register("remove", never, prepare=no_chat)
+    queue.start()
+    try:
+        first = queue.submit("remove", [{"user_id": 1}])
+        while not first.finished:
+            await asyncio.sleep(0.01)
+        assert first.status == "failed" and first.error == "Нет доступа к целевому чату"
+
+        second = queue.submit("remove", [{"user_id": 2}])
+        while not second.finished:
+            await asyncio.sleep(0.01)
+        # сверх max_jobs забываются самые старые завершённые
+        third = queue.submit("remove", [{"user_id": 3}])
+        assert queue.get(first.id) is None
+        assert queue.get(second.id) is second and queue.get(third.id) is third
+    finally:
+        await queue.stop()
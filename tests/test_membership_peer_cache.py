@@ -0,0 +1,70 @@
+"""
+Кэш резолва пиров membership-сервиса (membership/peer_cache.py):
+LRU access_hash с TTL, тёплый старт из файла, сброс кэша чата по ошибке.
+"""
+import json
+import time
+
+from membership.peer_cache import ChatPeerCache, UserPeerCache
+
+
+def test_user_cache_lru_ttl_and_hit_rate(monkeypatch):
+    cache = UserPeerCache(None, max_size=2, ttl_sec=60)
+    cache.put(1, 111)
+    cache.put(2, 222)
+    assert cache.get(1) == 111                 # 1 свежее 2 → вытеснится 2
+    cache.put(3, 333)
+    assert cache.get(2) is None and cache.get(3) == 333
+    assert cache.stats()["evictions"] == 1
+
+    real = time.time
+    monkeypatch.setattr(time, "time", lambda: real() + 61)
+    assert cache.get(1) is None                # TTL истёк
+    stats = cache.stats()
+    assert stats["expired"] == 1 and stats["hits"] == 2 and stats["misses"] == 2
+    assert stats["hit_rate"] == 0.5
+
+
+def test_user_cache_survives_restart(tmp_path):
+    path = str(tmp_path / "peer_cache.json")
+    cache = UserPeerCache(path, ttl_sec=3600)
+    assert cache.load() == 0 and not cache.save()          # пустой и не менялся
+    for uid in range(1, 101):
+        cache.put(uid, uid * 7)
+    cache.discard(50)
+    assert cache.save() and not cache.save()               # второй раз писать нечего
+
+    data = json.loads(open(path, encoding="utf-8").read())
+    data["999"] = [1, time.time() - 7200]                   # устаревшая запись
+    open(path, "w", encoding="utf-8").write(json.dumps(data))
+
+    warm = UserPeerCache(path, max_size=50, ttl_sec=3600)
+    assert warm.load() == 50                               # остались самые свежие
+    assert warm.get(100) == 700 and warm.get(1) is None and warm.get(999) is None
+
+    open(path, "w", encoding="utf-8").write("{broken")
+    assert UserPeerCache(path).load() == 0                 # битый файл — холодный старт
+
+
+async def test_chat_cache_resolves_once_until_invalidated():
+    cache = ChatPeerCache()
+    calls = []
+
+    async def resolve():
+        calls.append(1)
+        return ("channel", object())
+
+    async def no_access():
+        return None
+
+    first = await cache.get("input_chat", resolve)
+    assert await cache.get("input_chat", resolve) is first
+    assert len(calls) == 1
+    assert await cache.get("entity", no_access) is None    # нет доступа — не кэшируется
+    assert await cache.get("entity", no_access) is None
+
+    cache.invalidate()
+    assert await cache.get("input_chat", resolve) is not first
+    stats = cache.stats()
+    assert len(calls) == 2 and stats["invalidations"] == 1
+    assert stats["hits"] == 1 and stats["misses"] == 4
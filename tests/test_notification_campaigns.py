@@ -0,0 +1,222 @@
+"""
+Движок кампаний уведомлений (bot/utils/notification.py): шаги как данные,
+сроки следующего шага в Redis ZSET, антидубль пачки одним pipeline,
+стоимость тика — по числу пользователей с наступившим сроком.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+import bot.utils.notification as notification
+from bot.utils.notification import Campaign, CampaignEngine, Step
+from bot.utils.redis_repo import NotificationScheduleRepo
+
+NOW = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+
+
+class MemoryRedis:
+    """Минимальный in-memory Redis для ZSET расписания и SET NX антидубля."""
+
+    def __init__(self):
+        self.zsets, self.keys = {}, {}
+        self.round_trips = 0
+
+    async def zrangebyscore(self, key, lo, hi, start=0, num=None):
+        self.round_trips += 1
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])
+        due = [m for m, s in items if s <= hi]
+        return due[start:start + num] if num is not None else due[start:]
+
+    async def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def pipeline(self):
+        return _Pipe(self)
+
+
+class _Pipe:
+    def __init__(self, r):
+        self.r, self.ops = r, []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self.ops.append((name, a, kw))
+
+    async def execute(self):
+        self.r.round_trips += 1
+        return [getattr(self, "_" + name)(*a, **kw) for name, a, kw in self.ops]
+
+    def _zadd(self, k, mapping, nx=False):
+        z = self.r.zsets.setdefault(k, {})
+        for m, score in mapping.items():
+            if not (nx and m in z):
+                z[m] = score
+
+    def _zrem(self, k, m):
+        return 1 if self.r.zsets.get(k, {}).pop(m, None) is not None else 0
+
+    def _set(self, k, v, ex=None, nx=False):
+        if nx and k in self.r.keys:
+            return None
+        self.r.keys[k] = v
+        return True
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, user_id, text, **kwargs):
+        self.sent.append((user_id, text))
+
+    async def send_photo(self, user_id, photo, caption=None, **kwargs):
+        self.sent.append((user_id, caption))
+
+
+def _engine():
+    redis = MemoryRedis()
+    return CampaignEngine(NotificationScheduleRepo(redis, prefix="t")), redis
+
+
+def _zset(redis, campaign):
+    return {int(m): s for m, s in redis.zsets.get(f"t:notif:next:{campaign}", {}).items()}
+
+
+def _campaign(rows, loads, name="c", steps=None):
+    def load(uids, now):
+        loads.append(list(uids))
+        return {uid: rows[uid] for uid in uids if uid in rows}
+
+    steps = steps or (
+        Step("a", "start", 0, "t:{uid}:a", text="A"),
+        Step("b", "start", 0, "t:{uid}:b", text="B"),
+        Step("c", "start", 48, "t:{uid}:c", text="C"),
+    )
+    return Campaign(name=name, steps=steps, load=load, population=lambda now: list(rows))
+
+
+async def test_unsub_campaign_visits_only_due_users(in_memory_app_db, monkeypatch):
+    repo, _ = in_memory_app_db
+    engine, redis = _engine()
+    monkeypatch.setattr("bot.utils.database._repo", repo)
+    monkeypatch.setattr(notification, "campaign_engine", engine)
+    monkeypatch.setattr(notification, "_utcnow", lambda: NOW)
+    monkeypatch.setattr(notification.billing_db, "membership_paid_until_map",
+                        lambda ids: {4: NOW + timedelta(days=30)} if 4 in ids else {})
+
+    async def last_post(bot, uid):
+        bot.sent.append((uid, "last-post"))
+
+    monkeypatch.setattr(notification, "send_last_published_to_chat", last_post)
+
+    # хук записи: новым пользователям — срок «сейчас», повторное событие срок не ставит
+    hooked = []
+    monkeypatch.setattr("bot.utils.database.schedule_notification_nowait",
+                        lambda campaign, uid, at=None: hooked.append((campaign, uid)))
+    from bot.utils import database as app_db
+    app_db.events_add_bulk([
+        (1, "CB:a", NOW - timedelta(hours=25)),            # D1
+        (2, "CB:a", NOW - timedelta(hours=40)),            # между окнами
+        (3, "CB:a", NOW - timedelta(hours=97)),            # D4
+        (4, "CB:a", NOW - timedelta(hours=49)),            # платный — откладываем
+        (5, "CB:a", NOW - timedelta(hours=200)),           # кампания закончилась
+    ])
+    app_db.events_add_bulk([(1, "CB:b", NOW - timedelta(hours=1))])
+    assert sorted(hooked) == [("unsub", uid) for uid in range(1, 6)]
+
+    assert await engine.reconcile_if_due(notification.UNSUB_CAMPAIGN) == 4
+    assert await engine.reconcile_if_due(notification.UNSUB_CAMPAIGN) == 0     # не чаще reconcile_sec
+
+    bot = FakeBot()
+    sent_in_run = set()
+    await notification.run_unsubscribed_nurture(bot, sent_in_run=sent_in_run)
+    assert sent_in_run == {1, 3}
+    assert [uid for uid, _ in bot.sent] == [1, 1, 3]                            # D1 = текст + последний пост
+
+    due = _zset(redis, "unsub")
+    ts = NOW.timestamp()
+    assert due[1] == ts + 23 * 3600                        # следующий шаг: D2 через 48 ч от первого события
+    assert due[2] == ts + 8 * 3600                         # D3
+    assert due[4] == ts + engine.retry_sec                 # окно D2 открыто, но пользователь платный
+    assert 3 not in due and 5 not in due                   # шагов больше нет
+
+    # повторный тик в тот же момент никого не трогает
+    bot.sent.clear()
+    await notification.run_unsubscribed_nurture(bot)
+    assert bot.sent == []
+
+
+async def test_claims_are_one_pipeline_per_round(monkeypatch):
+    monkeypatch.setattr(notification, "_utcnow", lambda: NOW)
+    engine, redis = _engine()
+    rows = {uid: {"start": NOW - timedelta(hours=1)} for uid in range(1, 301)}
+    loads = []
+    campaign = _campaign(rows, loads)
+    await engine.reconcile_if_due(campaign)
+    redis.keys["t:7:a"] = "1"                              # шаг a пользователю 7 уже отправлен
+
+    bot = FakeBot()
+    redis.round_trips = 0
+    sent = await engine.run_campaign(bot, campaign)
+
+    assert sent == {"a": 299, "b": 1, "c": 0}
+    assert (7, "B") in bot.sent and len(bot.sent) == 300
+    assert len(loads) == 1                                 # одна загрузка строк на пачку
+    # zrangebyscore + ZREM + 2 раунда антидубля + ZADD следующих сроков
+    assert redis.round_trips == 5
+
+    due = _zset(redis, "c")
+    assert due[1] == NOW.timestamp() + engine.retry_sec    # шаг b ещё открыт — в следующий тик
+    assert due[7] == (NOW + timedelta(hours=47)).timestamp()
+
+
+async def test_tick_cost_depends_on_due_users_only(monkeypatch):
+    monkeypatch.setattr(notification, "_utcnow", lambda: NOW)
+    engine, redis = _engine()
+    engine.batch = 2
+    start_future = NOW + timedelta(hours=5)
+    rows = {uid: {"start": start_future} for uid in range(1, 20001)}
+    for uid in (11, 12, 13):
+        rows[uid] = {"start": NOW - timedelta(minutes=5)}
+    loads = []
+    campaign = _campaign(rows, loads)
+    await engine.schedule.schedule_many("c", {uid: start_future.timestamp() for uid in rows})
+    await engine.schedule.schedule_many("c", {11: NOW.timestamp(), 12: NOW.timestamp(), 13: NOW.timestamp()})
+
+    t0 = time.perf_counter()
+    sent = await engine.run_campaign(FakeBot(), campaign)
+    elapsed = time.perf_counter() - t0
+
+    assert sent["a"] == 3
+    assert sorted(uid for batch in loads for uid in batch) == [11, 12, 13]
+    assert [len(b) for b in loads] == [2, 1]              # пачками по batch
+    assert elapsed < 0.5
+    assert len(_zset(redis, "c")) == 20000
+
+
+async def test_paid_pre_renew_guard_and_epoch_key(monkeypatch):
+    monkeypatch.setattr(notification, "_utcnow", lambda: NOW)
+    engine, redis = _engine()
+    nca = NOW + timedelta(hours=20)
+    subs = {
+        1: {"created_at": NOW - timedelta(days=30), "next_charge_at": nca,
+            "last_charge_at": NOW - timedelta(hours=1)},          # только что списали
+        2: {"created_at": NOW - timedelta(days=30), "next_charge_at": nca,
+            "last_charge_at": NOW - timedelta(days=30)},
+        3: {"created_at": NOW - timedelta(hours=73), "next_charge_at": NOW + timedelta(days=27),
+            "last_charge_at": None},
+    }
+    monkeypatch.setattr(notification.billing_db, "paid_lifecycle_map", lambda uids, now: {
+        uid: subs[uid] for uid in uids if uid in subs
+    })
+    await engine.schedule.schedule_many("paid", {uid: NOW.timestamp() for uid in (1, 2, 3, 4)})
+
+    bot = FakeBot()
+    sent = await engine.run_campaign(bot, notification.PAID_CAMPAIGN)
+
+    assert sent["pre"] == 1 and sent["d3"] == 1
+    assert f"notif:paid:2:pre:{int(nca.timestamp())}" in redis.keys
+    assert "notif:paid:3:d3" in redis.keys and not any(k.startswith("notif:paid:1:") for k in redis.keys)
+    due = _zset(redis, "paid")
+    assert due[1] == NOW.timestamp() + engine.retry_sec        # pre отложен guard'ом
+    assert 2 not in due                # до следующего списания: его хук (или сверка) вернёт в расписание
+    assert due[3] == (NOW - timedelta(hours=73) + timedelta(hours=120)).timestamp()
+    assert 4 not in due                                        # нет активной подписки — выбыл
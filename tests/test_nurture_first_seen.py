@@ -0,0 +1,160 @@
+"""
+users.first_seen_at/last_seen_at (ведутся в events_add_bulk) и выборка
+по окнам порогов без агрегации event_log (сверка кампании «не подписался»).
+"""
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine, func, insert, select, text, update
+from sqlalchemy.orm import sessionmaker
+
+from bot.utils.database import AppRepository, Base, EventLog, User
+
+NOW = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+THRESHOLDS = [24, 48, 72, 96]
+WINDOW = 12.0
+
+
+def _naive(dt):
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _seen(SessionLocal, uid):
+    with SessionLocal() as s:
+        f, l = s.execute(select(User.first_seen_at, User.last_seen_at).where(User.user_id == uid)).one()
+    return f and f.replace(tzinfo=None), l and l.replace(tzinfo=None)
+
+
+def _legacy_candidates(SessionLocal, now):
+    """Прежняя выборка: MIN(created_at) по всему event_log + фильтр окон в Python."""
+    with SessionLocal() as s:
+        rows = s.query(EventLog.user_id, func.min(EventLog.created_at)).group_by(EventLog.user_id).all()
+    out = set()
+    for uid, first_at in rows:
+        first_at = first_at if first_at.tzinfo else first_at.replace(tzinfo=timezone.utc)
+        h = (now - first_at).total_seconds() / 3600.0
+        if any(t <= h < t + WINDOW for t in THRESHOLDS):
+            out.add(uid)
+    return out
+
+
+def test_events_add_bulk_tracks_first_and_last_seen(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    t0 = NOW - timedelta(hours=30)
+    repo.events_add_bulk([(1, "CB:a", t0), (1, "CB:b", t0 + timedelta(minutes=5)), (2, "TEXT:x", t0)])
+    assert _seen(SessionLocal, 1) == (_naive(t0), _naive(t0 + timedelta(minutes=5)))
+
+    # поздняя пачка с более ранним событием двигает только first_seen
+    repo.events_add_bulk([(1, "CB:late", t0 - timedelta(hours=1)), (2, "CB:y", t0 + timedelta(hours=2))])
+    assert _seen(SessionLocal, 1) == (_naive(t0 - timedelta(hours=1)), _naive(t0 + timedelta(minutes=5)))
+    assert _seen(SessionLocal, 2) == (_naive(t0), _naive(t0 + timedelta(hours=2)))
+
+    repo.ensure_user(3)
+    assert _seen(SessionLocal, 3) == (None, None)          # без событий — не в кампании
+
+
+def test_backfill_and_window_query_match_legacy(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    rnd = random.Random(5)
+    events = []
+    for uid in range(1, 2001):
+        first = NOW - timedelta(hours=rnd.uniform(0, 24 * 8))
+        events += [(uid, "CB:x", first + timedelta(minutes=rnd.uniform(0, 600))) for _ in range(3)]
+        events.append((uid, "CB:first", first))
+    rnd.shuffle(events)
+    for i in range(0, len(events), 200):
+        repo.events_add_bulk(events[i:i + 200])
+
+    expected = _legacy_candidates(SessionLocal, NOW)
+    got = repo.list_first_seen_in_windows(NOW, THRESHOLDS, WINDOW)
+    assert {uid for uid, _ in got} == expected and len(got) == len(expected) > 0
+
+    # «старая» база: колонки есть, но пусты — разовое заполнение по event_log
+    with SessionLocal() as s, s.begin():
+        s.execute(update(User).values(first_seen_at=None, last_seen_at=None))
+    repo.ensure_user(99999)                               # без событий — останется NULL
+    assert repo.seen_backfill_pending()
+    assert repo.backfill_seen_at(chunk=300) == 2000
+    assert not repo.seen_backfill_pending()               # повторный старт заполнение не запускает
+    assert {uid for uid, _ in repo.list_first_seen_in_windows(NOW, THRESHOLDS, WINDOW)} == expected
+    assert _seen(SessionLocal, 99999) == (None, None)
+
+
+def test_interrupted_backfill_is_resumed_on_next_start(in_memory_app_db, monkeypatch):
+    import bot.utils.database as app_db
+
+    repo, SessionLocal = in_memory_app_db
+    repo.events_add_bulk([(uid, "CB:x", NOW - timedelta(days=30)) for uid in range(1, 11)])
+    with SessionLocal() as s, s.begin():
+        # колонка уже добавлена прошлым стартом, заполнение прервалось на половине
+        s.execute(update(User).where(User.user_id > 5).values(first_seen_at=None, last_seen_at=None))
+
+    engine = SessionLocal.kw["bind"]
+    monkeypatch.setattr(app_db, "engine", engine)
+    monkeypatch.setattr(app_db, "SessionLocal", SessionLocal)
+    app_db.init_schema()
+
+    assert not repo.seen_backfill_pending()
+    assert _seen(SessionLocal, 8)[0] == _naive(NOW - timedelta(days=30))
+
+
+def _bench_sizes():
+    # 1M строк event_log ~ 10 с на заполнение; полный прогон — NURTURE_BENCH_FULL=1
+    return [1_000_000] if os.getenv("NURTURE_BENCH_FULL") == "1" else [200_000]
+
+
+@pytest.mark.parametrize("n_events", _bench_sizes())
+def test_nurture_tick_cost_independent_of_history(n_events):
+    engine = create_engine("sqlite://", future=True)
+    Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    repo = AppRepository(SessionLocal)
+
+    n_users = 50_000
+    rnd = random.Random(11)
+    first = {uid: _naive(NOW) - timedelta(hours=rnd.uniform(0, 24 * 180)) for uid in range(1, n_users + 1)}
+    with engine.begin() as c:
+        c.execute(insert(User), [
+            {"user_id": uid, "first_seen_at": f, "last_seen_at": f} for uid, f in first.items()
+        ])
+
+    def add_events(n):
+        with engine.begin() as c:
+            for _ in range(0, n, 50_000):
+                batch = []
+                for _ in range(50_000):
+                    uid = rnd.randint(1, n_users)
+                    batch.append({"user_id": uid, "message": "CB:x",
+                                  "created_at": first[uid] + timedelta(minutes=rnd.uniform(0, 600))})
+                c.execute(insert(EventLog), batch)
+            c.execute(text("ANALYZE"))
+
+    def tick():
+        repo.list_first_seen_in_windows(NOW, THRESHOLDS, WINDOW)     # прогрев
+        best = float("inf")
+        for _ in range(5):
+            t0 = time.perf_counter()
+            rows = repo.list_first_seen_in_windows(NOW, THRESHOLDS, WINDOW)
+            best = min(best, time.perf_counter() - t0)
+        return best, rows
+
+    add_events(50_000)
+    small, rows_small = tick()
+    add_events(n_events - 50_000)
+    big, rows_big = tick()
+
+    t0 = time.perf_counter()
+    legacy = _legacy_candidates(SessionLocal, NOW)
+    legacy_sec = time.perf_counter() - t0
+    print(f"\nnurture tick: {len(rows_big)} candidates of {n_users} users; "
+          f"history 50k -> {small * 1000:.1f} ms, {n_events} -> {big * 1000:.1f} ms; "
+          f"legacy GROUP BY over event_log {legacy_sec * 1000:.0f} ms")
+
+    assert rows_small == rows_big and len(rows_big) > 0
+    assert big < 0.02
+    assert big < small * 3 + 0.002                         # от объёма event_log не зависит
+    assert {uid for uid, _ in rows_big} <= set(first)
+    engine.dispose()
@@ -0,0 +1,201 @@
+"""
+Кеш ответов на возражения (executor/response_cache.py): точный и похожий уровни,
+несколько вариантов на ключ, лимит размера, обход кеша, метрики.
+"""
+import os
+
+os.environ.setdefault("EXECUTOR_PORT", "5055")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import httpx
+import pytest
+
+from executor import controller
+from executor.app import create_app
+from executor.response_cache import ResponseCache, normalize
+from tests.test_executor_load import StubLLM, stub_llm  # noqa: F401 — фикстура
+
+
+class MemoryRedis:
+    """Минимальный in-memory Redis для команд, которыми пользуется кеш."""
+
+    def __init__(self, fail=False):
+        self.lists, self.hashes, self.zsets = {}, {}, {}
+        self.fail = fail
+
+    def _check(self):
+        if self.fail:
+            raise ConnectionError("redis is down")
+
+    async def lrange(self, key, start, end):
+        self._check()
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    async def hgetall(self, key):
+        self._check()
+        return dict(self.hashes.get(key, {}))
+
+    async def zrangebyscore(self, key, lo, hi):
+        z = self.zsets.get(key, {})
+        return [m for m, s in sorted(z.items(), key=lambda kv: kv[1]) if s <= hi]
+
+    async def zrange(self, key, start, end):
+        z = self.zsets.get(key, {})
+        return [m for m, _ in sorted(z.items(), key=lambda kv: kv[1])][start:end + 1]
+
+    def pipeline(self):
+        return _Pipe(self)
+
+
+class _Pipe:
+    def __init__(self, r):
+        self.r, self.ops = r, []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self.ops.append((name, a, kw))
+
+    async def execute(self):
+        self.r._check()
+        out = []
+        for name, a, kw in self.ops:
+            out.append(getattr(self, "_" + name)(*a, **kw))
+        return out
+
+    def _lpush(self, k, v):
+        self.r.lists.setdefault(k, []).insert(0, v)
+
+    def _ltrim(self, k, s, e):
+        self.r.lists[k] = self.r.lists.get(k, [])[s:e + 1]
+
+    def _expire(self, k, ttl):
+        return True
+
+    def _hset(self, k, f, v):
+        self.r.hashes.setdefault(k, {})[f] = v
+
+    def _hdel(self, k, *fs):
+        for f in fs:
+            self.r.hashes.get(k, {}).pop(f, None)
+
+    def _zadd(self, k, mapping):
+        self.r.zsets.setdefault(k, {}).update(mapping)
+
+    def _zcard(self, k):
+        return len(self.r.zsets.get(k, {}))
+
+    def _zrem(self, k, *ms):
+        for m in ms:
+            self.r.zsets.get(k, {}).pop(m, None)
+
+    def _delete(self, k):
+        self.r.lists.pop(k, None)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    c = ResponseCache("objection", variants=2, similarity=0.8, redis=MemoryRedis())
+    c.set_namespace("test-model", "test-prompt")
+    monkeypatch.setattr(controller, "objection_cache", c)
+    monkeypatch.setattr("executor.openai_service.objection_cache", c)
+    return c
+
+
+async def _ask(http, question, **params):
+    r = await http.post("/api/v1/objection/generate", json={"question": question}, params={"debug": "1", **params})
+    assert r.status_code == 200
+    return r.json()
+
+
+def test_normalize():
+    assert normalize("  Дорого!!  Ёлки ") == "дорого елки"
+
+
+async def test_objection_cache_tiers_and_hit_rate(stub_llm, cache):
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://executor") as http:
+        # первые VARIANTS ответов идут в LLM и копят разнообразие
+        assert (await _ask(http, "Дорого"))["debug"]["cache"] == "miss"
+        assert (await _ask(http, "дорого!"))["debug"]["cache"] == "miss"
+        assert stub_llm.calls == 2
+
+        # дальше — из кеша, мимо LLM (в т.ч. с другим регистром/пунктуацией)
+        for q in ("ДОРОГО", "дорого...", "  дорого "):
+            body = await _ask(http, q)
+            assert body["debug"]["cache"] == "exact"
+            assert body["text"]
+        assert stub_llm.calls == 2
+
+        # похожий вопрос попадает в уже заполненный ключ
+        await _ask(http, "у другого агента дешевле")
+        body = await _ask(http, "У другого агента дешевле будет?")
+        assert body["debug"]["cache"] == "similar" and body["debug"]["score"] >= 0.8
+        # а «недорого» — не похож на «дорого»
+        assert (await _ask(http, "недорого"))["debug"]["cache"] == "miss"
+        calls = stub_llm.calls
+
+        # обход кеша: ответ от LLM
+        assert (await _ask(http, "дорого", cache="0"))["debug"]["cache"] == "miss"
+        assert stub_llm.calls == calls + 1
+
+        health = (await http.get("/health")).json()
+
+    st = cache.stats()
+    assert st["exact_hits"] == 3 and st["similar_hits"] == 1 and st["bypass"] == 1
+    assert st["hit_rate"] == round(4 / st["lookups"], 3)
+    assert "hit_rate" in health["objection_cache"]
+
+
+async def test_cache_hit_is_served_while_limiter_is_saturated(stub_llm, cache, monkeypatch):
+    from executor import limits
+
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://executor") as http:
+        for q in ("Дорого", "дорого!"):                    # заполняем оба варианта ключа
+            await _ask(http, q)
+
+        # все слоты эндпоинта заняты, очередь полна
+        lim = limits.EndpointLimiter("objection", max_concurrency=1, max_queue=0)
+        monkeypatch.setitem(limits._registry.limiters, "objection", lim)
+        async with lim.slot():
+            assert (await _ask(http, "ДОРОГО"))["debug"]["cache"] == "exact"
+            r = await http.post("/api/v1/objection/generate", json={"question": "дорого"}, params={"stream": "1"})
+            assert r.status_code == 200
+            assert "event: done" in r.text and "error" not in r.text
+            # промах кеша при этом — честный 429
+            r = await http.post("/api/v1/objection/generate", json={"question": "недорого"}, params={"stream": "1"})
+            assert r.status_code == 429
+    assert lim.rejected == 1 and lim.accepted == 1
+
+
+async def test_variants_are_capped_and_entries_evicted():
+    r = MemoryRedis()
+    c = ResponseCache("objection", variants=2, max_entries=2, similarity=0, redis=r)
+    for i in range(3):
+        await c.store("дорого", f"ответ {i}", "gpt-5")
+    assert len(r.lists[c._vkey(c._hash("дорого"))]) == 2
+
+    await c.store("подумаю", "ответ", "gpt-5")
+    await c.store("дешевле у других", "ответ", "gpt-5")
+    # лимит 2 вопроса: самый старый вытеснен вместе с вариантами
+    assert c._vkey(c._hash("дорого")) not in r.lists
+    assert c.stats()["evicted"] == 1
+    assert await c.lookup("дорого") is None
+
+
+async def test_redis_failure_is_a_miss_with_backoff():
+    r = MemoryRedis(fail=True)
+    c = ResponseCache("objection", redis=r)
+    assert await c.lookup("дорого") is None
+    await c.store("дорого", "ответ", "gpt-5")
+    # после ошибки кеш молчит (не дёргает Redis на каждом запросе)
+    assert c.stats()["errors"] == 1
+
+
+async def test_namespace_change_hides_old_answers():
+    c = ResponseCache("objection", variants=1, similarity=0, redis=MemoryRedis())
+    c.set_namespace("gpt-5", "prompt v1")
+    await c.store("дорого", "старый ответ", "gpt-5")
+    assert (await c.lookup("дорого")).text == "старый ответ"
+    c.set_namespace("gpt-5", "prompt v2")
+    assert await c.lookup("дорого") is None
@@ -0,0 +1,164 @@
+"""
+Потоковый режим генерации: SSE executor'а → ExecutorClient.stream_text → склейка правок
+в Telegram (StreamingMessage) с ограничением частоты правок на чат.
+"""
+import asyncio
+import os
+import socket
+import time
+
+os.environ.setdefault("EXECUTOR_PORT", "5055")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import httpx
+import pytest
+import uvicorn
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+from openai import AsyncOpenAI
+
+from bot.utils.executor_client import ExecutorClient, ExecutorHTTPError
+from bot.utils.stream_editor import CURSOR, ChatEditThrottle, StreamingMessage, strip_partial_html
+from executor import limits
+import executor.apps.description_generate as description_module
+from executor.app import create_app
+from executor.llm_gateway import gateway
+from tests.test_executor_load import StubLLM, stub_llm  # noqa: F401 — фикстура
+
+
+TOKENS = [f"слово{i} " for i in range(10)]
+
+
+class FakeBot:
+    """Записывает правки сообщений (время, текст); можно подсунуть ошибки."""
+
+    def __init__(self, errors=None):
+        self.edits = []
+        self.errors = list(errors or [])
+
+    async def edit_message_text(self, *, chat_id, message_id, text, parse_mode=None, reply_markup=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append((time.monotonic(), text))
+
+
+@pytest.fixture
+async def executor_url(stub_llm):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_app(), host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await task
+
+
+@pytest.fixture
+async def client(executor_url):
+    c = ExecutorClient(executor_url, streaming=True)
+    try:
+        yield c
+    finally:
+        await c.close()
+
+
+async def test_objection_stream_first_text_arrives_before_completion(stub_llm, client):
+    stub_llm.stream_tokens = TOKENS
+    stub_llm.token_delay = 0.2
+    seen = []
+
+    t0 = time.monotonic()
+
+    async def on_text(text):
+        seen.append((time.monotonic() - t0, text))
+
+    data = await client.stream_text("objection/generate", {"question": "дорого"}, on_text=on_text)
+    total = time.monotonic() - t0
+
+    assert data["text"] == "".join(TOKENS).strip()
+    assert data["model"]
+    # накопленный текст растёт по дельтам
+    assert [t for _, t in seen] == ["".join(TOKENS[: i + 1]) for i in range(len(TOKENS))]
+    ttft = seen[0][0]
+    print(f"\nstream: ttft={ttft * 1000:.0f} ms, total={total * 1000:.0f} ms")
+    # без стриминга первый текст появился бы только через total
+    assert ttft < total / 3
+
+
+async def test_stream_edits_are_coalesced_and_throttled(stub_llm, client):
+    stub_llm.stream_tokens = TOKENS
+    stub_llm.token_delay = 0.1
+    bot = FakeBot()
+    throttle = ChatEditThrottle(0.3)
+    sm = StreamingMessage(bot, chat_id=1, message_id=10, throttle=throttle)
+
+    await client.stream_text("review/mutate", {"base_text": "Отличный агент", "operation": "short"}, on_text=sm.update)
+    await sm.finish()
+
+    assert 2 <= len(bot.edits) < len(TOKENS)
+    gaps = [b[0] - a[0] for a, b in zip(bot.edits, bot.edits[1:])]
+    assert all(g >= 0.29 for g in gaps)
+    assert all(text.endswith(CURSOR) for _, text in bot.edits)
+    # после finish() чат снова можно править финальным текстом
+    assert throttle.ready(1)
+
+
+async def test_stream_error_event_raises(stub_llm, client):
+    broken = AsyncOpenAI(api_key="sk-test", base_url="http://127.0.0.1:9/v1", max_retries=0)
+    gateway.set_client(broken)
+    try:
+        with pytest.raises(ExecutorHTTPError) as ei:
+            await client.stream_text("objection/generate", {"question": "дорого"}, on_text=lambda t: asyncio.sleep(0))
+    finally:
+        await broken.close()
+    assert ei.value.status == 502
+
+
+async def test_retry_after_pauses_edits_in_chat():
+    retry = TelegramRetryAfter(method=EditMessageText(chat_id=1, message_id=10, text="x"),
+                               message="Too Many Requests", retry_after=5)
+    bot = FakeBot(errors=[retry])
+    throttle = ChatEditThrottle(0.0)
+    sm = StreamingMessage(bot, chat_id=1, message_id=10, throttle=throttle)
+
+    assert await sm.update("первый") is False
+    assert await sm.update("первый кусок") is False
+    assert bot.edits == []
+    assert not throttle.ready(1)
+
+
+def test_strip_partial_html_drops_cut_tags():
+    assert strip_partial_html("<b>Понимаю</b> вас. <i>Давай") == "Понимаю вас. Давай"
+    assert strip_partial_html("Ответ <b") == "Ответ "
+
+
+async def test_description_stream_sends_partial_callbacks(stub_llm, monkeypatch):
+    stub_llm.stream_tokens = TOKENS
+    stub_llm.token_delay = 0.05
+    monkeypatch.setattr(description_module, "DESCRIPTION_PARTIAL_INTERVAL_SEC", 0.1)
+
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://executor") as http:
+        r = await http.post("/api/v1/description/generate", json={
+            "fields": {"type": "flat", "deal_type": "sale"},
+            "callback_url": f"{stub_llm.base_url}/callback",
+            "chat_id": 1,
+            "msg_id": 7,
+            "stream": True,
+        })
+    assert r.status_code == 202
+    assert await limits.drain(timeout=10)
+
+    partials = [cb for cb in stub_llm.callbacks if cb.get("partial")]
+    final = [cb for cb in stub_llm.callbacks if not cb.get("partial")]
+    assert len(final) == 1 and final[0]["text"] == "".join(TOKENS).strip()
+    assert 2 <= len(partials) < len(TOKENS)
+    # каждый промежуточный колбэк — растущий префикс итогового текста
+    texts = [cb["text"] for cb in partials]
+    assert texts == sorted(texts, key=len)
+    assert all("".join(TOKENS).startswith(t) for t in texts)
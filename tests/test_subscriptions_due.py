@@ -0,0 +1,305 @@
+"""
+subscriptions_due: выборка одним SQL-запросом должна совпадать с прежней реализацией
+(три агрегации + сопоставление в Python), и укладываться в 100 мс на больших объёмах.
+"""
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import sessionmaker
+
+from bot.utils.billing_db import Base, BillingRepository, ChargeAttempt, Subscription
+from bot.utils.time_helpers import from_db_naive, to_aware_msk, to_utc_for_db, UTC
+
+
+def _legacy_subscriptions_due(repo, *, now, limit=200):
+    """Прежняя реализация BillingRepository.subscriptions_due (эталон для сравнения)."""
+    now_msk = to_aware_msk(now)
+    now_utc = to_utc_for_db(now_msk)  # Для сравнения с БД (БД хранит в UTC)
+
+    # Политика ретраев авто-списаний:
+    # 1) Не чаще 2-х попыток в сутки (окно 24h).
+    # 2) Минимальный интервал между попытками — 12 часов.
+    # 3) Максимум 6 НЕуспешных попыток В РАМКАХ ОДНОГО ПЛАТЕЖНОГО ЦИКЛА
+    #    (т.е. для той же пары subscription_id + due_at = next_charge_at),
+    #    считаются только status IN ('canceled','expired').
+    window_24h = timedelta(hours=24)
+    min_gap = timedelta(hours=12)
+
+    with repo._session() as s:
+        q = (
+            s.query(Subscription)
+            .filter(
+                Subscription.status == "active",
+                Subscription.next_charge_at != None,                     # noqa: E711
+                Subscription.next_charge_at <= now_utc,  # Сравниваем с UTC (БД хранит в UTC)
+                Subscription.payment_method_id != None,                  # noqa: E711
+            )
+            .order_by(Subscription.next_charge_at.asc())
+            .limit(limit * 3)
+        )
+        # Некоторым диалектам не нравится параметризация LIMIT — подстрахуемся.
+        try:
+            subs = list(q.limit(int(limit * 3)))
+        except Exception:
+            subs = list(q)
+        # Ограничение 2 попытки в сутки
+        since_24h_msk = now_msk - window_24h
+        since_24h_utc = to_utc_for_db(since_24h_msk)
+        blocked_ids_day2 = {
+            sub_id for (sub_id,) in
+            s.query(ChargeAttempt.subscription_id)
+             .filter(ChargeAttempt.attempted_at >= since_24h_utc)
+             .group_by(ChargeAttempt.subscription_id)
+             .having(text("COUNT(*) >= 2"))
+             .all()
+        }
+
+        # Минимальный интервал 12 часов (любая последняя попытка, независимо от статуса)
+        since_12h_msk = now_msk - min_gap
+        since_12h_utc = to_utc_for_db(since_12h_msk)
+        blocked_ids_gap12h = {
+            sub_id for (sub_id,) in
+            s.query(ChargeAttempt.subscription_id)
+             .filter(ChargeAttempt.attempted_at >= since_12h_utc)
+             .group_by(ChargeAttempt.subscription_id)
+             .all()
+        }
+
+        # Лимит 6 НЕуспешных попыток в рамках ТЕКУЩЕГО цикла (due_at == rec.next_charge_at)
+        # Сначала соберём пары (sub_id, due_at) для кандидатов
+        # Округляем due_at до секунд для сравнения
+        candidate_pairs = []
+        for rec in subs:
+            due_at_raw = from_db_naive(rec.next_charge_at)
+            if due_at_raw:
+                due_at_rounded = due_at_raw.replace(microsecond=0)
+                candidate_pairs.append((rec.id, due_at_rounded))
+            else:
+                candidate_pairs.append((rec.id, None))
+
+        # Вычислим counts по всем парам разом: group by (subscription_id, due_at)
+        from sqlalchemy import func
+        failed_counts = {}
+        if candidate_pairs:
+            # Конвертируем due_at в UTC для сравнения с БД и округляем
+            due_at_utc_set = {
+                to_utc_for_db(due_at).replace(microsecond=0) 
+                for (_, due_at) in candidate_pairs 
+                if due_at is not None
+            }
+            if due_at_utc_set:
+                failed_rows = (
+                    s.query(
+                        ChargeAttempt.subscription_id,
+                        ChargeAttempt.due_at,
+                        func.count("*")
+                    )
+                    .filter(
+                        ChargeAttempt.status.in_(('canceled', 'expired')),
+                        ChargeAttempt.subscription_id.in_([sid for (sid, _) in candidate_pairs]),
+                        ChargeAttempt.due_at.in_(due_at_utc_set)
+                    )
+                    .group_by(ChargeAttempt.subscription_id, ChargeAttempt.due_at)
+                    .all()
+                )
+                # Маппинг обратно на МСК для сравнения
+                for sid, due_at_utc, cnt in failed_rows:
+                    due_at_msk = from_db_naive(due_at_utc)
+                    if due_at_msk:
+                        due_at_msk = due_at_msk.replace(microsecond=0)
+                    # Находим соответствующую пару
+                    for pair_sid, pair_due in candidate_pairs:
+                        if pair_sid == sid:
+                            if pair_due and due_at_msk:
+                                # Сравниваем округлённые значения
+                                if pair_due.replace(microsecond=0) == due_at_msk:
+                                    failed_counts[(sid, pair_due)] = cnt
+                                    break
+                            elif pair_due is None and due_at_msk is None:
+                                failed_counts[(sid, None)] = cnt
+                                break
+
+        items = []
+        for rec in subs:
+            # Быстрые проверки на самой подписке — второй щит
+            if rec.consecutive_failures is not None and rec.consecutive_failures >= 6:
+                # skip: max failures reached (>=6)
+                continue
+            # last_attempt_at может быть naive → привести к aware МСК
+            last_attempt_msk = from_db_naive(rec.last_attempt_at)
+            if last_attempt_msk is not None and (now_msk - last_attempt_msk) < min_gap:
+                # skip: 12h gap not passed
+                continue
+            # Лимиты по окнам + лимит 6 фейлов В ТЕКУЩЕМ ЦИКЛЕ
+            # (по паре (subscription_id, due_at = rec.next_charge_at))
+            next_charge_msk = from_db_naive(rec.next_charge_at)
+            if next_charge_msk:
+                next_charge_msk = next_charge_msk.replace(microsecond=0)
+            pair = (rec.id, next_charge_msk)
+            failed6_now = failed_counts.get(pair, 0) >= 6
+            if (rec.id in blocked_ids_day2) or (rec.id in blocked_ids_gap12h) or failed6_now:
+                continue
+            items.append({
+                "id": rec.id,
+                "user_id": rec.user_id,
+                "plan_code": rec.plan_code,
+                "interval_months": rec.interval_months,
+                "amount_value": rec.amount_value,
+                "amount_currency": rec.amount_currency,
+                "payment_method_id": rec.payment_method_id,
+                "consecutive_failures": rec.consecutive_failures,
+                "last_attempt_at": rec.last_attempt_at,
+            })
+            if len(items) >= limit:
+                break
+        return items
+
+
+NOW_UTC = datetime(2025, 3, 1, 12, 0, 0)
+NOW_MSK = to_aware_msk(NOW_UTC)
+
+
+def _random_dataset(rnd, n_subs, attempts_per_sub):
+    """Подписки и попытки в naive UTC (как их хранит MySQL DATETIME)."""
+    subs, attempts = [], []
+    for sid in range(1, n_subs + 1):
+        next_at = None
+        if rnd.random() > 0.05:
+            next_at = NOW_UTC + timedelta(hours=rnd.randint(-120, 48))
+            if rnd.random() < 0.3:
+                next_at = next_at.replace(microsecond=rnd.randint(1, 999_999))
+        last_attempt = None
+        if rnd.random() < 0.6:
+            last_attempt = NOW_UTC - rnd.choice([timedelta(hours=12), timedelta(hours=rnd.uniform(0, 48))])
+        subs.append({
+            "id": sid,
+            "user_id": 1000 + sid,
+            "plan_code": "1m",
+            "interval_months": 1,
+            "amount_value": "2490.00",
+            "amount_currency": "RUB",
+            "payment_method_id": None if rnd.random() < 0.05 else f"pm_{sid}",
+            "status": "active" if rnd.random() < 0.9 else "canceled",
+            "next_charge_at": next_at,
+            "last_attempt_at": last_attempt,
+            "consecutive_failures": rnd.choice([0, 0, 0, 1, 3, 5, 6, 7]),
+            "created_at": NOW_UTC - timedelta(days=60),
+            "updated_at": NOW_UTC - timedelta(days=1),
+        })
+        cycle_due = next_at.replace(microsecond=0) if next_at else None
+        for _ in range(rnd.randint(0, attempts_per_sub * 2)):
+            attempts.append({
+                "subscription_id": sid,
+                "user_id": 1000 + sid,
+                "status": rnd.choice(["created", "succeeded", "canceled", "expired", "expired"]),
+                # чаще — текущий цикл, иногда — прошлый или без якоря
+                "due_at": rnd.choice([cycle_due, cycle_due, cycle_due, cycle_due and cycle_due - timedelta(days=30), None]),
+                "attempted_at": NOW_UTC - rnd.choice([
+                    timedelta(hours=24), timedelta(hours=12), timedelta(hours=rnd.uniform(0, 24 * 7)),
+                ]),
+            })
+    return subs, attempts
+
+
+def _fill(session_factory, subs, attempts, chunk=50_000):
+    with session_factory() as s:
+        for i in range(0, len(subs), chunk):
+            s.execute(insert(Subscription), subs[i:i + chunk])
+        for i in range(0, len(attempts), chunk):
+            s.execute(insert(ChargeAttempt), attempts[i:i + chunk])
+        s.commit()
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_subscriptions_due_matches_legacy(in_memory_db, seed):
+    repo, SessionLocal = in_memory_db
+    subs, attempts = _random_dataset(random.Random(seed), n_subs=600, attempts_per_sub=5)
+    _fill(SessionLocal, subs, attempts)
+
+    # limit с запасом: прежняя реализация обрезала кандидатов до limit*3 ещё до фильтров
+    expected = _legacy_subscriptions_due(repo, now=NOW_MSK, limit=10_000)
+    actual = repo.subscriptions_due(now=NOW_MSK, limit=10_000)
+
+    assert expected, "датасет должен давать непустую выборку"
+    assert [r["id"] for r in actual] == [r["id"] for r in expected]
+    assert actual == expected
+
+
+def test_failed_attempts_limit_is_per_cycle(in_memory_db):
+    repo, SessionLocal = in_memory_db
+    next_at = NOW_UTC - timedelta(days=1, microseconds=-123_456)   # с микросекундами
+    cycle = next_at.replace(microsecond=0)
+    base = {"plan_code": "1m", "interval_months": 1, "amount_value": "2490.00", "amount_currency": "RUB",
+            "status": "active", "next_charge_at": next_at, "consecutive_failures": 0,
+            "created_at": NOW_UTC, "updated_at": NOW_UTC}
+    subs = [{**base, "id": i, "user_id": i, "payment_method_id": f"pm_{i}"} for i in (1, 2, 3)]
+    old = NOW_UTC - timedelta(days=3)
+
+    def failed(sid, n, due):
+        return [{"subscription_id": sid, "user_id": sid, "status": "expired", "due_at": due,
+                 "attempted_at": old - timedelta(hours=k)} for k in range(n)]
+
+    attempts = failed(1, 6, cycle) + failed(2, 5, cycle) + failed(3, 6, cycle - timedelta(days=30))
+    _fill(SessionLocal, subs, attempts)
+
+    ids = [r["id"] for r in repo.subscriptions_due(now=NOW_MSK, limit=10)]
+    # 6 фейлов в текущем цикле — стоп; 5 — можно; 6 в прошлом цикле — не считаются
+    assert ids == [2, 3]
+    assert ids == [r["id"] for r in _legacy_subscriptions_due(repo, now=NOW_MSK, limit=10)]
+
+
+def test_subscriptions_due_limit_counts_eligible_only(in_memory_db):
+    repo, SessionLocal = in_memory_db
+    subs, attempts = _random_dataset(random.Random(7), n_subs=600, attempts_per_sub=3)
+    _fill(SessionLocal, subs, attempts)
+
+    full = repo.subscriptions_due(now=NOW_MSK, limit=10_000)
+    assert repo.subscriptions_due(now=NOW_MSK, limit=5) == full[:5]
+
+
+def _bench_sizes():
+    sizes = [(10_000, 100_000)]
+    # полный прогон (100k подписок / 1M попыток) — по запросу: BILLING_BENCH_FULL=1
+    if os.getenv("BILLING_BENCH_FULL") == "1":
+        sizes += [(10_000, 1_000_000), (100_000, 1_000_000)]
+    return sizes
+
+
+@pytest.mark.parametrize("n_subs,n_attempts", _bench_sizes())
+def test_subscriptions_due_benchmark(n_subs, n_attempts):
+    engine = create_engine("sqlite://", future=True)
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    repo = BillingRepository(session_factory)
+
+    subs, attempts = _random_dataset(random.Random(42), n_subs=n_subs, attempts_per_sub=0)
+    rnd = random.Random(43)
+    attempts = [
+        {
+            "subscription_id": sid,
+            "user_id": 1000 + sid,
+            "status": rnd.choice(["succeeded", "canceled", "expired"]),
+            "due_at": NOW_UTC - timedelta(days=rnd.randint(0, 3) * 30),
+            "attempted_at": NOW_UTC - timedelta(hours=rnd.uniform(0, 24 * 90)),
+        }
+        for sid in (rnd.randint(1, n_subs) for _ in range(n_attempts))
+    ]
+    _fill(session_factory, subs, attempts)
+    with engine.connect() as c:
+        c.execute(text("ANALYZE"))
+
+    repo.subscriptions_due(now=NOW_MSK, limit=100)  # прогрев
+    timings = []
+    for _ in range(5):
+        t0 = time.perf_counter()
+        due = repo.subscriptions_due(now=NOW_MSK, limit=100)
+        timings.append(time.perf_counter() - t0)
+    best = min(timings)
+    print(f"\nsubscriptions_due: subs={n_subs} attempts={n_attempts} -> {len(due)} rows in {best * 1000:.1f} ms")
+    assert len(due) == 100
+    assert best < 0.1
+    engine.dispose()
@@ -0,0 +1,145 @@
+"""
+Кэш file_id (bot/utils/tg_assets.py): файл с диска загружается в Telegram один раз
+на содержимое, дальше отправляется по file_id; отвергнутый file_id — повторная загрузка.
+"""
+from datetime import datetime
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import EditMessageMedia, SendMediaGroup
+from aiogram.types import Chat, FSInputFile, InputFile, InputMediaPhoto, Message, PhotoSize
+
+from bot.utils.redis_repo import TelegramFileIdRepo
+from bot.utils.tg_assets import AssetRegistry, FileIdCacheMiddleware
+
+
+class FakeTelegram(BaseSession):
+    """Bot API: считает загрузки; file_id из revoked отвечает «wrong file identifier»."""
+
+    def __init__(self):
+        super().__init__()
+        self.uploads = []                      # имена загруженных файлов
+        self.by_id = []                        # отправки по file_id
+        self.revoked = set()
+        self._n = 0
+
+    def _accept(self, media, chat_id):
+        if isinstance(media, InputFile):
+            self._n += 1
+            self.uploads.append(media.filename)
+            fid = f"fid-{self._n}"
+        else:
+            if media in self.revoked:
+                raise TelegramBadRequest(method=None, message="Bad Request: wrong file identifier/HTTP URL specified")
+            self.by_id.append(media)
+            fid = media
+        return Message(
+            message_id=self._n, date=datetime.now(), chat=Chat(id=chat_id, type="private"),
+            photo=[PhotoSize(file_id=f"{fid}-thumb", file_unique_id="t", width=90, height=90),
+                   PhotoSize(file_id=fid, file_unique_id="u", width=1280, height=720)],
+        )
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, SendMediaGroup):
+            return [self._accept(m.media, method.chat_id) for m in method.media]
+        if isinstance(method, EditMessageMedia):
+            return self._accept(method.media.media, method.chat_id)
+        return self._accept(method.photo, method.chat_id)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+class MemoryRedis:
+    """HMGET/HSET/HDEL — хранилище TelegramFileIdRepo."""
+
+    def __init__(self):
+        self.h = {}
+
+    async def hmget(self, key, fields):
+        return [self.h.get(key, {}).get(f) for f in fields]
+
+    async def hset(self, key, mapping):
+        self.h.setdefault(key, {}).update(mapping)
+
+    async def hdel(self, key, *fields):
+        for f in fields:
+            self.h.get(key, {}).pop(f, None)
+
+
+def _bot(api, registry):
+    bot = Bot(token="42:TEST", session=api)
+    bot.session.middleware(FileIdCacheMiddleware(registry))
+    return bot
+
+
+@pytest.fixture
+def images(tmp_path):
+    a, same_as_a, b = tmp_path / "menu.png", tmp_path / "copy.png", tmp_path / "plan.png"
+    a.write_bytes(b"\x89PNG menu")
+    same_as_a.write_bytes(b"\x89PNG menu")
+    b.write_bytes(b"\x89PNG plan")
+    return a, same_as_a, b
+
+
+async def test_file_uploaded_once_per_content_and_shared_between_processes(images):
+    menu, copy, plan = images
+    api, redis = FakeTelegram(), MemoryRedis()
+    registry = AssetRegistry(TelegramFileIdRepo(redis, prefix="t"))
+    bot = _bot(api, registry)
+
+    for chat in range(1, 51):
+        await bot.send_photo(chat, FSInputFile(menu), caption="меню")
+    await bot.send_photo(7, FSInputFile(copy))                       # тот же контент, другой путь
+    assert api.uploads == ["menu.png"] and api.by_id == ["fid-1"] * 50
+    assert registry.stats() == {"reused": 50, "uploaded": 1, "rejected": 0, "known": 1}
+
+    # другой процесс того же бота: file_id берётся из Redis
+    other = _bot(api, AssetRegistry(TelegramFileIdRepo(redis, prefix="t")))
+    await other.send_photo(8, FSInputFile(menu))
+    assert api.uploads == ["menu.png"]
+
+    # картинку заменили на диске — новое содержимое загружается заново
+    menu.write_bytes(b"\x89PNG menu v2, new size")
+    await bot.send_photo(9, FSInputFile(menu))
+    await bot.send_photo(9, FSInputFile(plan))
+    assert api.uploads == ["menu.png", "menu.png", "plan.png"]
+    await bot.session.close()
+
+
+async def test_rejected_file_id_falls_back_to_upload(images):
+    menu, _, _ = images
+    api = FakeTelegram()
+    registry = AssetRegistry(TelegramFileIdRepo(MemoryRedis(), prefix="t"))
+    bot = _bot(api, registry)
+
+    await bot.send_photo(1, FSInputFile(menu))
+    api.revoked.add("fid-1")
+    msg = await bot.send_photo(2, FSInputFile(menu))                  # отвергнут → загрузка, без ошибки
+    await bot.send_photo(3, FSInputFile(menu))
+
+    assert msg.photo[-1].file_id == "fid-2"
+    assert api.uploads == ["menu.png", "menu.png"] and api.by_id == ["fid-2"]
+    assert registry.stats()["rejected"] == 1
+    await bot.session.close()
+
+
+async def test_media_group_and_edit_media_reuse_ids(images):
+    menu, _, plan = images
+    api = FakeTelegram()
+    bot = _bot(api, AssetRegistry(TelegramFileIdRepo(MemoryRedis(), prefix="t")))
+
+    await bot.send_photo(1, FSInputFile(menu))
+    await bot.send_media_group(1, [InputMediaPhoto(media=FSInputFile(menu)), InputMediaPhoto(media=FSInputFile(plan))])
+    assert api.uploads == ["menu.png", "plan.png"]                   # в альбоме загружен только новый файл
+
+    await bot.edit_message_media(InputMediaPhoto(media=FSInputFile(plan), caption="план"), chat_id=1, message_id=1)
+    await bot.send_media_group(2, [InputMediaPhoto(media=FSInputFile(plan)), InputMediaPhoto(media=FSInputFile(menu))])
+    assert api.uploads == ["menu.png", "plan.png"]
+    assert api.by_id == ["fid-1", "fid-2", "fid-2", "fid-1"]
+    await bot.session.close()
@@ -0,0 +1,216 @@
+"""
+Общий слой исходящих сообщений (bot/utils/tg_shaper.py) против симулятора Bot API,
+который, как Telegram, отвечает RetryAfter на превышение лимитов бота и чата.
+Лимиты в тестах масштабированы (200/с на бота, 20/с на чат), чтобы прогон был коротким.
+"""
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Chat, Message
+
+from bot.utils.redis_repo import TelegramRateRepo
+from bot.utils.tg_shaper import Priority, TrafficShaper, TrafficShaperMiddleware, send_priority
+
+RATE = 200
+CHAT_INTERVAL = 0.05
+
+
+class FakeTelegram(BaseSession):
+    """
+    Bot API с лимитами: не больше global_limit сообщений за любую секунду
+    (fixed_window — за календарную секунду, как общий счётчик в Redis)
+    и не больше chat_limit в один чат за секунду. Превышение — RetryAfter и нарушение в счётчик.
+    """
+
+    def __init__(self, global_limit, chat_limit, *, fixed_window=False, fail_first=0):
+        super().__init__()
+        self.global_limit, self.chat_limit = global_limit, chat_limit
+        self.fixed_window = fixed_window
+        self.fail_first = fail_first
+        self.log = []                                      # (monotonic, wall, chat_id, text)
+        self.violations = 0
+        self.rejected_at = []
+
+    def connect(self):
+        """Ещё один процесс бота: своя сессия (и middleware), общий Telegram."""
+        return _Connection(self)
+
+    def _reject(self, method):
+        self.rejected_at.append(time.monotonic())
+        raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+
+    async def make_request(self, bot, method, timeout=None):
+        now, wall = time.monotonic(), time.time()
+        if self.fail_first:
+            self.fail_first -= 1
+            self._reject(method)
+        if self.fixed_window:
+            in_window = sum(1 for _, w, _, _ in self.log if int(w) == int(wall))
+        else:
+            in_window = sum(1 for t, _, _, _ in self.log if t > now - 1.0)
+        in_chat = sum(1 for t, _, c, _ in self.log if c == method.chat_id and t > now - 1.0)
+        if in_window >= self.global_limit or in_chat >= self.chat_limit:
+            self.violations += 1
+            self._reject(method)
+        self.log.append((now, wall, method.chat_id, method.text))
+        return Message(message_id=len(self.log), date=datetime.now(),
+                       chat=Chat(id=method.chat_id, type="private"), text=method.text)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+class _Connection(BaseSession):
+    def __init__(self, api):
+        super().__init__()
+        self.api = api
+
+    async def make_request(self, bot, method, timeout=None):
+        return await self.api.make_request(bot, method, timeout)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+class MemoryRedis:
+    """INCRBY/EXPIRE/GET/SET — общий счётчик и пауза TelegramRateRepo."""
+
+    def __init__(self):
+        self.kv = {}
+
+    def pipeline(self):
+        return _Pipe(self)
+
+    async def set(self, key, value, ex=None):
+        self.kv[key] = value
+        return True
+
+
+class _Pipe:
+    def __init__(self, r):
+        self.r, self.ops = r, []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self.ops.append((name, a, kw))
+
+    async def execute(self):
+        return [getattr(self, "_" + name)(*a, **kw) for name, a, kw in self.ops]
+
+    def _incrby(self, k, n):
+        self.r.kv[k] = int(self.r.kv.get(k, 0)) + n
+        return self.r.kv[k]
+
+    def _expire(self, k, ttl):
+        return True
+
+    def _get(self, k):
+        return self.r.kv.get(k)
+
+
+def _bot(api, shaper):
+    bot = Bot(token="42:TEST", session=api)
+    bot.session.middleware(TrafficShaperMiddleware(shaper))
+    return bot
+
+
+def _shaper(repo=None):
+    return TrafficShaper(repo, global_rate=RATE, chat_interval=CHAT_INTERVAL, chat_burst=3)
+
+
+async def test_limits_hold_and_interactive_jumps_the_broadcast_queue():
+    api = FakeTelegram(global_limit=RATE + 2, chat_limit=int(1 / CHAT_INTERVAL) + 3)
+    shaper = _shaper()
+    bot = _bot(api, shaper)
+
+    async def broadcast():
+        with send_priority(Priority.BROADCAST):
+            await asyncio.gather(*(bot.send_message(10_000 + i, "b") for i in range(300)))
+
+    async def interactive():
+        await asyncio.sleep(0.2)
+        started = time.monotonic()
+        # ответы 20 разным пользователям и серия из 10 сообщений в один чат
+        await asyncio.gather(
+            *(bot.send_message(1 + i, "i") for i in range(20)),
+            *(bot.send_message(777, "i") for _ in range(10)),
+        )
+        return time.monotonic() - started
+
+    t0 = time.monotonic()
+    _, interactive_sec = await asyncio.gather(broadcast(), interactive())
+    elapsed = time.monotonic() - t0
+
+    assert api.violations == 0 and len(api.log) == 330
+    assert 330 / RATE - 0.05 <= elapsed < 330 / RATE + 0.5          # темп близок к лимиту, без простоя
+    # ответы не ждут хвоста рассылки (~1.2 с), их ограничивает только темп чата 777
+    assert interactive_sec < 7 * CHAT_INTERVAL + 0.25
+    first_interactive = next(i for i, (_, _, _, text) in enumerate(api.log) if text == "i")
+    assert Counter(text for *_, text in api.log[first_interactive:first_interactive + 25])["i"] >= 20
+    assert shaper.stats()["sent"] == {"interactive": 30, "payment": 0, "lifecycle": 0, "broadcast": 300}
+    await bot.session.close()
+
+
+async def test_retry_after_pauses_everyone_and_retries():
+    api = FakeTelegram(global_limit=RATE + 2, chat_limit=100, fail_first=1)
+    shaper = _shaper()
+    bot = _bot(api, shaper)
+
+    with send_priority(Priority.LIFECYCLE):
+        await asyncio.gather(*(bot.send_message(100 + i, "n") for i in range(5)))
+
+    assert len(api.log) == 5 and api.violations == 0
+    rejected = api.rejected_at[0]
+    assert min(t for t, *_ in api.log) - rejected >= 0.98          # никто не слал во время паузы
+    assert shaper.stats()["retry_after"] == 1
+    await bot.session.close()
+
+
+async def test_group_retry_after_pauses_only_that_chat():
+    api = FakeTelegram(global_limit=RATE + 2, chat_limit=100, fail_first=1)
+    redis = MemoryRedis()
+    shaper = _shaper(TelegramRateRepo(redis, prefix="t"))
+    bot = _bot(api, shaper)
+
+    # группа упёрлась в свой лимит — ответы в личку идут без паузы
+    group = asyncio.create_task(bot.send_message(-100500, "g"))
+    while not api.rejected_at:
+        await asyncio.sleep(0.005)
+    t0 = time.monotonic()
+    await asyncio.gather(*(bot.send_message(200 + i, "hi") for i in range(5)))
+    assert time.monotonic() - t0 < 0.5
+    assert "t:tg:pause_until" not in redis.kv
+
+    await group
+    (sent_at,) = [t for t, _, chat, _ in api.log if chat == -100500]
+    assert sent_at - api.rejected_at[0] >= 0.98                     # чат ждал retry_after
+    assert shaper.stats()["retry_after"] == 1 and shaper.stats()["global_pauses"] == 0
+    await bot.session.close()
+
+
+async def test_processes_share_rate_through_redis():
+    # два процесса бота, у каждого свой шейпер, общий счётчик в Redis
+    api = FakeTelegram(global_limit=RATE, chat_limit=100, fixed_window=True)
+    repo = TelegramRateRepo(MemoryRedis(), prefix="t")
+    bots = [_bot(api.connect(), _shaper(repo)), _bot(api.connect(), _shaper(repo))]
+
+    with send_priority(Priority.BROADCAST):
+        await asyncio.gather(*(
+            b.send_message(n * 1000 + i, "b") for n, b in enumerate(bots) for i in range(250)
+        ))
+
+    per_second = Counter(int(wall) for _, wall, _, _ in api.log)
+    assert len(api.log) == 500 and api.violations == 0
+    assert max(per_second.values()) <= RATE
+    for b in bots:
+        await b.session.close()
@@ -0,0 +1,120 @@
+"""
+Regression tests for User relationship loading (no implicit eager load of child collections).
+"""
+import time
+
+import pytest
+from sqlalchemy import event, insert
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import selectinload
+
+from bot.utils.database import User, EventLog, UserConsent
+from bot.utils.time_helpers import now_msk, to_utc_for_db
+
+
+HEAVY_USER_ID = 100500
+HEAVY_EVENTS = 50_000
+
+
+def _seed_events(SessionLocal, user_id: int, n: int) -> None:
+    ts = to_utc_for_db(now_msk())
+    with SessionLocal() as s, s.begin():
+        s.add(User(user_id=user_id))
+        s.flush()
+        s.execute(
+            insert(EventLog),
+            [{"user_id": user_id, "message": f"CB:{i}", "created_at": ts} for i in range(n)],
+        )
+
+
+def _count_selects(engine, fn) -> int:
+    statements = []
+
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _before)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", _before)
+    return len(statements)
+
+
+def _median_time(fn, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def test_user_get_does_not_load_child_collections(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    _seed_events(SessionLocal, HEAVY_USER_ID, 100)
+    engine = SessionLocal.kw["bind"]
+
+    def _get():
+        with SessionLocal() as s:
+            assert s.get(User, HEAVY_USER_ID) is not None
+
+    # один SELECT по users, без selectin-догрузки шести коллекций
+    assert _count_selects(engine, _get) == 1
+
+    with SessionLocal() as s:
+        u = s.get(User, HEAVY_USER_ID)
+        with pytest.raises(InvalidRequestError):
+            _ = u.events
+
+
+def test_children_available_via_explicit_loader_options(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    repo.add_consent(7, kind="tos")
+    with SessionLocal() as s:
+        u = s.get(User, 7, options=[selectinload(User.consents)])
+        assert [c.kind for c in u.consents] == ["tos"]
+
+
+def test_existence_checks_are_pk_only(in_memory_app_db):
+    repo, SessionLocal = in_memory_app_db
+    _seed_events(SessionLocal, HEAVY_USER_ID, 10)
+    engine = SessionLocal.kw["bind"]
+
+    selects = []
+
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM users" in statement:
+            selects.append(" ".join(statement.split()))
+
+    event.listen(engine, "before_cursor_execute", _before)
+    try:
+        repo.set_trial(HEAVY_USER_ID, hours=1)
+        repo.add_consent(HEAVY_USER_ID, kind="tos")
+    finally:
+        event.remove(engine, "before_cursor_execute", _before)
+
+    assert selects
+    assert all(sql.startswith("SELECT users.user_id FROM users") for sql in selects)
+
+
+def test_event_add_constant_time_for_heavy_user(in_memory_app_db):
+    """
+    Бенчмарк: пользователь с 50k событий. event_add/set_trial/add_consent не должны
+    зависеть от объёма event_log (раньше s.get(User) тянул все 50k строк через selectin).
+    """
+    repo, SessionLocal = in_memory_app_db
+    _seed_events(SessionLocal, HEAVY_USER_ID, HEAVY_EVENTS)
+    repo.ensure_user(1)
+
+    light = _median_time(lambda: repo.event_add(1, "CB:x"))
+    heavy = _median_time(lambda: repo.event_add(HEAVY_USER_ID, "CB:x"))
+    heavy_trial = _median_time(lambda: repo.set_trial(HEAVY_USER_ID, hours=1), repeat=5)
+    heavy_ensure = _median_time(lambda: repo.ensure_user(HEAVY_USER_ID, username="u"), repeat=5)
+
+    # константное время: «тяжёлый» пользователь не медленнее лёгкого больше чем в разы
+    assert heavy < max(light * 5, 0.01), f"light={light * 1000:.2f}ms heavy={heavy * 1000:.2f}ms"
+    assert heavy_trial < 0.05
+    assert heavy_ensure < 0.05
@@ -0,0 +1,190 @@
+"""
+Входящая очередь вебхуков YooKassa (webhook_inbox + bot/utils/webhook_queue.py):
+быстрый ACK хендлера /payment, порядок событий внутри платежа, ретраи и dead letters.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+import aiohttp
+from aiohttp import web
+
+import bot.utils.webhook_queue as wq
+from bot.utils.billing_db import WebhookEvent
+from bot.utils.webhook_queue import WebhookQueue
+
+
+def _event(payment_id, status, event=None):
+    return {
+        "type": "notification",
+        "event": event or f"payment.{status}",
+        "object": {
+            "id": payment_id,
+            "status": status,
+            "amount": {"value": "2490.00", "currency": "RUB"},
+            "metadata": {"user_id": "1", "plan_code": "1m"},
+        },
+    }
+
+
+def test_claim_keeps_order_within_payment(shared_db):
+    repo, _ = shared_db
+    first = repo.webhook_enqueue(payload=_event("p1", "waiting_for_capture"))
+    second = repo.webhook_enqueue(payload=_event("p1", "succeeded"))
+    other = repo.webhook_enqueue(payload=_event("p2", "succeeded"))
+    # повтор доставки не создаёт вторую строку
+    assert repo.webhook_enqueue(payload=_event("p1", "succeeded")) is None
+
+    batch = repo.webhook_claim(worker_id="w1", limit=10)
+    assert [x["id"] for x in batch] == [first, other]
+    assert batch[0]["payload"]["object"]["status"] == "waiting_for_capture"
+    # пока первое событие p1 в работе, второе не выдаётся никому
+    assert repo.webhook_claim(worker_id="w2", limit=10) == []
+
+    assert repo.webhook_done(event_id=first, worker_id="w1")
+    assert [x["id"] for x in repo.webhook_claim(worker_id="w2", limit=10)] == [second]
+
+
+def test_retry_backoff_dead_letter_and_requeue(shared_db):
+    repo, SessionLocal = shared_db
+    event_id = repo.webhook_enqueue(payload=_event("p1", "succeeded"))
+    later = repo.webhook_enqueue(payload=_event("p1", "canceled"))
+
+    (item,) = repo.webhook_claim(worker_id="w1")
+    assert item["attempts"] == 1
+    assert repo.webhook_failed(event_id=event_id, worker_id="w1", error="500: boom", retry_in_sec=60)
+    # ждёт ретрая — и держит следующее событие платежа
+    assert repo.webhook_claim(worker_id="w1", limit=10) == []
+
+    with SessionLocal() as s, s.begin():
+        rec = s.get(WebhookEvent, event_id)
+        rec.next_attempt_at = rec.created_at
+    (item,) = repo.webhook_claim(worker_id="w1")
+    assert item["attempts"] == 2
+    assert repo.webhook_failed(event_id=event_id, worker_id="w1", error="400: bad", retry_in_sec=None)
+
+    (dead,) = repo.webhook_dead_letters()
+    assert dead["id"] == event_id and dead["last_error"] == "400: bad"
+    assert repo.webhook_stats() == {"dead": 1, "pending": 1}
+    # dead-событие не блокирует платёж
+    assert [x["id"] for x in repo.webhook_claim(worker_id="w1")] == [later]
+
+    assert repo.webhook_requeue(event_id=event_id)
+    assert not repo.webhook_requeue(event_id=event_id)
+    assert repo.webhook_dead_letters() == []
+
+
+def test_lease_expiry_returns_event(shared_db):
+    repo, _ = shared_db
+    event_id = repo.webhook_enqueue(payload=_event("p1", "succeeded"))
+    assert repo.webhook_claim(worker_id="w1", lease_sec=-1)          # воркер «упал»
+    (item,) = repo.webhook_claim(worker_id="w2")
+    assert item["id"] == event_id and item["attempts"] == 2
+    # результат от старого владельца аренды не записывается
+    assert not repo.webhook_done(event_id=event_id, worker_id="w1")
+    assert repo.webhook_done(event_id=event_id, worker_id="w2")
+
+    # остановка воркера: не начатые события сразу возвращаются в очередь
+    ids = [repo.webhook_enqueue(payload=_event(f"p{i}", "succeeded")) for i in (2, 3)]
+    assert [x["id"] for x in repo.webhook_claim(worker_id="w1", limit=10)] == ids
+    assert repo.webhook_release(event_ids=ids, worker_id="w1") == 2
+    assert [x["attempts"] for x in repo.webhook_claim(worker_id="w2", limit=10)] == [1, 1]
+
+
+async def test_replay_1000_webhooks(shared_db, monkeypatch, capsys):
+    """
+    1000 событий (500 платежей × waiting_for_capture → succeeded) через реальный
+    хендлер /payment: ACK не ждёт обработки, порядок внутри платежа, ретраи и dead letter.
+    p50/p99 ACK печатаются как замер: абсолютные миллисекунды зависят от машины.
+    """
+    from bot.run import yookassa_webhook_handler
+
+    repo, _ = shared_db
+    monkeypatch.setattr(wq, "RETRY_BASE_SEC", 0.05)
+    flaky = {f"pay_{i}" for i in range(0, 500, 25)}      # первая обработка падает с 500
+    broken = "pay_7"                                     # succeeded некорректен → dead
+    seen = defaultdict(list)
+    all_acked = asyncio.Event()
+
+    async def handler(payload):
+        # обработка стоит, пока не получены все ACK: если бы ответ /payment ждал
+        # обработку, доставка не завершилась бы (wait_for ниже)
+        await all_acked.wait()
+        obj = payload["object"]
+        pid, status = obj["id"], obj["status"]
+        seen[pid].append(status)
+        await asyncio.sleep(0.005)                       # Redis + БД + Telegram
+        if pid in flaky and seen[pid].count(status) == 1:
+            return 500, "error: transient"
+        if pid == broken and status == "succeeded":
+            return 400, "missing user_id in metadata"
+        return 200, "ok"
+
+    queue = WebhookQueue(workers=4, poll_sec=0.2, max_attempts=3)
+    app = web.Application()
+    app.router.add_post("/payment", yookassa_webhook_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/payment"
+
+    latencies = []
+    statuses = []
+    sem = asyncio.Semaphore(50)
+
+    async def deliver(session, payment_id):
+        # события одного платежа YooKassa шлёт по очереди, разные платежи — параллельно
+        async with sem:
+            for status in ("waiting_for_capture", "succeeded"):
+                t0 = time.perf_counter()
+                async with session.post(url, data=json.dumps(_event(payment_id, status))) as resp:
+                    statuses.append(resp.status)
+                latencies.append(time.perf_counter() - t0)
+
+    try:
+        with patch("bot.run.webhook_queue", queue):
+            queue.start(handler)
+            async with aiohttp.ClientSession() as session:
+                ids = [f"pay_{i}" for i in range(500)]
+                random.Random(1).shuffle(ids)
+                await asyncio.wait_for(asyncio.gather(*(deliver(session, pid) for pid in ids)), timeout=60)
+                # повторная доставка (YooKassa не дождалась ответа) и мусор
+                async with session.post(url, data=json.dumps(_event("pay_1", "succeeded"))) as resp:
+                    assert resp.status == 200
+                async with session.post(url, data="not json") as resp:
+                    assert resp.status == 400
+            assert not seen                                  # все ACK — до начала обработки
+            all_acked.set()
+
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline:
+                stats = repo.webhook_stats()
+                if not stats.get("pending") and not stats.get("processing"):
+                    break
+                await asyncio.sleep(0.1)
+    finally:
+        await queue.stop()
+        await runner.cleanup()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    with capsys.disabled():
+        print(f"\nwebhook ack latency over {len(latencies)} events: p50 {p50:.1f} ms, p99 {p99:.1f} ms; "
+              f"queue stats {queue.stats()}")
+
+    assert len(latencies) == 1000 and set(statuses) == {200}
+    assert repo.webhook_stats() == {"done": 999, "dead": 1}
+    (dead,) = repo.webhook_dead_letters()
+    assert dead["payment_id"] == broken and dead["status"] == "succeeded"
+    for pid, order in seen.items():
+        # порядок событий платежа сохранён, ретрай — сразу за своей неудачей
+        expected = ["waiting_for_capture", "succeeded"]
+        if pid in flaky:
+            expected = ["waiting_for_capture", "waiting_for_capture", "succeeded", "succeeded"]
+        assert order == expected, pid
+    assert queue.counters["retried"] == 2 * len(flaky)
@@ -0,0 +1,195 @@
+"""
+Асинхронный клиент YooKassa (bot/utils/yookassa_client.py) и параллельный billing_loop
+против локальной заглушки YooKassa: keep-alive, Idempotence-Key, ретраи, charges/sec.
+"""
+import asyncio
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web
+
+from bot.utils import youmoney
+from bot.utils.billing_db import ChargeAttempt
+from bot.utils.time_helpers import now_msk
+from bot.utils.yookassa_client import YooKassaClient, YooKassaError
+
+
+class StubYooKassa:
+    """Локальная YooKassa: POST /v3/payments с задержкой, идемпотентностью и сценарием статусов."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.script = []          # очередь статусов перед успешным ответом
+        self.keys = []            # Idempotence-Key всех запросов
+        self.payments = {}        # ключ → id платежа (повтор с тем же ключом — тот же платёж)
+        self.connections = set()
+        self.auth = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._runner = None
+        self.base_url = ""
+
+    async def _payments(self, request: web.Request) -> web.Response:
+        self.connections.add(request.transport.get_extra_info("peername"))
+        self.auth.add(request.headers.get("Authorization"))
+        key = request.headers["Idempotence-Key"]
+        self.keys.append(key)
+        body = await request.json()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        status = self.script.pop(0) if self.script else 200
+        if status == 202:
+            return web.json_response({"type": "processing", "retry_after": 10}, status=202)
+        if status != 200:
+            return web.json_response(
+                {"type": "error", "code": "invalid_request" if status == 400 else "internal_server_error",
+                 "description": "stub"},
+                status=status, headers={"Retry-After": "0"},
+            )
+        pay_id = self.payments.setdefault(key, f"pay_{len(self.payments) + 1}")
+        return web.json_response({"id": pay_id, "status": "pending", "amount": body["amount"], "paid": False})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self._payments)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/v3"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+@pytest.fixture
+async def yk():
+    stub = StubYooKassa()
+    await stub.start()
+    client = YooKassaClient("shop", "secret", base_url=stub.base_url, limit=10)
+    try:
+        with patch.object(youmoney, "yookassa_client", client):
+            yield stub, client
+    finally:
+        await client.close()
+        await stub.stop()
+
+
+async def _charge(attempt_id, **kw):
+    return await youmoney.charge_saved_method_async(
+        user_id=1, payment_method_id="pm_token_1234567", amount_rub="2490.00",
+        description="Подписка 1m", subscription_id=7, attempt_id=attempt_id, **kw,
+    )
+
+
+async def test_pool_reuses_connections_and_sends_idempotence_key(yk):
+    stub, client = yk
+    stub.delay = 0.01
+    ids = await asyncio.gather(*(_charge(i) for i in range(40)))
+    assert len(set(ids)) == 40
+    assert sorted(stub.keys) == sorted(f"sa-recurring-{i}" for i in range(40))
+    # 40 запросов через пул из 10 keep-alive соединений
+    assert len(stub.connections) <= 10
+    assert stub.max_in_flight <= 10
+    assert stub.auth == {"Basic c2hvcDpzZWNyZXQ="}   # shop:secret
+
+
+async def test_retry_keeps_idempotence_key(yk, monkeypatch):
+    stub, client = yk
+    monkeypatch.setattr("bot.utils.yookassa_client._RETRY_BACKOFF_SEC", 0.0)
+    stub.script = [500, 202]
+    pay_id = await _charge(42)
+    assert stub.keys == ["sa-recurring-42"] * 3
+    assert client.stats()["retries"] == 2
+
+    # повтор той же попытки (например, после таймаута) — тот же платёж, не второй
+    assert await _charge(42) == pay_id
+
+
+async def test_bad_request_is_validation_error(yk):
+    stub, client = yk
+    stub.script = [400]
+    with pytest.raises(ValueError, match="Payment validation error"):
+        await _charge(1)
+    assert len(stub.keys) == 1        # 4xx не повторяется
+
+    stub.script = [503] * 10
+    client.retries = 1
+    with pytest.raises(YooKassaError):
+        await _charge(2)
+
+
+async def test_billing_batch_is_concurrent(in_memory_db, yk, capsys):
+    """charges/sec: последовательная обработка против BILLING_CONCURRENCY=10 (50 мс на запрос)."""
+    from bot.run import process_claimed_batch
+
+    repo, SessionLocal = in_memory_db
+    stub, client = yk
+    stub.delay = 0.05
+    now = now_msk()
+    for uid in range(1, 61):
+        repo.subscription_upsert(
+            user_id=uid, plan_code="1m", interval_months=1, amount_value="2490.00",
+            amount_currency="RUB", payment_method_id=f"pm_token_{uid:08d}",
+            next_charge_at=now - timedelta(days=1), status="active",
+        )
+
+    event = asyncio.Event()
+    rates = {}
+    with patch('bot.run.billing_db._repo', repo):
+        for concurrency in (1, 10):
+            claimed = repo.claim_due_subscriptions(now=now, worker_id="w1", limit=30)
+            assert len(claimed) == 30
+            t0 = time.perf_counter()
+            created = await process_claimed_batch(claimed, event, concurrency=concurrency)
+            rates[concurrency] = created / (time.perf_counter() - t0)
+            assert created == 30
+
+    with capsys.disabled():
+        print(f"\nbilling batch: serial {rates[1]:.1f} charges/s, concurrency=10 {rates[10]:.1f} charges/s")
+    assert rates[10] > rates[1] * 4
+    assert stub.max_in_flight == 10
+
+    # у каждой попытки свой платёж, ключ идемпотентности = id попытки
+    with SessionLocal() as s:
+        attempts = s.query(ChargeAttempt).all()
+    assert len(attempts) == 60
+    assert all(a.status == "created" and a.payment_id for a in attempts)
+    assert sorted(stub.keys) == sorted(f"sa-recurring-{a.id}" for a in attempts)
+
+    # повторный проход: всё уже списывается — забирать нечего
+    assert repo.claim_due_subscriptions(now=now, worker_id="w1") == []
+
+
+async def test_billing_batch_releases_claims_on_shutdown(in_memory_db, yk):
+    from bot.run import process_claimed_batch
+
+    repo, SessionLocal = in_memory_db
+    stub, client = yk
+    now = now_msk()
+    for uid in range(1, 6):
+        repo.subscription_upsert(
+            user_id=uid, plan_code="1m", interval_months=1, amount_value="2490.00",
+            amount_currency="RUB", payment_method_id=f"pm_token_{uid:08d}",
+            next_charge_at=now - timedelta(days=1), status="active",
+        )
+    claimed = repo.claim_due_subscriptions(now=now, worker_id="w1")
+    assert len(claimed) == 5
+
+    event = asyncio.Event()
+    event.set()
+    with patch('bot.run.billing_db._repo', repo):
+        assert await process_claimed_batch(claimed, event) == 0
+    assert stub.keys == []
+    # не начатые списания возвращены: попыток нет, подписки снова можно забрать
+    with SessionLocal() as s:
+        assert s.query(ChargeAttempt).count() == 0
+    assert len(repo.claim_due_subscriptions(now=now, worker_id="w2")) == 5